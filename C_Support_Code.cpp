@@ -383,6 +383,7 @@ public:
 	TwoDArray():
 	size1_(0),
 	size2_(0),
+	capacity_(0),
 	data_(0)
 	{
 
@@ -391,6 +392,7 @@ public:
 	TwoDArray(size_t size1, size_t size2):
 	size1_(size1),
 	size2_(size2),
+	capacity_(size1*size2),
 	data_(new T[size1*size2]())
 	{
 
@@ -401,18 +403,28 @@ public:
 		delete[] data_;
 	}
 
+	//zero-initializes, keeps the memory if it is big enough (e.g. when reused for all seqs of a batch)
 	void resize(size_t size1, size_t size2)
 	{
 		size1_ = size1;
 		size2_ = size2;
-		delete[] data_;
-		data_ = new T[size1*size2]();
+		if(size1*size2 > capacity_)
+		{
+			delete[] data_;
+			capacity_ = size1*size2;
+			data_ = new T[capacity_]();
+		}
+		else
+		{
+			std::fill(data_, data_ + size1*size2, T());
+		}
 	}
 
 	void swap(TwoDArray<T>& other)
 	{
 		std::swap(size1_, other.size1_);
 		std::swap(size2_, other.size2_);
+		std::swap(capacity_, other.capacity_);
 		std::swap(data_, other.data_);
 	}
 
@@ -462,6 +474,7 @@ public:
 private:
 	size_t size1_;
 	size_t size2_;
+	size_t capacity_;
 	T * data_;
 };
 
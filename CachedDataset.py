@@ -1,7 +1,6 @@
 
 import gc
 import numpy
-import theano
 from Dataset import Dataset
 from Log import log
 from Util import NumbersDict
@@ -45,17 +44,20 @@ class CachedDataset(Dataset):
                      ("(fully loaded, %s GB left over)" if self.definite_cache_leftover else "(%s GB free)") % \
                      max(temp_cache_size_bytes / float(1024 * 1024 * 1024), 0)
 
-  def init_seq_order(self, epoch=None, seq_list=None):
+  def init_seq_order(self, epoch=None, seq_list=None, seq_order=None):
     """
     :type epoch: int|None
     :param list[str] | None seq_list: In case we want to set a predefined order.
+    :param list[int]|numpy.ndarray|None seq_order: like seq_list, but the real seq idxs (see get_all_tags())
     Initialize lists:
       self.seq_index  # sorted seq idx
     """
     old_index_map = self._index_map[:]
     self._index_map = range(self.num_seqs)
     super(CachedDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
-    if seq_list:
+    if seq_order is not None:
+      seq_index = [int(idx) for idx in seq_order]
+    elif seq_list:
       seq_index = [self.tag_idx[tag] for tag in seq_list]
     else:
       seq_index = self.get_seq_order_for_epoch(epoch, self.num_seqs, lambda s: self._seq_lengths[s][0])
@@ -16,11 +16,10 @@ from random import Random, random
 import sys
 import os
 import numpy
-import theano
 
 from Log import log
 from EngineBatch import Batch, BatchSetGenerator
-from Util import try_run, NumbersDict, unicode
+from Util import try_run, NumbersDict, unicode, get_floatX
 
 
 class Dataset(object):
@@ -264,10 +263,10 @@ class Dataset(object):
     if int(self.window) % 2 == 0:
       self.window += 1
 
-    self.nbytes = numpy.array([], dtype=theano.config.floatX).itemsize * (self.num_inputs * self.window + 1 + 1)
+    self.nbytes = numpy.array([], dtype=get_floatX()).itemsize * (self.num_inputs * self.window + 1 + 1)
 
     if self.window > 1:
-      self.zpad = numpy.zeros((int(self.window) / 2, self.num_inputs), dtype=theano.config.floatX)
+      self.zpad = numpy.zeros((int(self.window) / 2, self.num_inputs), dtype=get_floatX())
 
     self.init_seq_order()
 
@@ -413,6 +412,23 @@ class Dataset(object):
       return False
     return True
 
+  def is_random_access(self):
+    """
+    :rtype: bool
+    :returns whether load_seqs() can start at any seq idx, and the data of a seq does not depend on
+      which seqs were loaded before. Otherwise, the seqs can only be loaded in ascending order from the start,
+      e.g. when they are streamed from an external process or generated with a running random state.
+    """
+    return False
+
+  def get_all_tags(self):
+    """
+    :return: the tags of all seqs by real seq idx (i.e. independent of the seq order), if known in advance.
+      If this is not None, init_seq_order() also accepts seq_order, the real seq idxs in the wanted order.
+    :rtype: list[str]|None
+    """
+    return None
+
   def get_data_shape(self, key):
     """
     :returns get_data(*, key).shape[1:], i.e. num-frames excluded
@@ -445,15 +461,64 @@ class Dataset(object):
     # in advance can handle this somehow.
     return n < self.num_seqs
 
-  def calculate_priori(self, target="classes"):
-    priori = numpy.zeros((self.num_outputs[target][0],), dtype=theano.config.floatX)
-    i = 0
-    while self.is_less_than_num_seqs(i):
-      self.load_seqs(i, i + 1)
-      for t in self.get_targets(target, i):
-        priori[t] += 1
-      i += 1
-    return numpy.array(priori / self.get_num_timesteps(), dtype=theano.config.floatX)
+  def calculate_priori(self, target="classes", load_seqs_step=100, num_workers=0):
+    """
+    Counts the labels of the target over the whole dataset.
+
+    :param str target:
+    :param int load_seqs_step: number of seqs which are loaded and counted at once
+    :param int num_workers: if > 1, count in that many processes, each on a range of seqs.
+      The processes are forked, i.e. they work on their own copy of the dataset.
+      Requires num_seqs and :func:`is_random_access`, otherwise we count in this process.
+    :return: relative frequency of each label
+    :rtype: numpy.ndarray
+    """
+    num_seqs = None
+    if num_workers > 1 and not self.is_random_access():
+      print("calculate_priori: %s does not support random access, cannot use multiple workers" % self,
+            file=log.v3)
+    elif num_workers > 1:
+      try:
+        num_seqs = self.num_seqs
+      except Exception:  # num_seqs not known in advance
+        print("calculate_priori: num_seqs unknown, cannot use multiple workers", file=log.v3)
+    if num_seqs:
+      import multiprocessing
+      num_ranges = min(num_seqs, num_workers * 4)
+      bounds = [num_seqs * i // num_ranges for i in range(num_ranges + 1)]
+      pool = multiprocessing.Pool(
+        processes=num_workers, initializer=_init_priori_worker, initargs=(self, target, load_seqs_step))
+      try:
+        # imap with chunksize 1 keeps the ranges ascending per worker, as needed for loading.
+        counts = sum(pool.imap(_count_targets_in_worker, zip(bounds[:-1], bounds[1:]), chunksize=1))
+      finally:
+        pool.terminate()
+    else:
+      counts = self._count_targets(target, start=0, end=None, load_seqs_step=load_seqs_step)
+    return numpy.array(counts / max(numpy.sum(counts), 1.0), dtype=get_floatX())
+
+  def _count_targets(self, target, start, end, load_seqs_step):
+    """
+    :param str target:
+    :param int start: seq idx
+    :param int|None end: seq idx, exclusive. None means until the end
+    :param int load_seqs_step: number of seqs which are loaded and counted at once
+    :return: count of each label
+    :rtype: numpy.ndarray
+    """
+    num_classes = self.num_outputs[target][0]
+    counts = numpy.zeros((num_classes,), dtype="float64")
+    seq_idx = start
+    while (end is None or seq_idx < end) and self.is_less_than_num_seqs(seq_idx):
+      step_end = seq_idx + 1
+      while (step_end < seq_idx + load_seqs_step and (end is None or step_end < end)
+             and self.is_less_than_num_seqs(step_end)):
+        step_end += 1
+      self.load_seqs(seq_idx, step_end)
+      targets = numpy.concatenate([self.get_targets(target, i) for i in range(seq_idx, step_end)]).astype("int64")
+      counts += numpy.bincount(targets, minlength=num_classes)
+      seq_idx = step_end
+    return counts
 
   def _iterate_seqs(self, chunk_size, chunk_step, used_data_keys):
     """
@@ -676,6 +741,27 @@ class DatasetSeq:
     return "<DataCache seq_idx=%i>" % self.seq_idx
 
 
+_priori_worker_dataset = None; " :type: (Dataset, str, int) "
+
+
+def _init_priori_worker(dataset, target, load_seqs_step):
+  """
+  Initializer of the worker processes of :func:`Dataset.calculate_priori`.
+  """
+  global _priori_worker_dataset
+  _priori_worker_dataset = (dataset, target, load_seqs_step)
+
+
+def _count_targets_in_worker(seq_range):
+  """
+  :param (int,int) seq_range: start, end
+  :rtype: numpy.ndarray
+  """
+  dataset, target, load_seqs_step = _priori_worker_dataset
+  start, end = seq_range
+  return dataset._count_targets(target, start=start, end=end, load_seqs_step=load_seqs_step)
+
+
 def get_dataset_class(name):
   from importlib import import_module
   # Only those modules which make sense to be loaded by the user,
@@ -1,8 +1,6 @@
 from TaskSystem import AsyncTask, ProcConnectionDied
-from Updater import Updater
 from Util import cmd, progress_bar, dict_diff_str, hms, start_daemon_thread, interrupt_main, CalledProcessError, NumbersDict, custom_exec, dict_joined, attr_chain
 from Log import log
-from Network import LayerNetwork
 from collections import OrderedDict
 import numpy
 import sys
@@ -402,6 +400,8 @@ class Device(object):
     import theano
     import theano.tensor as T
     import h5py
+    from Network import LayerNetwork
+    from Updater import Updater
     self.T = T
     self.seq_train_parallel_control = None  # type: SeqTrainParallelControlDevHost. will be set via SprintErrorSignals
     self.network_task = config.value('task', 'train')
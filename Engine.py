@@ -3,7 +3,6 @@ from __future__ import print_function
 
 import numpy
 import sys
-import os
 from collections import OrderedDict
 import h5py
 import json
@@ -12,11 +11,13 @@ from EngineTask import TrainTaskThread, EvalTaskThread, HDFForwardTaskThread, Cl
 import SprintCache
 from Log import log
 from Updater import Updater
+from StepProfiler import StepProfiler
 import Device
 from LearningRateControl import loadLearningRateControlFromConfig
 from Pretrain import pretrainFromConfig
 import EngineUtil
-from Util import hms, hdf5_dimension, BackendEngine, model_epoch_from_filename
+from EngineBase import EngineBase
+from Util import hms, hdf5_dimension, BackgroundCheckpointSaver
 import errno
 import time
 try:
@@ -29,12 +30,8 @@ except ImportError:  # Python3
   BaseHTTPServer = SimpleHTTPServer
 import json
 import cgi
-from GeneratingDataset import StaticDataset
-import hashlib
 
-class Engine:
-
-  _epoch_model = None; """ :type: (int|None,str|None) """  # See get_epoch_model().
+class Engine(EngineBase):
 
   def __init__(self, devices):
     """
@@ -49,136 +46,8 @@ class Engine:
     self.dataset_batches = {}
     self.pretrain = None; " :type: Pretrain.Pretrain "
     self.init_train_epoch_posthook = None
-
-  @classmethod
-  def config_get_final_epoch(cls, config):
-    """ :type config: Config.Config """
-    return config.int('num_epochs', 5)
-
-  @classmethod
-  def get_existing_models(cls, config):
-    model_filename = config.value('model', '')
-    if not model_filename:
-      return []
-    # Automatically search the filesystem for existing models.
-    file_list = []
-    for epoch in range(1, cls.config_get_final_epoch(config) + 1):
-      for is_pretrain in [False, True]:
-        fn = cls.epoch_model_filename(model_filename, epoch, is_pretrain)
-        if os.path.exists(fn):
-          file_list += [(epoch, fn)]  # epoch, fn
-          break
-        if BackendEngine.is_tensorflow_selected():
-          if os.path.exists(fn + ".index"):
-            file_list += [(epoch, fn)]  # epoch, fn
-            break
-    file_list.sort()
-    return file_list
-
-  @classmethod
-  def get_epoch_model(cls, config):
-    """
-    :type config: Config.Config
-    :returns (epoch, modelFilename)
-    :rtype: (int|None, str|None)
-    """
-    # XXX: We cache it, although this is wrong if we have changed the config.
-    if cls._epoch_model:
-      return cls._epoch_model
-
-    start_epoch_mode = config.value('start_epoch', 'auto')
-    if start_epoch_mode == 'auto':
-      start_epoch = None
-    else:
-      start_epoch = int(start_epoch_mode)
-      assert start_epoch >= 1
-
-    load_model_epoch_filename = config.value('load', '')
-    if load_model_epoch_filename:
-      fn_postfix = ""
-      if BackendEngine.is_tensorflow_selected():
-        fn_postfix = ".meta"
-      assert os.path.exists(load_model_epoch_filename + fn_postfix)
-
-    import_model_train_epoch1 = config.value('import_model_train_epoch1', '')
-    if import_model_train_epoch1:
-      assert os.path.exists(import_model_train_epoch1)
-
-    existing_models = cls.get_existing_models(config)
-
-    # Only use this when we don't train.
-    # For training, we first consider existing models before we take the 'load' into account when in auto epoch mode.
-    # In all other cases, we use the model specified by 'load'.
-    if load_model_epoch_filename and (config.value('task', 'train') != 'train' or start_epoch is not None):
-      epoch = model_epoch_from_filename(load_model_epoch_filename)
-      if config.value('task', 'train') == 'train' and start_epoch is not None:
-        # Ignore the epoch. To keep it consistent with the case below.
-        epoch = None
-      epoch_model = (epoch, load_model_epoch_filename)
-
-    # In case of training, always first consider existing models.
-    # This is because we reran CRNN training, we usually don't want to train from scratch
-    # but resume where we stopped last time.
-    elif existing_models:
-      epoch_model = existing_models[-1]
-      if load_model_epoch_filename:
-        print("note: there is a 'load' which we ignore because of existing model", file=log.v4)
-
-    elif config.value('task', 'train') == 'train' and import_model_train_epoch1 and start_epoch in [None, 1]:
-      epoch_model = (0, import_model_train_epoch1)
-
-    # Now, consider this also in the case when we train, as an initial model import.
-    elif load_model_epoch_filename:
-      # Don't use the model epoch as the start epoch in training.
-      # We use this as an import for training.
-      epoch_model = (model_epoch_from_filename(load_model_epoch_filename), load_model_epoch_filename)
-
-    else:
-      epoch_model = (None, None)
-
-    if start_epoch == 1:
-      if epoch_model[0]:  # existing model
-        print("warning: there is an existing model: %s" % (epoch_model,), file=log.v4)
-        epoch_model = (None, None)
-    elif (start_epoch or 0) > 1:
-      if epoch_model[0]:
-        if epoch_model[0] != start_epoch - 1:
-          print("warning: start_epoch %i but there is %s" % (start_epoch, epoch_model), file=log.v4)
-        epoch_model = existing_models[start_epoch-1]
-
-    cls._epoch_model = epoch_model
-    return epoch_model
-
-  @classmethod
-  def get_train_start_epoch_batch(cls, config):
-    """
-    We will always automatically determine the best start (epoch,batch) tuple
-    based on existing model files.
-    This ensures that the files are present and enforces that there are
-    no old outdated files which should be ignored.
-    Note that epochs start at idx 1 and batches at idx 0.
-    :type config: Config.Config
-    :returns (epoch,batch)
-    :rtype (int,int)
-    """
-    start_batch_mode = config.value('start_batch', 'auto')
-    if start_batch_mode == 'auto':
-      start_batch_config = None
-    else:
-      start_batch_config = int(start_batch_mode)
-    last_epoch, _ = cls.get_epoch_model(config)
-    if last_epoch is None:
-      start_epoch = 1
-      start_batch = start_batch_config or 0
-    elif start_batch_config is not None:
-      # We specified a start batch. Stay in the same epoch, use that start batch.
-      start_epoch = last_epoch
-      start_batch = start_batch_config
-    else:
-      # Start with next epoch.
-      start_epoch = last_epoch + 1
-      start_batch = 0
-    return start_epoch, start_batch
+    self.save_model_async = False
+    self.checkpoint_saver = BackgroundCheckpointSaver()
 
   def init_train_from_config(self, config, train_data, dev_data=None, eval_data=None):
     """
@@ -197,12 +66,14 @@ class Engine:
     self.model_filename = config.value('model', None)
     self.save_model_epoch_interval = config.int('save_interval', 1)
     self.save_epoch1_initial_model = config.bool('save_epoch1_initial_model', False)
+    self.save_model_async = config.bool('save_model_async', False)
     self.learning_rate_control = loadLearningRateControlFromConfig(config)
     self.learning_rate = self.learning_rate_control.defaultLearningRate
     self.initial_learning_rate = self.learning_rate
     self.pretrain_learning_rate = config.float('pretrain_learning_rate', self.learning_rate)
     self.final_epoch = self.config_get_final_epoch(config)  # Inclusive.
     self.max_seqs = config.int('max_seqs', -1)
+    self.priori_num_workers = config.int('priori_num_workers', 0)
     self.updater = Updater.initFromConfig(config)
     self.ctc_prior_file = config.value('ctc_prior_file', None)
     self.exclude = config.int_list('exclude', [])
@@ -226,6 +97,9 @@ class Engine:
     self.pretrain = pretrainFromConfig(config)
     self.max_seqs = config.int('max_seqs', -1)
     self.compression = config.bool('compression', False)
+    self.forward_hdf_compression = config.value('forward_hdf_compression', "gzip" if self.compression else None)
+    self.forward_hdf_chunk_frames = config.int('forward_hdf_chunk_frames', 0)
+    self.step_profile_file = config.value('step_profile_file', None)
 
     epoch, model_epoch_filename = self.get_epoch_model(config)
     assert model_epoch_filename or self.start_epoch
@@ -320,7 +194,7 @@ class Engine:
     print("learning rate control:", self.learning_rate_control, file=log.v4)
     print("pretrain:", self.pretrain, file=log.v4)
     if self.network.loss == 'priori':
-      prior = self.train_data.calculate_priori()
+      prior = self.train_data.calculate_priori(num_workers=self.priori_num_workers)
       self.network.output["output"].priori.set_value(prior)
       self.network.output["output"].initialize()
 
@@ -376,6 +250,7 @@ class Engine:
       # Save last model, in case it was not saved yet (depends on save_model_epoch_interval).
       if self.model_filename:
         self.save_model(self.get_epoch_model_filename(), self.epoch)
+      self.checkpoint_saver.wait()
 
       if self.epoch != self.final_epoch:
         print("Stopped after epoch %i and not %i as planned." % (self.epoch, self.final_epoch), file=log.v3)
@@ -390,19 +265,6 @@ class Engine:
       eval_datasets[name] = dataset
     return eval_datasets
 
-  @classmethod
-  def epoch_model_filename(cls, model_filename, epoch, is_pretrain):
-    """
-    :type model_filename: str
-    :type epoch: int
-    :type is_pretrain: bool
-    :rtype: str
-    """
-    if sys.platform == "win32" and model_filename.startswith("/tmp/"):
-      import tempfile
-      model_filename = tempfile.gettempdir() + model_filename[len("/tmp")]
-    return model_filename + (".pretrain" if is_pretrain else "") + ".%03d" % epoch
-
   def get_epoch_model_filename(self):
     return self.epoch_model_filename(self.model_filename, self.epoch, self.is_pretrain_epoch())
 
@@ -447,6 +309,8 @@ class Engine:
 
   def train_epoch(self):
     print("start", self.get_epoch_str(), "with learning rate", self.learning_rate, "...", file=log.v4)
+    # Raises the exception of the background save of the last epoch, if there was one.
+    self.checkpoint_saver.check_error()
 
     if self.epoch == 1 and self.save_epoch1_initial_model:
       epoch0_model_filename = self.epoch_model_filename(self.model_filename, 0, self.is_pretrain_epoch())
@@ -476,11 +340,14 @@ class Engine:
                               exclude=self.exclude,
                               seq_train_parallel=self.seq_train_parallel,
                               report_prefix=("pre" if self.is_pretrain_epoch() else "") + "train epoch %s" % self.epoch,
-                              epoch=self.epoch)
+                              epoch=self.epoch,
+                              step_profiler=StepProfiler.create(
+                                name="train", epoch=self.epoch, file_prefix=self.step_profile_file))
     trainer.join()
     if not trainer.finalized:
       if trainer.device_crash_batch is not None:  # Otherwise we got an unexpected exception - a bug in our code.
         self.save_model(self.get_epoch_model_filename() + ".crash_%i" % trainer.device_crash_batch, self.epoch - 1)
+      self.checkpoint_saver.wait()
       sys.exit(1)
 
     assert not any(numpy.isinf(trainer.score.values())) or any(numpy.isnan(trainer.score.values())), \
@@ -520,7 +387,9 @@ class Engine:
       else:
         self.dataset_batches[dataset_name].reset()
       tester = EvalTaskThread(self.network, self.devices, data=dataset, batches=self.dataset_batches[dataset_name],
-                              report_prefix=self.get_epoch_str() + " eval", epoch=self.epoch)
+                              report_prefix=self.get_epoch_str() + " eval", epoch=self.epoch,
+                              step_profiler=StepProfiler.create(
+                                name="eval %s" % dataset_name, epoch=self.epoch, file_prefix=self.step_profile_file))
       tester.join()
       eval_dump_str += [" %s: score %s error %s" % (
                         dataset_name, self.format_score(tester.score), self.format_score(tester.error))]
@@ -529,12 +398,34 @@ class Engine:
         self.learning_rate_control.save()
     print(" ".join(eval_dump_str).strip(), file=log.v1)
 
+  def finalize(self):
+    """
+    Waits for a pending background save of the model.
+    """
+    self.checkpoint_saver.wait()
+
   def save_model(self, filename, epoch):
     """
     :param str filename: full filename for model
     :param int epoch: save epoch idx
     """
     print("Save model from epoch %i under %s" % (epoch, filename), file=log.v4)
+    if self.save_model_async:
+      # Snapshot into host memory now. The file is written in the background.
+      network = self.network
+      params_snapshot = network.get_params_snapshot()
+      update_step = network.update_step
+
+      def write_model(tmp_filename):
+        model = h5py.File(tmp_filename, "w")
+        try:
+          network.save_hdf(model, epoch, params_snapshot=params_snapshot, update_step=update_step)
+        finally:
+          model.close()
+        return [tmp_filename]
+
+      self.checkpoint_saver.save(filename, write_model)
+      return
     # We add some extra logic to try again for DiskQuota and other errors.
     # This could save us multiple hours of computation.
     try_again_wait_time = 10
@@ -561,7 +452,8 @@ class Engine:
     cache = h5py.File(output_file, "w")
     batches = data.generate_batches(recurrent_net=self.network.recurrent, batch_size=batch_size, max_seqs=self.max_seqs)
     forwarder = HDFForwardTaskThread(self.network, self.devices, data, batches, cache,
-                                     "gzip" if self.compression else None)
+                                     compression=self.forward_hdf_compression,
+                                     chunk_frames=self.forward_hdf_chunk_frames)
     forwarder.join()
     cache.close()
 
@@ -576,55 +468,44 @@ class Engine:
   # print rpc.result(ret['result']['hash'])
 
   def daemon(self, config):
+    """
+    Serves the network via HTTP (and json-rpc if jsonrpclib is available).
+    Requests are batched and cached, see :class:`EngineServer.BatchingInferenceServer`.
+
+    :param Config.Config config:
+    """
+    from EngineServer import BatchingInferenceServer
     network = self.network
-    devices = self.devices
-    workers = {}
+    inference_server = BatchingInferenceServer(
+      network=network, devices=self.devices,
+      batch_size=config.int('batch_size', 0), max_seqs=config.int('max_seqs', -1),
+      max_wait_time=config.float('daemon.max_wait_ms', 10.0) / 1000.0,
+      cache_size=config.int('daemon.cache_size', 1000),
+      report_interval=config.float('daemon.report_interval', 60.0))
 
     def _classify(params):
       ret = { }
-      output_dim = {}
-      hash = hashlib.new('ripemd160')
-      hash.update(json.dumps(params))
-      hash = hash.hexdigest()
       for k in params:
+        if k != 'data' and not k in network.n_out:
+          ret['error'] = 'unknown target: %s' % k
+          return ret
         try:
-          params[k] = numpy.asarray(params[k], dtype='float32')
-          if k != 'data':
-            output_dim[k] = network.n_out[k] # = [network.n_in,2] if k == 'data' else network.n_out[k]
-        except Exception:
-          if k != 'data' and not k in network.n_out:
-            ret['error'] = 'unknown target: %s' % k
-          else:
-            ret['error'] = 'unable to convert %s to an array from value %s' % (k,str(params[k]))
-          break
-      if not 'error' in ret:
-        data = StaticDataset(data=[params], output_dim=output_dim)
-        data.init_seq_order()
-        try:
-          data = StaticDataset(data=[params], output_dim=output_dim)
-          data.init_seq_order()
+          numpy.asarray(params[k], dtype='float32')
         except Exception:
-          ret['error'] = "invalid data: %s" % params
-        else:
-          batches = data.generate_batches(recurrent_net=network.recurrent,
-                                          batch_size=sys.maxsize, max_seqs=1)
-          if not hash in workers:
-            workers[hash] = ClassificationTaskThread(network, devices, data, batches)
-            workers[hash].json_params = params
-            print >> log.v3, "worker started:", hash
-          ret['result'] = { 'hash' : hash }
+          ret['error'] = 'unable to convert %s to an array from value %s' % (k,str(params[k]))
+          return ret
+      if not 'data' in params:
+        ret['error'] = "invalid data: %s" % params
+        return ret
+      hash = inference_server.submit(params)
+      ret['result'] = { 'hash' : hash }
       return ret
 
-    def _backprob(params):
-      ret = {}
-
-
     def _result(hash):
-      if not workers[hash].isAlive():
-        return { 'result' : { k : workers[hash].result[k].tolist() for k in workers[hash].result } }
-      else:
-        return { 'error' : "working ..."}
-
+      ret = inference_server.poll(hash)
+      if 'result' in ret:
+        ret['result'] = { 'seq-0' : ret['result'] }  # format as for a single-seq dataset
+      return ret
 
     class RequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
       def do_POST(self):
@@ -664,14 +545,10 @@ class Engine:
             return
           ret = { 'error' : "" }
           self.path = self.path[1:].split('/')
-          if self.path[0] in ['result']:
-            if self.path[1] in workers:
-              if not workers[self.path[1]].isAlive():
-                ret['result'] = { k : workers[self.path[1]].result[k] for k in workers[self.path[1]].result }
-              else:
-                ret['error'] = "working ..."
-            else:
-              ret['error'] = "unknown hash: " % self.path[1]
+          if self.path[0] in ['result'] and len(self.path) > 1:
+            ret = _result(self.path[1])
+          elif self.path[0] in ['stats']:
+            ret = { 'result' : inference_server.get_stats() }
           else:
             ret['error'] = "invalid command: %s" % self.path[0]
           self.send_response(200)
@@ -686,7 +563,7 @@ class Engine:
 
     port = config.int('daemon.port', 3333)
     httpd = ThreadingServer(("", port), RequestHandler)
-    print >> log.v3, "httpd listening on port", port
+    print("httpd listening on port", port, file=log.v3)
     try:
       from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer # https://pypi.python.org/pypi/jsonrpclib/0.1.6
     except Exception:
@@ -697,7 +574,8 @@ class Engine:
       server = SimpleJSONRPCServer(('0.0.0.0', port+1))
       server.register_function(_classify, 'classify')
       server.register_function(_result, 'result')
-      print("json-rpc listening on port", 3334, file=log.v3)
+      server.register_function(inference_server.get_stats, 'stats')
+      print("json-rpc listening on port", port+1, file=log.v3)
       server.serve_forever()
 
 ###################################################################################
@@ -0,0 +1,163 @@
+
+"""
+Backend independent parts of the engines, i.e. Engine.Engine (Theano) and TFEngine.Engine.
+This does not import any backend, e.g. the epoch and model file handling.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+from Log import log
+from Util import BackendEngine, model_epoch_from_filename
+
+
+class EngineBase(object):
+  """
+  Base class for the engines.
+  """
+
+  _epoch_model = None; """ :type: (int|None,str|None) """  # See get_epoch_model().
+
+  @classmethod
+  def config_get_final_epoch(cls, config):
+    """ :type config: Config.Config """
+    return config.int('num_epochs', 5)
+
+  @classmethod
+  def get_existing_models(cls, config):
+    model_filename = config.value('model', '')
+    if not model_filename:
+      return []
+    # Automatically search the filesystem for existing models.
+    file_list = []
+    for epoch in range(1, cls.config_get_final_epoch(config) + 1):
+      for is_pretrain in [False, True]:
+        fn = cls.epoch_model_filename(model_filename, epoch, is_pretrain)
+        if os.path.exists(fn):
+          file_list += [(epoch, fn)]  # epoch, fn
+          break
+        if BackendEngine.is_tensorflow_selected():
+          if os.path.exists(fn + ".index"):
+            file_list += [(epoch, fn)]  # epoch, fn
+            break
+    file_list.sort()
+    return file_list
+
+  @classmethod
+  def get_epoch_model(cls, config):
+    """
+    :type config: Config.Config
+    :returns (epoch, modelFilename)
+    :rtype: (int|None, str|None)
+    """
+    # XXX: We cache it, although this is wrong if we have changed the config.
+    if cls._epoch_model:
+      return cls._epoch_model
+
+    start_epoch_mode = config.value('start_epoch', 'auto')
+    if start_epoch_mode == 'auto':
+      start_epoch = None
+    else:
+      start_epoch = int(start_epoch_mode)
+      assert start_epoch >= 1
+
+    load_model_epoch_filename = config.value('load', '')
+    if load_model_epoch_filename:
+      fn_postfix = ""
+      if BackendEngine.is_tensorflow_selected():
+        fn_postfix = ".meta"
+      assert os.path.exists(load_model_epoch_filename + fn_postfix)
+
+    import_model_train_epoch1 = config.value('import_model_train_epoch1', '')
+    if import_model_train_epoch1:
+      assert os.path.exists(import_model_train_epoch1)
+
+    existing_models = cls.get_existing_models(config)
+
+    # Only use this when we don't train.
+    # For training, we first consider existing models before we take the 'load' into account when in auto epoch mode.
+    # In all other cases, we use the model specified by 'load'.
+    if load_model_epoch_filename and (config.value('task', 'train') != 'train' or start_epoch is not None):
+      epoch = model_epoch_from_filename(load_model_epoch_filename)
+      if config.value('task', 'train') == 'train' and start_epoch is not None:
+        # Ignore the epoch. To keep it consistent with the case below.
+        epoch = None
+      epoch_model = (epoch, load_model_epoch_filename)
+
+    # In case of training, always first consider existing models.
+    # This is because we reran CRNN training, we usually don't want to train from scratch
+    # but resume where we stopped last time.
+    elif existing_models:
+      epoch_model = existing_models[-1]
+      if load_model_epoch_filename:
+        print("note: there is a 'load' which we ignore because of existing model", file=log.v4)
+
+    elif config.value('task', 'train') == 'train' and import_model_train_epoch1 and start_epoch in [None, 1]:
+      epoch_model = (0, import_model_train_epoch1)
+
+    # Now, consider this also in the case when we train, as an initial model import.
+    elif load_model_epoch_filename:
+      # Don't use the model epoch as the start epoch in training.
+      # We use this as an import for training.
+      epoch_model = (model_epoch_from_filename(load_model_epoch_filename), load_model_epoch_filename)
+
+    else:
+      epoch_model = (None, None)
+
+    if start_epoch == 1:
+      if epoch_model[0]:  # existing model
+        print("warning: there is an existing model: %s" % (epoch_model,), file=log.v4)
+        epoch_model = (None, None)
+    elif (start_epoch or 0) > 1:
+      if epoch_model[0]:
+        if epoch_model[0] != start_epoch - 1:
+          print("warning: start_epoch %i but there is %s" % (start_epoch, epoch_model), file=log.v4)
+        epoch_model = existing_models[start_epoch-1]
+
+    cls._epoch_model = epoch_model
+    return epoch_model
+
+  @classmethod
+  def get_train_start_epoch_batch(cls, config):
+    """
+    We will always automatically determine the best start (epoch,batch) tuple
+    based on existing model files.
+    This ensures that the files are present and enforces that there are
+    no old outdated files which should be ignored.
+    Note that epochs start at idx 1 and batches at idx 0.
+    :type config: Config.Config
+    :returns (epoch,batch)
+    :rtype (int,int)
+    """
+    start_batch_mode = config.value('start_batch', 'auto')
+    if start_batch_mode == 'auto':
+      start_batch_config = None
+    else:
+      start_batch_config = int(start_batch_mode)
+    last_epoch, _ = cls.get_epoch_model(config)
+    if last_epoch is None:
+      start_epoch = 1
+      start_batch = start_batch_config or 0
+    elif start_batch_config is not None:
+      # We specified a start batch. Stay in the same epoch, use that start batch.
+      start_epoch = last_epoch
+      start_batch = start_batch_config
+    else:
+      # Start with next epoch.
+      start_epoch = last_epoch + 1
+      start_batch = 0
+    return start_epoch, start_batch
+
+  @classmethod
+  def epoch_model_filename(cls, model_filename, epoch, is_pretrain):
+    """
+    :type model_filename: str
+    :type epoch: int
+    :type is_pretrain: bool
+    :rtype: str
+    """
+    if sys.platform == "win32" and model_filename.startswith("/tmp/"):
+      import tempfile
+      model_filename = tempfile.gettempdir() + model_filename[len("/tmp")]
+    return model_filename + (".pretrain" if is_pretrain else "") + ".%03d" % epoch
@@ -0,0 +1,368 @@
+
+"""
+Inference server with dynamic batching, used by Engine.daemon().
+Concurrent requests are collected in a queue and forwarded together
+through the already initialized devices.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+try:
+  from Queue import Queue, Empty
+except ImportError:  # Python3
+  from queue import Queue, Empty
+import numpy
+from Log import log
+
+
+class LRUCache(object):
+  """
+  Bounded dict which drops the least recently used entry.
+  """
+
+  def __init__(self, max_size):
+    """
+    :param int max_size:
+    """
+    assert max_size > 0
+    self.max_size = max_size
+    self.dict = OrderedDict()
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.dict)
+
+  def __contains__(self, key):
+    return key in self.dict
+
+  def get(self, key, default=None):
+    with self.lock:
+      if key not in self.dict:
+        return default
+      value = self.dict.pop(key)
+      self.dict[key] = value  # most recently used is last
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.dict.pop(key, None)
+      self.dict[key] = value
+      while len(self.dict) > self.max_size:
+        self.dict.popitem(last=False)
+
+  def pop(self, key, default=None):
+    with self.lock:
+      return self.dict.pop(key, default)
+
+
+class LatencyStats(object):
+  """
+  Keeps the latencies of the last requests, to report percentiles.
+  """
+
+  def __init__(self, max_len=10000):
+    """
+    :param int max_len: number of last latencies to keep
+    """
+    self.latencies = deque(maxlen=max_len)
+    self.lock = threading.Lock()
+
+  def add(self, latency):
+    """
+    :param float latency: in secs
+    """
+    with self.lock:
+      self.latencies.append(latency)
+
+  def percentile(self, q):
+    """
+    :param float q: in [0,100]
+    :rtype: float|None
+    """
+    with self.lock:
+      if not self.latencies:
+        return None
+      return float(numpy.percentile(list(self.latencies), q))
+
+
+class InferenceRequest(object):
+  def __init__(self, key, params, num_frames):
+    """
+    :param str key: hash of the input
+    :param dict[str,numpy.ndarray] params: "data" and maybe targets
+    :param int num_frames: len of "data"
+    """
+    self.key = key
+    self.params = params
+    self.num_frames = num_frames
+    self.start_time = time.time()
+    self.done = threading.Event()
+    self.result = None; " :type: numpy.ndarray | None "
+    self.error = None; " :type: str | None "
+
+
+def make_request_key(params):
+  """
+  :param dict[str] params: the request as it came in, e.g. from json
+  :return: hash of the input
+  :rtype: str
+  """
+  params = {k: numpy.asarray(v).tolist() for (k, v) in params.items()}
+  return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class BatchingInferenceServer(object):
+  """
+  Requests are put into a queue. A single thread takes them from the queue and forms batches
+  of up to batch_size frames and max_seqs seqs, but waits at most max_wait_time for more requests
+  after the first request of a batch arrived.
+  Every batch is forwarded in one go. The results are kept in a LRU cache, keyed by the input hash.
+  The errors of failed requests are kept in another LRU cache, such that poll() can report them,
+  but a resubmit of the same input is forwarded again.
+  """
+
+  def __init__(self, network, devices, batch_size=0, max_seqs=-1, max_wait_time=0.01, cache_size=1000,
+               report_interval=60.0, forward_func=None):
+    """
+    :param Network.LayerNetwork|None network:
+    :param list[Device.Device]|None devices:
+    :param int batch_size: max num of frames per batch. 0 means unlimited
+    :param int max_seqs: max num of seqs per batch. -1 means unlimited
+    :param float max_wait_time: in secs. deadline for forming a batch, starting at the first request
+    :param int cache_size: max num of results in the cache, and also of errors in the error cache
+    :param float report_interval: in secs. how often to log the stats
+    :param ((list[dict[str,numpy.ndarray]]) -> list[numpy.ndarray])|None forward_func:
+      forwards the requests. by default via the devices, see :func:`forward_with_devices`
+    """
+    self.network = network
+    self.devices = devices
+    self.batch_size = batch_size
+    self.max_seqs = max_seqs
+    self.max_wait_time = max_wait_time
+    self.report_interval = report_interval
+    self.forward_func = forward_func or self.forward_with_devices
+    self.cache = LRUCache(cache_size)
+    self.errors = LRUCache(cache_size); " :type: LRUCache "  # key -> error str of failed requests
+    self.queue = Queue()
+    self.pending = {}; " :type: dict[str,InferenceRequest] "
+    self.lock = threading.Lock()
+    self.latency_stats = LatencyStats()
+    self.max_queue_depth = 0
+    self.num_requests = 0
+    self.num_cache_hits = 0
+    self.num_batches = 0
+    self.num_batch_seqs = 0
+    self.num_batch_frames = 0
+    self._last_report_time = time.time()
+    self._next_request = None; " :type: InferenceRequest | None "
+    self._stopped = False
+    self.thread = threading.Thread(target=self._batching_loop, name="BatchingInferenceServer")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self._stopped = True
+    self.thread.join()
+
+  def submit(self, params):
+    """
+    :param dict[str] params: "data" (time,dim) and maybe targets, as lists or arrays
+    :return: key of the request. the result can be fetched via :func:`poll` or :func:`wait`
+    :rtype: str
+    """
+    key = make_request_key(params)
+    with self.lock:
+      self.num_requests += 1
+      if key in self.cache:
+        self.num_cache_hits += 1
+        return key
+      if key in self.pending:
+        return key
+      self.errors.pop(key)  # failed before, try again
+      params = {k: numpy.asarray(v, dtype="float32") for (k, v) in params.items()}
+      assert "data" in params, "no data in request"
+      request = InferenceRequest(key=key, params=params, num_frames=params["data"].shape[0])
+      self.pending[key] = request
+      self.queue.put(request)
+      self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+    return key
+
+  def poll(self, key):
+    """
+    :param str key: from :func:`submit`
+    :return: in the format of the daemon responses, i.e. with "result" or "error"
+    :rtype: dict[str]
+    """
+    result = self.cache.get(key)
+    if result is not None:
+      return {"result": result.tolist()}
+    with self.lock:
+      request = self.pending.get(key)
+    if request is None:
+      error = self.errors.get(key)
+      if error is not None:
+        return {"error": error}
+      return {"error": "unknown hash: %s" % key}
+    return {"error": "working ..."}
+
+  def wait(self, key, timeout=None):
+    """
+    :param str key: from :func:`submit`
+    :param float|None timeout: in secs
+    :return: output of the network, (time,dim)
+    :rtype: numpy.ndarray
+    """
+    result = self.cache.get(key)
+    if result is not None:
+      return result
+    with self.lock:
+      request = self.pending.get(key)
+    if request is None:  # maybe was just finished
+      result = self.cache.get(key)
+      if result is None:
+        error = self.errors.get(key)
+        if error is not None:
+          raise Exception(error)
+      assert result is not None, "unknown hash: %s" % key
+      return result
+    assert request.done.wait(timeout), "timeout for request %s" % key
+    if request.error:
+      raise Exception(request.error)
+    return request.result
+
+  def classify(self, params, timeout=None):
+    """
+    :param dict[str] params: see :func:`submit`
+    :param float|None timeout: in secs
+    :return: output of the network, (time,dim)
+    :rtype: numpy.ndarray
+    """
+    return self.wait(self.submit(params), timeout=timeout)
+
+  def get_stats(self):
+    """
+    :rtype: dict[str,float|int|None]
+    """
+    num_batches = max(self.num_batches, 1)
+    stats = {
+      "queue_depth": self.queue.qsize(),
+      "max_queue_depth": self.max_queue_depth,
+      "num_requests": self.num_requests,
+      "num_cache_hits": self.num_cache_hits,
+      "num_batches": self.num_batches,
+      "avg_batch_seqs": float(self.num_batch_seqs) / num_batches,
+      "avg_batch_frames": float(self.num_batch_frames) / num_batches,
+      "latency_p50": self.latency_stats.percentile(50),
+      "latency_p99": self.latency_stats.percentile(99)}
+    if self.max_seqs > 0:
+      stats["avg_batch_fill_seqs"] = stats["avg_batch_seqs"] / self.max_seqs
+    if self.batch_size > 0:
+      stats["avg_batch_fill_frames"] = stats["avg_batch_frames"] / self.batch_size
+    return stats
+
+  def _is_batch_full(self, num_seqs, num_frames):
+    if 0 < self.max_seqs <= num_seqs:
+      return True
+    if 0 < self.batch_size <= num_frames:
+      return True
+    return False
+
+  def _get_next_batch(self):
+    """
+    :return: requests for the next batch, or empty list if there were none
+    :rtype: list[InferenceRequest]
+    """
+    if self._next_request:
+      first, self._next_request = self._next_request, None
+    else:
+      try:
+        first = self.queue.get(timeout=0.1)
+      except Empty:
+        return []
+    requests = [first]
+    num_frames = first.num_frames
+    deadline = first.start_time + self.max_wait_time
+    while not self._is_batch_full(num_seqs=len(requests), num_frames=num_frames):
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        request = self.queue.get(timeout=timeout)
+      except Empty:
+        break
+      if self.batch_size > 0 and num_frames + request.num_frames > self.batch_size:
+        self._next_request = request  # first of the next batch
+        break
+      requests.append(request)
+      num_frames += request.num_frames
+    return requests
+
+  def _run_batch(self, requests):
+    """
+    :param list[InferenceRequest] requests:
+    """
+    try:
+      results = self.forward_func([request.params for request in requests])
+      assert len(results) == len(requests)
+    except Exception as exc:
+      print("BatchingInferenceServer: exception %s: %s" % (type(exc).__name__, exc), file=log.v2)
+      for request in requests:
+        request.error = "forward failed: %s" % exc
+        self.errors.put(request.key, request.error)
+        with self.lock:
+          self.pending.pop(request.key, None)
+        request.done.set()
+      return
+    end_time = time.time()
+    for request, result in zip(requests, results):
+      request.result = result
+      self.cache.put(request.key, result)
+      with self.lock:
+        self.pending.pop(request.key, None)
+      self.latency_stats.add(end_time - request.start_time)
+      request.done.set()
+    self.num_batches += 1
+    self.num_batch_seqs += len(requests)
+    self.num_batch_frames += sum([request.num_frames for request in requests])
+
+  def _maybe_report(self):
+    if time.time() - self._last_report_time < self.report_interval:
+      return
+    self._last_report_time = time.time()
+    print("BatchingInferenceServer stats:", self.get_stats(), file=log.v3)
+
+  def _batching_loop(self):
+    while not self._stopped:
+      requests = self._get_next_batch()
+      if requests:
+        self._run_batch(requests)
+      self._maybe_report()
+
+  def forward_with_devices(self, params_list):
+    """
+    :param list[dict[str,numpy.ndarray]] params_list:
+    :return: output of the network per request, (time,dim)
+    :rtype: list[numpy.ndarray]
+    """
+    from GeneratingDataset import StaticDataset
+    from EngineTask import BatchClassificationTaskThread
+    # All seqs of one dataset need the same keys.
+    keys = set.intersection(*[set(params.keys()) for params in params_list])
+    output_dim = {k: self.network.n_out[k] for k in keys if k != "data"}
+    data = StaticDataset(data=[{k: params[k] for k in keys} for params in params_list], output_dim=output_dim)
+    data.init_seq_order()
+    batches = data.generate_batches(recurrent_net=self.network.recurrent,
+                                    batch_size=self.batch_size or sys.maxsize, max_seqs=self.max_seqs)
+    target = "classes"
+    if self.network.get_layer('output'):
+      target = self.network.get_layer('output').attrs.get('target', target)
+    forwarder = BatchClassificationTaskThread(self.network, self.devices, data, batches, target=target)
+    forwarder.join()
+    assert len(forwarder.result) == len(params_list), "device crashed"
+    return [forwarder.result[seq_idx] for seq_idx in range(len(params_list))]
@@ -6,14 +6,16 @@ import time
 import theano
 from EngineUtil import assign_dev_data
 from Log import log
-from Util import hms, progress_bar, terminal_size, hdf5_strings, interrupt_main, NumbersDict
+from Util import hms, progress_bar, terminal_size, hdf5_strings, hdf5_chunk_shape, interrupt_main, NumbersDict
+from Util import HDFForwardWriterThread
+from StepProfiler import StepProfiler
 from Device import Device
 from TaskSystem import ProcConnectionDied
 from math import ceil
 
 
 class TaskThread(threading.Thread):
-    def __init__(self, task, network, devices, data, batches, eval_batch_size=0, start_batch=0, share_batches = False, report_prefix=None, exclude=None, epoch=None):
+    def __init__(self, task, network, devices, data, batches, eval_batch_size=0, start_batch=0, share_batches = False, report_prefix=None, exclude=None, epoch=None, step_profiler=None):
       """
       :type task: str
       :type network: Network.LayerNetwork
@@ -22,6 +24,7 @@ class TaskThread(threading.Thread):
       :type batches: EngineBatch.BatchSetGenerator
       :type start_batch: int
       :param str report_prefix: such as epoch or so. only for reporting
+      :param StepProfiler|None step_profiler: times the phases of the steps. by default without export
       """
       threading.Thread.__init__(self, name="TaskThread %s" % task)
       if eval_batch_size == 0:
@@ -47,6 +50,7 @@ class TaskThread(threading.Thread):
       self.device_crash_batch = None; " :type: int | None "
       self.report_prefix = report_prefix or self.task
       self.epoch = epoch
+      self.step_profiler = step_profiler or StepProfiler(name=self.report_prefix, epoch=epoch)
       self.lock = threading.Lock()
       self.start()
 
@@ -215,7 +219,8 @@ class TaskThread(threading.Thread):
 
       def allocate(self):
         self.devices_batches_idx = self.parent.batches.get_current_batch_idx()
-        self.devices_batches = self.parent.allocate_devices(self.alloc_devices)
+        with self.parent.step_profiler.phase(StepProfiler.Data, step=self.devices_batches_idx):
+          self.devices_batches = self.parent.allocate_devices(self.alloc_devices)
         self.run_frames = NumbersDict(0)
         for batches, device in zip(self.devices_batches,self.alloc_devices):
           assert batches
@@ -232,7 +237,9 @@ class TaskThread(threading.Thread):
         """
         :returns whether everything is fine.
         """
-        device_results, outputs_format = self.device_collect_results()
+        profiler = self.parent.step_profiler
+        with profiler.phase(StepProfiler.Collect, step=self.run_start_batch_idx):
+          device_results, outputs_format = self.device_collect_results()
         if device_results is None:
           if not getattr(sys, "exited", False):
             print >> log.v3, "device crashed on batch", self.run_start_batch_idx
@@ -242,6 +249,7 @@ class TaskThread(threading.Thread):
         assert len(device_results) == len(self.alloc_devices) == len(self.devices_batches)
 
         if outputs_format and any([k.startswith("gparam:") for k in outputs_format]):
+          sync_start_time = time.time()
           # WARNING: this code is untested and likely broken!
           for i in range(len(self.alloc_devices)):
             res = Device.make_result_dict(device_results[i], outputs_format)
@@ -262,19 +270,23 @@ class TaskThread(threading.Thread):
             self.parent.updater.setNetParamDeltas(gparams)
             self.parent.updater.update()
             self.alloc_devices[i].set_net_params(self.parent.network)
-
-        self.result = { 'batchess': self.devices_batches, 'results': device_results, 'result_format': outputs_format, 'num_frames': self.num_frames }
-        self.eval_info = self.parent.evaluate(**self.result)
-        self.parent.lock.acquire()
-        self.print_process()
-        self.parent.lock.release()
+          profiler.add(StepProfiler.Sync, sync_start_time, time.time(), step=self.run_start_batch_idx)
+
+        with profiler.phase(StepProfiler.Eval, step=self.run_start_batch_idx):
+          self.result = { 'batchess': self.devices_batches, 'results': device_results, 'result_format': outputs_format, 'num_frames': self.num_frames }
+          self.eval_info = self.parent.evaluate(**self.result)
+          self.parent.lock.acquire()
+          self.print_process()
+          self.parent.lock.release()
+        profiler.finish_step(self.run_start_batch_idx)
         return True
 
       def run(self):
         try:
           while self.active and not getattr(sys, "exited", False):
             if self.allocated and not self.finished:
-              self.device_run()
+              with self.parent.step_profiler.phase(StepProfiler.Compute, step=self.devices_batches_idx):
+                self.device_run()
               self.num_frames = self.run_frames
               self.processing = True
               self.allocated = False
@@ -441,7 +453,8 @@ class TaskThread(threading.Thread):
             results['num_frames'] = run_frames
             self.num_frames += run_frames
             if self.share_batches: run_frames *= len(self.devices)
-            self.reduce(run_frames)
+            with self.step_profiler.phase(StepProfiler.Sync):
+              self.reduce(run_frames)
             self.eval_batch_idx += 1
             run_frames = NumbersDict(0)
             results['batchess'] = []
@@ -478,6 +491,7 @@ class TaskThread(threading.Thread):
       self.finalize()
       if self.interactive: progress_bar()
       self.elapsed = (time.time() - self.start_time)
+      self.step_profiler.finalize()
 
 
 class ModelBrokenError(Exception):
@@ -655,9 +669,16 @@ class EvalTaskThread(TaskThread):
         device.set_net_params(self.network)
 
 class HDFForwardTaskThread(TaskThread):
-    def __init__(self, network, devices, data, batches, cache, compression="none"):
+    def __init__(self, network, devices, data, batches, cache, compression=None, compression_opts=None,
+                 chunk_frames=0, writer_queue_size=4):
+      """
+      :param h5py.File cache: output file
+      :param str|None compression: "gzip" or "lzf" or None
+      :param int|None compression_opts: for gzip, the level
+      :param int chunk_frames: frames per HDF chunk. 0 means automatic
+      :param int writer_queue_size: max number of batches waiting for the writer thread
+      """
       super(HDFForwardTaskThread, self).__init__('extract', network, devices, data, batches, eval_batch_size=1)
-      self.tags = []
       self.cache = cache
       self.network = network
       self.num_seqs = 0
@@ -665,35 +686,61 @@ class HDFForwardTaskThread(TaskThread):
         target = network.get_layer('output').attrs['target']
       else:
         target = 'classes'
+      self.target = target
       cache.attrs['numTimesteps'] = 0
       cache.attrs['inputPattSize'] = data.num_inputs
       cache.attrs['numDims'] = 1
       cache.attrs['numLabels'] = data.num_outputs[target]
-      self.compression=compression
+      if compression == "none":  # old default
+        compression = None
+      self.compression = compression
+      self.compression_opts = compression_opts
+      self.chunk_frames = chunk_frames
+      self.writer_queue_size = writer_queue_size
       if target in data.labels:
         hdf5_strings(cache, 'labels', data.labels[target])
       try:
         cache.attrs['numSeqs'] = data.num_seqs
       except Exception:
         cache.attrs['numSeqs'] = 1
-        self.seq_lengths = cache.create_dataset("seqLengths", (cache.attrs['numSeqs'],), dtype='i', maxshape=(None,), compression=compression)
       else:
-        self.seq_lengths = cache.create_dataset("seqLengths", (cache.attrs['numSeqs'],), dtype='i', compression=compression)
         self.seq_dims = cache.create_dataset("seqDims", (cache.attrs['numSeqs'], 1), dtype='i', compression=compression)
+      # Presized, and shrunk in the end to the real num of seqs.
+      self.seq_lengths = cache.create_dataset(
+        "seqLengths", (cache.attrs['numSeqs'],), dtype='i', maxshape=(None,), compression=compression)
       try:
         self.targets = { k: cache.create_dataset("targets/data/" + k, (data.get_num_timesteps(),), dtype='i', compression=compression) for k in data.get_target_list() }
       except Exception:
         self.targets = None
-      self.times = []
+      self.inputs = None
+      self.writer = None; " :type: HDFForwardWriterThread | None "
 
     def initialize(self):
       self.toffset = 0
 
+    def _init_inputs(self, dim):
+      """
+      Creates "inputs", presized to the total num of frames, if we know it.
+
+      :param int dim: feature dim of the output
+      """
+      try:
+        num_frames = self.data.get_num_timesteps()
+      except Exception:  # not known in advance
+        num_frames = 0
+      opts = {"chunks": hdf5_chunk_shape([None, dim], "float32", chunk_frames=self.chunk_frames)}
+      if self.compression:
+        opts.update({"compression": self.compression, "compression_opts": self.compression_opts})
+      self.inputs = self.cache.create_dataset("inputs", (num_frames, dim), dtype='f', maxshape=(None, dim), **opts)
+      self.writer = HDFForwardWriterThread(
+        cache=self.cache, inputs=self.inputs, seq_lengths=self.seq_lengths, queue_size=self.writer_queue_size)
+
     def finalize(self):
-      hdf5_strings(self.cache, 'seqTags', self.tags)
-      if self.times:
-        times = self.cache.create_dataset("times", (len(self.times), 2), dtype='f')
-        times[...] = self.times
+      if self.writer:
+        self.writer.finish()
+        self.cache.attrs['numTimesteps'] = self.writer.num_frames
+      else:  # no batches at all
+        hdf5_strings(self.cache, 'seqTags', [])
       self.cache.attrs['numSeqs'] = self.num_seqs
 
     def evaluate(self, batchess, results, result_format, num_frames):
@@ -714,47 +761,63 @@ class HDFForwardTaskThread(TaskThread):
       batch = batchess[0][0]
       from EngineBatch import Batch
       assert isinstance(batch, Batch)
-      if "inputs" not in self.cache:
-        self.inputs = self.cache.create_dataset("inputs", (self.cache.attrs['numSeqs'], features.shape[-1]), dtype='f', maxshape=(None, None), compression=self.compression)
-      if features.shape[-1] > self.inputs.shape[1]:
-        self.inputs.resize(features.shape[-1],axis=1)
-      tt = 0
+      if self.inputs is None:
+        self._init_inputs(features.shape[-1])
+      assert features.shape[-1] == self.inputs.shape[1]
       feats = []
+      tags = []
+      times = []
       self.num_seqs += batch.get_num_seqs()
-      for seq_idx in range(batch.start_seq, batch.end_seq):
-        if self.network.recurrent:
-          seqfeats = features[:, seq_idx - batch.start_seq]
-          if batch.end_seq - batch.start_seq > 1:
-            seqfeats = seqfeats[~numpy.all(seqfeats == 0,axis=1)]
-          if seqfeats.shape[0] == 0:
-            seqfeats = features[:, seq_idx - batch.start_seq]
-        else:
-          seq = batch.seqs[seq_idx - batch.start_seq]
-          seqfeats = features[
-                       seq.batch_frame_offset["data"]:seq.batch_frame_offset["data"] + seq.frame_length["data"],
-                       seq.batch_slice]
+      for seq_idx, seqfeats in split_batch_output(
+            batch, features, recurrent=self.network.recurrent, target=self.target):
         print >> log.v5, "extracting", seqfeats.shape[-1], "features over", seqfeats.shape[0], "time steps for sequence", self.data.get_tag(seq_idx)
-        self.cache.attrs['numTimesteps'] += seqfeats.shape[0]
-        tt += seqfeats.shape[0]
-        #self.seq_dims[seq_idx] = [seqfeats.shape[1]]
-        if self.seq_lengths.shape[0] <= seq_idx:
-          self.seq_lengths.resize(seq_idx+1,axis=0)
-        self.seq_lengths[seq_idx] = seqfeats.shape[0]
-        #self.inputs[self.toffset:self.toffset + seqfeats.shape[0]] = numpy.asarray(seqfeats)
         feats.append(seqfeats)
-        self.tags.append(self.data.get_tag(seq_idx))
+        tags.append(self.data.get_tag(seq_idx))
         try:
-          times = self.data.get_times(seq_idx)
-          self.times.extend(times)
+          times.extend(self.data.get_times(seq_idx))
         except Exception:
           pass
-        if self.inputs.shape[1] < seqfeats.shape[1]:
-          self.inputs.resize(seqfeats.shape[1], axis=1)
-      if self.inputs.shape[0] < self.toffset + tt:
-        self.inputs.resize(self.toffset + tt, axis = 0)
-      self.inputs[self.toffset:self.toffset + tt,:feats[0].shape[1]] = numpy.concatenate(feats,axis=0)
-      self.cache.attrs['inputPattSize'] = self.inputs.shape[1]
-      self.toffset += tt
+      self.writer.add(
+        numpy.concatenate(feats, axis=0), numpy.array([seqfeats.shape[0] for seqfeats in feats], dtype="int32"),
+        tags=tags, times=numpy.array(times, dtype="float32").reshape((-1, 2)))
+      self.toffset += sum([seqfeats.shape[0] for seqfeats in feats])
+
+
+def split_batch_output(batch, features, recurrent, target="classes"):
+  """
+  Splits the output of a forwarded batch into the seqs, without the padding.
+  The seqs are cut by their lengths of the data key which matches the time axis of the output,
+  i.e. "data" or the target.
+  Only if none matches (the output length is unrelated to the inputs), the zero padding frames are stripped.
+
+  :param EngineBatch.Batch batch:
+  :param numpy.ndarray features: (time,batch,dim)
+  :param bool recurrent: whether the batch was created for a recurrent net, i.e. with one slice per seq
+  :param str target:
+  :return: (seq_idx, features of the seq) per seq in the batch
+  :rtype: list[(int,numpy.ndarray)]
+  """
+  len_key = "data"
+  if recurrent:
+    len_key = None
+    for key in ["data", target]:
+      if features.shape[0] == batch.max_num_frames_per_slice[key]:
+        len_key = key
+        break
+  res = []
+  for seq in batch.seqs:
+    if len_key:
+      seqfeats = features[
+                   seq.batch_frame_offset[len_key]:seq.batch_frame_offset[len_key] + seq.frame_length[len_key],
+                   seq.batch_slice]
+    else:
+      seqfeats = features[:, seq.batch_slice]
+      if batch.get_num_seqs() > 1:
+        seqfeats = seqfeats[~numpy.all(seqfeats == 0, axis=1)]
+      if seqfeats.shape[0] == 0:
+        seqfeats = features[:, seq.batch_slice]
+    res.append((seq.seq_idx, seqfeats))
+  return res
 
 
 class ClassificationTaskThread(TaskThread):
@@ -769,6 +832,26 @@ class ClassificationTaskThread(TaskThread):
       self.result[self.data.get_tag(batchess[0][0].start_seq)] = numpy.concatenate(results, axis=1)
 
 
+class BatchClassificationTaskThread(TaskThread):
+    """
+    Like ClassificationTaskThread, but the batches can have multiple seqs and go to multiple devices.
+    """
+    def __init__(self, network, devices, data, batches, target="classes"):
+      self.result = {}; " :type: dict[int,numpy.ndarray] "  # seq idx -> output, without padding
+      self.target = target
+      super(BatchClassificationTaskThread, self).__init__('extract', network, devices, data, batches, eval_batch_size=1)
+
+    def evaluate(self, batchess, results, result_format, num_frames):
+      assert len(batchess) == len(results)
+      for batches, device_results in zip(batchess, results):
+        # Like HDFForwardTaskThread, a single batch per device.
+        assert len(batches) == 1
+        assert len(device_results) == 1
+        for seq_idx, seqfeats in split_batch_output(
+              batches[0], device_results[0], recurrent=self.network.recurrent, target=self.target):
+          self.result[seq_idx] = seqfeats
+
+
 class PriorEstimationTaskThread(TaskThread):
     def __init__(self, network, devices, data, batches, priori_file, target, extract_type):
       from Network import LayerNetwork
@@ -779,7 +862,7 @@ class PriorEstimationTaskThread(TaskThread):
       self.extract_type = extract_type
       assert extract_type in ["log-posteriors", "log-posteriors-sum", "posteriors", "posteriors-sum"]
       self.num_outputs = network.n_out[target][0]
-      self.sum_posteriors = numpy.zeros(int(self.num_outputs))
+      self.sum_posteriors = numpy.zeros(int(self.num_outputs), dtype="float64")
       print >> log.v1, "Prior estimation via posteriors of %r. output dimension = %i" % (target, self.num_outputs)
       if not extract_type.endswith("-sum"):
         print >>log.v1, "HINT: You can set extract=posteriors-sum in your config to speed up the estimation."
@@ -789,20 +872,19 @@ class PriorEstimationTaskThread(TaskThread):
         print >>log.v1, "WARNING: Dataset uses chunking. You might want to disable that."
 
     def evaluate(self, batchess, results, result_format, num_frames):
+      # The accumulation over the batches is here on the host, in float64.
+      # The devices only reduce over the frames of their batch (with extract=posteriors-sum),
+      # so per run, we get one vector per device, which we sum up in one go.
+      # Index-masked frames are zero, so these sums work.
+      ress = [res for device_results in results for res in device_results]
+      for res in ress:
+        assert isinstance(res, numpy.ndarray)
+        assert res.ndim == (1 if self.extract_type.endswith("-sum") else 3)
       if self.extract_type.endswith("-sum"):
-        for ress in results:
-          for res in ress:
-            assert isinstance(res, numpy.ndarray)
-            assert res.ndim == 1
-            # Index-masked frames are zero, so this sum works.
-            self.sum_posteriors += res
+        self.sum_posteriors += numpy.sum(numpy.stack(ress), axis=0, dtype="float64")
       else:
-        for ress in results:
-          for res in ress:
-            assert isinstance(res, numpy.ndarray)
-            assert res.ndim == 3
-            # Index-masked frames are zero, so this sum works.
-            self.sum_posteriors += numpy.sum(res, axis=(0, 1))
+        for res in ress:
+          self.sum_posteriors += numpy.sum(res.reshape((-1, res.shape[-1])), axis=0, dtype="float64")
 
     def finalize(self):
       print >>log.v1, "Dumping priors in +log-space to file", self.priori_file
@@ -101,7 +101,7 @@ def maybe_subtract_priors(network, train, config):
   """
   if config.bool('subtract_priors', False):
     prior_scale = config.float('prior_scale', 0.0)
-    priors = train.calculate_priori()
+    priors = train.calculate_priori(num_workers=config.int('priori_num_workers', 0))
     priors[priors == 0] = 1e-10 #avoid priors of zero which would yield a bias of inf
     l = [p for p in network.train_params_vars if p.name == 'b_output']
     assert len(l) == 1, len(l)
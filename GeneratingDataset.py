@@ -6,7 +6,22 @@ import numpy
 
 class GeneratingDataset(Dataset):
 
-  def __init__(self, input_dim, output_dim, window=1, num_seqs=float("inf"), fixed_random_seed=None, **kwargs):
+  def __init__(self, input_dim, output_dim, window=1, num_seqs=float("inf"), fixed_random_seed=None,
+               num_workers=0, block_size=None, num_lookahead_blocks=2, **kwargs):
+    """
+    :param int input_dim:
+    :param int|dict[str,int|(int,int)] output_dim:
+    :param int window:
+    :param int|float num_seqs:
+    :param int|None fixed_random_seed: useful when used as eval dataset
+    :param int num_workers: if > 0, generate the seqs ahead of time in a process pool of this size
+    :param int|None block_size: generate this many seqs at once, via :func:`generate_seqs`.
+      Every block gets its own random state, seeded by the epoch and the block index,
+      thus the data does not depend on num_workers.
+      If None (default) and without workers, all seqs of an epoch are generated one by one via :func:`generate_seq`
+      with one random state, i.e. the data is the same as without these options.
+    :param int num_lookahead_blocks: with workers, the number of blocks to generate ahead
+    """
     assert window == 1
     super(GeneratingDataset, self).__init__(window=window, **kwargs)
     assert self.shuffle_frames_of_nseqs == 0
@@ -20,6 +35,14 @@ class GeneratingDataset(Dataset):
     self._num_seqs = num_seqs
     self.random = numpy.random.RandomState(1)
     self.fixed_random_seed = fixed_random_seed  # useful when used as eval dataset
+    self.num_workers = num_workers
+    if num_workers and not block_size:
+      block_size = 32
+    self.block_size = block_size
+    self.num_lookahead_blocks = num_lookahead_blocks
+    self._random_seed = 1
+    self._blocks = {}; " :type: dict[int,list[DatasetSeq]|multiprocessing.pool.AsyncResult] "
+    self._worker_pool = None
 
   def init_seq_order(self, epoch=None, seq_list=None):
     """
@@ -29,11 +52,15 @@ class GeneratingDataset(Dataset):
     """
     super(GeneratingDataset, self).init_seq_order(epoch=epoch)
     assert not seq_list, "predefined order doesn't make sense for %s" % self.__class__.__name__
-    self.random.seed(self.fixed_random_seed or epoch or 1)
+    self._random_seed = self.fixed_random_seed or epoch or 1
+    self.random.seed(self._random_seed)
     self._num_timesteps = 0
     self.reached_final_seq = False
     self.expected_load_seq_start = 0
     self.added_data = []; " :type: list[DatasetSeq] "
+    # The workers are forked from our current state, thus we need new ones for a new epoch.
+    self._close_workers()
+    self._blocks.clear()
     return True
 
   def _cleanup_old_seqs(self, seq_idx_end):
@@ -50,6 +77,10 @@ class GeneratingDataset(Dataset):
         return data
     return None
 
+  def is_random_access(self):
+    # With block_size, every block has its own random state. Otherwise, we depend on the running random state.
+    return bool(self.block_size)
+
   def is_cached(self, start, end):
     # Always False, to force that we call self._load_seqs().
     # This is important for our buffer management.
@@ -74,7 +105,14 @@ class GeneratingDataset(Dataset):
       end = self.num_seqs
     if end >= self.num_seqs:
       self.reached_final_seq = True
-    seqs = [self.generate_seq(seq_idx=seq_idx) for seq_idx in range(start, end)]
+    if start >= end:
+      return  # all already loaded
+    if self.block_size:
+      seqs = self._get_seqs_from_blocks(start, end)
+    else:
+      # The vectorized generate_seqs draws the random numbers in another order,
+      # thus we keep the original data stream here.
+      seqs = [self.generate_seq(seq_idx=seq_idx) for seq_idx in range(start, end)]
     self._num_timesteps += sum([seq.num_frames for seq in seqs])
     self.added_data += seqs
 
@@ -85,6 +123,90 @@ class GeneratingDataset(Dataset):
     """
     raise NotImplementedError
 
+  def generate_seqs(self, start, end):
+    """
+    Generates multiple seqs at once.
+    Override this if the generation can be vectorized.
+
+    :param int start: seq idx, inclusive
+    :param int end: seq idx, exclusive
+    :rtype: list[DatasetSeq]
+    """
+    return [self.generate_seq(seq_idx=seq_idx) for seq_idx in range(start, end)]
+
+  def _get_block_range(self, block_idx):
+    """
+    :param int block_idx:
+    :return: (start, end) seq idx
+    :rtype: (int, int)
+    """
+    start = block_idx * self.block_size
+    return start, int(min(start + self.block_size, self.num_seqs))
+
+  def _generate_block(self, block_idx):
+    """
+    :param int block_idx:
+    :rtype: list[DatasetSeq]
+    """
+    self.random = numpy.random.RandomState([self._random_seed, block_idx])
+    start, end = self._get_block_range(block_idx)
+    return self.generate_seqs(start, end)
+
+  def _request_block(self, block_idx):
+    """
+    Starts generating the block in the worker pool, if not already there.
+
+    :param int block_idx:
+    """
+    if block_idx in self._blocks:
+      return
+    if self._worker_pool is None:
+      import multiprocessing
+      # Forked, thus the workers get a copy of our current state.
+      self._worker_pool = multiprocessing.Pool(
+        processes=self.num_workers, initializer=_init_generating_worker, initargs=(self,))
+    self._blocks[block_idx] = self._worker_pool.apply_async(_generate_block_in_worker, (block_idx,))
+
+  def _get_block(self, block_idx):
+    """
+    :param int block_idx:
+    :rtype: list[DatasetSeq]
+    """
+    if block_idx not in self._blocks:
+      self._blocks[block_idx] = self._generate_block(block_idx)
+    block = self._blocks[block_idx]
+    if not isinstance(block, list):  # AsyncResult
+      block = self._blocks[block_idx] = block.get()
+    return block
+
+  def _get_seqs_from_blocks(self, start, end):
+    """
+    :param int start: seq idx, inclusive
+    :param int end: seq idx, exclusive. <= num_seqs
+    :rtype: list[DatasetSeq]
+    """
+    if start >= end:
+      return []
+    first_block_idx = start // self.block_size
+    last_block_idx = (end - 1) // self.block_size
+    if self.num_workers:
+      for block_idx in range(first_block_idx, last_block_idx + self.num_lookahead_blocks + 1):
+        if block_idx * self.block_size >= self.num_seqs:
+          break
+        self._request_block(block_idx)
+    seqs = []
+    for block_idx in range(first_block_idx, last_block_idx + 1):
+      seqs += [seq for seq in self._get_block(block_idx) if start <= seq.seq_idx < end]
+    for block_idx in list(self._blocks.keys()):
+      if block_idx < last_block_idx:
+        del self._blocks[block_idx]
+    return seqs
+
+  def _close_workers(self):
+    if self._worker_pool is not None:
+      self._worker_pool.terminate()
+      self._worker_pool = None
+
   def _shuffle_frames_in_seqs(self, start, end):
     assert False, "Shuffling in GeneratingDataset does not make sense."
 
@@ -116,6 +238,27 @@ class GeneratingDataset(Dataset):
     return self._get_seq(sorted_seq_idx).seq_tag
 
 
+_worker_dataset = None; " :type: GeneratingDataset "
+
+
+def _init_generating_worker(dataset):
+  """
+  Initializer of the GeneratingDataset worker pool processes.
+
+  :param GeneratingDataset dataset:
+  """
+  global _worker_dataset
+  _worker_dataset = dataset
+
+
+def _generate_block_in_worker(block_idx):
+  """
+  :param int block_idx:
+  :rtype: list[DatasetSeq]
+  """
+  return _worker_dataset._generate_block(block_idx)
+
+
 class Task12AXDataset(GeneratingDataset):
   """
   12AX memory task.
@@ -151,6 +294,58 @@ class Task12AXDataset(GeneratingDataset):
         seq += self.random.choice(list(self._input_classes))
     return list(map(self._input_classes.index, seq[:seq_len]))
 
+  def generate_input_seqs(self, seq_lens):
+    """
+    Vectorized variant of :func:`generate_input_seq`, with the same distribution.
+    The rounds of the loop there (optional 1/2, optional AX/BY, random chars)
+    are drawn for all seqs at once, and every seq consumes whole rounds until it is long enough.
+
+    :param list[int]|numpy.ndarray seq_lens:
+    :rtype: list[numpy.ndarray]
+    """
+    idx = self._input_classes.index
+    one_two = numpy.array([idx("1"), idx("2")])
+    pairs = numpy.array([[idx("A"), idx("X")], [idx("B"), idx("Y")]])
+    seq_lens = numpy.asarray(seq_lens)
+    start_digits = self.random.randint(-1, 2, size=len(seq_lens))  # -1 means no start char
+    # The expected round length is 0.5 + 0.9 * 2 + 1 = 3.3.
+    num_rounds = int(numpy.sum(seq_lens) / 3.) + 100
+    while True:
+      with_digit = self.random.uniform(size=num_rounds) < 0.5
+      digits = one_two[self.random.randint(0, 2, size=num_rounds)]
+      with_pair = self.random.uniform(size=num_rounds) < 0.9
+      round_pairs = pairs[self.random.randint(0, 2, size=num_rounds)]
+      num_rnd_chars = self.random.geometric(0.5, size=num_rounds) - 1
+      round_lens = with_digit + 2 * with_pair + num_rnd_chars
+      round_ends = numpy.cumsum(round_lens)
+      round_starts = round_ends - round_lens
+      stream = numpy.zeros((int(round_ends[-1]),), dtype="int32")
+      stream[round_starts[with_digit]] = digits[with_digit]
+      pair_starts = (round_starts + with_digit)[with_pair]
+      stream[pair_starts] = round_pairs[with_pair, 0]
+      stream[pair_starts + 1] = round_pairs[with_pair, 1]
+      rnd_chars_starts = round_starts + with_digit + 2 * with_pair
+      rnd_chars_ends = numpy.cumsum(num_rnd_chars)
+      rnd_chars_pos = (numpy.repeat(rnd_chars_starts, num_rnd_chars) +
+                       numpy.arange(rnd_chars_ends[-1]) - numpy.repeat(rnd_chars_ends - num_rnd_chars, num_rnd_chars))
+      stream[rnd_chars_pos] = self.random.randint(0, len(self._input_classes), size=rnd_chars_pos.shape[0])
+      seqs = []
+      round_idx = 0
+      for start_digit, seq_len in zip(start_digits, seq_lens):
+        seq_prefix = one_two[start_digit:start_digit + 1] if start_digit >= 0 else one_two[:0]
+        needed = seq_len - len(seq_prefix)
+        offset = round_starts[round_idx] if round_idx < num_rounds else round_ends[-1]
+        # Consume whole rounds, like the loop in generate_input_seq.
+        end_round_idx = numpy.searchsorted(round_ends, offset + needed, side="left") + 1
+        if needed > 0 and end_round_idx > num_rounds:
+          break  # not enough rounds
+        seqs.append(numpy.concatenate([seq_prefix, stream[offset:offset + max(needed, 0)]])[:seq_len])
+        if needed > 0:
+          round_idx = end_round_idx
+      if len(seqs) == len(seq_lens):
+        return seqs
+      num_rounds *= 2
+
   @classmethod
   def make_output_seq(cls, input_seq):
     """
@@ -197,6 +392,16 @@ class Task12AXDataset(GeneratingDataset):
     targets = numpy.array(output_seq)
     return DatasetSeq(seq_idx=seq_idx, features=features, targets=targets)
 
+  def generate_seqs(self, start, end):
+    seq_lens = self.random.randint(10, 100, size=end - start)
+    seqs = []
+    for seq_idx, input_seq in zip(range(start, end), self.generate_input_seqs(seq_lens)):
+      output_seq = self.make_output_seq(input_seq)
+      features = class_idx_seq_to_1_of_k(input_seq, num_classes=len(self._input_classes))
+      targets = numpy.array(output_seq)
+      seqs.append(DatasetSeq(seq_idx=seq_idx, features=features, targets=targets))
+    return seqs
+
 
 class TaskEpisodicCopyDataset(GeneratingDataset):
   """
@@ -479,8 +684,8 @@ class TaskVariableAssignmentDataset(GeneratingDataset):
 class DummyDataset(GeneratingDataset):
 
   def __init__(self, input_dim, output_dim, num_seqs, seq_len=2,
-               input_max_value=10.0, input_shift=None, input_scale=None):
-    super(DummyDataset, self).__init__(input_dim=input_dim, output_dim=output_dim, num_seqs=num_seqs)
+               input_max_value=10.0, input_shift=None, input_scale=None, **kwargs):
+    super(DummyDataset, self).__init__(input_dim=input_dim, output_dim=output_dim, num_seqs=num_seqs, **kwargs)
     self.seq_len = seq_len
     self.input_max_value = input_max_value
     if input_shift is None: input_shift = -input_max_value / 2.0
@@ -499,6 +704,19 @@ class DummyDataset(GeneratingDataset):
                            for i in range(i1, i2)])
     return DatasetSeq(seq_idx=seq_idx, features=features, targets=targets)
 
+  def is_random_access(self):
+    return True  # no randomness
+
+  def generate_seqs(self, start, end):
+    seq_len = self.seq_len
+    seq_idxs = numpy.arange(start, end)[:, None]
+    num_feature_values = seq_len * self.num_inputs
+    features = ((((seq_idxs + numpy.arange(num_feature_values)[None, :]) % self.input_max_value) + self.input_shift)
+                * self.input_scale).reshape((end - start, seq_len, self.num_inputs))
+    targets = (seq_idxs + num_feature_values + numpy.arange(seq_len)[None, :]) % self.num_outputs["classes"][0]
+    return [DatasetSeq(seq_idx=seq_idx, features=features[i], targets=targets[i])
+            for i, seq_idx in enumerate(range(start, end))]
+
 
 class StaticDataset(GeneratingDataset):
 
@@ -552,6 +770,9 @@ class StaticDataset(GeneratingDataset):
                       features=data["data"],
                       targets={target: data[target] for target in self.target_list})
 
+  def is_random_access(self):
+    return True
+
   def get_target_list(self):
     return self.target_list
 
@@ -589,6 +810,14 @@ class CopyTaskDataset(GeneratingDataset):
     seq_np = numpy.array(seq, dtype="int8")
     return DatasetSeq(seq_idx=seq_idx, features=seq_np, targets={"classes": seq_np})
 
+  def generate_seqs(self, start, end):
+    seq_lens = [self.get_random_seq_len() for seq_idx in range(start, end)]
+    symbols = self.random.randint(0, self.nsymbols, size=sum(seq_lens)).astype("int8")
+    seqs = []
+    for seq_idx, seq_np in zip(range(start, end), numpy.split(symbols, numpy.cumsum(seq_lens)[:-1])):
+      seqs.append(DatasetSeq(seq_idx=seq_idx, features=seq_np, targets={"classes": seq_np}))
+    return seqs
+
 
 def demo():
   import better_exchook
@@ -2,9 +2,9 @@
 import gc
 import h5py
 import numpy
-import theano
 from CachedDataset import CachedDataset
 from Log import log
+from Util import get_floatX
 
 # Common attribute names for HDF dataset, which should be used in order to be proceed with HDFDataset class.
 attr_seqLengths = 'seqLengths'
@@ -106,11 +106,11 @@ class HDFDataset(CachedDataset):
         self.data_dtype[name] = str(fin['targets/data'][name].dtype) if tdim > 1 else 'int32'
         #print name, self.data_dtype[name], fin['targets/data'][name][0:3][...]
         if self.data_dtype[name] == 'int32':
-          self.targets[name] = numpy.zeros((self._num_codesteps[self.target_keys.index(name)],), dtype=theano.config.floatX) - 1
+          self.targets[name] = numpy.zeros((self._num_codesteps[self.target_keys.index(name)],), dtype=get_floatX()) - 1
         else:
-          self.targets[name] = numpy.zeros((self._num_codesteps[self.target_keys.index(name)],tdim), dtype=theano.config.floatX) - 1
+          self.targets[name] = numpy.zeros((self._num_codesteps[self.target_keys.index(name)],tdim), dtype=get_floatX()) - 1
     else:
-      self.targets = { 'classes' : numpy.zeros((self._num_timesteps,), dtype=theano.config.floatX)  }
+      self.targets = { 'classes' : numpy.zeros((self._num_timesteps,), dtype=get_floatX())  }
       self.data_dtype['classes'] = 'int32'
     self.data_dtype["data"] = fin['inputs'].dtype
     assert len(self.target_keys) == len(self._seq_lengths[0]) - 1
@@ -154,10 +154,16 @@ class HDFDataset(CachedDataset):
     gc.collect()
     assert self.is_cached(start, end)
 
+  def is_random_access(self):
+    return True
+
   def get_tag(self, sorted_seq_idx):
     ids = self._seq_index[self._index_map[sorted_seq_idx]]
     return self.tags[ids]
 
+  def get_all_tags(self):
+    return self.tags
+
   def is_data_sparse(self, key):
     if key in self.num_outputs:
       return self.num_outputs[key][1] == 1
@@ -14,6 +14,21 @@
 #define VERBOSE 1
 #define AUTO_INCREASE_SKIP 1
 
+// The ops in Inv.py align the seqs of a batch in parallel, with a dynamic OpenMP schedule.
+// Returns the seqs with the most expensive ones first, such that all threads finish at about the same time.
+std::vector<int> invSeqOrder(CArrayI& len_x, CArrayI& len_y)
+{
+    int B = len_x.dim(0);
+    std::vector<std::pair<long, int> > costs(B);
+    for(int i = 0; i < B; ++i)
+        costs[i] = std::make_pair(-(long) len_x(i) * len_y(i), i);
+    std::sort(costs.begin(), costs.end());
+    std::vector<int> order(B);
+    for(int i = 0; i < B; ++i)
+        order[i] = costs[i].second;
+    return order;
+}
+
 class Inv
 {
 public:
@@ -43,11 +58,14 @@ public:
           else if((T - M) / (N * S) > M)
           {
               M = (T - M) / (N * S) + 1;
-              static int max_skip_warning_limit = 0;
-              if(VERBOSE && M > max_skip_warning_limit)
+              #pragma omp critical(inv_max_skip_warning)
               {
-                  max_skip_warning_limit = M;
-                  cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                  static int max_skip_warning_limit = 0;
+                  if(VERBOSE && M > max_skip_warning_limit)
+                  {
+                      max_skip_warning_limit = M;
+                      cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                  }
               }
           }
         }
@@ -226,11 +244,14 @@ public:
         if(T / (N * S) > M)
         {
             M = T / (N * S) + 1;
-            static int max_skip_warning_limit = 0;
-            if(VERBOSE && M > max_skip_warning_limit)
+            #pragma omp critical(inv_max_skip_warning)
             {
-                max_skip_warning_limit = M;
-                cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                static int max_skip_warning_limit = 0;
+                if(VERBOSE && M > max_skip_warning_limit)
+                {
+                    max_skip_warning_limit = M;
+                    cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                }
             }
         }
 
@@ -435,11 +456,14 @@ public:
         if((T - M) / (N * S) > M)
         {
             M = (T - M) / (N * S) + 1;
-            static int max_skip_warning_limit = 0;
-            if(M > max_skip_warning_limit)
+            #pragma omp critical(inv_max_skip_warning)
             {
-                max_skip_warning_limit = M;
-                cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                static int max_skip_warning_limit = 0;
+                if(M > max_skip_warning_limit)
+                {
+                    max_skip_warning_limit = M;
+                    cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                }
             }
         }
 
@@ -546,11 +570,14 @@ public:
         if(T / (N * S) > M)
         {
             M = T / (N * S) + 1;
-            static int max_skip_warning_limit = 0;
-            if(M > max_skip_warning_limit)
+            #pragma omp critical(inv_max_skip_warning)
             {
-                max_skip_warning_limit = M;
-                cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                static int max_skip_warning_limit = 0;
+                if(M > max_skip_warning_limit)
+                {
+                    max_skip_warning_limit = M;
+                    cout << "warning: increasing max skip to " << M << " in order to avoid empty alignment" << endl;
+                }
             }
         }
 
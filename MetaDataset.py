@@ -3,9 +3,12 @@ from __future__ import print_function
 
 from Dataset import Dataset, DatasetSeq, init_dataset, convert_data_dims
 from CachedDataset2 import CachedDataset2
-from Util import NumbersDict, load_json
+from Util import NumbersDict, load_json, human_size
 from Log import log
 from random import Random
+from collections import deque
+import bisect
+import os
 import numpy
 
 
@@ -21,6 +24,8 @@ class MetaDataset(CachedDataset2):
                datasets,
                data_map, data_dims,
                data_dtypes=None,
+               join_index_cache_file=None,
+               parallel_load_seqs=True,
                window=1, **kwargs):
     """
     :param str seq_list_file: filename. line-separated
@@ -30,6 +35,10 @@ class MetaDataset(CachedDataset2):
       Should contain 'data' as key. Also defines the target-list, which is all except 'data'.
     :param dict[str,(int,int)] data_dims: self-data-key -> data-dimension, len(shape) (1 ==> sparse repr).
     :param dict[str,str] data_dtypes: self-data-key -> dtype. automatic if not specified
+    :param str|None join_index_cache_file: npz file where we store the join index (see _init_join_index).
+      It is keyed by the content of the seq list, the seq lens and the seq lists of the sub-datasets,
+      so it is rebuilt automatically when they change.
+    :param bool parallel_load_seqs: call load_seqs() of the sub-datasets concurrently
     """
     assert window == 1  # not implemented
     super(MetaDataset, self).__init__(**kwargs)
@@ -38,12 +47,13 @@ class MetaDataset(CachedDataset2):
     self.seq_list_original = open(seq_list_file).read().splitlines()
     self.tag_idx = {tag: idx for (idx, tag) in enumerate(self.seq_list_original)}
     self._num_seqs = len(self.seq_list_original)
+    self._seq_index = None  # type: numpy.ndarray  # sorted seq idx -> original seq idx. via init_seq_order
 
     self.data_map = data_map
     self.dataset_keys = set([m[0] for m in self.data_map.values()]); ":type: set[str]"
     self.data_keys = set(self.data_map.keys()); ":type: set[str]"
     assert "data" in self.data_keys
-    self.target_list = sorted(self.data_keys - ["data"])
+    self.target_list = sorted(self.data_keys - {"data"})
 
     data_dims = convert_data_dims(data_dims)
     self.data_dims = data_dims
@@ -55,47 +65,130 @@ class MetaDataset(CachedDataset2):
 
     self.data_dtypes = {data_key: _select_dtype(data_key, data_dims, data_dtypes) for data_key in self.data_keys}
 
-    if seq_lens_file:
-      seq_lens = load_json(filename=seq_lens_file)
-      assert isinstance(seq_lens, dict)
-      # dict[str,NumbersDict], seq-tag -> data-key -> len
-      self._seq_lens = {tag: NumbersDict(l) for (tag, l) in seq_lens.items()}
-    else:
-      self._seq_lens = None
+    # Will only init the needed datasets.
+    self.datasets = {key: init_dataset(datasets[key]) for key in self.dataset_keys}
+    self._dataset_checked_seq_end = {key: 0 for key in self.dataset_keys}  # dataset-key -> seq idx end
 
+    # data-key -> original seq idx -> len (or None without seq lens file),
+    # dataset-key -> original seq idx -> real seq idx in that dataset (for the datasets which know their tags).
+    self._seq_lens, self._seq_idx_maps = self._init_join_index(
+      seq_list_file=seq_list_file, seq_lens_file=seq_lens_file, cache_file=join_index_cache_file)
     if self._seq_lens:
-      self._num_timesteps = sum([self._seq_lens[s] for s in self.seq_list_original])
+      self._num_timesteps = NumbersDict({key: int(lens.sum()) for (key, lens) in self._seq_lens.items()})
     else:
       self._num_timesteps = None
+    self._sub_datasets_runner = _SubDatasetsRunner(parallel=parallel_load_seqs)
 
-    # Will only init the needed datasets.
-    self.datasets = {key: init_dataset(datasets[key]) for key in self.dataset_keys}
+  def _init_join_index(self, seq_list_file, seq_lens_file=None, cache_file=None):
+    """
+    The join index maps every original seq idx (i.e. the line in the seq list) to its lens,
+    and to the real seq idx in every sub-dataset which knows its tags in advance (see Dataset.get_all_tags()).
+    Having this as flat int arrays instead of a dict seq-tag -> NumbersDict
+    makes the seq ordering and get_seq_length() cheap, and it is much smaller in memory.
+    With the seq idx map, the sub-datasets get their seq order as real seq idxs,
+    thus there is no tag lookup and no tag check per seq anymore.
+    Building it needs to parse the whole seq lens json and all tags, thus we optionally cache it on disk.
+
+    :param str seq_list_file:
+    :param str|None seq_lens_file:
+    :param str|None cache_file: npz file
+    :return: data-key -> original seq idx -> len (or None without seq_lens_file),
+      dataset-key -> original seq idx -> real seq idx in that dataset
+    :rtype: (dict[str,numpy.ndarray]|None, dict[str,numpy.ndarray])
+    """
+    import hashlib
+
+    def as_bytes(s):
+      return s.encode("utf8") if not isinstance(s, bytes) else s
+
+    dataset_tags = {key: dataset.get_all_tags() for (key, dataset) in self.datasets.items()}
+    dataset_tags = {key: tags for (key, tags) in dataset_tags.items() if tags is not None}
+    seq_lens_content = open(seq_lens_file).read() if seq_lens_file else None
+    h = hashlib.sha1()
+    h.update(open(seq_list_file, "rb").read())
+    if seq_lens_content is not None:
+      h.update(as_bytes(seq_lens_content))
+    for key in sorted(dataset_tags.keys()):
+      h.update(as_bytes("\n%s:\n" % key))
+      h.update(as_bytes("\n".join(dataset_tags[key])))
+    cache_key = h.hexdigest()
+    if cache_file and os.path.exists(cache_file):
+      cache = numpy.load(cache_file)
+      if str(cache["cache_key"]) == cache_key:
+        print("MetaDataset: load join index from %r" % cache_file, file=log.v4)
+        seq_lens = {key[len("lens_"):]: cache[key] for key in cache.files if key.startswith("lens_")}
+        seq_idx_maps = {key[len("map_"):]: cache[key] for key in cache.files if key.startswith("map_")}
+        return (seq_lens if seq_lens_content is not None else None), seq_idx_maps
+      print("MetaDataset: join index cache %r is outdated, rebuild" % cache_file, file=log.v4)
+
+    seq_lens = None
+    if seq_lens_content is not None:
+      seq_lens_json = load_json(content=seq_lens_content)
+      assert isinstance(seq_lens_json, dict)
+      keys = sorted(seq_lens_json[self.seq_list_original[0]].keys()) if self.seq_list_original else []
+      seq_lens = {key: numpy.zeros((self._num_seqs,), dtype="int32") for key in keys}
+      for idx, tag in enumerate(self.seq_list_original):
+        for key, l in seq_lens_json[tag].items():
+          seq_lens[key][idx] = l
+    seq_idx_maps = {}
+    for key, tags in dataset_tags.items():
+      tag_idx = {tag: idx for (idx, tag) in enumerate(tags)}
+      seq_idx_map = numpy.array([tag_idx.get(tag, -1) for tag in self.seq_list_original], dtype="int64")
+      missing = numpy.flatnonzero(seq_idx_map < 0)
+      assert len(missing) == 0, "MetaDataset: dataset %r does not have the seqs %r" % (
+        key, [self.seq_list_original[idx] for idx in missing[:10]])
+      seq_idx_maps[key] = seq_idx_map
+    if cache_file:
+      arrays = {"lens_%s" % key: v for (key, v) in (seq_lens or {}).items()}
+      arrays.update({"map_%s" % key: v for (key, v) in seq_idx_maps.items()})
+      # Write to a temp file first and rename, such that concurrent readers never see a partial file.
+      tmp_filename = "%s.tmp%i.npz" % (cache_file, os.getpid())
+      numpy.savez(tmp_filename, cache_key=numpy.array(cache_key), **arrays)
+      os.rename(tmp_filename, cache_file)
+      print("MetaDataset: stored join index in %r" % cache_file, file=log.v4)
+    return seq_lens, seq_idx_maps
 
   def init_seq_order(self, epoch=None, seq_list=None):
     need_reinit = self.epoch is None or self.epoch != epoch
     super(MetaDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
     if not need_reinit:
+      self._num_seqs = len(self.seq_list_ordered)  # CachedDataset2 resets it, but we know it in advance
       return False
 
     if seq_list:
       seq_index = [self.tag_idx[tag] for tag in seq_list]
     else:
       if self._seq_lens:
-        get_seq_len = lambda s: self._seq_lens[self.seq_list_original[s]]["data"]
+        get_seq_len = self._seq_lens["data"].__getitem__
       else:
         get_seq_len = None
-      seq_index = self.get_seq_order_for_epoch(epoch, self.num_seqs, get_seq_len)
+      seq_index = self.get_seq_order_for_epoch(epoch, len(self.seq_list_original), get_seq_len)
+    self._seq_index = numpy.array(seq_index, dtype="int64")
     self.seq_list_ordered = [self.seq_list_original[s] for s in seq_index]
+    self._num_seqs = len(self.seq_list_ordered)  # CachedDataset2 resets it, but we know it in advance
 
-    for dataset in self.datasets.values():
-      dataset.init_seq_order(epoch=epoch, seq_list=self.seq_list_ordered)
+    # The sub-datasets get the same seq order, thus their sorted seq idx is the same as ours.
+    def init_dataset_seq_order(dataset_key):
+      dataset = self.datasets[dataset_key]
+      if dataset_key in self._seq_idx_maps:
+        dataset.init_seq_order(epoch=epoch, seq_order=self._seq_idx_maps[dataset_key][self._seq_index])
+      else:
+        dataset.init_seq_order(epoch=epoch, seq_list=self.seq_list_ordered)
+    self._sub_datasets_runner.map(init_dataset_seq_order, sorted(self.datasets.keys()))
+    self._dataset_checked_seq_end = {key: 0 for key in self.dataset_keys}
     return True
 
   def _load_seqs(self, start, end):
-    for dataset in self.datasets.values():
+    def load_dataset_seqs(dataset_key):
+      dataset = self.datasets[dataset_key]
       dataset.load_seqs(start, end)
-      for seq_idx in range(start, end):
+      if dataset_key in self._seq_idx_maps:
+        return  # the join index already matched the tags
+      # Every seq only needs to be checked once per epoch.
+      for seq_idx in range(max(start, self._dataset_checked_seq_end[dataset_key]), end):
         self._check_dataset_seq(dataset, seq_idx)
+      self._dataset_checked_seq_end[dataset_key] = max(end, self._dataset_checked_seq_end[dataset_key])
+    self._sub_datasets_runner.map(load_dataset_seqs, sorted(self.datasets.keys()))
     super(MetaDataset, self)._load_seqs(start=start, end=end)
 
   def _check_dataset_seq(self, dataset, seq_idx):
@@ -129,7 +222,8 @@ class MetaDataset(CachedDataset2):
 
   def get_seq_length(self, sorted_seq_idx):
     if self._seq_lens:
-      return self._seq_lens[self.seq_list_ordered[sorted_seq_idx]]
+      idx = self._seq_index[sorted_seq_idx]
+      return NumbersDict({key: int(lens[idx]) for (key, lens) in self._seq_lens.items()})
     return super(MetaDataset, self).get_seq_length(sorted_seq_idx)
 
   def get_tag(self, sorted_seq_idx):
@@ -261,9 +355,12 @@ class ConcatDataset(CachedDataset2):
   It will go through the datasets always in order.
   """
 
-  def __init__(self, datasets, **kwargs):
+  def __init__(self, datasets, parallel_init_seq_order=True, prefetch_num_seqs=10, **kwargs):
     """
     :param list[dict[str]] datasets: list of kwargs for init_dataset
+    :param bool parallel_init_seq_order: call init_seq_order() of the sub-datasets concurrently
+    :param int prefetch_num_seqs: when we are close to the end of one sub-dataset,
+      start loading that many seqs of the next sub-dataset in the background. 0 disables it.
     """
     super(ConcatDataset, self).__init__(**kwargs)
     self.datasets = [init_dataset(d_kwargs) for d_kwargs in datasets]
@@ -274,6 +371,10 @@ class ConcatDataset(CachedDataset2):
     for ds in self.datasets[1:]:
       assert ds.num_inputs == self.num_inputs
       assert ds.num_outputs == self.num_outputs
+    self.prefetch_num_seqs = prefetch_num_seqs
+    self.dataset_seq_idx_starts = [0]  # dataset-idx -> first seq idx. only for the datasets we have reached
+    self._prefetches = {}  # type: dict[int,multiprocessing.pool.AsyncResult]  # dataset-idx -> pending prefetch
+    self._sub_datasets_runner = _SubDatasetsRunner(parallel=parallel_init_seq_order)
 
   def init_seq_order(self, epoch=None, seq_list=None):
     """
@@ -282,7 +383,8 @@ class ConcatDataset(CachedDataset2):
     """
     need_reinit = self.epoch is None or self.epoch != epoch
     super(ConcatDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
-    self.dataset_seq_idx_offsets = [0]
+    self._wait_for_prefetches()
+    self.dataset_seq_idx_starts = [0]
     if not need_reinit:
       return False
 
@@ -290,7 +392,7 @@ class ConcatDataset(CachedDataset2):
       seq_lists = []
       for dataset in self.datasets:
         # This depends on the num_seqs of our childs.
-        seq_lists += seq_list[:dataset.num_seqs]
+        seq_lists.append(seq_list[:dataset.num_seqs])
         seq_list = seq_list[dataset.num_seqs:]
       assert len(seq_list) == 0  # we have consumed all
     else:
@@ -300,45 +402,75 @@ class ConcatDataset(CachedDataset2):
         raise NotImplementedError("seq_ordering %s" % self.seq_ordering)
 
     assert len(seq_lists) == len(self.datasets)
-    for dataset, sub_list in zip(self.datasets, seq_lists):
-      dataset.init_seq_order(epoch=epoch, seq_list=sub_list)
+    self._sub_datasets_runner.map(
+      lambda args: args[0].init_seq_order(epoch=epoch, seq_list=args[1]),
+      list(zip(self.datasets, seq_lists)))
     return True
 
+  def _wait_for_prefetches(self, dataset_idx=None):
+    """
+    :param int|None dataset_idx: if None, wait for all
+    """
+    for idx in sorted(self._prefetches.keys()):
+      if dataset_idx is None or idx == dataset_idx:
+        # This reraises any exception from the prefetch.
+        self._prefetches.pop(idx).get()
+
+  def _maybe_prefetch_next(self, dataset_idx, dataset_seq_idx_end):
+    """
+    :param int dataset_idx: the dataset we are currently loading from
+    :param int dataset_seq_idx_end: the seq idx end within that dataset which we have loaded
+    """
+    next_idx = dataset_idx + 1
+    if self.prefetch_num_seqs <= 0 or next_idx >= len(self.datasets):
+      return
+    if next_idx < len(self.dataset_seq_idx_starts) or next_idx in self._prefetches:
+      return  # already reached or prefetching
+    if self.datasets[dataset_idx].is_less_than_num_seqs(dataset_seq_idx_end + self.prefetch_num_seqs):
+      return  # not close to the end yet
+    next_dataset = self.datasets[next_idx]
+    self._prefetches[next_idx] = self._sub_datasets_runner.apply_async(
+      next_dataset.load_seqs, (0, self.prefetch_num_seqs))
+
   def _get_dataset_for_seq_idx(self, seq_idx):
-    i = 0
-    while i < len(self.dataset_seq_idx_offsets):
-      if seq_idx + self.dataset_seq_idx_offsets[i] < 0:
-        return i - 1
-      i += 1
-    return i - 1
+    """
+    :param int seq_idx:
+    :return: dataset-idx. only considers the datasets we have reached so far
+    :rtype: int
+    """
+    return bisect.bisect_right(self.dataset_seq_idx_starts, seq_idx) - 1
 
   def _load_seqs(self, start, end):
     sub_start = start
     # We maybe need to call load_seqs on several of our datasets, thus we need this loop.
     while True:
       dataset_idx = self._get_dataset_for_seq_idx(sub_start)
+      self._wait_for_prefetches(dataset_idx)
       dataset = self.datasets[dataset_idx]
-      dataset_seq_idx_start = sub_start + self.dataset_seq_idx_offsets[dataset_idx]
-      dataset_seq_idx_end = end + self.dataset_seq_idx_offsets[dataset_idx]
+      dataset_seq_idx_start = sub_start - self.dataset_seq_idx_starts[dataset_idx]
+      dataset_seq_idx_end = end - self.dataset_seq_idx_starts[dataset_idx]
       dataset.load_seqs(dataset_seq_idx_start, dataset_seq_idx_end)
       if dataset.is_less_than_num_seqs(dataset_seq_idx_end):
         # We are still inside this dataset and have loaded everything.
         # Thus we can stop now.
+        self._maybe_prefetch_next(dataset_idx, dataset_seq_idx_end)
         break
       # We have reached the end of the dataset.
       if dataset_idx + 1 == len(self.datasets):
         # We are at the last dataset.
         break
       # Continue with the next one.
-      self.dataset_seq_idx_offsets[dataset_idx + 1:dataset_idx + 2] = [
-        self.dataset_seq_idx_offsets[dataset_idx] - dataset.num_seqs]
-      sub_start = -self.dataset_seq_idx_offsets[dataset_idx + 1]
+      self.dataset_seq_idx_starts[dataset_idx + 1:dataset_idx + 2] = [
+        self.dataset_seq_idx_starts[dataset_idx] + dataset.num_seqs]
+      sub_start = self.dataset_seq_idx_starts[dataset_idx + 1]
     super(ConcatDataset, self)._load_seqs(start=start, end=end)
 
   def _collect_single_seq(self, seq_idx):
     dataset_idx = self._get_dataset_for_seq_idx(seq_idx)
     dataset = self.datasets[dataset_idx]
-    dataset_seq_idx = seq_idx + self.dataset_seq_idx_offsets[dataset_idx]
+    dataset_seq_idx = seq_idx - self.dataset_seq_idx_starts[dataset_idx]
+    if not dataset.is_less_than_num_seqs(dataset_seq_idx):
+      return None  # end of the last dataset
     seq_tag = dataset.get_tag(dataset_seq_idx)
     features = dataset.get_input_data(dataset_seq_idx)
     targets = {k: dataset.get_targets(k, dataset_seq_idx) for k in dataset.get_target_list()}
@@ -368,6 +500,7 @@ class CombinedDataset(CachedDataset2):
                datasets,
                data_map, data_dims,
                data_dtypes=None,
+               parallel_load_seqs=True,
                window=1, **kwargs):
     """
     :param dict[str,dict[str]] datasets: dataset-key -> dataset-kwargs. including keyword 'class' and maybe 'files'
@@ -375,6 +508,7 @@ class CombinedDataset(CachedDataset2):
       Should contain 'data' as key. Also defines the target-list, which is all except 'data'.
     :param dict[str,(int,int)] data_dims: self-data-key -> data-dimension, len(shape) (1 ==> sparse repr).
     :param dict[str,str] data_dtypes: self-data-key -> dtype. automatic if not specified
+    :param bool parallel_load_seqs: call load_seqs() of the sub-datasets concurrently
     """
     assert window == 1  # not implemented
     super(CombinedDataset, self).__init__(**kwargs)
@@ -410,6 +544,7 @@ class CombinedDataset(CachedDataset2):
 
     # Will only init the needed datasets.
     self.datasets = {key: init_dataset(datasets[key]) for key in self.dataset_keys}
+    self._sub_datasets_runner = _SubDatasetsRunner(parallel=parallel_load_seqs)
 
     try:
       self._num_seqs = sum([self.datasets[k].num_seqs for k in sorted(self.datasets.keys())])
@@ -424,32 +559,32 @@ class CombinedDataset(CachedDataset2):
 
   def _canonical_seqs_dataset_idxs(self):
     """
-    :returns: list of dataset-idx, via self.dataset_idxs, so that we cover the sum of num-seqs
-    :rtype: list[int]
+    :returns: dataset-idx, via self.dataset_idxs, so that we cover the sum of num-seqs
+    :rtype: numpy.ndarray
     """
-    l = []
-    for i in range(len(self.datasets)):
-      dataset = self.datasets[self.dataset_idxs[i]]
-      l += [i] * dataset.num_seqs
-    return l
+    num_seqs = [self.datasets[self.dataset_idxs[i]].num_seqs for i in range(len(self.datasets))]
+    return numpy.repeat(numpy.arange(len(self.datasets), dtype="int64"), num_seqs)
 
   def _dataset_seq_idxs(self, seqs_dataset_idx):
     """
-    :returns: list of (dataset-idx, dataset-seq-idx)
-    :rtype: list[(int,int)]
+    :param numpy.ndarray seqs_dataset_idx: seq-idx -> dataset-idx
+    :returns: seq-idx -> (dataset-idx, dataset-seq-idx)
+    :rtype: numpy.ndarray
     """
-    l = []
-    seq_idx_counter = [0] * len(self.datasets)  # dataset-idx -> dataset-seq-idx
-    for dataset_idx in seqs_dataset_idx:
-      seq_idx = seq_idx_counter[dataset_idx]
-      seq_idx_counter[dataset_idx] += 1
-      l += [(dataset_idx, seq_idx)]
-    return l
+    seqs_dataset_idx = numpy.asarray(seqs_dataset_idx, dtype="int64")
+    dataset_seq_idx = numpy.zeros_like(seqs_dataset_idx)
+    for i in range(len(self.datasets)):
+      mask = seqs_dataset_idx == i
+      dataset_seq_idx[mask] = numpy.arange(numpy.count_nonzero(mask))
+    return numpy.column_stack([seqs_dataset_idx, dataset_seq_idx])
 
   def init_seq_order(self, epoch=None, seq_list=None):
     assert seq_list is None, "seq_list not supported for %s" % self.__class__
     need_reinit = self.epoch is None or self.epoch != epoch
+    num_seqs = self._num_seqs
     super(CombinedDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    if self.know_num_seqs_beforehand:
+      self._num_seqs = num_seqs  # CachedDataset2 resets it, but we know it in advance
     if not need_reinit:
       return False
 
@@ -460,11 +595,13 @@ class CombinedDataset(CachedDataset2):
 
       seqs_dataset_idx = self._canonical_seqs_dataset_idxs()
       if self.seq_ordering in ("default", "random"):  # default is random. this is different from base class!
+        # Shuffle as a list, which is faster with Random.shuffle, and keeps the same order as before.
+        seqs_dataset_idx = seqs_dataset_idx.tolist()
         self.rnd.shuffle(seqs_dataset_idx)
       elif self.seq_ordering == "in-order":
         pass  # keep as-is
       elif self.seq_ordering == "reversed":
-        seqs_dataset_idx = reversed(seqs_dataset_idx)
+        seqs_dataset_idx = seqs_dataset_idx[::-1]
       else:
         raise Exception("seq_ordering %s not supported" % self.seq_ordering)
 
@@ -475,8 +612,7 @@ class CombinedDataset(CachedDataset2):
       self.dataset_seq_idxs = [] #We will fill this as we go
       self.used_num_seqs_per_subset = [0] * len(self.datasets)
 
-    for dataset in self.datasets.values():
-      dataset.init_seq_order(epoch=epoch)
+    self._sub_datasets_runner.map(lambda dataset: dataset.init_seq_order(epoch=epoch), list(self.datasets.values()))
     return True
 
   def _expand_dataset_sec_idxs(self, num_values):
@@ -545,15 +681,16 @@ class CombinedDataset(CachedDataset2):
     if not self.know_num_seqs_beforehand and end > len(self.dataset_seq_idxs):
       self._expand_dataset_sec_idxs(end-len(self.dataset_seq_idxs))
 
-    requested_seqs = self.dataset_seq_idxs[start:end]
+    requested_seqs = numpy.array(self.dataset_seq_idxs[start:end], dtype="int64").reshape((-1, 2))
 
+    sub_loads = []  # list of (dataset, sub_start, sub_end)
     for i in range(len(self.datasets)):
       dataset = self.datasets[self.dataset_idxs[i]]
-      sub_requested_seqs = [s[1] for s in requested_seqs if s[0]==i]
-      if sub_requested_seqs == []:
+      sub_requested_seqs = requested_seqs[requested_seqs[:, 0] == i, 1]
+      if len(sub_requested_seqs) == 0:
         continue
-      sub_start, sub_end = min(sub_requested_seqs), max(sub_requested_seqs)
-      dataset.load_seqs(sub_start, sub_end+1)
+      sub_loads.append((dataset, int(sub_requested_seqs.min()), int(sub_requested_seqs.max()) + 1))
+    self._sub_datasets_runner.map(lambda args: args[0].load_seqs(args[1], args[2]), sub_loads)
     super(CombinedDataset, self)._load_seqs(start=start, end=end)
 
   def _check_dataset_seq(self, dataset, seq_idx): # TODO this check makes no sense here
@@ -587,7 +724,7 @@ class CombinedDataset(CachedDataset2):
     """
     if not self.is_less_than_num_seqs(seq_idx):
       return None
-    dataset_idx, dataset_seq_idx = self.dataset_seq_idxs[seq_idx]
+    dataset_idx, dataset_seq_idx = [int(i) for i in self.dataset_seq_idxs[seq_idx]]
     dataset_key = self.dataset_idxs[dataset_idx]
     dataset = self.datasets[dataset_key]
 
@@ -622,22 +759,29 @@ class CombinedDataset(CachedDataset2):
 
 class ChunkShuffleDataset(CachedDataset2):
   """
-  This goes through a dataset, caches some recent chunks
+  This goes through a dataset, caches some recent chunks, and returns them in random order.
+  The shuffle window is a preallocated ring buffer of frames (see _FramesRingBuffer),
+  thus the memory usage is bounded by chunk_shuffle_buffer_size_mb, no matter how long the epoch is.
   """
 
   def __init__(self, dataset,
                chunk_shuffle_cache=1000,
+               chunk_shuffle_buffer_size_mb=512,
                batch_gen_batch_size=5000, batch_gen_max_seqs=1,
                batch_gen_recurrent_net=True,
                **kwargs):
     """
     :param dict[str] dataset: kwargs for init_dataset
+    :param int chunk_shuffle_cache: max number of chunks in the shuffle window
+    :param int|float chunk_shuffle_buffer_size_mb: size of the shuffle window (all data-keys together), in MB
     """
     super(ChunkShuffleDataset, self).__init__(**kwargs)
     self.dataset = init_dataset(dataset)
     assert self.dataset
     self.dataset_last_load_seq_end = None
     self.chunk_shuffle_cache = chunk_shuffle_cache
+    self.chunk_shuffle_buffer_size_bytes = int(chunk_shuffle_buffer_size_mb * 1024 * 1024)
+    assert self.chunk_shuffle_buffer_size_bytes > 0
     self.batch_gen = None
     self.batch_gen_batch_size = batch_gen_batch_size
     self.batch_gen_max_seqs = batch_gen_max_seqs
@@ -646,7 +790,12 @@ class ChunkShuffleDataset(CachedDataset2):
     self.num_outputs = self.dataset.num_outputs
     self.labels = self.dataset.labels
     self.rng = Random(0)
-    self.load_seqs_end = None
+    self.ring_buffers = {}  # type: dict[str,_FramesRingBuffer]  # data-key -> buffer. created with the first chunk
+    self._fetched_chunks = deque()  # type: deque[(str,dict[str,numpy.ndarray])]  # not yet in the ring buffer
+    self._window = []  # type: list[(str,dict[str,int|None])]  # (tag, key -> ring buffer handle)
+    self._seq_ring_handles = {}  # type: dict[int,dict[str,int|None]]  # seq idx -> key -> handle, for delivered seqs
+    self._num_chunks = 0
+    self._num_delivered = 0
 
   def init_seq_order(self, epoch=None, seq_list=None):
     """
@@ -655,9 +804,15 @@ class ChunkShuffleDataset(CachedDataset2):
     """
     need_reinit = self.epoch is None or self.epoch != epoch
     super(ChunkShuffleDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
-    self.load_seqs_end = 0
     self.dataset_last_load_seq_end = 0
     self.rng.seed(epoch or 1)
+    for ring_buffer in self.ring_buffers.values():
+      ring_buffer.clear()
+    self._fetched_chunks = deque()
+    self._window = []
+    self._seq_ring_handles = {}
+    self._num_chunks = 0
+    self._num_delivered = 0
     if not need_reinit:
       return False
 
@@ -672,43 +827,11 @@ class ChunkShuffleDataset(CachedDataset2):
                                                    max_seqs=self.batch_gen_max_seqs)
     return True
 
-  def _add_data(self, data, original_tag):
+  def _fetch_more(self):
     """
-    :type data: dict[str,numpy.ndarray]
-    :type original_tag: str
-    """
-    features = data["data"]
-    if not self.added_data:
-      seq_idx = 0
-      assert self.expected_load_seq_start == 0
-    else:
-      seq_idx = self.added_data[-1].seq_idx + 1
-    tag = "%s.%i" % (original_tag, seq_idx)
-    seq = DatasetSeq(seq_idx=seq_idx, features=features, targets=data, seq_tag=tag)
-    self._num_timesteps_accumulated += seq.num_frames
-    self.added_data += [seq]
-
-  def _shuffle(self):
-    start_seq_idx = self.added_data[0].seq_idx
-    end_seq_idx = self.added_data[-1].seq_idx
-    assert start_seq_idx < self.load_seqs_end < end_seq_idx
-    start_idx = 0
-    if start_seq_idx < self.load_seqs_end:
-      start_idx = self.load_seqs_end - start_seq_idx
-      assert self.added_data[start_idx].seq_idx == self.load_seqs_end
-      start_seq_idx = self.load_seqs_end
-    sublist = self.added_data[start_idx:]
-    self.rng.shuffle(sublist)
-    for i, seq in enumerate(sublist):
-      seq.seq_idx = i + start_seq_idx
-    assert sublist[-1].seq_idx == end_seq_idx
-    self.added_data[start_idx:] = sublist
-
-  def _add_more(self):
-    """
-    Adds each chunk/batch seq as a single DatasetSeq.
+    Fetches the next batch from the dataset, where each chunk/batch seq is one chunk for us.
     See EngineUtil.assign_dev_data() for comparison.
-    :returns whether we added some more
+    :returns whether we fetched some more
     """
     if not self.batch_gen.has_more(): return False
     batches = self.batch_gen.peek_next_n(1)
@@ -726,27 +849,113 @@ class ChunkShuffleDataset(CachedDataset2):
           if data is not None:
             res_data[k] = data[seq.seq_start_frame[k]:seq.seq_end_frame[k]]
         original_tag = self.dataset.get_tag(seq.seq_idx)
-        self._add_data(data=res_data, original_tag=original_tag)
+        self._fetched_chunks.append((original_tag, res_data))
 
     self.batch_gen.advance(len(batches))
     return True
 
-  def _add_more_until(self, end, shuffle=False):
-    if self.added_data and end <= self.added_data[-1].seq_idx: return True
-    while self._add_more():
-      assert self.added_data
-      if end <= self.added_data[-1].seq_idx:
-        if shuffle:
-          self._shuffle()
-        return True
-    # We have reached the end.
-    if not self.added_data:
-      self._num_seqs = 0
-      print("warning: empty dataset", file=log.v3)
-    else:
-      self._num_seqs = self.added_data[-1].seq_idx + 1
-    self.reached_final_seq = True
-    return False
+  def _init_ring_buffers(self, data):
+    """
+    :param dict[str,numpy.ndarray] data: some chunk, to get the dtypes and shapes
+    """
+    frame_bytes = {k: v.dtype.itemsize * int(numpy.prod(v.shape[1:])) for (k, v) in data.items()}
+    num_frames = max(self.chunk_shuffle_buffer_size_bytes // max(sum(frame_bytes.values()), 1), 1)
+    print("ChunkShuffleDataset: shuffle buffer of %i frames (%s bytes)" % (
+      num_frames, human_size(num_frames * sum(frame_bytes.values()))), file=log.v4)
+    self.ring_buffers = {
+      k: _FramesRingBuffer(num_frames=num_frames, frame_shape=v.shape[1:], dtype=v.dtype)
+      for (k, v) in data.items()}
+
+  def _add_to_window(self, original_tag, data):
+    """
+    Copies the chunk into the ring buffers.
+
+    :param str original_tag:
+    :param dict[str,numpy.ndarray] data:
+    :return: whether there was enough space
+    :rtype: bool
+    """
+    if not self.ring_buffers:
+      self._init_ring_buffers(data)
+    if not all([self.ring_buffers[k].can_alloc(v.shape[0]) for (k, v) in data.items()]):
+      return False
+    handles = {}
+    for k, v in data.items():
+      handles[k] = self.ring_buffers[k].alloc(v.shape[0])
+      self.ring_buffers[k].get(handles[k])[...] = v
+    tag = "%s.%i" % (original_tag, self._num_chunks)
+    self._num_chunks += 1
+    self._window.append((tag, handles))
+    return True
+
+  def _fill_window(self):
+    """
+    Fills up the shuffle window, as far as the ring buffers and chunk_shuffle_cache allow.
+    """
+    while len(self._window) < self.chunk_shuffle_cache:
+      if not self._fetched_chunks:
+        if not self._fetch_more():
+          return
+        continue
+      original_tag, data = self._fetched_chunks[0]
+      if not self._add_to_window(original_tag=original_tag, data=data):
+        if self._window:
+          return  # Buffer is full. Wait until some chunks have been consumed.
+        # The chunk does not fit even though the window is empty,
+        # i.e. the currently loaded seqs occupy the whole buffer. We must grow it.
+        for k, v in data.items():
+          self.ring_buffers[k].grow(min_free_frames=v.shape[0])
+        print("ChunkShuffleDataset: warning: shuffle buffer too small, grow to %i frames" % (
+          max([b.num_frames for b in self.ring_buffers.values()])), file=log.v3)
+        continue
+      self._fetched_chunks.popleft()
+
+  def _deliver_next(self):
+    """
+    Takes a random chunk out of the shuffle window and makes it the next seq.
+    The seq data are views into the ring buffers, which stay valid until the seq is cleaned up.
+
+    :return: whether we had some chunk left
+    :rtype: bool
+    """
+    self._fill_window()
+    if not self._window:
+      return False
+    i = self.rng.randint(0, len(self._window) - 1)
+    self._window[i], self._window[-1] = self._window[-1], self._window[i]
+    tag, handles = self._window.pop()
+    seq_idx = self._num_delivered
+    self._num_delivered += 1
+    data = {k: self.ring_buffers[k].get(handle) for (k, handle) in handles.items()}
+    seq = DatasetSeq(seq_idx=seq_idx, features=data["data"], targets=data, seq_tag=tag)
+    self._seq_ring_handles[seq_idx] = handles
+    self._num_timesteps_accumulated += seq.num_frames
+    self.added_data += [seq]
+    return True
+
+  def _deliver_until(self, end):
+    """
+    :param int end: exclusive seq idx end
+    :return: whether we have delivered all seqs until end
+    :rtype: bool
+    """
+    while self._num_delivered < end:
+      if not self._deliver_next():
+        # We have reached the end.
+        self._num_seqs = self._num_delivered
+        if self._num_seqs == 0:
+          print("warning: empty dataset", file=log.v3)
+        self.reached_final_seq = True
+        return False
+    return True
+
+  def _cleanup_old_seqs(self, seq_idx_end):
+    for seq in self.added_data:
+      if seq.seq_idx >= seq_idx_end:
+        break
+      for k, handle in self._seq_ring_handles.pop(seq.seq_idx).items():
+        self.ring_buffers[k].free(handle)
+    super(ChunkShuffleDataset, self)._cleanup_old_seqs(seq_idx_end)
 
   def is_less_than_num_seqs(self, seq_idx):
     """
@@ -756,9 +965,8 @@ class ChunkShuffleDataset(CachedDataset2):
     until it knows that n is behind the end or that we have the seq.
     """
     if self._num_seqs is not None: return seq_idx < self._num_seqs
-    if seq_idx < self.expected_load_seq_start: return True
-    if self.added_data and seq_idx <= self.added_data[-1].seq_idx: return True
-    return self._add_more_until(seq_idx)
+    if seq_idx < self._num_delivered: return True
+    return self._deliver_until(seq_idx + 1)
 
   def _load_seqs(self, start, end):
     """
@@ -770,11 +978,10 @@ class ChunkShuffleDataset(CachedDataset2):
     # This will already be called with _load_seqs_superset indices.
     assert start >= self.expected_load_seq_start
     if start > self.expected_load_seq_start:
-      # Cleanup old data.
+      # Cleanup old data. This frees their space in the ring buffers.
       self._cleanup_old_seqs(start)
       self.expected_load_seq_start = start
-    self.load_seqs_end = end
-    self._add_more_until(end + self.chunk_shuffle_cache, shuffle=True)
+    self._deliver_until(end)
 
   def _collect_single_seq(self, seq_idx):
     """
@@ -787,6 +994,168 @@ class ChunkShuffleDataset(CachedDataset2):
     return self.dataset.get_target_list()
 
 
+class _FramesRingBuffer(object):
+  """
+  Preallocated ring buffer of frames of one data-key, for ChunkShuffleDataset.
+  Chunks are allocated as contiguous ranges of frames, going around the buffer (next-fit).
+  Because of the shuffling, chunks are freed in random order. Freed space is reused
+  as soon as the allocation cursor comes by, i.e. we do not need to wait for the oldest chunk.
+  """
+
+  def __init__(self, num_frames, frame_shape, dtype):
+    """
+    :param int num_frames: capacity
+    :param tuple[int] frame_shape: shape of a single frame, e.g. () for sparse or (dim,)
+    :param numpy.dtype|str dtype:
+    """
+    self.num_frames = num_frames
+    self.buffer = numpy.empty((num_frames,) + tuple(frame_shape), dtype=dtype)
+    self.allocs = {}  # type: dict[int,(int,int)]  # handle -> (offset, len)
+    self.used_starts = []  # type: list[int]  # sorted offsets of the allocs
+    self.used_ends = []  # type: list[int]  # offset + len, same order as used_starts
+    self.cursor = 0
+    self.next_handle = 0
+
+  def clear(self):
+    self.allocs.clear()
+    self.used_starts = []
+    self.used_ends = []
+    self.cursor = 0
+
+  def _find_offset(self, n):
+    """
+    :param int n: num frames, > 0
+    :return: offset where we can allocate n frames, or None
+    :rtype: int|None
+    """
+    # Free gaps, in order of the offsets.
+    gaps = list(zip([0] + self.used_ends, self.used_starts + [self.num_frames]))
+    # First look behind the cursor, then wrap around.
+    for gap_start, gap_end in gaps:
+      if gap_end - max(gap_start, self.cursor) >= n:
+        return max(gap_start, self.cursor)
+    for gap_start, gap_end in gaps:
+      if gap_start >= self.cursor:
+        break
+      if min(gap_end, self.cursor) - gap_start >= n:
+        return gap_start
+    return None
+
+  def can_alloc(self, n):
+    """
+    :param int n: num frames
+    :rtype: bool
+    """
+    return n == 0 or self._find_offset(n) is not None
+
+  def alloc(self, n):
+    """
+    :param int n: num frames
+    :return: handle, for get() and free(). None for empty chunks, which do not use any space
+    :rtype: int|None
+    """
+    if n == 0:
+      return None
+    offset = self._find_offset(n)
+    assert offset is not None, "ring buffer full"
+    i = bisect.bisect_left(self.used_starts, offset)
+    self.used_starts.insert(i, offset)
+    self.used_ends.insert(i, offset + n)
+    self.cursor = offset + n
+    handle = self.next_handle
+    self.next_handle += 1
+    self.allocs[handle] = (offset, n)
+    return handle
+
+  def free(self, handle):
+    """
+    :param int|None handle: like returned by alloc()
+    """
+    if handle is None:
+      return
+    offset, _ = self.allocs.pop(handle)
+    i = bisect.bisect_left(self.used_starts, offset)
+    assert self.used_starts[i] == offset
+    del self.used_starts[i]
+    del self.used_ends[i]
+
+  def get(self, handle):
+    """
+    :param int|None handle: like returned by alloc()
+    :return: view, no copy
+    :rtype: numpy.ndarray
+    """
+    if handle is None:
+      return self.buffer[:0]
+    offset, n = self.allocs[handle]
+    return self.buffer[offset:offset + n]
+
+  def grow(self, min_free_frames):
+    """
+    Enlarges the buffer such that there is at least min_free_frames space at the end.
+    Only used when the ring buffer is too small for what is currently in use.
+    Views which were returned by get() before still refer to the old buffer, which stays valid.
+
+    :param int min_free_frames:
+    """
+    old_num_frames = self.num_frames
+    self.num_frames = max(old_num_frames * 2, old_num_frames + min_free_frames)
+    new_buffer = numpy.empty((self.num_frames,) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+    new_buffer[:old_num_frames] = self.buffer
+    self.buffer = new_buffer
+
+
+class _SubDatasetsRunner(object):
+  """
+  Runs some function (e.g. load_seqs) on multiple independent sub-datasets concurrently.
+  The sub-datasets mostly wait for I/O (HDF files, Sprint caches, LM text),
+  which releases the GIL, so threads are sufficient here.
+  """
+
+  def __init__(self, parallel=True):
+    """
+    :param bool parallel: if False, we just run everything in the calling thread
+    """
+    self.parallel = parallel
+    self.pool = None  # type: multiprocessing.pool.ThreadPool
+    self.pool_num_threads = 0
+
+  def map(self, func, items):
+    """
+    :param (T)->R func:
+    :param list[T] items:
+    :return: like map(func, items). exceptions are reraised in the calling thread
+    :rtype: list[R]
+    """
+    if not self.parallel or len(items) <= 1:
+      return [func(item) for item in items]
+    self._ensure_pool(num_threads=len(items))
+    return self.pool.map(func, items)
+
+  def apply_async(self, func, args=()):
+    """
+    Runs func in the background, even if not self.parallel.
+
+    :param (...)->R func:
+    :param tuple args:
+    :return: async result. call get() on it to wait for it. exceptions are reraised from there
+    :rtype: multiprocessing.pool.AsyncResult
+    """
+    self._ensure_pool(num_threads=1)
+    return self.pool.apply_async(func, args)
+
+  def _ensure_pool(self, num_threads):
+    """
+    :param int num_threads: min number of threads
+    """
+    if self.pool_num_threads < num_threads:
+      from multiprocessing.pool import ThreadPool
+      if self.pool is not None:
+        self.pool.close()  # pending tasks still finish
+      self.pool = ThreadPool(processes=num_threads)
+      self.pool_num_threads = num_threads
+
+
 def _simple_to_bool(v):
   if v == 0: v = False
   if v == 1: v = True
@@ -1,4 +1,5 @@
 
+import sys
 import numpy
 import theano
 import theano.sandbox.cuda
@@ -157,7 +158,7 @@ def _naive_multi_batch_beam_grad(array, start_idxs, batch_lens, beam_width, wrap
         if idx >= batch_lens[i1]:
           D_pad_right += D_beam[i0, i1]
           continue
-      D_array[idx, i1] = D_beam[i0, i1]
+      D_array[idx, i1] += D_beam[i0, i1]
 
   if wrap_mode == "pad":
     if D_pad_left.ndim > pad_left.ndim:
@@ -205,6 +206,102 @@ def _theano_cpu_multi_batch_beam_grad(array, start_idxs, batch_lens, beam_width,
   return D_array, D_pad_left, D_pad_right
 
 
+# C++ support code for the CPU implementations (c_code) of MultiBatchBeamOp and MultiBatchBeamGradAddOp.
+# Both ops only support the (time,batch,...) format (idx_dim == 0, batch_dim == 1) in C,
+# otherwise they fall back to perform().
+# The same string for both ops, so that Theano can merge it if they end up in the same module.
+c_support_code_multi_batch_beam = """
+#include <vector>
+#include <algorithm>
+#include <cmath>
+
+// Like numpy.round (round half to even, in the default rounding mode), for float indices (e.g. from the GPU).
+template<typename T> inline long multi_batch_beam_index(T x) { return (long) x; }
+template<> inline long multi_batch_beam_index<float>(float x) { return (long) nearbyintf(x); }
+template<> inline long multi_batch_beam_index<double>(double x) { return (long) nearbyint(x); }
+
+// Only use multiple threads (over the batch) if there are at least that many elements to copy.
+static const long multi_batch_beam_min_parallel_work = 4096;
+
+// For every (beam,batch), the index in the time dim of the array, or -1 / -2 for the left / right padding.
+// Returns false and sets the Python exception on invalid input.
+template<typename TStart, typename TLen>
+static bool multi_batch_beam_idxs(
+  PyArrayObject* start_idxs, PyArrayObject* batch_lens, long beam_width, long n_time, bool wrap_around,
+  std::vector<long>& idxs)
+{
+  const long n_batch = PyArray_DIM(start_idxs, 0);
+  if(PyArray_DIM(batch_lens, 0) != n_batch) {
+    PyErr_Format(PyExc_ValueError, "MultiBatchBeam: start_idxs and batch_lens have different len: %ld vs %ld",
+      n_batch, (long) PyArray_DIM(batch_lens, 0));
+    return false;
+  }
+  if(beam_width < 0) {
+    PyErr_Format(PyExc_ValueError, "MultiBatchBeam: invalid beam_width %ld", beam_width);
+    return false;
+  }
+  idxs.resize(beam_width * n_batch);
+  for(long b = 0; b < n_batch; ++b) {
+    long start = multi_batch_beam_index(*(TStart*) PyArray_GETPTR1(start_idxs, b));
+    long len = multi_batch_beam_index(*(TLen*) PyArray_GETPTR1(batch_lens, b));
+    if(wrap_around && len <= 0) {
+      PyErr_Format(PyExc_ValueError, "MultiBatchBeam: batch_lens[%ld] = %ld, must be positive", b, len);
+      return false;
+    }
+    for(long i0 = 0; i0 < beam_width; ++i0) {
+      long idx = start + i0;
+      if(wrap_around) {
+        idx %= len;
+        if(idx < 0) idx += len;  // like Python modulo
+      }
+      else if(idx < 0) { idxs[i0 * n_batch + b] = -1; continue; }
+      else if(idx >= len) { idxs[i0 * n_batch + b] = -2; continue; }
+      if(idx >= n_time) {
+        PyErr_Format(PyExc_IndexError, "MultiBatchBeam: index %ld out of range for time dim %ld in batch %ld",
+          idx, n_time, b);
+        return false;
+      }
+      idxs[i0 * n_batch + b] = idx;
+    }
+  }
+  return true;
+}
+
+// Broadcasts pad (aligned to the last dims) to the dims after (time,batch) of array, casted to T.
+// Returns false and sets the Python exception on invalid input.
+template<typename T, typename TPad>
+static bool multi_batch_beam_pad_block(PyArrayObject* pad, PyArrayObject* array, std::vector<T>& block)
+{
+  const int nd = PyArray_NDIM(array);
+  const int pad_nd = PyArray_NDIM(pad);
+  long inner = 1;
+  for(int d = 2; d < nd; ++d)
+    inner *= PyArray_DIM(array, d);
+  for(int d = nd - pad_nd; d < nd; ++d) {
+    npy_intp pad_dim = PyArray_DIM(pad, d - (nd - pad_nd));
+    if(d < 2 || (pad_dim != 1 && pad_dim != PyArray_DIM(array, d))) {
+      PyErr_SetString(PyExc_ValueError, "MultiBatchBeam: pad shape does not match the array shape");
+      return false;
+    }
+  }
+  block.resize(inner);
+  for(long j = 0; j < inner; ++j) {
+    long rest = j;
+    npy_intp offset = 0;
+    for(int d = nd - 1; d >= nd - pad_nd; --d) {
+      long i = rest % PyArray_DIM(array, d);
+      rest /= PyArray_DIM(array, d);
+      int pad_d = d - (nd - pad_nd);
+      if(PyArray_DIM(pad, pad_d) != 1)
+        offset += i * PyArray_STRIDE(pad, pad_d);
+    }
+    block[j] = (T) *(TPad*) (PyArray_BYTES(pad) + offset);
+  }
+  return true;
+}
+"""
+
+
 class MultiBatchBeamOp(theano.Op):
   __props__ = ("wrap_mode", "idx_dim", "batch_dim")
 
@@ -265,6 +362,81 @@ class MultiBatchBeamOp(theano.Op):
     beam = beam_trans.transpose(*map(array_trans_dims_order.index, range(array.ndim)))
     beam_out[0] = beam
 
+  def c_support_code(self):
+    return c_support_code_multi_batch_beam
+
+  def c_compile_args(self):
+    if sys.platform != "darwin":  # the default clang there does not support it
+      return ['-fopenmp']
+    return []
+
+  def c_code(self, node, name, inp, out, sub):
+    array, start_idxs, batch_lens, beam_width, pad_left, pad_right = inp
+    beam, = out
+    fail = sub['fail']
+    array_var, _, _, _, pad_left_var, pad_right_var = node.inputs
+    if self.idx_dim != 0 or self.batch_dim != 1:
+      raise NotImplementedError("MultiBatchBeamOp: C code only for (time,batch,...)")  # will use perform()
+    if array_var.dtype.startswith("complex"):
+      raise NotImplementedError("MultiBatchBeamOp: C code not for complex")
+    if self.wrap_mode == "pad" and max(pad_left_var.ndim, pad_right_var.ndim) > array_var.ndim - 2:
+      raise NotImplementedError("MultiBatchBeamOp: C code only with pad values for the dims after (time,batch)")
+    wrap_around = int(self.wrap_mode == "wrap_around")
+    return """
+      {
+        const long beam_width = multi_batch_beam_index(*(dtype_%(beam_width)s*) PyArray_DATA(%(beam_width)s));
+        PyArrayObject* array = PyArray_GETCONTIGUOUS(%(array)s);
+        const int nd = PyArray_NDIM(array);
+        const long n_time = PyArray_DIM(array, 0);
+        const long n_batch = PyArray_DIM(array, 1);
+        long inner = 1;
+        for(int d = 2; d < nd; ++d)
+          inner *= PyArray_DIM(array, d);
+        std::vector<long> idxs;
+        std::vector<dtype_%(array)s> pad_left, pad_right;
+        bool ok = true;
+        if(PyArray_DIM(%(start_idxs)s, 0) != n_batch) {
+          PyErr_Format(PyExc_ValueError, "MultiBatchBeamOp: start_idxs len %%ld does not match n_batch %%ld",
+            (long) PyArray_DIM(%(start_idxs)s, 0), n_batch);
+          ok = false;
+        }
+        ok = ok && multi_batch_beam_idxs<dtype_%(start_idxs)s, dtype_%(batch_lens)s>(
+          %(start_idxs)s, %(batch_lens)s, beam_width, n_time, %(wrap_around)i, idxs);
+        if(ok && !%(wrap_around)i)
+          ok = multi_batch_beam_pad_block<dtype_%(array)s, dtype_%(pad_left)s>(%(pad_left)s, array, pad_left) &&
+            multi_batch_beam_pad_block<dtype_%(array)s, dtype_%(pad_right)s>(%(pad_right)s, array, pad_right);
+        if(ok) {
+          std::vector<npy_intp> dims(PyArray_DIMS(array), PyArray_DIMS(array) + nd);
+          dims[0] = beam_width;
+          Py_XDECREF(%(beam)s);
+          %(beam)s = (PyArrayObject*) PyArray_EMPTY(nd, &dims[0], PyArray_TYPE(array), 0);
+          ok = %(beam)s != NULL;
+        }
+        if(ok && beam_width * n_batch * inner > 0) {
+          const dtype_%(array)s* src = (dtype_%(array)s*) PyArray_DATA(array);
+          dtype_%(array)s* dst = (dtype_%(array)s*) PyArray_DATA(%(beam)s);
+          #pragma omp parallel for if(beam_width * n_batch * inner >= multi_batch_beam_min_parallel_work)
+          for(long b = 0; b < n_batch; ++b) {
+            for(long i0 = 0; i0 < beam_width; ++i0) {
+              long idx = idxs[i0 * n_batch + b];
+              const dtype_%(array)s* from;
+              if(idx >= 0) from = src + (idx * n_batch + b) * inner;
+              else if(idx == -1) from = &pad_left[0];
+              else from = &pad_right[0];
+              std::copy(from, from + inner, dst + (i0 * n_batch + b) * inner);
+            }
+          }
+        }
+        Py_DECREF(array);
+        if(!ok)
+          %(fail)s;
+      }
+    """ % locals()
+
+  # IMPORTANT: change this, if you change the c-code
+  def c_code_cache_version(self):
+    return (1,)
+
   def infer_shape(self, node, input_shapes):
     array, start_idxs, batch_lens, beam_width, pad_left, pad_right = node.inputs
     beam_width = T.cast(beam_width, dtype="int64")
@@ -384,6 +556,103 @@ class MultiBatchBeamGradAddOp(theano.Op):
     else:
       return [input_shapes[0]]
 
+  def c_support_code(self):
+    return c_support_code_multi_batch_beam
+
+  def c_compile_args(self):
+    if sys.platform != "darwin":  # the default clang there does not support it
+      return ['-fopenmp']
+    return []
+
+  def c_code(self, node, name, inp, out, sub):
+    D_array_or_shape, start_idxs, batch_lens, beam_width, D_beam = inp
+    D_array_out, = out
+    fail = sub['fail']
+    if self.idx_dim != 0 or self.batch_dim != 1:
+      raise NotImplementedError("MultiBatchBeamGradAddOp: C code only for (time,batch,...)")  # will use perform()
+    if node.inputs[-1].dtype.startswith("complex"):
+      raise NotImplementedError("MultiBatchBeamGradAddOp: C code not for complex")
+    wrap_around = int(self.wrap_mode == "wrap_around")
+    if self.zero_with_shape:
+      init_D_array = """
+        if(PyArray_DIM(%(D_array_or_shape)s, 0) != nd) {
+          PyErr_SetString(PyExc_ValueError, "MultiBatchBeamGradAddOp: D_array shape does not match D_beam");
+        }
+        else {
+          std::vector<npy_intp> dims(nd);
+          for(int d = 0; d < nd; ++d)
+            dims[d] = *(dtype_%(D_array_or_shape)s*) PyArray_GETPTR1(%(D_array_or_shape)s, d);
+          D_array = (PyArrayObject*) PyArray_ZEROS(nd, &dims[0], NPY_FLOAT32, 0);
+        }
+      """ % locals()
+    elif self.inplace:
+      init_D_array = """
+        if(PyArray_TYPE(%(D_array_or_shape)s) == NPY_FLOAT32 && PyArray_IS_C_CONTIGUOUS(%(D_array_or_shape)s)) {
+          D_array = %(D_array_or_shape)s;
+          Py_INCREF(D_array);
+        }
+        else
+          D_array = (PyArrayObject*) PyArray_FROM_OTF(
+            (PyObject*) %(D_array_or_shape)s, NPY_FLOAT32, NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ENSURECOPY);
+      """ % locals()
+    else:
+      init_D_array = """
+        D_array = (PyArrayObject*) PyArray_FROM_OTF(
+          (PyObject*) %(D_array_or_shape)s, NPY_FLOAT32, NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ENSURECOPY);
+      """ % locals()
+    return """
+      {
+        const long beam_width = multi_batch_beam_index(*(dtype_%(beam_width)s*) PyArray_DATA(%(beam_width)s));
+        PyArrayObject* D_beam = PyArray_GETCONTIGUOUS(%(D_beam)s);
+        const int nd = PyArray_NDIM(D_beam);
+        PyArrayObject* D_array = NULL;
+        %(init_D_array)s
+        bool ok = D_array != NULL;
+        long n_time = 0, n_batch = 0, inner = 1;
+        if(ok) {
+          n_time = PyArray_DIM(D_array, 0);
+          n_batch = PyArray_DIM(D_array, 1);
+          ok = PyArray_NDIM(D_array) == nd && PyArray_DIM(D_beam, 0) == beam_width && PyArray_DIM(D_beam, 1) == n_batch;
+          for(int d = 2; ok && d < nd; ++d) {
+            ok = PyArray_DIM(D_array, d) == PyArray_DIM(D_beam, d);
+            inner *= PyArray_DIM(D_array, d);
+          }
+          if(!ok)
+            PyErr_SetString(PyExc_ValueError, "MultiBatchBeamGradAddOp: D_array shape does not match D_beam");
+        }
+        std::vector<long> idxs;
+        ok = ok && multi_batch_beam_idxs<dtype_%(start_idxs)s, dtype_%(batch_lens)s>(
+          %(start_idxs)s, %(batch_lens)s, beam_width, n_time, %(wrap_around)i, idxs);
+        if(ok && beam_width * n_batch * inner > 0) {
+          const dtype_%(D_beam)s* src = (dtype_%(D_beam)s*) PyArray_DATA(D_beam);
+          float* dst = (float*) PyArray_DATA(D_array);
+          // Every thread covers its own batches, thus the increments (maybe to the same idx) don't conflict.
+          #pragma omp parallel for if(beam_width * n_batch * inner >= multi_batch_beam_min_parallel_work)
+          for(long b = 0; b < n_batch; ++b) {
+            for(long i0 = 0; i0 < beam_width; ++i0) {
+              long idx = idxs[i0 * n_batch + b];
+              if(idx < 0) continue;  // padding. XXX: D_pad_left / D_pad_right are ignored
+              const dtype_%(D_beam)s* from = src + (i0 * n_batch + b) * inner;
+              float* to = dst + (idx * n_batch + b) * inner;
+              for(long j = 0; j < inner; ++j)
+                to[j] += (float) from[j];
+            }
+          }
+        }
+        Py_DECREF(D_beam);
+        if(!ok) {
+          Py_XDECREF(D_array);
+          %(fail)s;
+        }
+        Py_XDECREF(%(D_array_out)s);
+        %(D_array_out)s = D_array;
+      }
+    """ % locals()
+
+  # IMPORTANT: change this, if you change the c-code
+  def c_code_cache_version(self):
+    return (1,)
+
   def perform(self, node, inputs, output_storage):
     D_array_or_shape, start_idxs, batch_lens, beam_width, D_beam = inputs
     out_D_array, = output_storage
@@ -1,5 +1,7 @@
 
+#include <algorithm>
 #include <assert.h>
+#include <cmath>
 #include <iostream>
 #include <fstream>
 #include <limits>
@@ -261,6 +263,10 @@ static void tf_cuda_sgemm(
 // <<<DimGrid,DimBlock,ShmemSize|0,Stream|0>>>. http://docs.nvidia.com/cuda/cuda-c-programming-guide/#execution-configuration
 #define start_dev_kernel(kernel, args) \
 	(kernel<<<DIM_GRID,DIM_BLOCK,0,CUDA_CUR_STREAM>>>  args);
+// See the CPU variant below. Here the same as start_dev_kernel.
+#define start_dev_kernel2(kernel, n_work, args) start_dev_kernel(kernel, args)
+
+#define elem_atomic_add(x, v) atomicAdd(x, v)
 
 static const char *_cudaGetErrorEnum(cublasStatus_t error) {
 	switch (error) {
@@ -352,6 +358,48 @@ static void _cudaHandleError(cublasStatus_t status, const char *file, int line)
 #define start_dev_kernel(kernel, args) \
 	{ for(_KernelLoop loop; !loop.finished(); loop.next()) { kernel args; } }
 
+/*
+Like start_dev_kernel, but the kernel must do the usual loop
+	for(idx = threadIdx.x + blockDim.x * blockIdx.x; idx < n_work; idx += gridDim.x * blockDim.x)
+over n_work independent iterations, i.e. different idx must not write to the same memory.
+Then we can split the loop over multiple CPU threads (via OpenMP, if enabled, i.e. compiled with -fopenmp).
+We emulate a grid with one block per CPU thread, where every block covers a contiguous range of idx.
+*/
+#define start_dev_kernel2(kernel, n_work, args) \
+	{ \
+		long _n_work = (n_work); \
+		int _n_threads = _get_kernel_num_threads(_n_work); \
+		long _block_size = (_n_work + _n_threads - 1) / _n_threads; \
+		_Pragma("omp parallel for num_threads(_n_threads) schedule(static) if(_n_threads > 1)") \
+		for(int _block_idx = 0; _block_idx < _n_threads; ++_block_idx) \
+			for(_KernelLoop loop(_block_idx, _n_threads, _block_size); !loop.finished(); loop.next()) { kernel args; } \
+	}
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// Threads have some overhead, thus we only use them if there is enough work.
+static const long _kernel_min_work_per_thread = 256;
+
+static int _get_kernel_num_threads(long n_work) {
+#ifdef _OPENMP
+	long n = n_work / _kernel_min_work_per_thread;
+	long max_threads = omp_get_max_threads();  // e.g. via OMP_NUM_THREADS
+	if(n > max_threads) n = max_threads;
+	return (n > 1) ? (int) n : 1;
+#else
+	return 1;
+#endif
+}
+
+static inline void elem_atomic_add(float* x, float v) {
+#ifdef _OPENMP
+	#pragma omp atomic
+#endif
+	*x += v;
+}
+
 struct _int3 {
     int x, y, z;
 };
@@ -365,10 +413,11 @@ static void resetVec3(T& v) {
     v.x = v.y = v.z = 0;
 }
 
-static _uint3 _threadIdx;
-static _uint3 _blockIdx;
-static _int3 _blockDim;
-static _int3 _gridDim;
+// Thread-local, such that kernels can run in multiple threads, see start_dev_kernel2.
+static __thread _uint3 _threadIdx;
+static __thread _uint3 _blockIdx;
+static __thread _int3 _blockDim;
+static __thread _int3 _gridDim;
 // We need those as macros to not infer with the CUDA versions if CUDA was also included.
 #define threadIdx _threadIdx
 #define blockIdx _blockIdx
@@ -376,21 +425,21 @@ static _int3 _gridDim;
 #define gridDim _gridDim
 
 struct _KernelLoop {
-	_KernelLoop() {
-		// When we can choose whatever we want here, this loops becomes trivial,
+	_KernelLoop(int block_idx = 0, int grid_size = 1, long block_size = 1) {
+		// When we can choose whatever we want here (start_dev_kernel), this loops becomes trivial,
 		// there will only be one iteration.
-		resetVec3(gridDim); gridDim.x = 1;
-		resetVec3(blockDim); blockDim.x = 1;
+		// With start_dev_kernel2, we loop over the threads of one block.
+		resetVec3(gridDim); gridDim.x = grid_size;
+		resetVec3(blockDim); blockDim.x = (int) block_size;
 		resetVec3(threadIdx);
-		resetVec3(blockIdx);
+		resetVec3(blockIdx); blockIdx.x = block_idx;
 	}
 	bool finished() {
-		// TODO: Also block idx but doesn't matter with the constants above.
 		// TODO: Also y/z but doesn't matter with the constants above.
-		return threadIdx.x >= blockDim.x;
+		return threadIdx.x >= (unsigned int) blockDim.x;
 	}
 	void next() {
-		// TODO: Also blockIdx and y/z, but doesn't matter with the constants above.
+		// TODO: Also y/z, but doesn't matter with the constants above.
 		threadIdx.x++;
 	}
 };
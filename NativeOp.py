@@ -4,19 +4,15 @@ Generic interface which automatically creates:
 * CPU and GPU op
 * inplace and not inplace
 * grad variants
+
+This module does not depend on Theano (only some functions import it when called),
+such that the op descriptions can also be used for TF, see TFNativeOp.
+The Theano op itself is in TheanoNativeOp.
 """
 
 import sys
-import os
 import numpy
-import theano
-import theano.sandbox.cuda
-import theano.tensor as T
-from theano.gof.opt import OpSub
-from theano.compile import optdb
-from theano import gof
-from Util import make_hashable, make_dll_name, escape_c_str
-from TheanoUtil import try_register_gpu_opt, make_var_tuple, softmax
+from Util import make_hashable, make_dll_name
 
 
 PY3 = sys.version_info[0] >= 3
@@ -244,321 +240,6 @@ class NativeOpBaseMixin(object):
 
 
 
-class NativeOp(theano.Op, NativeOpBaseMixin):
-  """
-  We wrap some C code which can define a forward pass
-  and optionally a backward pass (for gradient calculation).
-  The C code should be Numpy and CUDA compatible. See NativeOp.cpp.
-  We also support inplace operations, i.e. we can operate inplace on some inputs.
-  You can define in a flexible way all the inputs and the outputs.
-  See __init__() for the details.
-
-  All output variables are created automatically with the right shape
-   but their content is not initialized,
-   except when its used by some input variable as the inplace output
-   - in that case, it is either the input variable or it has a copy of its data.
-  """
-
-  __props__ = ("in_info", "out_info",
-               "c_fw_code", "c_bw_code", "c_extra_support_code", "code_version",
-               "grad_input_map", "name",
-               "custom_grad")
-
-  def __init__(self, custom_grad=None, **kwargs):
-    """
-    :param function custom_grad: if given, will use this instead for self.grad
-    :param dict[str] kwargs: all passed to NativeOpBaseMixin
-    """
-    theano.Op.__init__(self)
-    NativeOpBaseMixin.__init__(self, **kwargs)
-    self.custom_grad = custom_grad
-
-  def __str__(self):
-    return "%s{%s,%s}" % (
-      self.__class__.__name__,
-      self.name,
-      "inplace" if self.destroy_map else "no_inplace")
-
-  @classmethod
-  def as_tensor_var(cls, v):
-    return theano.tensor.as_tensor_variable(v)
-
-  @classmethod
-  def tensor_type(cls, dtype, ndim):
-    return T.TensorType(dtype=dtype, broadcastable=(False,) * ndim)
-
-  @classmethod
-  def contiguous(cls, v):
-    from TheanoUtil import Contiguous
-    assert isinstance(v, theano.Variable)
-    if getattr(v, 'owner', None):
-      assert isinstance(v.owner, theano.Apply)
-      if isinstance(v.owner.op, Contiguous.__base__):
-        return v
-    return Contiguous()(v)
-
-  def _convert_input_var(self, v, info):
-    v = self.as_tensor_var(v)
-    dtype = info.get("dtype", "float32")
-    if v.dtype != dtype:
-      v = T.cast(v, dtype)
-    if v.ndim != info["ndim"]:
-      raise TypeError("input var ndim %i does not match with info %r" % (v.ndim, info))
-    if info.get("need_contiguous", False):
-      v = self.contiguous(v)
-    return v
-
-  def grad(self, inputs, output_grads):
-    if self.custom_grad:
-      return self.custom_grad(self, inputs, output_grads)
-
-    if not self.c_bw_code:
-      # Unknown how to calculate gradient.
-      return [T.DisconnectedType()() for inp in inputs]
-
-    assert len(self.in_info) == len(inputs)
-    assert len(self.out_info) == len(output_grads)
-
-    # Some of output_grads might be of disconnected type.
-    out_shapes = self.infer_shape(None, [v.shape for v in inputs])
-    assert len(out_shapes) == len(output_grads)
-    for i, out_grad in enumerate(output_grads):
-      if isinstance(out_grad.type, T.DisconnectedType):
-        output_grads[i] = T.zeros(out_shapes[i], dtype="float32")
-
-    kwargs_for_grad = self.kwargs_for_grad_op()
-    grad_op = self.__class__(**kwargs_for_grad)
-
-    grad_inputs = inputs + list(make_var_tuple(self(*inputs))) + output_grads
-    grad_inputs = self._filter_grad_inputs(grad_inputs)
-    assert len(grad_op.in_info) == len(grad_inputs)
-    grad_outputs = make_var_tuple(grad_op(*grad_inputs))
-    assert len(grad_op.out_info) == len(grad_outputs)
-    if grad_op.num_dummy_outs > 0:
-      grad_outputs = grad_outputs[:-grad_op.num_dummy_outs]  # remove any dummy outputs
-
-    def print_fn(op, x):
-      import numpy
-      first = x[(0,) * x.ndim]
-      stats = (first, x.shape, numpy.min(x), numpy.max(x), numpy.mean(x), numpy.std(x),
-               numpy.isinf(x).any(), numpy.isnan(x).any())
-      print(op.message, "first/shape/min/max/mean/std/any-inf/any-nan:", stats)
-    #input_grads = [theano.printing.Print("in grad %i" % i, global_fn=print_fn)(v)
-    #               for (i, v) in enumerate(input_grads)]
-
-    return self.make_results_of_gradient(grad_outputs, disconnected_type=T.DisconnectedType())
-
-  def connection_pattern(self, node):
-    assert len(node.inputs) == len(self.in_info)
-    pattern = [[info.get("gradient", "") != "disconnected"] * len(self.out_info)
-               for info in self.in_info]
-    return pattern
-
-  def make_node(self, *args):
-    assert len(args) == len(self.in_info)
-    args = [self._convert_input_var(arg, info) for arg, info in zip(args, self.in_info)]
-    outputs = [self.tensor_type(dtype=info.get("dtype", "float32"), ndim=info["ndim"])()
-               for info in self.out_info]
-    return theano.Apply(self, args, outputs)
-
-  def perform(self, node, inputs, output_storage):
-    raise NotImplementedError("NativeOp: no pure Python implementation, only C implementation")
-
-  def c_code_cache_version(self):
-    return self.code_version
-
-  def c_support_code(self):
-    base_src = open(os.path.dirname(__file__) + "/NativeOp.cpp").read()
-    return "\n\n".join([
-      T.blas.blas_header_text(),
-      "#define CUDA 0",
-      base_src,
-      self.c_extra_support_code])
-
-  def c_libraries(self):
-    return T.blas.ldflags()
-
-  def c_compile_args(self):
-    return T.blas.ldflags(libs=False, flags=True)
-
-  def c_lib_dirs(self):
-    return T.blas.ldflags(libs=False, libs_dir=True)
-
-  def c_header_dirs(self):
-    return T.blas.ldflags(libs=False, include_dir=True)
-
-  def c_code(self, node, name, inputs, outputs, sub):
-    assert len(inputs) == len(self.in_info)
-    assert len(outputs) == len(self.out_info)
-    return """
-    {
-      int n_inputs = %(n_inputs)i, n_outputs = %(n_outputs)i;
-      Ndarray* inputs[] = {%(input_var_names_str)s};
-      Ndarray** outputs[] = {%(output_var_names_str)s};
-      int in_ndims[] = {%(input_ndims_str)s};
-      int out_ndims[] = {%(output_ndims_str)s};
-      Ndarray_DIM_Type output_shapes_flat[] = {%(output_shapes_flat_str)s};
-      int in_want_inplace[] = {%(input_want_inplace_str)s};
-      bool in_is_inplace[] = {%(input_is_inplace_str)s};
-
-      // Check if we can reuse any preallocated output.
-      // Reset those which we cannot reuse.
-      {
-        int out_shape_idx = 0;
-        for(int i = 0; i < n_outputs; ++i) {
-          assert_cmp(out_shape_idx + out_ndims[i], <=, ARRAY_LEN(output_shapes_flat));
-          if(*outputs[i]) {
-            bool can_reuse = true;
-            for(int j = 0; j < out_ndims[i]; ++j)
-              if(output_shapes_flat[out_shape_idx + j] != Ndarray_DIMS(*outputs[i])[j]) {
-                can_reuse = false;
-                break;
-              }
-            if(!can_reuse)
-              Py_CLEAR(*outputs[i]);
-          }
-          out_shape_idx += out_ndims[i];
-        }
-        assert_cmp(out_shape_idx, ==, ARRAY_LEN(output_shapes_flat));
-      }
-
-      // Maybe reuse or otherwise copy input into output vars.
-      for(int i = 0; i < n_inputs; ++i)
-        if(in_want_inplace[i] >= 0) {
-          assert_cmp(in_want_inplace[i], <, n_outputs);
-          Py_XDECREF(*outputs[in_want_inplace[i]]);
-          if(in_is_inplace[i]) {
-            *(outputs[in_want_inplace[i]]) = inputs[i];
-            Py_INCREF(inputs[i]);
-          } else {
-            *(outputs[in_want_inplace[i]]) = (Ndarray*) Ndarray_Copy(inputs[i]);
-            if(!*(outputs[in_want_inplace[i]])) %(fail)s;
-            inputs[i] = *(outputs[in_want_inplace[i]]);  // reset with copy
-          }
-        }
-
-      // Init the remaining output vars. Note that they are initialized randomly!
-      {
-        int out_shape_idx = 0;
-        for(int i = 0; i < n_outputs; ++i) {
-          assert(out_shape_idx + out_ndims[i] <= ARRAY_LEN(output_shapes_flat));
-          if(*(outputs[i])) {
-            for(int j = 0; j < out_ndims[i]; ++j)
-              // If this fails, we maybe have reused an input which has an invalid shape.
-              assert_cmp(output_shapes_flat[out_shape_idx + j], ==, Ndarray_DIMS(*outputs[i])[j]);
-          }
-          else {
-            *(outputs[i]) = (Ndarray*) Ndarray_NewDims(out_ndims[i], &output_shapes_flat[out_shape_idx]);
-            if(!*(outputs[i])) %(fail)s;
-          }
-          out_shape_idx += out_ndims[i];
-        }
-        assert_cmp(out_shape_idx, ==, ARRAY_LEN(output_shapes_flat));
-      }
-
-      // And the user C code starts here.
-      // --------------------------------
-      %(c_code)s;
-    }
-    """ % {
-      'name': name, 'fail': sub['fail'],
-      'op_name': escape_c_str(self.name),
-      'c_code': self.c_fw_code % {'fail': sub['fail']},
-      'n_inputs': len(inputs), 'n_outputs': len(outputs),
-      'input_var_names_str': ", ".join(["%s" % inp for inp in inputs]),
-      'output_var_names_str': ", ".join(["&%s" % out for out in outputs]),
-      'input_ndims_str': ', '.join(["%i" % info["ndim"] for info in self.in_info]),
-      'output_ndims_str': ', '.join(["%i" % info["ndim"] for info in self.out_info]),
-      'output_shapes_flat_str':
-        ', '.join([(("%i" % s) if isinstance(s, (int, long))
-                    else "Ndarray_DIMS(inputs[%i])[%i]" % s)
-                   for info in self.out_info for s in info["shape"]]),
-      "input_want_inplace_str": ", ".join([str(int(info.get("want_inplace", -1)))
-                                           for info in self.in_info]),
-      "input_is_inplace_str": ", ".join([str(int(info.get("is_inplace", False)))
-                                         for info in self.in_info])
-    }
-
-
-class GpuNativeOp(NativeOp, theano.sandbox.cuda.GpuOp):
-
-  @classmethod
-  def as_tensor_var(cls, v):
-    from theano.sandbox.cuda.basic_ops import as_cuda_ndarray_variable
-    return as_cuda_ndarray_variable(v)
-
-  @classmethod
-  def tensor_type(cls, dtype, ndim):
-    from theano.sandbox.cuda import CudaNdarrayType
-    if dtype != "float32":
-      print("%s: WARNING: cannot handle type %r, will use float32 instead" % ("GpuNativeOp", dtype))
-      dtype = "float32"
-    return CudaNdarrayType(dtype=dtype, broadcastable=(False,) * ndim)
-
-  @classmethod
-  def contiguous(cls, v):
-    from theano.sandbox.cuda.basic_ops import gpu_contiguous
-    assert isinstance(v, (theano.sandbox.cuda.CudaNdarrayVariable, theano.sandbox.cuda.CudaNdarrayConstant))
-    if getattr(v, 'owner', None):
-      assert isinstance(v.owner, theano.Apply)
-      if v.owner.op == gpu_contiguous:
-        return v
-    return gpu_contiguous(v)
-
-  def c_support_code(self):
-    src = open(os.path.dirname(__file__) + "/NativeOp.cpp").read()
-    return "\n\n".join([
-      "#define CUDA 1",
-      src,
-      self.c_extra_support_code,
-      "// end of c_support_code\n\n\n"])
-
-
-@gof.local_optimizer([NativeOp], inplace=True)
-def inplace_NativeOp(node):
-  if isinstance(node.op, NativeOp) and not node.op.destroy_map:
-    kwargs = {k: getattr(node.op, k) for k in node.op.__props__}
-    # TODO: We could try to make each input inplace individually.
-    # What we do now is just to try to make all inplace.
-    kwargs["in_info"] = [dict(info) for info in node.op.in_info]
-    any_inplace = False
-    for info in kwargs["in_info"]:
-      if info.get("want_inplace", -1) >= 0:
-        any_inplace = True
-        info["is_inplace"] = True
-    if not any_inplace:
-      return False
-    new_op = node.op.__class__(**kwargs)
-    from TheanoUtil import make_var_tuple
-    new_v = make_var_tuple(new_op(*node.inputs))
-    return new_v
-  return False
-
-try:
-  optdb.register('inplace_NativeOp',
-                 gof.TopoOptimizer(inplace_NativeOp
-                                   , failure_callback=gof.TopoOptimizer.warn_inplace
-                                   ),
-                 60, 'fast_run', 'inplace')
-except ValueError:  # can happen if it was already registered before, e.g. when we reload the module
-  pass
-
-
-@try_register_gpu_opt(NativeOp)
-def local_gpu_NativeOp(node):
-  if isinstance(node.op, NativeOp):
-    # see also: https://github.com/Theano/Theano/blob/master/theano/sandbox/cuda/opt.py
-    from theano.sandbox.cuda import host_from_gpu, gpu_from_host, as_cuda_ndarray_variable
-    args = node.inputs
-    if any([(x.owner and x.owner.op == host_from_gpu) for x in args]):
-      gpu_op = GpuNativeOp(**{key: getattr(node.op, key) for key in node.op.__props__})
-      args = [x.owner.inputs[0] if (x.owner and x.owner.op == host_from_gpu) else x
-              for x in args]
-      from TheanoUtil import make_var_tuple
-      outputs = make_var_tuple(gpu_op(*args))
-      return [host_from_gpu(out) for out in outputs]
-
-
 class NativeOpGenBase:
   """
   Base interface for op generation.
@@ -579,6 +260,7 @@ class NativeOpGenBase:
     assert cls.in_info is not None
     assert cls.out_info is not None
     assert cls.c_fw_code is not None
+    from TheanoNativeOp import NativeOp
     return NativeOp(in_info=cls.in_info, out_info=cls.out_info,
                     c_fw_code=cls.c_fw_code, c_bw_code=cls.c_bw_code,
                     c_extra_support_code=cls.c_extra_support_code,
@@ -629,6 +311,7 @@ class LstmGenericBase(NativeOpGenBase):
 
   @classmethod
   def map_layer_inputs_to_op(cls, Z, V_h, i):
+    import theano.tensor as T
     assert Z.ndim == 3
     assert V_h.ndim == 2
     assert i.ndim == 2
@@ -764,7 +447,7 @@ class LstmGenericBase(NativeOpGenBase):
         affine_y_x(x-1, Y,  x, V_h,  x, H);
       }
 
-      start_dev_kernel(lstm_kernel, (
+      start_dev_kernel2(lstm_kernel, n_cells * n_batch, (
         data_ptr(H, x),
         x > 0 ? data_ptr(H, x - 1) : Ndarray_DEV_DATA(c),
         x > 0,
@@ -804,7 +487,7 @@ class LstmGenericBase(NativeOpGenBase):
       if(!rightBorder)
         affine_y_x(x+1, DZ,  x, V_h,  x, tmpDc,  false, true);
 
-      start_dev_kernel(lstm_bwd_kernel, (
+      start_dev_kernel2(lstm_bwd_kernel, n_cells * n_batch, (
         data_ptr(DZ, x),
         data_ptr(tmpDc, x),
         rightBorder ? Ndarray_DEV_DATA(Dd) : data_ptr(tmpDc, x + 1),
@@ -931,7 +614,7 @@ class Chunking(NativeOpGenBase):
     assert_cmp(Ndarray_DIMS(output)[1], ==, Ndarray_DIMS(oindex)[1]);
     assert_cmp(Ndarray_DIMS(output)[2], ==, Ndarray_DIMS(input)[2]);
 
-    start_dev_kernel(copy_kernel, (
+    start_dev_kernel2(copy_kernel, Ndarray_DIMS(output)[0] * Ndarray_DIMS(output)[1], (
       Ndarray_DEV_DATA(chunk_params),
       Ndarray_DEV_DATA(input),
         Ndarray_DIMS(input)[0],
@@ -972,6 +655,7 @@ class Chunking(NativeOpGenBase):
 
   @classmethod
   def custom_grad(cls, op, inputs, output_grads):
+    import theano.tensor as T
     assert len(op.in_info) == len(inputs)
     assert len(op.out_info) == len(output_grads)
 
@@ -994,6 +678,7 @@ class Chunking(NativeOpGenBase):
 
 
 def chunk(x, index, chunk_size, chunk_step):
+  import theano.tensor as T
   assert x.ndim == 3
   n_time = x.shape[0]
   n_batch = x.shape[1]
@@ -1144,7 +829,7 @@ class UnChunking(NativeOpGenBase):
     assert_cmp(Ndarray_DIMS(oindex)[0], ==, Ndarray_DIMS(ofactors)[0]);
     assert_cmp(Ndarray_DIMS(oindex)[1], ==, Ndarray_DIMS(ofactors)[1]);
 
-    start_dev_kernel(unchunk_kernel, (
+    start_dev_kernel2(unchunk_kernel, Ndarray_DIMS(output)[0] * Ndarray_DIMS(output)[1], (
       Ndarray_DEV_DATA(chunk_params),
       Ndarray_DEV_DATA(input),
         Ndarray_DIMS(input)[0],
@@ -1175,6 +860,7 @@ class UnChunking(NativeOpGenBase):
 
   @classmethod
   def custom_grad(cls, op, inputs, output_grads):
+    import theano.tensor as T
     assert len(op.in_info) == len(inputs)
     assert len(op.out_info) == len(output_grads)
 
@@ -1193,6 +879,7 @@ class UnChunking(NativeOpGenBase):
 
 
 def unchunk(x, index, chunk_size, chunk_step, n_time, n_batch):
+  import theano.tensor as T
   assert x.ndim == 3
   n_dim = x.shape[2]
   chunk_params = T.concatenate([T.as_tensor(chunk_size).reshape((1,)), T.as_tensor(chunk_step).reshape((1,))])
@@ -1285,7 +972,7 @@ class SubtensorBatchedIndex(NativeOpGenBase):
     assert_cmp(Ndarray_DIMS(y)[0], ==, Ndarray_DIMS(idx)[0]);
     assert_cmp(Ndarray_DIMS(y)[1], ==, Ndarray_DIMS(idx)[1]);
 
-    start_dev_kernel(select_kernel, (
+    start_dev_kernel2(select_kernel, Ndarray_DIMS(x)[0] * Ndarray_DIMS(x)[1], (
       Ndarray_DEV_DATA(x),
         Ndarray_DIMS(x)[0],
         Ndarray_DIMS(x)[1],
@@ -1323,7 +1010,7 @@ class SubtensorBatchedIndex(NativeOpGenBase):
     assert_cmp(Ndarray_DIMS(Dx)[2], ==, Ndarray_DIMS(x)[2]);
 
     Ndarray_set_zero(Dx);
-    start_dev_kernel(select_bw_kernel, (
+    start_dev_kernel2(select_bw_kernel, Ndarray_DIMS(Dx)[0] * Ndarray_DIMS(Dx)[1], (
       Ndarray_DEV_DATA(Dx),
         Ndarray_DIMS(Dx)[0],
         Ndarray_DIMS(Dx)[1],
@@ -1392,7 +1079,7 @@ class SparseToDense(NativeOpGenBase):
         if(t < 0 || t >= n_time) continue;  // error somehow?
         if(j < 0 || j >= n_dim) continue;  // error somehow?
         long out_idx = t * n_batch * n_dim + batch * n_dim + j;
-        out[out_idx] += y;
+        elem_atomic_add(&out[out_idx], y);  // the same [t,j] can occur multiple times
       }
     }
     """
@@ -1424,7 +1111,7 @@ class SparseToDense(NativeOpGenBase):
     int n_time = Ndarray_DIMS(out_W)[0];
     int n_dim = Ndarray_DIMS(out_W)[2];
 
-    start_dev_kernel(assign_kernel, (
+    start_dev_kernel2(assign_kernel, n_batch * n_sparse_idx, (
       Ndarray_DEV_DATA(out_W),
       Ndarray_DEV_DATA(s0),
       Ndarray_DEV_DATA(s1),
@@ -1436,6 +1123,7 @@ class SparseToDense(NativeOpGenBase):
 
 
 def sparse_to_dense(s0, s1, weight, mask, n_time, n_dim):
+  import theano.tensor as T
   assert s0.ndim == 2
   assert s1.ndim == 2
   assert weight.ndim == 2
@@ -1449,6 +1137,7 @@ def sparse_to_dense(s0, s1, weight, mask, n_time, n_dim):
 
 
 def onehot_to_sparse(y, mask):
+  import theano.tensor as T
   assert y.ndim == 2
   assert mask.ndim == 2
   n_time = y.shape[0]
@@ -1466,6 +1155,7 @@ def sparse_slice_offset(s0, idx):
   :return: s0_idx, such that s0[i] >= idx for all i >= s0_idx, s0[i] < idx for all i < s0_idx.
   This assumes that the indices in s0 are ordered.
   """
+  import theano.tensor as T
   mask = s0 < idx
   return T.sum(mask)
 
@@ -1556,7 +1246,7 @@ class MaxAndArgmaxSparse(NativeOpGenBase):
     assert(n_out_time == Ndarray_DIMS(out_max)[0]);
     assert(out_max != out_arg);  // earlier bug in NativeOp
 
-    start_dev_kernel(doit_kernel, (
+    start_dev_kernel2(doit_kernel, n_batch, (
       n_batch, n_in_time, n_out_time,
       Ndarray_DEV_DATA(s0),
       Ndarray_DEV_DATA(s1),
@@ -1672,7 +1362,8 @@ class CrossEntropySoftmaxAndGradientZSparse(NativeOpGenBase):
         long out_y_idx = t * n_batch * n_dim + batch * n_dim + j;
         // This assumes that out_grad_z is still softmax(z).
         // This also assumes that every [t,j] is only represented once in the sparse data.
-        out_ce[out_ce_idx] -= y_target * log(fmax(out_grad_z[out_y_idx], 1e-30f));
+        // Multiple j for the same [t,batch], thus atomic.
+        elem_atomic_add(&out_ce[out_ce_idx], -y_target * log(fmax(out_grad_z[out_y_idx], 1e-30f)));
         out_grad_z[out_y_idx] -= y_target;
       }
     }
@@ -1722,17 +1413,17 @@ class CrossEntropySoftmaxAndGradientZSparse(NativeOpGenBase):
     assert(n_sparse_index == Ndarray_DIMS(w)[0]);
     assert(n_sparse_index == Ndarray_DIMS(s_mask)[0]);
 
-    start_dev_kernel(max_kernel, (
+    start_dev_kernel2(max_kernel, n_time * n_batch, (
       Ndarray_DEV_DATA(out_max_z), Ndarray_DEV_DATA(z), Ndarray_DEV_DATA(z_mask),
       n_dim, n_time * n_batch
     ));
     Ndarray_set_zero(out_ce);
-    start_dev_kernel(softmax_kernel, (
+    start_dev_kernel2(softmax_kernel, n_time * n_batch, (
       Ndarray_DEV_DATA(out_grad_z),
       Ndarray_DEV_DATA(z), Ndarray_DEV_DATA(out_max_z), Ndarray_DEV_DATA(z_mask),
       n_dim, n_time * n_batch
     ));
-    start_dev_kernel(ce_sm_grad_kernel, (
+    start_dev_kernel2(ce_sm_grad_kernel, n_batch * n_sparse_index, (
       Ndarray_DEV_DATA(out_ce), Ndarray_DEV_DATA(out_grad_z),
       Ndarray_DEV_DATA(z), Ndarray_DEV_DATA(out_max_z), Ndarray_DEV_DATA(z_mask),
       Ndarray_DEV_DATA(s0), Ndarray_DEV_DATA(s1), Ndarray_DEV_DATA(w), Ndarray_DEV_DATA(s_mask),
@@ -1748,6 +1439,8 @@ def crossentropy_softmax_and_gradient_z_sparse(z, z_mask, y_target_t, y_target_i
 
 
 def crossentropy_softmax_and_gradient_z_sparse__slow(z, z_mask, y_target_t, y_target_i, y_target_w, y_target_mask):
+  import theano.tensor as T
+  from TheanoUtil import softmax
   assert z.ndim == 3
   n_time = z.shape[0]
   n_batch = z.shape[1]
@@ -1767,6 +1460,9 @@ class FastBaumWelchOp(NativeOpGenBase):
     :param weights: weights of the edges
   outputs:
     :param output: Baum-Welch alignment, scores in -log space. 3d (time,batch,dim), like am_scores
+    :param sums: -log of the sum over all paths per frame, 2d (time,batch). 0 for frames after the seq end
+
+  There is a CUDA and a CPU implementation. The CPU variant runs the seqs of the batch in parallel (via OpenMP).
   """
   in_info = (
     {"name": "am_scores",        "ndim": 3, "shape": (None,   None,    None), "need_contiguous": True, "gradient": "disconnected"},
@@ -1783,13 +1479,16 @@ class FastBaumWelchOp(NativeOpGenBase):
 
   c_extra_support_code = {
     "01_set_start_states" : """
+      #if CUDA
       __global__
       void set_start_states(float* states, unsigned* start_states) {
         unsigned state_idx = start_states[blockIdx.x * blockDim.x + threadIdx.x];
         states[state_idx] = 0.0;
       }
+      #endif
     """,
     "02_init_bwd_state_buffer": """
+      #if CUDA
       __global__
       void init_bwd_state_buffer(float* states, unsigned* end_states, unsigned t, unsigned max_t, float* index, unsigned index_stride) {
         unsigned idx = blockIdx.x * blockDim.x + threadIdx.x;
@@ -1798,8 +1497,10 @@ class FastBaumWelchOp(NativeOpGenBase):
           states[state_idx] = 0.0;
         }
       }
+      #endif
     """,
     "10_fill_array" : """
+      #if CUDA
       __global__
       void fill_array(float* array, float value, unsigned size) {
         unsigned idx = blockIdx.x * blockDim.x + threadIdx.x;
@@ -1807,8 +1508,10 @@ class FastBaumWelchOp(NativeOpGenBase):
           array[idx] = value;
         }
       }
+      #endif
     """,
     "11_prob_add": """
+      #if CUDA
       __device__
       float prob_add(float a, float b) {
         float diff = a - b;
@@ -1819,8 +1522,20 @@ class FastBaumWelchOp(NativeOpGenBase):
           return -log1p(exp(-abs(diff))) + min(a, b);
         }
       }
+      #else
+      static inline float prob_add(float a, float b) {
+        float diff = a - b;
+        if (std::isnan(diff)) {
+          return std::numeric_limits<float>::infinity();
+        }
+        else {
+          return -log1pf(expf(-fabsf(diff))) + std::min(a, b);
+        }
+      }
+      #endif
     """,
     "12_atomic_prob_add": """
+      #if CUDA
       __device__
       void atomic_prob_add(float* a, float b) {
         int* addr = (int*)a;
@@ -1831,8 +1546,10 @@ class FastBaumWelchOp(NativeOpGenBase):
           old     = atomicCAS(addr, assumed, __float_as_int(prob_add(__int_as_float(old), b)));
         } while (old != assumed);
       }
+      #endif
     """,
     "20_next_frame": """
+      #if CUDA
       __global__
       void next_frame(bool fwd, unsigned num_edges, unsigned  num_emissions,
                       unsigned* sequence_idxs, unsigned* from_buffer, unsigned* to_buffer, float* weight_buffer, unsigned* emission_idxs,
@@ -1864,8 +1581,10 @@ class FastBaumWelchOp(NativeOpGenBase):
         }
         atomic_prob_add(next_frame + to, val);
       }
+      #endif
     """,
     "21_normalize": """
+      #if CUDA
       __global__
       void normalize(float* buffer, unsigned* sequence_idxs, unsigned num_edges, float* debug_out) {
         extern __shared__ float sum[];
@@ -1915,8 +1634,10 @@ class FastBaumWelchOp(NativeOpGenBase):
           }
         }
       }
+      #endif
     """,
     "21_normalize_2": """
+      #if CUDA
       __global__
       void normalize_2(float* buffer, unsigned* sequence_idxs, unsigned num_edges, unsigned num_seqs, float* sum_output) {
         extern __shared__ float sum[];
@@ -1947,8 +1668,10 @@ class FastBaumWelchOp(NativeOpGenBase):
           buffer[e] -= sum[s];
         }
       }
+      #endif
     """,
     "22_compute_result": """
+      #if CUDA
       __global__
       void compute_result(float* edge_buffer, float* out, unsigned* emission_idxs, unsigned* sequence_idxs,
                           unsigned frame_stride, unsigned seq_stride,
@@ -1966,8 +1689,10 @@ class FastBaumWelchOp(NativeOpGenBase):
 
         atomic_prob_add(out + frame * frame_stride + seq_idx * seq_stride + emission_idx, score);
       }
+      #endif
     """,
     "23_write_alignment_to_file": """
+      #if CUDA
       void write_alignment_to_file(float* d_state_buffer, float* d_index, unsigned index_stride,
                                    unsigned* d_start_states, unsigned* d_end_states,
                                    float pruning, unsigned n_frames, unsigned n_seqs, unsigned n_states, unsigned batch_idx) {
@@ -2006,8 +1731,10 @@ class FastBaumWelchOp(NativeOpGenBase):
           }
         }
       }
+      #endif
     """,
     "24_write_output_to_file": """
+      #if CUDA
       void write_output_to_file(float* d_out, float* d_index, unsigned index_stride,
                                 float pruning, unsigned n_frames, unsigned n_seqs, unsigned n_emissions, unsigned batch_idx) {
         std::vector<float> buffer(n_frames * n_seqs * n_emissions);
@@ -2033,6 +1760,117 @@ class FastBaumWelchOp(NativeOpGenBase):
           }
         }
       }
+      #endif
+    """,
+    "30_fast_bw_seq_cpu": """
+      #if !CUDA
+      // CPU variant of the whole fwd/bwd pass (next_frame, normalize_2, compute_result) for a single seq.
+      // The seqs of the batch are independent, thus the caller can run them in parallel.
+      // seq_edges are the edges of this seq.
+      // We map the states of the seq to a local range, such that the state buffers stay small.
+      void fast_bw_seq_cpu(unsigned seq, const unsigned* seq_edges, unsigned n_seq_edges,
+                           const unsigned* from_buffer, const unsigned* to_buffer, const float* weight_buffer,
+                           const unsigned* emission_idxs, unsigned start_state, unsigned end_state,
+                           const float* am_scores, unsigned frame_stride, unsigned sequence_stride,
+                           const float* index, unsigned index_stride,
+                           float* out, unsigned out_frame_stride, unsigned out_sequence_stride,
+                           float* sum_output, unsigned n_frames, unsigned n_seqs, unsigned n_emissions) {
+        const float inf = std::numeric_limits<float>::infinity();
+        for (unsigned t = 0u; t < n_frames; t++) {
+          float* out_t = out + t * out_frame_stride + seq * out_sequence_stride;
+          std::fill(out_t, out_t + n_emissions, inf);
+          sum_output[t * n_seqs + seq] = 0.0;
+        }
+
+        // Like init_bwd_state_buffer, the bwd pass starts at the last frame of the seq.
+        // All frames after that would only get inf.
+        unsigned n_used_frames = n_frames;
+        while (n_used_frames > 0u && index[(n_used_frames - 1u) * index_stride + seq] != 1.0) {
+          n_used_frames--;
+        }
+        if (n_used_frames == 0u || n_seq_edges == 0u) {
+          return;
+        }
+
+        std::vector<unsigned> states;
+        states.reserve(2u * n_seq_edges + 2u);
+        states.push_back(start_state);
+        states.push_back(end_state);
+        for (unsigned i = 0u; i < n_seq_edges; i++) {
+          states.push_back(from_buffer[seq_edges[i]]);
+          states.push_back(to_buffer[seq_edges[i]]);
+        }
+        std::sort(states.begin(), states.end());
+        states.erase(std::unique(states.begin(), states.end()), states.end());
+        unsigned n_states = states.size();
+
+        std::vector<unsigned> from(n_seq_edges), to(n_seq_edges), emission(n_seq_edges);
+        std::vector<float> weight(n_seq_edges);
+        for (unsigned i = 0u; i < n_seq_edges; i++) {
+          unsigned e = seq_edges[i];
+          from[i]     = std::lower_bound(states.begin(), states.end(), from_buffer[e]) - states.begin();
+          to[i]       = std::lower_bound(states.begin(), states.end(), to_buffer[e]) - states.begin();
+          emission[i] = emission_idxs[e];
+          weight[i]   = weight_buffer[e];
+        }
+        unsigned local_start_state = std::lower_bound(states.begin(), states.end(), start_state) - states.begin();
+        unsigned local_end_state   = std::lower_bound(states.begin(), states.end(), end_state) - states.begin();
+
+        std::vector<float> prev_frame(n_states, inf), next_frame(n_states);
+        std::vector<float> edge_buffer((size_t) n_used_frames * n_seq_edges);
+
+        // fwd pass. The edge buffer gets the fwd score of the edge, i.e. alpha(from) + weight + am_score.
+        // If alpha(from) is inf, this is also inf, like in next_frame.
+        prev_frame[local_start_state] = 0.0;
+        for (unsigned t = 0u; t < n_used_frames; t++) {
+          const float* am_scores_t = am_scores + t * frame_stride + seq * sequence_stride;
+          float* edge_buffer_t = &edge_buffer[(size_t) t * n_seq_edges];
+          for (unsigned i = 0u; i < n_seq_edges; i++) {
+            edge_buffer_t[i] = prev_frame[from[i]] + weight[i] + am_scores_t[emission[i]];
+          }
+          std::fill(next_frame.begin(), next_frame.end(), inf);
+          for (unsigned i = 0u; i < n_seq_edges; i++) {
+            next_frame[to[i]] = prob_add(next_frame[to[i]], edge_buffer_t[i]);
+          }
+          std::swap(prev_frame, next_frame);
+        }
+
+        // bwd pass. The edge buffer gets beta(to) added.
+        std::fill(prev_frame.begin(), prev_frame.end(), inf);
+        for (unsigned t = n_used_frames; t > 0u; t--) {
+          if (index[(t - 1u) * index_stride + seq] == 1.0 && (t == n_frames || index[t * index_stride + seq] == 0.0)) {
+            prev_frame[local_end_state] = 0.0;
+          }
+          const float* am_scores_t = am_scores + (t - 1u) * frame_stride + seq * sequence_stride;
+          float* edge_buffer_t = &edge_buffer[(size_t) (t - 1u) * n_seq_edges];
+          std::fill(next_frame.begin(), next_frame.end(), inf);
+          for (unsigned i = 0u; i < n_seq_edges; i++) {
+            float prev_val = prev_frame[to[i]];
+            edge_buffer_t[i] += prev_val;
+            next_frame[from[i]] = prob_add(next_frame[from[i]], prev_val + weight[i] + am_scores_t[emission[i]]);
+          }
+          std::swap(prev_frame, next_frame);
+        }
+
+        // normalize at each time frame, and sum up the edges by emission
+        for (unsigned t = 0u; t < n_used_frames; t++) {
+          const float* edge_buffer_t = &edge_buffer[(size_t) t * n_seq_edges];
+          float sum = inf;
+          for (unsigned i = 0u; i < n_seq_edges; i++) {
+            sum = prob_add(sum, edge_buffer_t[i]);
+          }
+          if (std::isinf(sum)) {
+            // if the frame is empty (happens due to batching of seqs with unequal length), keep 0 and inf
+            continue;
+          }
+          sum_output[t * n_seqs + seq] = sum;
+          float* out_t = out + t * out_frame_stride + seq * out_sequence_stride;
+          for (unsigned i = 0u; i < n_seq_edges; i++) {
+            out_t[emission[i]] = prob_add(out_t[emission[i]], edge_buffer_t[i] - sum);
+          }
+        }
+      }
+      #endif
     """
   }
 
@@ -2076,7 +1914,7 @@ class FastBaumWelchOp(NativeOpGenBase):
     float*    d_state_buffer_prev = Ndarray_DEV_DATA(state_buffer) + 0 * Ndarray_STRIDE(state_buffer, 0);
     float*    d_state_buffer_next = Ndarray_DEV_DATA(state_buffer) + 1 * Ndarray_STRIDE(state_buffer, 0);
     float*    d_out               = Ndarray_DEV_DATA(out);
-    float*    d_sum_output        = CudaNdarray_DEV_DATA(sum_output);
+    float*    d_sum_output        = Ndarray_DEV_DATA(sum_output);
 
     unsigned n_frames    = Ndarray_DIMS(am_scores)[0];
     unsigned n_seqs      = Ndarray_DIMS(am_scores)[1];
@@ -2104,6 +1942,7 @@ class FastBaumWelchOp(NativeOpGenBase):
     //std::cerr << "sequnence_stride: " << sequence_stride << std::endl;
     //std::cerr << "index_stride: "     << index_stride    << std::endl;
 
+    #if CUDA
     // initialize edge buffer
     float* d_edge_buffer = reinterpret_cast<float*>(device_malloc(n_edges * n_frames * sizeof(float)));
     unsigned n_fill_blocks = (n_edges * n_frames + n_threads - 1u) / n_threads;
@@ -2201,8 +2040,77 @@ class FastBaumWelchOp(NativeOpGenBase):
     }
     //std::cerr << "fast_bw finished" << std::endl;
     batch_idx++;
+
+    #else
+    // Group the edges by seq. Then every seq is independent, and we run one seq per thread.
+    std::vector<unsigned> seq_edges_offsets(n_seqs + 1u, 0u);
+    for (unsigned e = 0u; e < n_edges; e++) {
+      assert(d_sequence_idxs[e] < n_seqs);
+      seq_edges_offsets[d_sequence_idxs[e] + 1u]++;
+    }
+    for (unsigned s = 0u; s < n_seqs; s++) {
+      seq_edges_offsets[s + 1u] += seq_edges_offsets[s];
+    }
+    std::vector<unsigned> seq_edges(n_edges);
+    {
+      std::vector<unsigned> pos(seq_edges_offsets.begin(), seq_edges_offsets.end() - 1);
+      for (unsigned e = 0u; e < n_edges; e++) {
+        seq_edges[pos[d_sequence_idxs[e]]++] = e;
+      }
+    }
+
+    #pragma omp parallel for schedule(dynamic) if(n_seqs > 1u)
+    for (long s = 0; s < (long) n_seqs; s++) {
+      fast_bw_seq_cpu(s, seq_edges.data() + seq_edges_offsets[s], seq_edges_offsets[s + 1] - seq_edges_offsets[s],
+                      d_from, d_to, d_weights, d_emission_idxs, d_start_states[s], d_end_states[s],
+                      d_am_scores, frame_stride, sequence_stride, d_index, index_stride,
+                      d_out, Ndarray_STRIDE(out, 0), Ndarray_STRIDE(out, 1),
+                      d_sum_output, n_frames, n_seqs, n_emissions);
+    }
+    #endif
   """
 
   c_bw_code = None
 
-  code_version = 55
+  code_version = 56
+
+
+def get_all_op_names():
+  """
+  :return: names of all ops of this module, i.e. the :class:`NativeOpGenBase` subclasses with C code
+  :rtype: list[str]
+  """
+  import inspect
+  return [name for (name, v) in sorted(globals().items())
+          if inspect.isclass(v) and issubclass(v, NativeOpGenBase) and v.c_fw_code]
+
+
+def get_op_names_from_network_json(network_json, tensorflow=False):
+  """
+  Collects the ops which would be used by the given network, e.g. to compile them ahead of time.
+  This covers the layers which use native ops directly.
+
+  :param dict[str,dict[str]] network_json: layer name -> layer dict, like config "network"
+  :param bool tensorflow: whether this is a TF network definition. otherwise Theano
+  :return: op names, see :func:`get_all_op_names`
+  :rtype: list[str]
+  """
+  op_names = set()
+  for layer in network_json.values():
+    if not isinstance(layer, dict):
+      continue
+    layer_class = layer.get("class", None)
+    if layer_class == "native_lstm":  # Theano NativeLstmLayer
+      op_names.add("LstmGenericBase")
+    elif layer_class == "native":  # Theano NativeLayer
+      op_names.add(layer["native_class"])
+    elif layer_class == "rec" and tensorflow:  # TF RecLayer
+      unit = layer.get("unit", "lstm")
+      if isinstance(unit, dict):  # subnetwork
+        op_names.update(get_op_names_from_network_json(unit, tensorflow=True))
+      elif unit.lower() == "nativelstm" or (
+            unit.lower() in ["lstm", "lstmp"] and not layer.get("output_feedback") and not layer.get("attention")):
+        op_names.add("LstmGenericBase")
+    if layer.get("loss", None) == "fast_bw":
+      op_names.add("FastBaumWelchOp")
+  return sorted(op_names)
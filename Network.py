@@ -123,39 +123,7 @@ class LayerNetwork(object):
     :param str mask: "unity", "none" or "dropout"
     :rtype: dict[str]
     """
-    json_content = None
-    if config.has("network") and config.is_typed("network"):
-      json_content = config.typed_value("network")
-      assert isinstance(json_content, dict)
-      assert json_content
-    elif config.network_topology_json:
-      start_var = config.network_topology_json.find('(config:', 0) # e.g. ..., "n_out" : (config:var), ...
-      while start_var > 0:
-        end_var = config.network_topology_json.find(')', start_var)
-        assert end_var > 0, "invalid variable syntax at " + str(start_var)
-        var = config.network_topology_json[start_var+8:end_var]
-        assert config.has(var), "could not find variable " + var
-        config.network_topology_json = config.network_topology_json[:start_var] + config.value(var,"") + config.network_topology_json[end_var+1:]
-        print >> log.v4, "substituting variable %s with %s" % (var,config.value(var,""))
-        start_var = config.network_topology_json.find('(config:', start_var+1)
-      try:
-        json_content = json.loads(config.network_topology_json)
-      except ValueError as e:
-        print >> log.v3, "----- BEGIN JSON CONTENT -----"
-        print >> log.v3, config.network_topology_json
-        print >> log.v3, "------ END JSON CONTENT ------"
-        assert False, "invalid json content, %r" % e
-      assert isinstance(json_content, dict)
-      if 'network' in json_content:
-        json_content = json_content['network']
-      assert json_content
-    if not json_content:
-      if not mask:
-        if sum(config.float_list('dropout', [0])) > 0.0:
-          mask = "dropout"
-      description = LayerNetworkDescription.from_config(config)
-      json_content = description.to_json_content(mask=mask)
-    return json_content
+    return LayerNetworkDescription.network_json_from_config(config, mask=mask)
 
   @classmethod
   def from_description(cls, description, mask=None, **kwargs):
@@ -174,12 +142,7 @@ class LayerNetwork(object):
     :rtype: dict[str]
     :returns the kwarg for cls.from_json()
     """
-    num_inputs, num_outputs = LayerNetworkDescription.num_inputs_outputs_from_config(config)
-    return {
-      "n_in": num_inputs, "n_out": num_outputs,
-      "sparse_input": config.bool("sparse_input", False),
-      "target": config.value('target', 'classes')
-    }
+    return LayerNetworkDescription.network_init_args_from_config(config)
 
   def init_args(self):
     return {
@@ -693,14 +656,28 @@ class LayerNetwork(object):
         params[p_name] = param
     return params
 
-  def save_hdf(self, model, epoch):
+  def get_params_snapshot(self):
+    """
+    :return: copy of all param values in host memory, layer name -> param name -> value.
+      used by :func:`save_hdf`, e.g. when the saving is done in a background thread
+    :rtype: dict[str,dict[str,numpy.ndarray]]
+    """
+    return {name: {p: v.get_value() for (p, v) in layer.params.items()}
+            for (name, layer) in list(self.output.items()) + list(self.hidden.items())}
+
+  def save_hdf(self, model, epoch, params_snapshot=None, update_step=None):
     """
     :type model: h5py.File
     :type epoch: int
+    :param dict[str,dict[str,numpy.ndarray]]|None params_snapshot: from :func:`get_params_snapshot`.
+      if not given, the current param values are used
+    :param int|None update_step: if not given, self.update_step
     """
+    if update_step is None:
+      update_step = self.update_step
     grp = model.create_group('training')
     model.attrs['json'] = self.json_content
-    model.attrs['update_step'] = self.update_step
+    model.attrs['update_step'] = update_step
     model.attrs['epoch'] = epoch
     model.attrs['output'] = 'output' #self.output.keys
     model.attrs['n_in'] = self.n_in
@@ -711,9 +688,9 @@ class LayerNetwork(object):
     for k in self.n_out:
       out_dim.attrs[k] = self.n_out[k][1]
     for h in self.hidden:
-      self.hidden[h].save(model)
+      self.hidden[h].save(model, param_values=params_snapshot[h] if params_snapshot else None)
     for k in self.output:
-      self.output[k].save(model)
+      self.output[k].save(model, param_values=params_snapshot[k] if params_snapshot else None)
 
   def to_json_content(self):
     out = {}
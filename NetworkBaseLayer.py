@@ -71,14 +71,18 @@ class Container(object):
     else:
       return T.tensordot(vec, mat, 1)
 
-  def save(self, head):
+  def save(self, head, param_values=None):
     """
     :type head: h5py.File
+    :param dict[str,numpy.ndarray]|None param_values: if given, saved instead of the current param values
     """
     grp = head.create_group(self.name)
     grp.attrs['class'] = self.layer_class
     for p in self.params.keys():
-      value = self.params[p].get_value()
+      if param_values is not None:
+        value = param_values[p]
+      else:
+        value = self.params[p].get_value()
       dset = grp.create_dataset(p, value.shape, dtype='f')
       dset[...] = value
     for p, v in self.attrs.items():
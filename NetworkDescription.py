@@ -1,4 +1,6 @@
 
+import json
+from Log import log
 from Util import simpleObjRepr, hdf5_dimension, hdf5_group, hdf5_shape
 
 
@@ -162,6 +164,65 @@ class LayerNetworkDescription:
       data[key] = init_args
     return data
 
+  @classmethod
+  def network_json_from_config(cls, config, mask=None):
+    """
+    Used by LayerNetwork.json_from_config(). Does not need Theano, thus it can also be used for TF.
+
+    :type config: Config.Config
+    :param str mask: "unity", "none" or "dropout"
+    :rtype: dict[str]
+    """
+    json_content = None
+    if config.has("network") and config.is_typed("network"):
+      json_content = config.typed_value("network")
+      assert isinstance(json_content, dict)
+      assert json_content
+    elif config.network_topology_json:
+      start_var = config.network_topology_json.find('(config:', 0) # e.g. ..., "n_out" : (config:var), ...
+      while start_var > 0:
+        end_var = config.network_topology_json.find(')', start_var)
+        assert end_var > 0, "invalid variable syntax at " + str(start_var)
+        var = config.network_topology_json[start_var+8:end_var]
+        assert config.has(var), "could not find variable " + var
+        config.network_topology_json = config.network_topology_json[:start_var] + config.value(var,"") + config.network_topology_json[end_var+1:]
+        print >> log.v4, "substituting variable %s with %s" % (var,config.value(var,""))
+        start_var = config.network_topology_json.find('(config:', start_var+1)
+      try:
+        json_content = json.loads(config.network_topology_json)
+      except ValueError as e:
+        print >> log.v3, "----- BEGIN JSON CONTENT -----"
+        print >> log.v3, config.network_topology_json
+        print >> log.v3, "------ END JSON CONTENT ------"
+        assert False, "invalid json content, %r" % e
+      assert isinstance(json_content, dict)
+      if 'network' in json_content:
+        json_content = json_content['network']
+      assert json_content
+    if not json_content:
+      if not mask:
+        if sum(config.float_list('dropout', [0])) > 0.0:
+          mask = "dropout"
+      description = cls.from_config(config)
+      json_content = description.to_json_content(mask=mask)
+    return json_content
+
+  @classmethod
+  def network_init_args_from_config(cls, config):
+    """
+    Used by LayerNetwork.init_args_from_config().
+
+    :type config: Config.Config
+    :rtype: dict[str]
+    :returns the kwarg for LayerNetwork.from_json()
+    """
+    num_inputs, num_outputs = cls.num_inputs_outputs_from_config(config)
+    return {
+      "n_in": num_inputs, "n_out": num_outputs,
+      "sparse_input": config.bool("sparse_input", False),
+      "target": config.value('target', 'classes')
+    }
+
   @classmethod
   def num_inputs_outputs_from_config(cls, config):
     """
@@ -3047,10 +3047,10 @@ class FAlignmentLayer(ForwardLayer):
     self.p_y_given_x = p_in
     y_in = self.y_in[target].reshape(self.index.shape)
     from theano.tensor.extra_ops import cpu_contiguous
-    from Inv import InvAlign
-    alpha = InvAlign(min_skip, max_skip, nstates, focus)(-T.log(self.p_y_given_x), cpu_contiguous(y_in),
-                                                          T.sum(self.sources[0].index, axis=0, dtype='int32'),
-                                                          T.sum(self.index, axis=0, dtype='int32'))
+    from Inv import InvAlignOp
+    alpha = InvAlignOp(min_skip, max_skip, nstates, focus)(-T.log(self.p_y_given_x), cpu_contiguous(y_in),
+                                                            T.sum(self.sources[0].index, axis=0, dtype='int32'),
+                                                            T.sum(self.index, axis=0, dtype='int32'))
     alpha = theano.gradient.disconnected_grad(alpha) # (NS)BT
     self.y_out = y_in.dimshuffle(0, 'x', 1).repeat(nstates, axis=1).reshape(
       (self.index.shape[0] * nstates, self.index.shape[1]))
@@ -506,7 +506,14 @@ class SequenceOutputLayer(OutputLayer):
                fast_bw_opts=None,
                loss_like_ce=False, trained_softmax_prior=False,
                sprint_opts=None, warp_ctc_lib=None,
+               ctc_decoder_opts=None,
                **kwargs):
+    """
+    :param dict[str]|str|None ctc_decoder_opts: for the label errors with CTC, use a prefix beam search
+      (see PrefixBeamSearchDecoder) instead of best path decoding, e.g. {"beam_size": 16}.
+      Optional char n-gram LM via "lm_file" (.npy from PrefixBeamSearchDecoder.estimate_char_ngram_lm),
+      "lm_weight" and "lm_bonus".
+    """
     if fast_bw_opts is None: fast_bw_opts = {}
     self._handle_old_kwargs(kwargs, fast_bw_opts=fast_bw_opts)
     super(SequenceOutputLayer, self).__init__(**kwargs)
@@ -550,6 +557,17 @@ class SequenceOutputLayer(OutputLayer):
     self.sprint_opts = sprint_opts
     if warp_ctc_lib:
       self.set_attr("warp_ctc_lib", warp_ctc_lib)
+    if ctc_decoder_opts:
+      if not isinstance(ctc_decoder_opts, dict):
+        import json
+        ctc_decoder_opts = json.loads(ctc_decoder_opts)
+      self.set_attr("ctc_decoder_opts", ctc_decoder_opts)
+    self.ctc_decoder_opts = ctc_decoder_opts
+    self.ctc_decoder_lm_scores = None
+    if ctc_decoder_opts and ctc_decoder_opts.get("lm_file"):
+      # Load the LM only once per layer. It is a shared variable, thus not embedded into the graph as a constant.
+      self.ctc_decoder_lm_scores = theano.shared(
+        numpy.load(ctc_decoder_opts["lm_file"]).astype("float32"), name="%s_ctc_decoder_lm_scores" % self.name)
     assert self.loss in (
       'ctc', 'ce_ctc', 'hmm', 'ctc2', 'sprint', 'viterbi', 'fast_bw', 'ctc_warp', 'ctc_rasr', 'inv'), 'invalid loss: ' + self.loss
 
@@ -563,6 +581,23 @@ class SequenceOutputLayer(OutputLayer):
         return T.cast(source.output_sizes[:, 1], "int32")
     return T.cast(T.sum(T.cast(self.sources[0].index, 'int32'), axis=0), 'int32')
 
+  def ctc_label_errors(self):
+    """
+    :return: number of label edits for each seq, via best path decoding or the prefix beam search (ctc_decoder_opts)
+    """
+    from theano.tensor.extra_ops import cpu_contiguous
+    y = cpu_contiguous(self.y.dimshuffle(1, 0))
+    if not self.ctc_decoder_opts:
+      return BestPathDecodeOp()(self.p_y_given_x, y, self.index_for_ctc())
+    from PrefixBeamSearchDecoder import PrefixBeamSearchErrorsOp, lm_order_for_scores
+    opts = dict(self.ctc_decoder_opts)
+    opts.pop("lm_file", None)
+    lm_scores = self.ctc_decoder_lm_scores
+    if lm_scores is not None:
+      opts["lm_order"] = lm_order_for_scores(lm_scores.get_value(borrow=True), num_labels=self.attrs['n_out'] - 1)
+    log_posteriors = T.cast(T.log(T.maximum(self.p_y_given_x, 1e-30)), "float32")
+    return PrefixBeamSearchErrorsOp(**opts)(log_posteriors, y, self.index_for_ctc(), lm_scores)
+
   def output_index(self):
     for source in self.sources:
       if hasattr(source, "output_sizes"):
@@ -863,7 +898,7 @@ class SequenceOutputLayer(OutputLayer):
       emissions = self.p_y_given_x
       if self.attrs.get('compute_priors', False):
         emissions = T.exp(T.log(emissions) - self.prior_scale * T.log(T.maximum(self.priors, 1e-10)))
-      return T.sum(BestPathDecodeOp()(self.p_y_given_x, cpu_contiguous(self.y.dimshuffle(1, 0)), self.index_for_ctc()))
+      return T.sum(self.ctc_label_errors())
       #return T.sum(TwoStateBestPathDecodeOp()(emissions, cpu_contiguous(self.y.dimshuffle(1, 0)), self.index_for_ctc()))
     elif self.loss == 'hmm' or (self.loss == 'fast_bw' and self.fast_bw_opts.get('decode',False)):
       emissions = self.p_y_given_x
@@ -882,8 +917,7 @@ class SequenceOutputLayer(OutputLayer):
       if self.fast_bw_opts.get("fsa_source") == "ctc_from_y":
         # TODO ... use Util.uniq / TheanoUtil.uniq ....
         from theano.tensor.extra_ops import cpu_contiguous
-        return T.sum(
-          BestPathDecodeOp()(self.p_y_given_x, cpu_contiguous(self.y.dimshuffle(1, 0)), self.index_for_ctc()))
+        return T.sum(self.ctc_label_errors())
       elif self.fast_bw_opts.get("fsa_source") == "ctc_from_chars":
         # TODO... maybe share code with cost(). we need the same target label seq anyway.
         pass
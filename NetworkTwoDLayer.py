@@ -172,10 +172,12 @@ class DeepLSTM(TwoDBaseLayer):
     W2, V_h2, V_v2 = self.create_and_add_2d_lstm_weights(n_in, n_out, "2")
 
     if str(theano.config.device).startswith('cpu'):
-      Y = T.dot(X,W1)[:n_out*2]
+      from TwoDLSTMCPUOp import TwoDLSTMCPUOp
+      Y1, Y2 = TwoDLSTMCPUOp(2)(*[T.cast(v, "float32") for v in [X, W1, W2, V_h1, V_h2, V_v1, V_v2, b1, b2, sizes]])[:2]
+      Y1, Y2 = T.cast(Y1, theano.config.floatX), T.cast(Y2, theano.config.floatX)
     else:
       Y1, Y2 = BidirectionalTwoDLSTMOpInstance(X, W1, W2, V_h1, V_h2, V_v1, V_v2, b1, b2, sizes)[:2]
-      Y = T.concatenate([Y1,Y2],axis=3)
+    Y = T.concatenate([Y1,Y2],axis=3)
 
     Y.name = 'Y'
     self.set_attr('n_out', n_out*2)
@@ -263,10 +265,14 @@ class TwoDLSTMLayer(TwoDBaseLayer):
       X = self.mass * mask * X
 
     if str(theano.config.device).startswith('cpu'):
-      Y = T.zeros_like(X)
-      if projection == 'concat':
-        Y = Y.repeat(directions,axis=-1)
-        n_out *= directions
+      from TwoDLSTMCPUOp import TwoDLSTMCPUOp
+      # The CPU op only supports float32, like the GPU ops.
+      Ws = [self.W1, self.W2, self.W3, self.W4][:directions]
+      V_hs = [self.V_h1, self.V_h2, self.V_h3, self.V_h4][:directions]
+      V_vs = [self.V_v1, self.V_v2, self.V_v3, self.V_v4][:directions]
+      bs = [self.b1, self.b2, self.b3, self.b4][:directions]
+      Y = TwoDLSTMCPUOp(directions)(*[T.cast(v, "float32") for v in [X] + Ws + V_hs + V_vs + bs + [sizes]])
+      Y = [T.cast(v, theano.config.floatX) for v in Y[:directions]]
     else:
       if directions <= 2:
         Y = BidirectionalTwoDLSTMOpInstance(X, self.W1, self.W2, self.V_h1, self.V_h2, self.V_v1, self.V_v2, self.b1, self.b2, sizes)
@@ -274,15 +280,15 @@ class TwoDLSTMLayer(TwoDBaseLayer):
         Y = MultiDirectionalTwoDLSTMOpInstance(X, self.W1, self.W2, self.W3, self.W4, self.V_h1, self.V_h2, self.V_h3, self.V_h4,
                                                self.V_v1, self.V_v2, self.V_v3, self.V_v4, self.b1, self.b2, self.b3, self.b4, sizes)
 
-      if directions > 1:
-        Y = T.stack(Y[:directions],axis=-1)
-        if projection == 'average':
-          Y = Y.mean(axis=-1)
-        elif projection == 'concat':
-          Y = Y.reshape((Y.shape[0],Y.shape[1],Y.shape[2],Y.shape[3]*Y.shape[4]))
-          n_out *= directions
-      else:
-        Y = Y[0]
+    if directions > 1:
+      Y = T.stack(Y[:directions],axis=-1)
+      if projection == 'average':
+        Y = Y.mean(axis=-1)
+      elif projection == 'concat':
+        Y = Y.reshape((Y.shape[0],Y.shape[1],Y.shape[2],Y.shape[3]*Y.shape[4]))
+        n_out *= directions
+    else:
+      Y = Y[0]
 
     Y.name = 'Y'
     self.set_attr('n_out', n_out)
@@ -6,23 +6,51 @@ import numpy
 
 
 class NumpyDumpDataset(Dataset):
+  """
+  Reads the numpy text dumps as written by dump-dataset.py,
+  i.e. one "<prefix><seq_idx>.data<postfix>" and one "<prefix><seq_idx>.targets<postfix>" file per seq.
+
+  Parsing text is slow. Via binary_cache_prefix, the text dumps are converted once
+  into a packed binary store (see :func:`convert_to_binary_cache`), which is memory-mapped,
+  and loading a seq is just a slice of it.
+  The text dumps stay the source of truth, i.e. the store is rebuilt if it does not match
+  (see :func:`NumpyDumpBinaryCache.matches`).
+  """
 
   file_format_data = "%i.data"
   file_format_targets = "%i.targets"
 
   def __init__(self, prefix, postfix=".txt.gz",
                start_seq=0, end_seq=None,
-               num_inputs=None, num_outputs=None, **kwargs):
+               num_inputs=None, num_outputs=None,
+               binary_cache_prefix=None, binary_cache_full_check=False, **kwargs):
+    """
+    :param str prefix: prefix of the dump files
+    :param str postfix: postfix of the dump files
+    :param int start_seq: first seq idx of the dump files
+    :param int|None end_seq: last seq idx (exclusive). if None, we use all seqs which are there
+    :param int num_inputs: dim of the features
+    :param int num_outputs: num classes of the targets
+    :param str|None binary_cache_prefix: if set, use (or build) the binary store with this prefix
+    :param bool binary_cache_full_check: check every dump file against the store, not just the index header
+    """
     super(NumpyDumpDataset, self).__init__(**kwargs)
     self.file_format_data = prefix + self.file_format_data + postfix
     self.file_format_targets = prefix + self.file_format_targets + postfix
     self.start_seq = start_seq
-    self._init_num_seqs(end_seq)
-    self._seq_index = None
-    self.cached_seqs = []; " :type: list[DatasetSeq] "
     self.num_inputs = num_inputs
     self.num_outputs = num_outputs
     assert num_inputs and num_outputs
+    self.binary_cache = None; " :type: NumpyDumpBinaryCache|None "
+    if binary_cache_prefix:
+      self.binary_cache = NumpyDumpBinaryCache.open_or_convert(
+        prefix=prefix, postfix=postfix, cache_prefix=binary_cache_prefix,
+        start_seq=start_seq, end_seq=end_seq, num_inputs=num_inputs, full_check=binary_cache_full_check)
+      self._num_seqs = self.binary_cache.num_seqs if end_seq is None else end_seq - start_seq
+    else:
+      self._init_num_seqs(end_seq)
+    self._seq_index = None
+    self.cached_seqs = []; " :type: list[DatasetSeq] "
 
   def _init_num_seqs(self, end_seq=None):
     last_seq = None
@@ -38,7 +66,7 @@ class NumpyDumpDataset(Dataset):
       i += 1
     if end_seq is None:
       assert last_seq is not None, "None found. Check %s." % (self.file_format_data % self.start_seq)
-      end_seq = last_seq
+      end_seq = last_seq + 1
     else:
       assert last_seq == end_seq - 1, "Check %s." % (self.file_format_data % end_seq)
     assert end_seq > self.start_seq
@@ -46,8 +74,11 @@ class NumpyDumpDataset(Dataset):
 
   def _load_numpy_seq(self, seq_idx):
     real_idx = self._seq_index[seq_idx]
-    features = numpy.loadtxt(self.file_format_data % real_idx)
-    targets = numpy.loadtxt(self.file_format_targets % real_idx)
+    if self.binary_cache:
+      features, targets = self.binary_cache.get_seq(real_idx - self.start_seq)
+    else:
+      features, targets = load_text_seq(
+        self.file_format_data, self.file_format_targets, real_idx, num_inputs=self.num_inputs)
     assert features.ndim == 2
     assert features.shape[1] == self.num_inputs
     assert targets.ndim == 1
@@ -79,6 +110,9 @@ class NumpyDumpDataset(Dataset):
   def get_ctc_targets(self, seq_idx):
     assert False, "No CTC targets."
 
+  def is_random_access(self):
+    return True
+
   def get_seq_length(self, seq_idx):
     # This is different from the other get_* functions.
     # load_seqs() might not have been called before.
@@ -122,7 +156,261 @@ class NumpyDumpDataset(Dataset):
       return -1
 
   def _add_cache_seq(self, seq_idx, features, targets):
-    last_seq_idx = self._get_cache_last_seq_idx()
-    assert seq_idx == last_seq_idx + 1
+    if self.cached_seqs:
+      assert seq_idx == self._get_cache_last_seq_idx() + 1
     self.cached_seqs += [DatasetSeq(seq_idx, features, targets)]
 
+
+
+class NumpyDumpBinaryCache(object):
+  """
+  Packed binary store of numpy text dumps:
+
+    * "<cache_prefix>data.bin": float32 features of all seqs, concatenated in time, shape (total_frames, num_inputs)
+    * "<cache_prefix>targets.bin": int32 targets of all seqs, concatenated in time
+    * "<cache_prefix>index.npz": frame offsets of the seqs in both blobs, and infos to check whether it matches,
+      i.e. the number of dump files in the dump directory and the mtime and size of every dump file
+
+  Both blobs are memory-mapped.
+  """
+
+  def __init__(self, cache_prefix):
+    """
+    :param str cache_prefix:
+    """
+    self.cache_prefix = cache_prefix
+    index = numpy.load(self.index_filename(cache_prefix))
+    self.start_seq = int(index["start_seq"])
+    self.num_inputs = int(index["num_inputs"])
+    self.source_file_format_data = str(index["file_format_data"])
+    self.data_offsets = index["data_offsets"]
+    self.targets_offsets = index["targets_offsets"]
+    # (num_seqs, 2, 2): per seq, data and targets file, mtime and size. None for stores without it.
+    self.source_file_stats = index["source_file_stats"] if "source_file_stats" in index.files else None
+    # Number of dump files in the dump directory at conversion time. None for stores without it.
+    self.num_dump_files = int(index["num_dump_files"]) if "num_dump_files" in index.files else None
+    self.num_seqs = self.data_offsets.shape[0] - 1
+    self.data = self._memmap(cache_prefix + "data.bin", numpy.float32, (int(self.data_offsets[-1]), self.num_inputs))
+    self.targets = self._memmap(cache_prefix + "targets.bin", numpy.int32, (int(self.targets_offsets[-1]),))
+
+  @staticmethod
+  def _memmap(filename, dtype, shape):
+    if shape[0] == 0:  # numpy.memmap cannot map empty files
+      return numpy.zeros(shape, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode="r", shape=shape)
+
+  @staticmethod
+  def index_filename(cache_prefix):
+    return cache_prefix + "index.npz"
+
+  def get_seq(self, idx):
+    """
+    :param int idx: relative to start_seq
+    :return: features, targets. read-only views into the store
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    assert 0 <= idx < self.num_seqs
+    features = self.data[self.data_offsets[idx]:self.data_offsets[idx + 1]]
+    targets = self.targets[self.targets_offsets[idx]:self.targets_offsets[idx + 1]]
+    return features, targets
+
+  def matches(self, prefix, postfix, start_seq, end_seq, num_inputs, full_check=False):
+    """
+    By default, this only compares what the index holds about the dump directory,
+    i.e. the number of dump files and the mtime and size of the first and the last used dump,
+    thus it does not access every dump file.
+    This catches added, removed or rewritten dumps, but not an in-place change of a dump in the middle
+    which keeps its mtime. For that, use full_check, or rebuild the store (see :func:`main`).
+
+    :param bool full_check: compare the mtime and size of every used dump file
+    :return: whether this store contains exactly what we would get from the text dumps
+    :rtype: bool
+    """
+    if self.source_file_format_data != prefix + NumpyDumpDataset.file_format_data + postfix:
+      return False
+    if self.start_seq != start_seq or self.num_inputs != num_inputs:
+      return False
+    if self.source_file_stats is None or self.num_dump_files is None:
+      return False
+    if end_seq is None:
+      # Dumps which were added later would be missing.
+      end_seq = start_seq + self.num_seqs
+      if os.path.exists(prefix + NumpyDumpDataset.file_format_data % end_seq + postfix):
+        return False
+    if end_seq <= start_seq or self.num_seqs < end_seq - start_seq:
+      return False
+    if _count_dump_files(prefix, postfix) != self.num_dump_files:
+      return False
+    file_formats = [prefix + file_format + postfix
+                    for file_format in [NumpyDumpDataset.file_format_data, NumpyDumpDataset.file_format_targets]]
+    if full_check:
+      idxs = range(end_seq - start_seq)
+    else:
+      idxs = sorted(set([0, end_seq - start_seq - 1]))
+    for idx in idxs:
+      stats = _get_file_stats([file_format % (start_seq + idx) for file_format in file_formats])
+      if stats is None or not numpy.array_equal(stats, self.source_file_stats[idx]):
+        return False
+    return True
+
+  @classmethod
+  def open_or_convert(cls, prefix, postfix, cache_prefix, start_seq, end_seq, num_inputs, full_check=False):
+    """
+    Opens the store, and (re)builds it first from the text dumps if it does not exist or does not match.
+
+    :param bool full_check: see :func:`matches`
+    :rtype: NumpyDumpBinaryCache
+    """
+    if os.path.exists(cls.index_filename(cache_prefix)):
+      cache = cls(cache_prefix)
+      if cache.matches(prefix=prefix, postfix=postfix, start_seq=start_seq, end_seq=end_seq, num_inputs=num_inputs,
+                       full_check=full_check):
+        print >> log.v4, "NumpyDumpDataset: use binary cache %s" % cache_prefix
+        return cache
+      print >> log.v4, "NumpyDumpDataset: binary cache %s does not match the dumps, rebuild" % cache_prefix
+    convert_to_binary_cache(
+      prefix=prefix, postfix=postfix, cache_prefix=cache_prefix,
+      start_seq=start_seq, end_seq=end_seq, num_inputs=num_inputs)
+    return cls(cache_prefix)
+
+
+def load_text_seq(file_format_data, file_format_targets, seq_idx, num_inputs=None):
+  """
+  Loads one seq from the numpy text dumps, with the same dtypes as :class:`NumpyDumpBinaryCache`.
+
+  :param str file_format_data: e.g. "dump-%i.data.txt.gz"
+  :param str file_format_targets: e.g. "dump-%i.targets.txt.gz"
+  :param int seq_idx:
+  :param int|None num_inputs: if None, taken from the file
+  :return: float32 features (time,num_inputs), int32 targets (time,)
+  :rtype: (numpy.ndarray, numpy.ndarray)
+  """
+  features = numpy.loadtxt(file_format_data % seq_idx, dtype="float32")
+  targets = numpy.loadtxt(file_format_targets % seq_idx, ndmin=1)
+  if num_inputs is None:
+    assert features.ndim == 2, "Check %s. Specify num_inputs." % (file_format_data % seq_idx)
+    num_inputs = features.shape[1]
+  features = features.reshape((-1, num_inputs))  # loadtxt squeezes single frames
+  assert features.shape[1] == num_inputs, "Check %s." % (file_format_data % seq_idx)
+  assert targets.ndim == 1, "Check %s." % (file_format_targets % seq_idx)
+  return features, targets.astype("int32")
+
+
+def _get_file_stats(filenames):
+  """
+  :param list[str] filenames:
+  :return: per file (mtime, size), or None if some file does not exist
+  :rtype: list[(float,int)]|None
+  """
+  stats = []
+  for filename in filenames:
+    if not os.path.exists(filename):
+      return None
+    st = os.stat(filename)
+    stats.append((st.st_mtime, st.st_size))
+  return stats
+
+
+def _count_dump_files(prefix, postfix):
+  """
+  :param str prefix: prefix of the dump files
+  :param str postfix: postfix of the dump files
+  :return: number of data and targets dump files in the dump directory
+  :rtype: int
+  """
+  import re
+  dirname, basename = os.path.split(prefix)
+  pattern = re.compile(
+    "^%s[0-9]+(%s|%s)%s$" % (
+      re.escape(basename), re.escape(NumpyDumpDataset.file_format_data[2:]),
+      re.escape(NumpyDumpDataset.file_format_targets[2:]), re.escape(postfix)))
+  return len([name for name in os.listdir(dirname or ".") if pattern.match(name)])
+
+
+def convert_to_binary_cache(prefix, postfix, cache_prefix, start_seq=0, end_seq=None, num_inputs=None):
+  """
+  Converts the numpy text dumps into a :class:`NumpyDumpBinaryCache`.
+  This is a single pass over the text dumps.
+  The blobs are written to temporary files first and renamed, and the index last,
+  such that an existing index always belongs to a complete store.
+
+  :param str prefix: prefix of the dump files
+  :param str postfix: postfix of the dump files
+  :param str cache_prefix:
+  :param int start_seq:
+  :param int|None end_seq: exclusive. if None, until the first missing dump
+  :param int|None num_inputs: if None, taken from the first seq
+  :return: num seqs
+  :rtype: int
+  """
+  file_format_data = prefix + NumpyDumpDataset.file_format_data + postfix
+  file_format_targets = prefix + NumpyDumpDataset.file_format_targets + postfix
+  tmp_suffix = ".tmp%i" % os.getpid()
+  # Like the file stats, taken before reading.
+  num_dump_files = _count_dump_files(prefix, postfix)
+  data_offsets = [0]
+  targets_offsets = [0]
+  source_file_stats = []
+  seq_idx = start_seq
+  with open(cache_prefix + "data.bin" + tmp_suffix, "wb") as data_file, \
+       open(cache_prefix + "targets.bin" + tmp_suffix, "wb") as targets_file:
+    while end_seq is None or seq_idx < end_seq:
+      if end_seq is None and not (
+            os.path.exists(file_format_data % seq_idx) and os.path.exists(file_format_targets % seq_idx)):
+        break
+      # Take the stats before reading, such that a dump which is changed meanwhile is converted again next time.
+      stats = _get_file_stats([file_format_data % seq_idx, file_format_targets % seq_idx])
+      assert stats is not None, "Check %s." % (file_format_data % seq_idx)
+      source_file_stats.append(stats)
+      features, targets = load_text_seq(file_format_data, file_format_targets, seq_idx, num_inputs=num_inputs)
+      num_inputs = features.shape[1]
+      data_file.write(features.tobytes())
+      targets_file.write(targets.tobytes())
+      data_offsets.append(data_offsets[-1] + features.shape[0])
+      targets_offsets.append(targets_offsets[-1] + targets.shape[0])
+      seq_idx += 1
+  num_seqs = seq_idx - start_seq
+  assert num_seqs > 0, "None found. Check %s." % (file_format_data % start_seq)
+  print >> log.v4, "NumpyDumpDataset: converted %i seqs, %i frames into binary cache %s" % (
+    num_seqs, data_offsets[-1], cache_prefix)
+  for name in ["data.bin", "targets.bin"]:
+    os.rename(cache_prefix + name + tmp_suffix, cache_prefix + name)
+  tmp_index_filename = NumpyDumpBinaryCache.index_filename(cache_prefix) + tmp_suffix + ".npz"
+  numpy.savez(
+    tmp_index_filename, start_seq=start_seq, num_inputs=num_inputs, file_format_data=file_format_data,
+    num_dump_files=num_dump_files,
+    data_offsets=numpy.array(data_offsets, dtype="int64"), targets_offsets=numpy.array(targets_offsets, dtype="int64"),
+    source_file_stats=numpy.array(source_file_stats, dtype="float64").reshape((num_seqs, 2, 2)))
+  os.rename(tmp_index_filename, NumpyDumpBinaryCache.index_filename(cache_prefix))
+  return num_seqs
+
+
+def main():
+  from argparse import ArgumentParser
+  arg_parser = ArgumentParser(description="Convert numpy text dumps into the NumpyDumpDataset binary cache.")
+  arg_parser.add_argument("prefix", help="prefix of the dump files, like for dump-dataset.py --dump_prefix")
+  arg_parser.add_argument("cache_prefix", help="prefix of the binary cache files")
+  arg_parser.add_argument("--postfix", default=".txt.gz")
+  arg_parser.add_argument("--start_seq", type=int, default=0)
+  arg_parser.add_argument("--end_seq", type=int, default=None)
+  arg_parser.add_argument(
+    "--full_check", action="store_true",
+    help="if the cache exists, check it against every dump file, and only rebuild it if it does not match")
+  args = arg_parser.parse_args()
+  log.initialize()
+  if args.full_check and os.path.exists(NumpyDumpBinaryCache.index_filename(args.cache_prefix)):
+    cache = NumpyDumpBinaryCache(args.cache_prefix)
+    if cache.matches(
+          prefix=args.prefix, postfix=args.postfix, start_seq=args.start_seq, end_seq=args.end_seq,
+          num_inputs=cache.num_inputs, full_check=True):
+      print >> log.v3, "NumpyDumpDataset: binary cache %s matches all dumps" % args.cache_prefix
+      return
+  convert_to_binary_cache(
+    prefix=args.prefix, postfix=args.postfix, cache_prefix=args.cache_prefix,
+    start_seq=args.start_seq, end_seq=args.end_seq)
+
+
+if __name__ == "__main__":
+  import better_exchook
+  better_exchook.install()
+  main()
@@ -0,0 +1,98 @@
+
+"""
+Common code of the CPU benchmark scripts (benchmark-*.py) which compare different numbers of OpenMP threads.
+OpenMP takes the number of threads from OMP_NUM_THREADS when it is loaded,
+thus the script runs itself in a subprocess (with the hidden --worker option) for every number of threads.
+The worker measures and prints its results as JSON in the last line.
+
+Usage in a script::
+
+  def measure(args):
+    ...
+    return {"fwd": frames_per_sec, ...}
+
+  def main(argv):
+    argparser = argparse.ArgumentParser(description=__doc__)
+    ...
+    args = OmpBenchmark.parse_args(argparser, argv)
+    if args.worker:
+      OmpBenchmark.run_worker(measure, args)
+      return
+    for num_threads, result in OmpBenchmark.run_threads(argv, args):
+      ...
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import argparse
+import json
+import multiprocessing
+import subprocess
+import time
+
+
+def parse_args(argparser, argv):
+  """
+  Adds the common options and parses argv.
+  --threads is the comma-separated list of num threads to compare.
+  --with_reference is set for the first worker only, for measurements which do not depend on the num threads.
+
+  :param argparse.ArgumentParser argparser: with the options of the script
+  :param list[str] argv: sys.argv
+  :rtype: argparse.Namespace
+  """
+  argparser.add_argument("--threads", default="1,%i" % multiprocessing.cpu_count(),
+                         help="comma-separated list of num threads to compare")
+  argparser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+  argparser.add_argument("--with_reference", action="store_true", help=argparse.SUPPRESS)
+  return argparser.parse_args(argv[1:])
+
+
+def measure_calls_per_sec(func, num_runs):
+  """
+  :param ()->None func:
+  :param int num_runs:
+  :return: calls of func per second, after one warmup call
+  :rtype: float
+  """
+  func()  # warmup
+  start_time = time.time()
+  for _ in range(num_runs):
+    func()
+  return num_runs / (time.time() - start_time)
+
+
+def run_worker(measure, args):
+  """
+  :param (argparse.Namespace)->dict[str,float] measure: the benchmark of the script
+  :param argparse.Namespace args: from :func:`parse_args`
+  """
+  print(json.dumps(measure(args)))
+
+
+def run_threads(argv, args, blas_num_threads=None):
+  """
+  Runs the script as worker in a subprocess for every num threads of args.threads.
+
+  :param list[str] argv: sys.argv
+  :param argparse.Namespace args: from :func:`parse_args`
+  :param int|None blas_num_threads: OpenBLAS and MKL would otherwise also use OMP_NUM_THREADS.
+    Unless set in the env, they get this num of threads in all runs.
+  :return: (num_threads, result) for every num threads, with the result of measure()
+  :rtype: list[(int,dict[str,float])]
+  """
+  results = []
+  for i, num_threads in enumerate([int(n) for n in args.threads.split(",")]):
+    env = os.environ.copy()
+    if blas_num_threads is not None:
+      env.setdefault("OPENBLAS_NUM_THREADS", str(blas_num_threads))
+      env.setdefault("MKL_NUM_THREADS", str(blas_num_threads))
+    env["OMP_NUM_THREADS"] = str(num_threads)
+    cmd = [sys.executable, argv[0], "--worker"] + argv[1:]
+    if i == 0:
+      cmd.append("--with_reference")
+    out = subprocess.check_output(cmd, env=env)
+    results.append((num_threads, json.loads(out.decode("utf8").strip().splitlines()[-1])))
+  return results
@@ -45,7 +45,8 @@ class InvAlignOp(theano.Op):
     return hmm.astype('int32').flatten()
 
   def _viterbi(self, start, end, scores, transcription):
-    """Fully aligns sequence from start to end but in inverse manner"""
+    """Fully aligns sequence from start to end but in inverse manner.
+    Same as _viterbi2, but the DP is vectorized over time for every state."""
     inf = 1e30
     lengthT = end - start
     skip = max(min(len(self.tdps), lengthT - self.nstates), 1)
@@ -59,9 +60,7 @@ class InvAlignOp(theano.Op):
 
     # precompute all scores and densities
     score = np.full((lengthS, lengthT + skip - 1), inf)
-    for t in range(0, lengthT):
-      for s in range(0, lengthS):
-        score[s][t + skip - 1] = scores[start + t, hmm[s] / self.nstates]
+    score[:, skip - 1:] = scores[start:end, hmm // self.nstates].T
 
     # forward
     scores = score[0, 0 + skip - 1:skip + skip - 2]
@@ -69,16 +68,16 @@ class InvAlignOp(theano.Op):
     fwdScore[0, 0 + skip - 1:skip + skip - 2] = scores
     bt[0, 0 + skip - 1:skip + skip - 2] = range(1, skip)
 
-    # remaining columns
+    # remaining columns, all frames of a state at once
+    tdps = np.array(tdps[::-1])
     for s in range(1, lengthS):
-      for t in range(max(lengthT - (lengthS - s) * skip,0), lengthT):
-        previous = fwdScore[s - 1, t:t + skip]
-        scores = score[s, t + skip - 1]
-        scores = np.add(scores, np.add(previous, tdps[::-1]))
+      t = np.arange(max(lengthT - (lengthS - s) * skip,0), lengthT)
+      previous = fwdScore[s - 1, t[:, None] + np.arange(skip)]
+      scores = np.add(score[s, t + skip - 1][:, None], np.add(previous, tdps))
 
-        best = np.argmin(scores)
-        fwdScore[s, t + skip - 1] = scores[best]
-        bt[s, t + skip - 1] = skip - 1 - best
+      best = np.argmin(scores, axis=1)
+      fwdScore[s, t + skip - 1] = np.min(scores, axis=1)
+      bt[s, t + skip - 1] = skip - 1 - best
 
     attention = np.full((lengthS), 0, dtype=np.int32)
     labelling = np.full((lengthS), 0, dtype=np.int32)
@@ -14,16 +14,13 @@ class NumpyAlignOp(theano.Op):
   def perform(self, node, inputs_storage, output_storage):
     index_in, index_out, scores, transcriptions = inputs_storage[:4]
     alignment = np.zeros(index_in.shape,'int32')
-    for b in range(scores.shape[1]):
-      length_x = index_in[:,b].sum()
-      length_y = index_out[:,b].sum()
-      if self.inverse:
-        alignment[:length_x,b] = self._fullAlignmentSequenceInv(0, length_x, scores[:length_x,b],
-                                                             transcriptions[:length_y,b])
-      else:
-        #alignment[:length_x,b] = self._fullAlignmentSequence(0, length_x, scores[:length_x,b],
-        #                                                        transcriptions[:length_y,b])
-        alignment[:length_x,b] = self._ViterbiSequence(0, length_x, scores[:length_x,b],transcriptions[:length_y,b])
+    length_x = index_in.sum(axis=0)
+    length_y = index_out.sum(axis=0)
+    # The batch variants give the same result as _fullAlignmentSequenceInv / _ViterbiSequence for every seq.
+    if self.inverse:
+      self._fullAlignmentBatchInv(scores, transcriptions, length_x, length_y, alignment)
+    else:
+      self._ViterbiBatch(scores, transcriptions, length_x, length_y, alignment)
     output_storage[0][0] = alignment
 
   # optional:
@@ -65,6 +62,63 @@ class NumpyAlignOp(theano.Op):
 
     return hmm
 
+  def _buildHmmBatch(self, transcriptions, length_y):
+    """
+    :return: hmm states (batch,max_states) padded with 0, number of states per seq (batch,)
+    """
+    hmms = [self._buildHmm(transcriptions[:length_y[b], b]) for b in range(transcriptions.shape[1])]
+    lengths = np.array([len(hmm) for hmm in hmms], dtype=np.int32)
+    hmm = np.zeros((len(hmms), max(lengths)), dtype=np.int32)
+    for b in range(len(hmms)):
+      hmm[b, :lengths[b]] = hmms[b]
+    return hmm, lengths
+
+  def _ViterbiBatch(self, scores, transcriptions, length_x, length_y, alignment):
+    """Like _ViterbiSequence for all seqs at once, the DP is vectorized over the batch and the states.
+    The padded states and frames of shorter seqs never influence the real ones, because the
+    transitions only go forward in time and states."""
+    inf = 1e30
+    if len(length_x) == 0 or max(length_x) == 0:
+      return
+    hmm, lengthsS = self._buildHmmBatch(transcriptions, length_y)
+    n_batch, lengthS = hmm.shape
+    lengthT = max(length_x)
+    batch_idxs = np.arange(n_batch)
+
+    # emission of every state, see _ViterbiSequence
+    h = (hmm + 1) // self.repetitions
+    h -= h % 3
+    h -= 1
+    h //= self.numStates
+    tdp = np.array(self.tdp[0:3][::-1])
+
+    # with margins of 2 at the bottom or top
+    fwdScore = np.full((n_batch, lengthS + 2), inf)
+    bt = np.full((lengthT, n_batch, lengthS + 2), -1, dtype=np.int8)
+    transScores = np.empty((n_batch, lengthS, 3))
+
+    # forward
+    # initialize first column
+    fwdScore[:, 2] = scores[0, batch_idxs, h[:, 0]]
+
+    # go through all following columns
+    for t in range(1, lengthT):
+      score = scores[t, batch_idxs[:, None], h].astype('float64')
+      for m in range(3):
+        transScores[:, :, m] = fwdScore[:, m:m + lengthS] + score + tdp[m]
+      best = np.argmin(transScores, axis=2)
+      fwdScore[:, 2:] = np.min(transScores, axis=2)
+      bt[t, :, 2:] = 2 - best
+
+    # backtrack, for all seqs in parallel, starting at their last frame
+    s = lengthsS - 1
+    for t in range(lengthT - 1, -1, -1):
+      if t + 1 < lengthT:
+        moving = t + 1 < length_x
+        s = np.where(moving, s - bt[t + 1, batch_idxs, (s + 2) % (lengthsS + 2)], s)
+      valid = t < length_x
+      alignment[t, valid] = hmm[batch_idxs, s % lengthsS][valid]
+
   def _ViterbiSequence(self, start, end, scores, transcription):
     """Align a given sequence with the full sum"""
 
@@ -232,6 +286,78 @@ class NumpyAlignOp(theano.Op):
     #print result
     return result
 
+  def _fullAlignmentBatchInv(self, scores, transcriptions, length_x, length_y, alignment):
+    """Like _fullAlignmentSequenceInv for all seqs at once, the DP is vectorized over the batch and time.
+    Shorter seqs keep their scores once they are through all their states, and the padded frames
+    come after the real ones, thus they never influence the result."""
+    inf = 1e30
+    if len(length_x) == 0 or max(length_x) == 0:
+      return
+    # max skip transitions derived from tdps
+    skip = len(self.tdp)
+    tdp = np.array(self.tdp)
+
+    hmm, lengthsS = self._buildHmmBatch(transcriptions, length_y)
+    n_batch, lengthS = hmm.shape
+    lengthT = max(length_x)
+    batch_idxs = np.arange(n_batch)
+
+    def score(s):
+      """:return: scores (batch,time) of state s (per seq), with margin of skip in front"""
+      res = np.full((n_batch, lengthT + skip - 1), inf)
+      res[:, skip - 1:] = scores[:lengthT, batch_idxs, hmm[batch_idxs, s] // self.numStates].T
+      return res
+
+    leftScore = np.full((n_batch, lengthT + skip - 1), inf)
+    bt = np.zeros((n_batch, lengthS, lengthT), dtype=np.int32)
+    # columns of the frames t, t - 1, ..., t - skip + 1, for every t
+    window = np.arange(lengthT)[:, None] + skip - 1 - np.arange(skip)[None, :]
+
+    # initialize first column
+    if self.silence:
+      leftScore[:, skip - 1:] = np.cumsum(score(0)[:, skip - 1:], axis=1)
+    else:
+      # no silence at the beginning
+      leftScore[:, skip - 1] = score(0)[:, skip - 1]
+
+    # go through all following columns except last (silence)
+    for s in range(1, lengthS - self.silence):
+      # scores calculates just as in recognition
+      cumScore = np.zeros((n_batch, lengthT, skip))
+      cumScore[:, :, 1:] = np.cumsum(score(s)[:, window[:, :-1]], axis=2)
+      transScores = cumScore + tdp + leftScore[:, window]
+
+      # index corresponds to transition
+      active = s < lengthsS - self.silence
+      rightScore = np.full((n_batch, lengthT + skip - 1), inf)
+      rightScore[:, skip - 1:] = np.min(transScores, axis=2)
+      leftScore[active] = rightScore[active]
+      bt[active, s] = np.argmin(transScores[active], axis=2)
+
+    # handle last column (silence) with 1 transitions
+    if self.silence:
+      s = lengthsS - 1
+      silScore = score(s)
+      for t in range(1, lengthT):
+        prevScore = leftScore[:, t + skip - 2] + silScore[:, t + skip - 1]
+        # do 1 transition in silence
+        update = leftScore[:, t + skip - 1] > prevScore
+        leftScore[update, t + skip - 1] = prevScore[update]
+        bt[batch_idxs[update], s[update], t] = bt[batch_idxs[update], s[update], t - 1] + 1
+
+    # backtrack alignment
+    for b in range(n_batch):
+      if length_x[b] == 0:
+        continue
+      t = length_x[b] - 1
+      for s in range(lengthsS[b] - 1, -1, -1):
+        label = (hmm[b, s] // self.numStates + 1) // self.repetitions
+        alignment[t - bt[b, s, t] + 1:t + 1, b] = label
+        t = t - bt[b, s, t]
+        assert t >= 0, "invalid alignment"
+      # handle remaining timeframes -> silence
+      alignment[:t + 1, b] = label
+
   def _fullAlignmentSequenceInv(self, start, end, scores, transcription):
     """Fully aligns sequence from start to end but in inverse manner"""
     inf = 1e30
@@ -0,0 +1,255 @@
+
+// CTC prefix beam search, see PrefixBeamSearchDecoder.py.
+// Like BestPathDecoder, the blank is the last label.
+// Scores are log probabilities. The score of a prefix is log(p_blank + p_non_blank), plus the LM score.
+//
+// LM (optional, lmOrder > 0): a character n-gram LM over the non-blank labels, given as a table
+// lmScores of shape ((numLabels + 1)^(lmOrder - 1), numLabels) with log probabilities,
+// where numLabels excludes the blank. The row is the context of the last lmOrder - 1 labels,
+// encoded in base numLabels + 1, where the digit numLabels means sentence begin. The last label is the lowest digit.
+// Every prefix gets lmWeight * (sum of the LM log probs of its labels) + lmBonus * (number of labels).
+
+class PrefixBeamSearchDecoder
+{
+public:
+    PrefixBeamSearchDecoder(int beamSize, int lmOrder, float lmWeight, float lmBonus):
+        beamSize_(beamSize), lmOrder_(lmOrder), lmWeight_(lmWeight), lmBonus_(lmBonus)
+    {
+    }
+
+    //activs: (time,batch,label) log posteriors
+    //returns the best labelling for seq idx
+    std::vector<int> decode(CArrayF& activs, CArrayI& seqLengths, int idx, CArrayF* lmScores)
+    {
+        nLabelsInclBlank_ = activs.dim(2);
+        blankIdx_ = nLabelsInclBlank_ - 1;
+        T_ = seqLengths(idx);
+        lmNumContexts_ = 1;
+        for(int i = 1; i < lmOrder_; ++i)
+            lmNumContexts_ *= nLabelsInclBlank_;  // base numLabels + 1, i.e. with sentence begin instead of blank
+
+        nodes_.clear();
+        Node root;
+        root.parent = -1;
+        root.label = -1;
+        root.lmContext = lmNumContexts_ - 1;  // all sentence begin
+        root.lmScore = 0;
+        root.pBlank = 0;
+        root.pNonBlank = logZero();
+        root.candStep = -1;
+        nodes_.push_back(root);
+        std::vector<int> beam(1, 0);
+
+        std::vector<Candidate> cands;
+        std::vector<int> candOrder;
+        for(int t = 0; t < T_; ++t)
+        {
+            cands.clear();
+            for(size_t i = 0; i < beam.size(); ++i)
+            {
+                int n = beam[i];
+                float pBlank = nodes_[n].pBlank, pNonBlank = nodes_[n].pNonBlank;
+                float pTotal = logAdd(pBlank, pNonBlank);
+                int lastLabel = nodes_[n].label;
+
+                //stay with the same prefix: blank, or repeat the last label
+                Candidate& self = candidateForNode(cands, n, t);
+                self.pBlank = logAdd(self.pBlank, pTotal + activs(t, idx, blankIdx_));
+                if(lastLabel >= 0)
+                    self.pNonBlank = logAdd(self.pNonBlank, pNonBlank + activs(t, idx, lastLabel));
+
+                //extend the prefix
+                for(int l = 0; l < blankIdx_; ++l)
+                {
+                    //the same label again needs a blank in between
+                    float p = (l == lastLabel ? pBlank : pTotal) + activs(t, idx, l);
+                    int child = findChild(n, l);
+                    if(child >= 0)
+                    {
+                        Candidate& c = candidateForNode(cands, child, t);
+                        c.pNonBlank = logAdd(c.pNonBlank, p);
+                    }
+                    else
+                    {
+                        //only reachable from n, thus no need to merge
+                        Candidate c;
+                        c.node = -1;
+                        c.parent = n;
+                        c.label = l;
+                        c.pBlank = logZero();
+                        c.pNonBlank = p;
+                        c.lmScore = nodes_[n].lmScore + lmLabelScore(nodes_[n].lmContext, l, lmScores);
+                        cands.push_back(c);
+                    }
+                }
+            }
+
+            //prune to the best beamSize_ prefixes
+            candOrder.resize(cands.size());
+            for(size_t i = 0; i < cands.size(); ++i)
+                candOrder[i] = i;
+            size_t newBeamSize = std::min(cands.size(), (size_t) beamSize_);
+            CandidateGreater greater(cands);
+            std::nth_element(candOrder.begin(), candOrder.begin() + newBeamSize, candOrder.end(), greater);
+            beam.clear();
+            for(size_t i = 0; i < newBeamSize; ++i)
+            {
+                const Candidate& c = cands[candOrder[i]];
+                int n = c.node;
+                if(n < 0)
+                    n = addChild(c.parent, c.label, c.lmScore);
+                nodes_[n].pBlank = c.pBlank;
+                nodes_[n].pNonBlank = c.pNonBlank;
+                beam.push_back(n);
+            }
+        }
+
+        int best = beam[0];
+        for(size_t i = 1; i < beam.size(); ++i)
+            if(nodeScore(beam[i]) > nodeScore(best))
+                best = beam[i];
+        std::vector<int> labelling;
+        for(int n = best; nodes_[n].parent >= 0; n = nodes_[n].parent)
+            labelling.push_back(nodes_[n].label);
+        std::reverse(labelling.begin(), labelling.end());
+        return labelling;
+    }
+
+    void labellingErrors(CArrayF& activs, CArrayI& seqLengths, int idx, CArrayI& labellings, ArrayI& lev,
+                         CArrayF* lmScores)
+    {
+        std::vector<int> labelling = decode(activs, seqLengths, idx, lmScores);
+        int len = calcLen(labellings, idx);
+        std::vector<int> reference(len);
+        for(int i = 0; i < len; ++i)
+        {
+            reference[i] = labellings(idx, i);
+        }
+        lev(idx) = levenshteinDist(labelling, reference);
+    }
+
+private:
+    struct Node
+    {
+        int parent;
+        int label;
+        int lmContext;
+        float lmScore;
+        float pBlank, pNonBlank;  // of the last frame in which the prefix was in the beam
+        std::vector<std::pair<int, int> > children;  // (label, node)
+        int candStep, candIdx;  // index into the candidates of the current frame
+    };
+
+    struct Candidate
+    {
+        int node;  // or -1 for a new prefix parent + label
+        int parent, label;
+        float pBlank, pNonBlank;
+        float lmScore;
+    };
+
+    struct CandidateGreater
+    {
+        const std::vector<Candidate>& cands;
+        CandidateGreater(const std::vector<Candidate>& cands_): cands(cands_) {}
+        bool operator()(int a, int b) const
+        {
+            return score(cands[a]) > score(cands[b]);
+        }
+        static float score(const Candidate& c)
+        {
+            return logAdd(c.pBlank, c.pNonBlank) + c.lmScore;
+        }
+    };
+
+    static float logZero()
+    {
+        return -std::numeric_limits<float>::infinity();
+    }
+
+    static float logAdd(float a, float b)
+    {
+        if(a < b)
+            std::swap(a, b);
+        if(b == logZero())
+            return a;
+        return a + log1pf(expf(b - a));
+    }
+
+    float nodeScore(int n) const
+    {
+        return logAdd(nodes_[n].pBlank, nodes_[n].pNonBlank) + nodes_[n].lmScore;
+    }
+
+    Candidate& candidateForNode(std::vector<Candidate>& cands, int n, int t)
+    {
+        Node& node = nodes_[n];
+        if(node.candStep != t)
+        {
+            node.candStep = t;
+            node.candIdx = cands.size();
+            Candidate c;
+            c.node = n;
+            c.parent = node.parent;
+            c.label = node.label;
+            c.pBlank = logZero();
+            c.pNonBlank = logZero();
+            c.lmScore = node.lmScore;
+            cands.push_back(c);
+        }
+        return cands[node.candIdx];
+    }
+
+    int findChild(int n, int label) const
+    {
+        const std::vector<std::pair<int, int> >& children = nodes_[n].children;
+        for(size_t i = 0; i < children.size(); ++i)
+            if(children[i].first == label)
+                return children[i].second;
+        return -1;
+    }
+
+    int addChild(int parent, int label, float lmScore)
+    {
+        Node node;
+        node.parent = parent;
+        node.label = label;
+        node.lmContext = lmNumContexts_ > 1 ? (nodes_[parent].lmContext * nLabelsInclBlank_ + label) % lmNumContexts_ : 0;
+        node.lmScore = lmScore;
+        node.candStep = -1;
+        int n = nodes_.size();
+        nodes_.push_back(node);
+        nodes_[parent].children.push_back(std::make_pair(label, n));
+        return n;
+    }
+
+    float lmLabelScore(int lmContext, int label, CArrayF* lmScores) const
+    {
+        if(lmOrder_ <= 0)
+            return lmBonus_;
+        return lmWeight_ * (*lmScores)(lmContext, label) + lmBonus_;
+    }
+
+    int calcLen(CArrayI& labellings, int idx)
+    {
+        int len = labellings.dim(1);
+        for(int j = 0; j < len; ++j)
+        {
+            if(labellings(idx, j) == -1)
+            {
+                return j;
+            }
+        }
+        return len;
+    }
+
+    int beamSize_;
+    int lmOrder_;
+    float lmWeight_;
+    float lmBonus_;
+    int lmNumContexts_;
+    int T_;
+    int blankIdx_;
+    int nLabelsInclBlank_;
+    std::vector<Node> nodes_;
+};
@@ -0,0 +1,261 @@
+
+"""
+CTC prefix beam search decoding on CPU, as an alternative to the best path (greedy) decoding of BestPathDecoder.
+The C++ code is in PrefixBeamSearchDecoder.cpp. It runs in parallel over the seqs of the batch (via OpenMP).
+
+Optionally, a character n-gram LM can be used (lexicon-free), see :func:`estimate_char_ngram_lm`.
+"""
+
+import theano
+import theano.tensor as T
+import numpy
+import os
+import sys
+
+
+class _PrefixBeamSearchOpBase(theano.Op):
+  __props__ = ("beam_size", "lm_order", "lm_weight", "lm_bonus")
+
+  def __init__(self, beam_size=16, lm_order=0, lm_weight=1.0, lm_bonus=0.0):
+    """
+    :param int beam_size: number of prefixes which we keep after every frame
+    :param int lm_order: order of the character n-gram LM, or 0 for no LM.
+      With an LM, the op expects the LM scores as an additional input, see :func:`estimate_char_ngram_lm`.
+    :param float lm_weight: scale for the LM log probs
+    :param float lm_bonus: added for every label (insertion bonus). also used without LM
+    """
+    super(_PrefixBeamSearchOpBase, self).__init__()
+    assert beam_size > 0
+    assert lm_order >= 0
+    self.beam_size = beam_size
+    self.lm_order = lm_order
+    self.lm_weight = float(lm_weight)
+    self.lm_bonus = float(lm_bonus)
+
+  def _make_inputs(self, log_posteriors, seq_lengths, lm_scores):
+    log_posteriors = T.as_tensor_variable(log_posteriors)
+    assert log_posteriors.ndim == 3  # tensor: nframes x nseqs x dim, blank is the last label
+    assert log_posteriors.dtype == "float32"
+    seq_lengths = T.as_tensor_variable(seq_lengths)
+    assert seq_lengths.ndim == 1  # vector of seqs lengths
+    assert seq_lengths.dtype == "int32"
+    inputs = [log_posteriors, seq_lengths]
+    if self.lm_order > 0:
+      assert lm_scores is not None, "lm_order %i needs the LM scores" % self.lm_order
+      lm_scores = T.as_tensor_variable(lm_scores)
+      assert lm_scores.ndim == 2  # matrix: contexts x labels without blank
+      assert lm_scores.dtype == "float32"
+      inputs.append(lm_scores)
+    else:
+      assert lm_scores is None
+    return inputs
+
+  def _c_decoder_init(self, inp_lm_scores, fail):
+    lm_scores = "0"
+    if self.lm_order > 0:
+      lm_scores = "&lmScoresWr"
+    return {
+      "lm_scores_wrapper": ("CArrayF lmScoresWr(%s);" % inp_lm_scores) if self.lm_order > 0 else "",
+      "check_seq_lengths": """
+        if(seqLensWr.dim(0) != xWr.dim(1))
+        {
+          PyErr_Format(PyExc_ValueError, "PrefixBeamSearch: got %%i seq lengths for %%i seqs",
+                       (int) seqLensWr.dim(0), (int) xWr.dim(1));
+          %(fail)s;
+        }
+        for(int i = 0; i < seqLensWr.dim(0); ++i)
+          if(seqLensWr(i) < 0 || seqLensWr(i) > xWr.dim(0))
+          {
+            PyErr_Format(PyExc_ValueError, "PrefixBeamSearch: seq %%i has length %%i, but there are %%i frames",
+                         i, (int) seqLensWr(i), (int) xWr.dim(0));
+            %(fail)s;
+          }
+      """ % {"fail": fail},
+      "decoder": "PrefixBeamSearchDecoder decoder(%i, %i, %r, %r);" % (
+        self.beam_size, self.lm_order, self.lm_weight, self.lm_bonus),
+      "lm_scores": lm_scores}
+
+  def c_compile_args(self):
+    if sys.platform != "darwin":  # the default clang there does not support it
+      return ['-fopenmp']
+    return []
+
+  # IMPORTANT: change this, if you change the c-code
+  def c_code_cache_version(self):
+    return (2,)
+
+  def c_support_code(self):
+    src = ""
+    path = os.path.dirname(os.path.abspath(__file__))
+    with open(path + '/C_Support_Code.cpp', 'r') as f:
+      src += f.read()
+    with open(path + '/PrefixBeamSearchDecoder.cpp', 'r') as f:
+      src += f.read()
+    return src
+
+
+class PrefixBeamSearchDecodeOp(_PrefixBeamSearchOpBase):
+  """
+  (log_posteriors, seq_lengths[, lm_scores]) -> (labellings, labelling_lengths).
+  labellings is (nseqs x max_labelling_length), padded with -1.
+  """
+
+  def make_node(self, log_posteriors, seq_lengths, lm_scores=None):
+    inputs = self._make_inputs(log_posteriors, seq_lengths, lm_scores)
+    return theano.Apply(self, inputs, [T.imatrix(), T.ivector()])
+
+  def c_code(self, node, name, inp, out, sub):
+    x, seq_lengths = inp[:2]
+    labellings, lens = out
+    fail = sub['fail']
+    d = self._c_decoder_init(inp[2] if self.lm_order > 0 else None, fail=fail)
+    d.update(locals())
+    return """
+      {
+        CArrayF xWr(%(x)s);
+        CArrayI seqLensWr(%(seq_lengths)s);
+        %(check_seq_lengths)s
+        %(lm_scores_wrapper)s
+        int numSeqs = seqLensWr.dim(0);
+        std::vector<std::vector<int> > results(numSeqs);
+        #pragma omp parallel for schedule(dynamic)
+        for(int i = 0; i < numSeqs; ++i)
+        {
+          %(decoder)s
+          results[i] = decoder.decode(xWr, seqLensWr, i, %(lm_scores)s);
+        }
+        int maxLen = 0;
+        for(int i = 0; i < numSeqs; ++i)
+          maxLen = std::max(maxLen, (int) results[i].size());
+        Py_XDECREF(%(labellings)s);
+        Py_XDECREF(%(lens)s);
+        npy_intp dims[] = {numSeqs, maxLen};
+        %(labellings)s = (PyArrayObject*) PyArray_EMPTY(2, dims, NPY_INT32, 0);
+        %(lens)s = (PyArrayObject*) PyArray_EMPTY(1, dims, NPY_INT32, 0);
+        if(!%(labellings)s || !%(lens)s)
+          %(fail)s;
+        ArrayI labellingsWr(%(labellings)s);
+        ArrayI lensWr(%(lens)s);
+        for(int i = 0; i < numSeqs; ++i)
+        {
+          lensWr(i) = results[i].size();
+          for(int j = 0; j < maxLen; ++j)
+            labellingsWr(i, j) = j < (int) results[i].size() ? results[i][j] : -1;
+        }
+      }
+    """ % d
+
+
+class PrefixBeamSearchErrorsOp(_PrefixBeamSearchOpBase):
+  """
+  Like BestPathDecoder.BestPathDecodeOp, i.e. the number of edits for each seq,
+  (log_posteriors, labellings, seq_lengths[, lm_scores]) -> edits,
+  where labellings is (nseqs x max_labelling_length), padded with -1.
+  """
+
+  def make_node(self, log_posteriors, labellings, seq_lengths, lm_scores=None):
+    inputs = self._make_inputs(log_posteriors, seq_lengths, lm_scores)
+    labellings = T.as_tensor_variable(labellings)
+    assert labellings.ndim == 2  # matrix: nseqs x max_labelling_length
+    inputs.insert(1, labellings)
+    return theano.Apply(self, inputs, [T.ivector()])
+    #output: number of edits for each sequence
+
+  def c_code(self, node, name, inp, out, sub):
+    x, y, seq_lengths = inp[:3]
+    lev, = out
+    fail = sub['fail']
+    d = self._c_decoder_init(inp[3] if self.lm_order > 0 else None, fail=fail)
+    d.update(locals())
+    return """
+      Py_XDECREF(%(lev)s);
+      npy_intp dims[] = {PyArray_DIM(%(x)s,1)};
+      %(lev)s = (PyArrayObject*) PyArray_Zeros(1, dims, PyArray_DescrFromType(NPY_INT32), 0);
+      if(!%(lev)s)
+        %(fail)s;
+      {
+        CArrayF xWr(%(x)s);
+        CArrayI yWr(%(y)s);
+        CArrayI seqLensWr(%(seq_lengths)s);
+        ArrayI levWr(%(lev)s);
+        %(check_seq_lengths)s
+        %(lm_scores_wrapper)s
+        int numSeqs = seqLensWr.dim(0);
+        #pragma omp parallel for schedule(dynamic)
+        for(int i = 0; i < numSeqs; ++i)
+        {
+          %(decoder)s
+          decoder.labellingErrors(xWr, seqLensWr, i, yWr, levWr, %(lm_scores)s);
+        }
+      }
+    """ % d
+
+
+def estimate_char_ngram_lm(labellings, num_labels, order=2, smoothing=1.0):
+  """
+  Estimates a character n-gram LM with add-k smoothing, in the format which the decoder expects.
+
+  :param list[list[int]] labellings: training label seqs, without blank
+  :param int num_labels: number of labels, without blank
+  :param int order: n-gram order, >= 1
+  :param float smoothing: k in add-k smoothing
+  :return: log probs, shape ((num_labels + 1) ** (order - 1), num_labels), float32.
+    The row is the context of the last order - 1 labels in base num_labels + 1,
+    where the digit num_labels is the sentence begin, and the last label is the lowest digit.
+  :rtype: numpy.ndarray
+  """
+  assert order >= 1
+  num_contexts = (num_labels + 1) ** (order - 1)
+  counts = numpy.full((num_contexts, num_labels), smoothing, dtype="float64")
+  for labelling in labellings:
+    context = num_contexts - 1  # all sentence begin
+    for label in labelling:
+      counts[context, label] += 1
+      context = (context * (num_labels + 1) + label) % num_contexts
+  return numpy.log(counts / numpy.sum(counts, axis=1, keepdims=True)).astype("float32")
+
+
+def lm_order_for_scores(lm_scores, num_labels):
+  """
+  :param numpy.ndarray lm_scores: see :func:`estimate_char_ngram_lm`
+  :param int num_labels: number of labels, without blank
+  :return: n-gram order of the LM
+  :rtype: int
+  """
+  assert lm_scores.ndim == 2 and lm_scores.shape[1] == num_labels, "invalid LM scores shape %r" % (lm_scores.shape,)
+  order = 1
+  while (num_labels + 1) ** (order - 1) < lm_scores.shape[0]:
+    order += 1
+  assert (num_labels + 1) ** (order - 1) == lm_scores.shape[0], "invalid LM scores shape %r" % (lm_scores.shape,)
+  return order
+
+
+_decode_funcs = {}
+
+def prefix_beam_search_decode(log_posteriors, seq_lengths, beam_size=16, lm_scores=None, lm_weight=1.0, lm_bonus=0.0):
+  """
+  Batch API, without the need to build a Theano graph.
+
+  :param numpy.ndarray log_posteriors: (time,batch,label), the blank is the last label
+  :param numpy.ndarray seq_lengths: (batch,)
+  :param int beam_size:
+  :param numpy.ndarray|None lm_scores: see :func:`estimate_char_ngram_lm`
+  :param float lm_weight:
+  :param float lm_bonus:
+  :return: labelling for every seq
+  :rtype: list[numpy.ndarray]
+  """
+  lm_order = 0
+  if lm_scores is not None:
+    lm_order = lm_order_for_scores(lm_scores, num_labels=log_posteriors.shape[2] - 1)
+  op = PrefixBeamSearchDecodeOp(beam_size=beam_size, lm_order=lm_order, lm_weight=lm_weight, lm_bonus=lm_bonus)
+  if op not in _decode_funcs:
+    inputs = [T.ftensor3("log_posteriors"), T.ivector("seq_lengths")]
+    if lm_order > 0:
+      inputs.append(T.fmatrix("lm_scores"))
+    _decode_funcs[op] = theano.function(inputs, op(*inputs))
+  args = [numpy.asarray(log_posteriors, dtype="float32"), numpy.asarray(seq_lengths, dtype="int32")]
+  if lm_order > 0:
+    args.append(numpy.asarray(lm_scores, dtype="float32"))
+  labellings, lens = _decode_funcs[op](*args)
+  return [labellings[i, :lens[i]] for i in range(len(lens))]
@@ -1,8 +1,7 @@
 
 from __future__ import print_function
 
-from Network import LayerNetwork
-from NetworkBaseLayer import Layer
+from NetworkDescription import LayerNetworkDescription
 from NetworkCopyUtils import intelli_copy_layer, LayerDoNotMatchForCopy
 from Log import log
 from Util import unicode
@@ -347,14 +346,16 @@ class Pretrain:
     :type epoch: int
     :rtype: Network.LayerNetwork
     """
+    from Network import LayerNetwork
+    from NetworkBaseLayer import Layer
     json_content = self.get_network_json_for_epoch(epoch)
     Layer.rng_seed = epoch
     return LayerNetwork.from_json(json_content, mask=mask, **self.network_init_args)
 
   def copy_params_from_old_network(self, new_network, old_network):
     """
-    :type new_network: LayerNetwork
-    :type old_network: LayerNetwork
+    :type new_network: Network.LayerNetwork
+    :type old_network: Network.LayerNetwork
     :returns the remaining hidden layer names which exist only in the new network.
     :rtype: set[str]
     """
@@ -402,8 +403,8 @@ def pretrainFromConfig(config):
   """
   pretrainType = config.value("pretrain", "")
   if pretrainType == "default":
-    network_init_args = LayerNetwork.init_args_from_config(config)
-    original_network_json = LayerNetwork.json_from_config(config)
+    network_init_args = LayerNetworkDescription.network_init_args_from_config(config)
+    original_network_json = LayerNetworkDescription.network_json_from_config(config)
     copy_output_layer = config.bool_or_other("pretrain_copy_output_layer", "ifpossible")
     greedy = config.bool("pretrain_greedy", None)
     if config.is_typed("pretrain_repetitions"):
@@ -1,19 +1,35 @@
-import h5py
 from CachedDataset2 import CachedDataset2
 from Dataset import DatasetSeq
 from Log import log
+import os
 import tempfile
 import scipy.io.wavfile
 import numpy as np
-import time
+
+
+def _readWavFile(wavFilePath):
+  """
+  Module-level such that it can be used by a multiprocessing.Pool.
+
+  :type wavFilePath: str
+  :rtype: numpy.ndarray
+  :return: 1D float32 time signal
+  """
+  (r, x) = scipy.io.wavfile.read(wavFilePath)
+  assert x.ndim == 1, "RawWavDataset: only mono wav files are supported: %s" % wavFilePath
+  return x.astype(np.float32)
+
 
 class RawWavDataset(CachedDataset2):
   """
-  This dataset returns the raw waveform information of wav files as sequence input data
-  It uses temporary hdf files to buffer the data, to avoid repeatadly rading the
-  wav files.
+  This dataset returns the raw waveform information of wav files as sequence input data.
+  All wav files are decoded once into a raw sample store (one float32 file plus an offsets index),
+  which is memory-mapped, to avoid repeatedly reading the wav files.
+  The store can be kept and reused across runs via sampleStoreFile.
+  The frames are strided views into the store, thus framing itself does not copy any data.
   """
-  def __init__(self, listFile, frameLength, frameShift, num_outputs=None, **kwargs):
+  def __init__(self, listFile, frameLength, frameShift, num_outputs=None,
+               sampleStoreFile=None, numDecodeWorkers=None, **kwargs):
     """
     constructor
 
@@ -25,11 +41,17 @@ class RawWavDataset(CachedDataset2):
     :type frameShift: int
     :param frameShift: shift length of frame in samples
     :type num_outputs: int
-    :param num_outputs: this needs to be set if the data set is used with  
+    :param num_outputs: this needs to be set if the data set is used with
                         only input data (e.g. for the extraction
-                        process). 
+                        process).
+    :type sampleStoreFile: str | None
+    :param sampleStoreFile: path of the raw sample store. the offsets index is stored in sampleStoreFile + ".index.npz".
+                            if it exists and matches listFile and the modification times of the wav files,
+                            it is reused. if None, a temporary file is used.
+    :type numDecodeWorkers: int | None
+    :param numDecodeWorkers: number of processes to decode the wav files when the store is built.
+                             None means one per CPU core
     """
-    self._flag_buffering = False
     super(RawWavDataset, self).__init__(**kwargs)
     self._listFile = listFile
     with open(self._listFile, 'r') as f:
@@ -38,13 +60,22 @@ class RawWavDataset(CachedDataset2):
     self._frameLength = frameLength
     self._frameShift = frameShift
     self._flag_pad = True #spcifies if signal is getting cut or zero padded for last frame
+    # After every wav file, the store contains this many zero samples,
+    # such that also the zero padded last frame can be a view into the store.
+    self._padSamples = max(frameLength, frameShift)
 
-    self._num_seqs = len(self._wavFiles) 
+    self._num_seqs = len(self._wavFiles)
     self._seq_index_list = None
 
-    self._hdfBufferHandler, self._hdfBufferPath = self._openHdfBuffer()
+    if sampleStoreFile is None:
+      fId, sampleStoreFile = tempfile.mkstemp(suffix=".rawwav")
+      os.close(fId)
+    self._sampleStoreFile = sampleStoreFile
+    self._numDecodeWorkers = numDecodeWorkers
+    self._sampleOffsets, self._sampleLengths = self._openSampleStore()
+    self._samples = np.memmap(self._sampleStoreFile, dtype=np.float32, mode='r')
 
-    self.num_inputs = self._frameLength 
+    self.num_inputs = self._frameLength
     self.num_outputs = self._getNumOutputs(num_outputs)
 
   def _collect_single_seq(self, seq_idx):
@@ -56,25 +87,8 @@ class RawWavDataset(CachedDataset2):
     :returns DatasetSeq or None if seq_idx >= num_seqs.
     """
     wavFileId = self._seq_index_list[seq_idx]
-    if not self._isInBuffer(wavFileId):
-      self._loadWavFileIdIntoBuffer(wavFileId)
-
-    return self._collect_single_seq_from_buffer(wavFileId, seq_idx)
-
-  def _collect_single_seq_from_buffer(self, wavFileId, seq_idx):
-    """
-    returns the sequence specified by the index seq_idx
-
-    :type wavFileId: int
-    :type seq_idx: int
-    :rtype: DatasetSeq | None
-    :returns DatasetSeq or None if seq_idx >= num_seqs.
-    """
     inputFeatures = self._getInputFeatures(wavFileId)
     outputFeatures = self._getOutputFeatures(wavFileId)
-    inputFeatures = inputFeatures.astype(np.float32)
-    if outputFeatures is not None:
-      outputFeatures = targets.astype(np.float32)
     return DatasetSeq(seq_idx, inputFeatures, outputFeatures)
 
   def _getNumOutputs(self, num_outputs):
@@ -86,35 +100,34 @@ class RawWavDataset(CachedDataset2):
     ret_num_outputs = {'classes': (num_outputs, 2)}
     return ret_num_outputs
 
+  def _getNumFrames(self, wavFileId):
+    """
+    :type wavFileId: int
+    :rtype: int
+    :return: number of frames of the wav file, without loading it
+    """
+    numSamples = int(self._sampleLengths[wavFileId])
+    nrOfFrames = int(np.ceil((float(numSamples - self._frameLength) / self._frameShift) + 1))
+    if not self._flag_pad:
+      nrOfFrames -= 1
+    return max(nrOfFrames, 0)
+
   def _getInputFeatures(self, wavFileId):
     """
 
     :type wavFileId: int
     :param wavFileId: list index of wav file for which to return the input features
     :rtype: 2D numpy.ndarray (frames, features)
-    :return: the 2d array containing the time signal segment for each frame
-    """
-    if not self._isInBuffer(wavFileId):
-      self._loadWavFileIdIntoBuffer(wavFileId)
-
-    timeSignal = self._hdfBufferHandler['timeSignal'][str(wavFileId)][...]
-    frameLength = self._frameLength
-    frameShift = self._frameShift
-    nrOfFrames = int(np.ceil((float(timeSignal.shape[0]-frameLength)/frameShift) + 1))
-    if self._flag_pad:
-      padLength = (nrOfFrames -1) * frameShift + frameLength - timeSignal.shape[0]
-      timeSignalPad = np.zeros((timeSignal.shape[0] + padLength, ))
-      timeSignalPad[0:timeSignal.shape[0]] = timeSignal
-    else:
-      nrOfFrames -= 1  
-      sigLength = (nrOfFrames -1) * frameShift + frameLength
-      timeSignalPad = np.zeros((sigLength, ))
-      timeSignalPad[:] = timeSignal[0:sigLength]
-        
-    inputFeatures = np.zeros((nrOfFrames, frameLength), dtype=np.float32)
-    for i1 in range(nrOfFrames):
-      inputFeatures[i1,:] = timeSignalPad[i1*frameShift:(i1*frameShift+frameLength)]
-    return inputFeatures
+    :return: the 2d array containing the time signal segment for each frame.
+             this is a read-only strided view into the sample store, i.e. frames overlap in memory
+    """
+    nrOfFrames = self._getNumFrames(wavFileId)
+    start = int(self._sampleOffsets[wavFileId])
+    # Covers also the zero padding of the last frame, see self._padSamples.
+    timeSignal = self._samples[start:start + self._sampleLengths[wavFileId] + self._padSamples]
+    itemSize = timeSignal.strides[0]
+    return np.lib.stride_tricks.as_strided(
+      timeSignal, shape=(nrOfFrames, self._frameLength), strides=(self._frameShift * itemSize, itemSize))
 
   def _getOutputFeatures(self, wavFileId):
     """
@@ -124,57 +137,83 @@ class RawWavDataset(CachedDataset2):
     :rtype: #TBD !!!
     :return: #TBD !!!
     """
-    if not self._isInBuffer(wavFileId):
-      self._loadWavFileIdIntoBuffer(wavFileId)
-    if not str(wavFileId) in self._hdfBufferHandler['outputs'].keys():
-      return None
-    else:
-      #TBD !!!
-      pass
+    return None
 
-  def _isInBuffer(self, wavFileId):
+  def _openSampleStore(self):
     """
-    returns true if the wav file has already been loaded into the hdf file buffer
+    Opens the sample store index, and builds the store first if it does not exist
+    or does not match our wav file list, e.g. because a wav file was modified after the store was built.
 
-    :type wavFileId: int
-    :rtype: bool
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    :return: (sample offset per wav file id, num samples per wav file id)
     """
-    if str(wavFileId) in self._hdfBufferHandler['timeSignal'].keys():
-      return True
-    else:
-      return False
-
-  def _loadWavFileIdIntoBuffer(self, wavFileId):
+    indexPath = self._sampleStoreFile + ".index.npz"
+    wavMtimes = self._getWavMtimes()
+    if os.path.exists(indexPath):
+      index = np.load(indexPath)
+      if (list(index['wavFiles']) == self._wavFiles and int(index['padSamples']) >= self._padSamples
+              and 'wavMtimes' in index.files and np.array_equal(index['wavMtimes'], wavMtimes)
+              and os.path.exists(self._sampleStoreFile)):
+        print >> log.v4, "RawWavDataset: use sample store %s" % self._sampleStoreFile
+        return index['offsets'], index['lengths']
+      print >> log.v4, "RawWavDataset: sample store %s does not match the wav files, rebuild" % self._sampleStoreFile
+    return self._buildSampleStore(indexPath, wavMtimes)
+
+  def _getWavMtimes(self):
     """
-    loads the specified wav file into the hdf file buffer
-
-    :type wavFileId: int
-    :param wavFileId: the list index specifying the wav file to be loaded to the buffer
-    """
-    if self._flag_buffering:
-        time.sleep(3)
-    self._flag_buffering = True
-    if self._isInBuffer(wavFileId):
-        return False
-    wavFilePath = self._wavFiles[wavFileId] 
-    (r, x) = scipy.io.wavfile.read(wavFilePath)
-    self._hdfBufferHandler['timeSignal'].create_dataset(str(wavFileId), data=x.astype(np.float32))
-    self._flag_buffering = False
-    return True
-
-  def _openHdfBuffer(self):
+    :rtype: numpy.ndarray
+    :return: modification time per wav file id
     """
-    opens creates a local hdf file used as buffer to avoid reopening wav files
+    return np.array([os.path.getmtime(path) for path in self._wavFiles], dtype=np.float64)
 
-    :rtype: (h5py._hl.file.File, string)
-    :return: (hdf buffer file handler, path to tmp file)
+  def _buildSampleStore(self, indexPath, wavMtimes):
     """
-    fId, tmpHdfFilePath = tempfile.mkstemp(suffix=".hdf") 
-    fileHandler = h5py.File(tmpHdfFilePath, 'w')
-    fileHandler.create_group('timeSignal')
-    fileHandler.create_group('outputs')
-
-    return fileHandler, tmpHdfFilePath 
+    Decodes all wav files, in parallel if possible, and writes them into the sample store.
+    Files are written to temporary paths first and then renamed, the index last,
+    such that an existing index always belongs to a complete store.
+    If the build fails, the temporary files are removed.
+
+    :type indexPath: str
+    :param numpy.ndarray wavMtimes: modification time per wav file id, from before we decode them
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    :return: (sample offset per wav file id, num samples per wav file id)
+    """
+    import multiprocessing
+    numWorkers = self._numDecodeWorkers or multiprocessing.cpu_count()
+    print >> log.v4, "RawWavDataset: build sample store %s from %i wav files with %i workers" % (
+      self._sampleStoreFile, len(self._wavFiles), numWorkers)
+    offsets = np.zeros((len(self._wavFiles),), dtype=np.int64)
+    lengths = np.zeros((len(self._wavFiles),), dtype=np.int64)
+    padding = np.zeros((self._padSamples,), dtype=np.float32)
+    pool = None
+    tmpStorePath = "%s.tmp%i" % (self._sampleStoreFile, os.getpid())
+    tmpIndexPath = "%s.tmp%i.npz" % (indexPath, os.getpid())
+    try:
+      if numWorkers > 1 and len(self._wavFiles) > 1:
+        pool = multiprocessing.Pool(processes=numWorkers)
+        timeSignals = pool.imap(_readWavFile, self._wavFiles, chunksize=4)
+      else:
+        timeSignals = (_readWavFile(path) for path in self._wavFiles)
+      offset = 0
+      with open(tmpStorePath, 'wb') as f:
+        for wavFileId, timeSignal in enumerate(timeSignals):
+          offsets[wavFileId] = offset
+          lengths[wavFileId] = timeSignal.shape[0]
+          f.write(timeSignal.tobytes())
+          f.write(padding.tobytes())
+          offset += timeSignal.shape[0] + padding.shape[0]
+      os.rename(tmpStorePath, self._sampleStoreFile)
+      np.savez(tmpIndexPath, wavFiles=np.array(self._wavFiles), wavMtimes=wavMtimes, padSamples=self._padSamples,
+               offsets=offsets, lengths=lengths)
+      os.rename(tmpIndexPath, indexPath)
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+      for path in [tmpStorePath, tmpIndexPath]:
+        if os.path.exists(path):
+          os.remove(path)
+    return offsets, lengths
 
   def get_data_dim(self, key):
     """This is copied from CachedDataset2 but the assertion is
@@ -213,7 +252,7 @@ class RawWavDataset(CachedDataset2):
     if seq_list:
       raise NotImplementedError('init_seq_order of RawWavDataset does not support a predefined seq_list yet.')
     else:
-      seq_index = self.get_seq_order_for_epoch(epoch, self.num_seqs, lambda s: self.get_seq_length(s).get('data', None))
+      seq_index = self.get_seq_order_for_epoch(epoch, self.num_seqs, self._getNumFrames)
 
     self._seq_index_list = seq_index
     if epoch is not None:
@@ -229,7 +268,5 @@ class RawWavDataset(CachedDataset2):
     :rtype: int
     """
     if self._num_seqs is None:
-      self._num_seqs = len(self._wavFiles) 
+      self._num_seqs = len(self._wavFiles)
     return self._num_seqs
-
-
@@ -26,7 +26,7 @@ import theano.tensor as T
 
 from SprintDataset import SprintDatasetBase
 from Log import log
-from Device import get_gpu_names
+from Device import get_gpu_names, TheanoFlags
 import rnn
 from Engine import Engine
 from EngineUtil import assign_dev_data_single_seq
@@ -274,7 +274,7 @@ def dumpFlags():
   print("CUDA via", theano_cuda.__file__)
   print("CUDA available:", theano_cuda.cuda_available)
 
-  print("THEANO_FLAGS:", rnn.TheanoFlags)
+  print("THEANO_FLAGS:", TheanoFlags)
   print("CUDA_LAUNCH_BLOCKING:", os.environ.get("CUDA_LAUNCH_BLOCKING"))
 
 
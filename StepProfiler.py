@@ -0,0 +1,157 @@
+
+"""
+Lightweight, always-on timing of the phases of each step (mini-batch) of the engines,
+such as waiting for data, the session run or device compute, collecting the device results,
+eval collection, summary writing and parameter sync.
+This is aggregated per epoch, such that we can see whether a job is input-bound or compute-bound.
+Optionally, the steps can be exported as JSONL and as Chrome trace (chrome://tracing).
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from Log import log
+
+
+class StepProfiler(object):
+  """
+  Collects the time spent in named phases per step.
+  Usage::
+
+    with profiler.phase("data", step=step):
+      ...
+    profiler.finish_step(step)
+    ...
+    profiler.finalize()
+
+  Phases can be timed from different threads. Steps are identified by the step (batch) idx.
+  """
+
+  # Typical phases. Other names are fine as well.
+  Data = "data"
+  Compute = "compute"
+  Collect = "collect"  # waiting for and fetching the results of an async compute, e.g. from the Theano devices
+  Eval = "eval"
+  Summary = "summary"
+  Sync = "sync"
+
+  def __init__(self, name, epoch=None, jsonl_filename=None, chrome_trace_filename=None):
+    """
+    :param str name: e.g. "train" or "eval dev". used in the reports and the exported records
+    :param int|None epoch:
+    :param str|None jsonl_filename: if given, one record per step is appended to this file
+    :param str|None chrome_trace_filename: if given, the Chrome trace is written there in finalize()
+    """
+    self.name = name
+    self.epoch = epoch
+    self.jsonl_filename = jsonl_filename
+    self.chrome_trace_filename = chrome_trace_filename
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    self.elapsed = None  # type: float|None
+    self.total_times = {}  # type: dict[str,float]  # phase -> secs
+    self.num_steps = 0
+    self._step_times = {}  # type: dict[int,dict[str,float]]  # step -> phase -> secs, for unfinished steps
+    self._trace_events = []  # type: list[dict[str]]
+    self._jsonl_file = None
+
+  @classmethod
+  def create(cls, name, epoch=None, file_prefix=None):
+    """
+    :param str name:
+    :param int|None epoch:
+    :param str|None file_prefix: if given, exports to file_prefix + ".jsonl" and a Chrome trace per name and epoch.
+      this is the config option "step_profile_file"
+    :rtype: StepProfiler
+    """
+    if not file_prefix:
+      return cls(name=name, epoch=epoch)
+    file_name = re.sub(r"[^a-zA-Z0-9_\-]+", "_", name).strip("_")
+    trace_filename = "%s.%s%s.trace.json" % (file_prefix, file_name, (".ep%03i" % epoch) if epoch is not None else "")
+    return cls(name=name, epoch=epoch, jsonl_filename="%s.jsonl" % file_prefix, chrome_trace_filename=trace_filename)
+
+  def add(self, phase, start_time, end_time, step=None):
+    """
+    :param str phase: e.g. StepProfiler.Data
+    :param float start_time: via time.time()
+    :param float end_time: via time.time()
+    :param int|None step:
+    """
+    duration = end_time - start_time
+    with self.lock:
+      self.total_times[phase] = self.total_times.get(phase, 0.0) + duration
+      if step is not None and self.jsonl_filename:
+        step_times = self._step_times.setdefault(step, {})
+        step_times[phase] = step_times.get(phase, 0.0) + duration
+      if self.chrome_trace_filename:
+        event = {
+          "name": phase, "cat": self.name, "ph": "X", "pid": os.getpid(), "tid": threading.current_thread().name,
+          "ts": int((start_time - self.start_time) * 1e6), "dur": int(duration * 1e6)}
+        if step is not None:
+          event["args"] = {"step": step}
+        self._trace_events.append(event)
+
+  @contextmanager
+  def phase(self, phase, step=None):
+    """
+    :param str phase:
+    :param int|None step:
+    """
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.add(phase, start_time, time.time(), step=step)
+
+  def finish_step(self, step=None):
+    """
+    :param int|None step:
+    """
+    with self.lock:
+      self.num_steps += 1
+      step_times = self._step_times.pop(step, None)
+      if not self.jsonl_filename:
+        return
+      if self._jsonl_file is None:
+        self._jsonl_file = open(self.jsonl_filename, "a")
+      record = {"name": self.name, "epoch": self.epoch, "step": step, "time": time.time()}
+      record.update(step_times or {})
+      self._jsonl_file.write(json.dumps(record) + "\n")
+
+  def get_summary_str(self):
+    """
+    :return: e.g. "data 12.0% (1.2s), compute 80.0% (8.0s), ..."
+    :rtype: str
+    """
+    elapsed = self.elapsed if self.elapsed is not None else time.time() - self.start_time
+    elapsed = max(elapsed, 1e-10)
+    parts = ["%s %.1f%% (%.2fs)" % (phase, t * 100.0 / elapsed, t)
+             for (phase, t) in sorted(self.total_times.items(), key=lambda item: -item[1])]
+    other = elapsed - sum(self.total_times.values())
+    if other > 0:
+      parts.append("other %.1f%% (%.2fs)" % (other * 100.0 / elapsed, other))
+    s = ", ".join(parts)
+    data_time = self.total_times.get(self.Data, 0.0)
+    compute_time = self.total_times.get(self.Compute, 0.0) + self.total_times.get(self.Collect, 0.0)
+    if data_time or compute_time:
+      s += "; %s-bound" % ("input" if data_time > compute_time else "compute")
+    return s
+
+  def finalize(self):
+    """
+    Prints the summary, and writes the exported files.
+    """
+    self.elapsed = time.time() - self.start_time
+    print("%s: %i steps, step time breakdown: %s" % (self.name, self.num_steps, self.get_summary_str()), file=log.v4)
+    with self.lock:
+      if self._jsonl_file:
+        self._jsonl_file.close()
+        self._jsonl_file = None
+      if self.chrome_trace_filename:
+        with open(self.chrome_trace_filename, "w") as f:
+          json.dump({"traceEvents": self._trace_events, "displayTimeUnit": "ms"}, f)
@@ -9,7 +9,6 @@ __author__ = 'menne'
 import os
 import numpy as np
 import h5py
-from collections import deque
 from CachedDataset2 import CachedDataset2
 from Dataset import DatasetSeq
 from BundleFile import BundleFile
@@ -87,6 +86,7 @@ class StereoHdfDataset(StereoDataset):
 
   def __init__(self, hdfFile, num_outputs=None, normalizationFile=None,
                flag_normalizeInputs=True, flag_normalizeTargets=True,
+               readAheadNumSeqs=32,
                **kwargs):
     """Constructor
 
@@ -113,6 +113,10 @@ class StereoHdfDataset(StereoDataset):
     :param flag_normalizeTargets: if True then targets will be normalized
                                  provided that the normalization HDF file has
                                  necessary datasets (i.e. mean and variance)
+    :type readAheadNumSeqs: int
+    :param readAheadNumSeqs: sequences are read in blocks of this size
+                             by a background thread, which always reads the next block ahead.
+                             0 disables it, i.e. sequences are read on demand.
     """
     super(StereoHdfDataset, self).__init__(**kwargs)
 
@@ -125,6 +129,12 @@ class StereoHdfDataset(StereoDataset):
     self._fileHandlers = None
     self._seqMap = None
     self._normData = None
+    # (mean, 1 / sqrt(variance)) as float32, each can be None
+    self._inputNorm = (None, None)
+    self._outputNorm = (None, None)
+    self._readAheadNumSeqs = readAheadNumSeqs
+    self._readAheadPool = None
+    self._readAheadBlocks = {}  # block start seq_idx -> AsyncResult of list[(inputs, targets)]
 
     if not os.path.isfile(hdfFile):
       raise IOError(hdfFile + ' does not exits')
@@ -169,15 +179,17 @@ class StereoHdfDataset(StereoDataset):
     """
     # initialize a sequence map to map the sequence index
     # from an hdf file into the corresponding
-    # hdfFile and hdf-dataset name,
-    # but it could e.g. be used for shuffling sequences as well
-    self._seqMap = {}
-    seqCounter = 0
+    # hdfFile and h5py object references of the input and output datasets,
+    # but it could e.g. be used for shuffling sequences as well.
+    # The datasets are resolved by name only once here,
+    # _readSeq then dereferences them directly via the file handler.
+    self._seqMap = []
     for fhIdx, fh in enumerate(self._fileHandlers):
-      for k in fh['inputs'].keys():
-        self._seqMap[seqCounter] = (fhIdx, k)
-        seqCounter += 1
-    return seqCounter
+      inputsGroup = fh['inputs']
+      outputsGroup = fh['outputs'] if 'outputs' in fh else None
+      for k in inputsGroup.keys():
+        self._seqMap.append((fhIdx, inputsGroup[k].ref, outputsGroup[k].ref if outputsGroup is not None else None))
+    return len(self._seqMap)
 
   def _setNormalization(self, normalizationFile):
     """Set optional normalization (mean and variance).
@@ -191,6 +203,26 @@ class StereoHdfDataset(StereoDataset):
     if not os.path.isfile(normalizationFile):
       raise IOError(normalizationFile + ' does not exist')
     self._normData = NormalizationData(normalizationFile)
+    if self._flag_normalizeInputs:
+      self._inputNorm = StereoHdfDataset._prepareNormalization(self._normData.inputMean, self._normData.inputVariance)
+    if self._flag_normalizeTargets:
+      self._outputNorm = StereoHdfDataset._prepareNormalization(self._normData.outputMean, self._normData.outputVariance)
+
+  @staticmethod
+  def _prepareNormalization(mean, variance):
+    """Helper method.
+
+    :type mean: numpy.ndarray | None
+    :type variance: numpy.ndarray | None
+    :rtype: (numpy.ndarray | None, numpy.ndarray | None)
+    :return: float32 mean and float32 inverse standard deviation, each None if not available
+    """
+    if mean is not None:
+      mean = np.asarray(mean, dtype=np.float32)
+    invStd = None
+    if variance is not None:
+      invStd = (1.0 / np.sqrt(np.asarray(variance, dtype=np.float64))).astype(np.float32)
+    return mean, invStd
 
   def _setInputAndOutputDimensions(self, num_outputs):
     """Set properties which correspond to input and output dimensions.
@@ -254,11 +286,19 @@ class StereoHdfDataset(StereoDataset):
     # has been set during initialization of dataset ...
     if self._num_seqs is not None:
       return self._num_seqs
-    # ... but for some reason _num_seqs is not set at specific points in the
-    # execution of rnn.py therefore the following is a saveguard to fall back on
-    self._num_seqs = self._calculateNumberOfSequences()
+    # ... but CachedDataset2.init_seq_order resets it,
+    # thus we fall back on the sequence index from the initialization
+    self._num_seqs = len(self._seqMap)
     return self._num_seqs
 
+  def init_seq_order(self, epoch=None, seq_list=None):
+    """
+    See StereoDataset.init_seq_order.
+    Pending read-ahead blocks belong to the old order, thus we discard them.
+    """
+    self._discardReadAhead()
+    return super(StereoHdfDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+
   def _collect_single_seq(self, seq_idx):
     """Returns the sequence specified by the index seq_idx.
     Normalization is applied to the input features if mean and variance
@@ -274,55 +314,105 @@ class StereoHdfDataset(StereoDataset):
     # map the seq_idx to the shuffled sequence indices
     if self._seq_index_list is None:
         self.init_seq_order()
-    shuf_seq_idx = self._seq_index_list[seq_idx]
 
-    seqMapping = self._seqMap[shuf_seq_idx]
-    fileIdx = seqMapping[0]
-    datasetName = seqMapping[1]
-    fileHandler = self._fileHandlers[fileIdx]
-    inputFeatures = fileHandler['inputs'][datasetName][...]
-    targets = None
-    if 'outputs' in fileHandler:
-      targets = fileHandler['outputs'][datasetName][...]
-
-    # optional normalization
-    if self._normData is not None:
-      assert isinstance(self._normData, NormalizationData)
-      # inputs
-      if self._flag_normalizeInputs:
-        inputFeatures = StereoHdfDataset._normalizeVector(inputFeatures, self._normData.inputMean, self._normData.inputVariance)
-      # outputs
-      if self._flag_normalizeTargets:
-        targets = StereoHdfDataset._normalizeVector(targets, self._normData.outputMean, self._normData.outputVariance)
+    if self._readAheadNumSeqs > 0 and self._readAheadPool is not None:
+      inputFeatures, targets = self._getFromReadAhead(seq_idx)
+    else:
+      inputFeatures, targets = self._readSeq(self._seq_index_list[seq_idx])
+      if self._readAheadNumSeqs > 0:
+        # The first sequence is read in the constructor (to get the dimensions),
+        # from then on, only the read-ahead thread accesses the HDF files.
+        from multiprocessing.pool import ThreadPool
+        self._readAheadPool = ThreadPool(processes=1)
+    return DatasetSeq(seq_idx, inputFeatures, targets)
 
+  def _readSeq(self, shufSeqIdx):
+    """Reads one sequence directly as float32 and normalizes it in place.
+
+    :type shufSeqIdx: int
+    :param shufSeqIdx: sequence index in the HDF files (i.e. after mapping via self._seq_index_list)
+    :rtype: (numpy.ndarray, numpy.ndarray | None)
+    :return: (input features, targets)
+    """
+    fileIdx, inputRef, outputRef = self._seqMap[shufSeqIdx]
+    fh = self._fileHandlers[fileIdx]
     # enforce float32 to enable Theano optimizations
-    inputFeatures = inputFeatures.astype(np.float32)
-    if targets is not None:
-      targets = targets.astype(np.float32)
+    inputFeatures = StereoHdfDataset._readFloat32(fh[inputRef])
+    StereoHdfDataset._normalizeInPlace(inputFeatures, *self._inputNorm)
+    targets = None
+    if outputRef is not None:
+      targets = StereoHdfDataset._readFloat32(fh[outputRef])
+      StereoHdfDataset._normalizeInPlace(targets, *self._outputNorm)
+    return inputFeatures, targets
 
-    return DatasetSeq(seq_idx, inputFeatures, targets)
+  def _readBlock(self, shufSeqIdxs):
+    """Runs in the read-ahead thread.
+
+    :type shufSeqIdxs: list[int]
+    :rtype: list[(numpy.ndarray, numpy.ndarray | None)]
+    """
+    return [self._readSeq(shufSeqIdx) for shufSeqIdx in shufSeqIdxs]
+
+  def _requestReadAheadBlock(self, blockStart):
+    """
+    :type blockStart: int
+    :param blockStart: a multiple of self._readAheadNumSeqs
+    """
+    if blockStart in self._readAheadBlocks or blockStart >= self.num_seqs:
+      return
+    blockEnd = min(blockStart + self._readAheadNumSeqs, self.num_seqs)
+    # Copy the index part, such that a changed seq order does not affect this read.
+    shufSeqIdxs = list(self._seq_index_list[blockStart:blockEnd])
+    self._readAheadBlocks[blockStart] = self._readAheadPool.apply_async(self._readBlock, (shufSeqIdxs,))
+
+  def _getFromReadAhead(self, seq_idx):
+    """
+    :type seq_idx: int
+    :rtype: (numpy.ndarray, numpy.ndarray | None)
+    """
+    blockStart = seq_idx - seq_idx % self._readAheadNumSeqs
+    for oldBlockStart in list(self._readAheadBlocks.keys()):
+      if oldBlockStart < blockStart:
+        del self._readAheadBlocks[oldBlockStart]  # not needed anymore. it would still finish in the background
+    self._requestReadAheadBlock(blockStart)
+    self._requestReadAheadBlock(blockStart + self._readAheadNumSeqs)
+    # This reraises any exception from the read-ahead thread.
+    return self._readAheadBlocks[blockStart].get()[seq_idx - blockStart]
+
+  def _discardReadAhead(self):
+    for block in self._readAheadBlocks.values():
+      block.wait()  # the thread should not read while we change the order
+    self._readAheadBlocks = {}
 
   @staticmethod
-  def _normalizeVector(v, mean, variance):
+  def _readFloat32(hdfDataset):
     """Helper method.
-    Applies optional normalization to the given vector.
+    Reads the whole h5py dataset into a new float32 array, with the type conversion done by h5py,
+    i.e. without an extra copy.
 
-    :type v: numpy.ndarray | None
-    :param v: vector if available or None otherwise
+    :type hdfDataset: h5py.Dataset
+    :rtype: numpy.ndarray
+    """
+    v = np.empty(hdfDataset.shape, dtype=np.float32)
+    if v.size > 0:
+      hdfDataset.read_direct(v)
+    return v
+
+  @staticmethod
+  def _normalizeInPlace(v, mean, invStd):
+    """Helper method.
+    Applies optional normalization to the given float32 array, in place.
+
+    :type v: numpy.ndarray
     :type mean: numpy.ndarray | None
-    :param mean: mean
-    :type variance: numpy.ndarray | None
-    :param variance: variance
-    :rtype: numpy.ndarray | None
-    :return: normalized vector or None if it was None
+    :param mean: float32 mean
+    :type invStd: numpy.ndarray | None
+    :param invStd: float32 1 / sqrt(variance)
     """
-    if v is None:
-      return v
     if mean is not None:
       v -= mean
-    if variance is not None:
-      v /= np.sqrt(variance)
-    return v
+    if invStd is not None:
+      v *= invStd
 
 
 class DatasetWithTimeContext(StereoHdfDataset):
@@ -366,27 +456,15 @@ class DatasetWithTimeContext(StereoHdfDataset):
     )
     inputFeatures = originalSeq.get_data('data')
     frames, bins = inputFeatures.shape
-    leftContext = deque()
-    rightContext = deque()
-    inFeatWithContext = []
-    for i in range(self._tau):
-      leftContext.append(np.zeros(bins))
-      if i + 1 < frames:
-        rightContext.append(inputFeatures[i + 1, ...])
-      else:
-        rightContext.append(np.zeros(bins))
-    for t in range(frames):
-      f = inputFeatures[t, ...]
-      newFeature = np.concatenate([np.concatenate(leftContext, axis=0), f, np.concatenate(rightContext, axis=0)],axis=0)
-      inFeatWithContext.append(newFeature)
-      leftContext.popleft()
-      leftContext.append(f)
-      rightContext.popleft()
-      if t + 1 + self._tau < frames:
-        rightContext.append(inputFeatures[t + 1 + self._tau, ...])
-      else:
-        rightContext.append(np.zeros(bins))
-    inputFeatures = np.array(inFeatWithContext)
+    # Zero pad tau frames on both sides. Then the context window of frame t
+    # is the contiguous memory of the padded frames t, ..., t + 2 * tau,
+    # thus the stacked features are just a strided view into the padded array.
+    padded = np.zeros((frames + 2 * self._tau, bins), dtype=inputFeatures.dtype)
+    padded[self._tau:self._tau + frames] = inputFeatures
+    itemSize = padded.strides[1]
+    inputFeatures = np.lib.stride_tricks.as_strided(
+      padded, shape=(frames, (2 * self._tau + 1) * bins), strides=(bins * itemSize, itemSize))
+    inputFeatures.setflags(write=False)  # the frames overlap in memory
     targets = None
     if 'classes' in originalSeq.get_data_keys():
       targets = originalSeq.get_data('classes')
@@ -14,15 +14,16 @@ import numpy
 import tensorflow as tf
 from tensorflow.python.client import timeline
 
-from Dataset import Batch, BatchSetGenerator
-from Engine import Engine as TheanoEngine
+from Dataset import BatchSetGenerator
+from EngineBase import EngineBase
 from LearningRateControl import loadLearningRateControlFromConfig
 from Log import log
-from Network import LayerNetwork
+from NetworkDescription import LayerNetworkDescription
 from Pretrain import pretrainFromConfig
-from TFNetwork import TFNetwork, ExternData
+from StepProfiler import StepProfiler
+from TFNetwork import TFNetwork, ExternData, CannotGrowNetwork
 from TFUpdater import Updater
-from Util import hms, NumbersDict
+from Util import hms, NumbersDict, BackgroundCheckpointSaver
 
 
 class DataProvider(object):
@@ -32,7 +33,8 @@ class DataProvider(object):
   It will run a background thread which reads the data from a dataset and puts it into a queue.
   """
 
-  def __init__(self, tf_session, dataset, batches, extern_data, data_keys=None, capacity=10, have_fixed_batch_size=False):
+  def __init__(self, tf_session, dataset, batches, extern_data, data_keys=None, capacity=10, have_fixed_batch_size=False,
+               provide_seq_info=False):
     """
     :param tf.Session tf_session:
     :param Dataset.Dataset dataset:
@@ -40,6 +42,7 @@ class DataProvider(object):
     :param ExternData extern_data:
     :param set(str)|None data_keys:
     :param int capacity:
+    :param bool provide_seq_info: whether to provide the seq idx and tag per batch slice, see self.last_seq_info
     """
     self.tf_session = tf_session
     self.coord = tf.train.Coordinator()
@@ -62,6 +65,10 @@ class DataProvider(object):
     self.num_frames = NumbersDict(0)
     self.thread_finished = False
     self.reached_end = False
+    self.provide_seq_info = provide_seq_info
+    if provide_seq_info:
+      assert not have_fixed_batch_size, "seq info only via the Python queue"
+    self.last_seq_info = None  # type: list[(int,str)|None]  # via get_feed_dict(), (seq_idx, seq_tag) per slice
 
   def start_thread(self):
     thread = Thread(target=self.thread_main, name="DataProvider thread")
@@ -110,12 +117,18 @@ class DataProvider(object):
               ls, l[k], seq.seq_start_frame, seq.seq_end_frame, seq.seq_idx, self.dataset.get_seq_length(seq.seq_idx)))
           data[k][q, o[k]:o[k] + ls] = v
           seq_lens[k][q] = max(seq_lens[k][q], o[k] + ls)
+    if self.provide_seq_info:
+      seq_info = [None] * shapes[self.data_keys[0]][0]  # the batch dim is the same for all data keys
+      with self.dataset.lock:
+        for seq in batch.seqs:
+          seq_info[seq.batch_slice] = (seq.seq_idx, self.dataset.get_tag(seq.seq_idx))
+      data["seq_info"] = seq_info
     return data, seq_lens
 
   def get_next_batch(self):
     data, seq_lens = self._get_next_batch()
     enqueue_args = data.copy()
-    for k in data.keys():
+    for k in seq_lens.keys():
       enqueue_args["%s_seq_lens" % k] = seq_lens[k]
     return enqueue_args
 
@@ -198,6 +211,7 @@ class DataProvider(object):
     else:
       output = self.queue.get() if self.queue else self.tf_queue.dequeue()  # TODO cache dequeue op
     assert isinstance(output, dict)
+    self.last_seq_info = output.get("seq_info")
     # The data itself.
     d = {self.extern_data.get_data(k).placeholder: output[k] for k in self.data_keys}
     # And seq lengths info.
@@ -240,6 +254,7 @@ class Runner(object):
     self.score = {}  # type: dict[str,float]  # entries like "cost:output"
     self.error = {}  # type: dict[str,float]  # entries like "error:output"
     self.stats = {}  # type: dict[str,float]  # entries like "stats:..."
+    self.step_profiler = None  # type: StepProfiler
 
     from Util import terminal_size
     terminal_width, _ = terminal_size()
@@ -404,6 +419,9 @@ class Runner(object):
     step_offset = self.engine.network.get_global_train_step(session=sess)
 
     coord = self.data_provider.coord
+    self.step_profiler = StepProfiler.create(
+      name=report_prefix, epoch=self.engine.epoch, file_prefix=self.engine.config.value("step_profile_file", None))
+    profiler = self.step_profiler
 
     threads = tf.train.start_queue_runners(sess=sess, coord=coord)
     self.data_provider.start_thread()
@@ -416,8 +434,11 @@ class Runner(object):
       # After get_fetches_dict, maybe some new uninitialized vars. Last check.
       self.engine.check_uninitialized_vars()
       feed_dict = None
-      while self.data_provider.have_more_data():
-        feed_dict = self.data_provider.get_feed_dict(previous_feed_dict=feed_dict)
+      while True:
+        with profiler.phase(StepProfiler.Data, step=step):
+          if not self.data_provider.have_more_data():
+            break
+          feed_dict = self.data_provider.get_feed_dict(previous_feed_dict=feed_dict)
         if self.engine.network.train_flag is not False:
           feed_dict[self.engine.network.train_flag] = self._should_train
         start_time = time.time()
@@ -426,25 +447,31 @@ class Runner(object):
           print('Storing metadata', file=log.v5)
           run_options = tf.RunOptions(
             trace_level=tf.RunOptions.FULL_TRACE)
-          fetches_results = sess.run(
-            fetches_dict,
-            feed_dict=feed_dict,
-            options=run_options,
-            run_metadata=run_metadata)
-          writer.add_summary(fetches_results["summary"], step + step_offset)
-          writer.add_run_metadata(run_metadata, 'step_{:04d}'.format(step + step_offset))
+          with profiler.phase(StepProfiler.Compute, step=step):
+            fetches_results = sess.run(
+              fetches_dict,
+              feed_dict=feed_dict,
+              options=run_options,
+              run_metadata=run_metadata)
+          with profiler.phase(StepProfiler.Summary, step=step):
+            writer.add_summary(fetches_results["summary"], step + step_offset)
+            writer.add_run_metadata(run_metadata, 'step_{:04d}'.format(step + step_offset))
           tl = timeline.Timeline(run_metadata.step_stats)
           timeline_path = os.path.join(logdir, 'timeline.trace')
           with open(timeline_path, 'w') as f:
             f.write(tl.generate_chrome_trace_format(show_memory=True))
         else:
-          fetches_results = sess.run(fetches_dict, feed_dict=feed_dict)
-          writer.add_summary(fetches_results["summary"], step + step_offset)
-
-        eval_info = self._collect_eval_info(fetches_results=fetches_results)
-        duration = time.time() - start_time
-        self._print_process(report_prefix=report_prefix, step=step, step_duration=duration,
-                            eval_info=eval_info)
+          with profiler.phase(StepProfiler.Compute, step=step):
+            fetches_results = sess.run(fetches_dict, feed_dict=feed_dict)
+          with profiler.phase(StepProfiler.Summary, step=step):
+            writer.add_summary(fetches_results["summary"], step + step_offset)
+
+        with profiler.phase(StepProfiler.Eval, step=step):
+          eval_info = self._collect_eval_info(fetches_results=fetches_results)
+          duration = time.time() - start_time
+          self._print_process(report_prefix=report_prefix, step=step, step_duration=duration,
+                              eval_info=eval_info)
+        profiler.finish_step(step)
         step += 1
 
       self._print_finish_process()
@@ -471,9 +498,115 @@ class Runner(object):
       coord.join(threads)
       self.data_provider.stop_thread()
       self.elapsed = time.time() - self.start_time
+      profiler.finalize()
+
+
+class ForwardSession(object):
+  """
+  Forwards lists of seqs through the network, without any Dataset, Batch or DataProvider.
+  The feed placeholders and the fetches are set up once, and the padding buffers are reused between calls,
+  thus the Python overhead per call is small.
+  This is intended for many short requests, e.g. for streaming recognition or rescoring.
+  See :func:`Engine.get_forward_session`.
+  """
 
+  def __init__(self, engine, output_layer_names, data_keys=None):
+    """
+    :param Engine engine:
+    :param list[str] output_layer_names: layers to fetch
+    :param list[str]|None data_keys: extern data keys to feed. by default only the default input, e.g. "data"
+    """
+    self.engine = engine
+    self.tf_session = engine.tf_session
+    self.network = engine.network
+    self.output_layer_names = list(output_layer_names)
+    if data_keys is None:
+      data_keys = [self.network.extern_data.default_input]
+    self.data_keys = list(data_keys)
+    self.extern_data = {k: self.network.extern_data.get_data(k) for k in self.data_keys}
+    for k, data in self.extern_data.items():
+      # Same as in DataProvider.
+      assert data.batch_dim_axis == 0 and data.time_dim_axis == 1, "unexpected extern data %r" % data
+      assert list(data.size_placeholder.keys()) == [0], (
+        "only variable length in the time-dim is supported, extern data %r" % data)
+    self._buffers = {}  # type: dict[str,numpy.ndarray]  # data key -> flat buffer, reused between calls
+    self._seq_lens_buffers = {}  # type: dict[str,numpy.ndarray]
+    self._fetches_dict = {}  # type: dict[str,tf.Tensor]
+    for name in self.output_layer_names:
+      assert name in self.network.layers, "output layer %r not found" % name
+      output = self.network.layers[name].output
+      # Batch-major, such that we can simply slice per seq. Time is axis 1 then.
+      self._fetches_dict["output:%s" % name] = output.get_placeholder_as_batch_major()
+      if output.time_dim_axis is not None:
+        self._fetches_dict["size:%s" % name] = output.size_placeholder[output.time_dim_axis_excluding_batch]
+    # Maybe some new uninitialized vars. Last check.
+    engine.check_uninitialized_vars()
 
-class Engine(object):
+  @staticmethod
+  def _get_buffer(buffers, key, shape, dtype):
+    """
+    :param dict[str,numpy.ndarray] buffers: flat buffers
+    :param str key:
+    :param tuple[int] shape:
+    :param str dtype:
+    :return: contiguous view into the buffer with the given shape. the buffer grows if needed
+    :rtype: numpy.ndarray
+    """
+    size = int(numpy.prod(shape))
+    buf = buffers.get(key)
+    if buf is None or buf.size < size:
+      buf = numpy.zeros((max(size, 2 * buf.size if buf is not None else 0),), dtype=dtype)
+      buffers[key] = buf
+    return buf[:size].reshape(shape)
+
+  def get_feed_dict(self, seqs):
+    """
+    :param list[dict[str,numpy.ndarray]] seqs: per seq, data-key -> data (time,...)
+    :rtype: dict[tf.Tensor,numpy.ndarray]
+    """
+    d = {}
+    for k in self.data_keys:
+      data = self.extern_data[k]
+      seq_lens = self._get_buffer(self._seq_lens_buffers, k, (len(seqs),), data.size_dtype)
+      for i, seq in enumerate(seqs):
+        seq_lens[i] = seq[k].shape[0]
+      shape = (len(seqs), int(seq_lens.max())) + seqs[0][k].shape[1:]
+      values = self._get_buffer(self._buffers, k, shape, data.dtype)
+      for i, seq in enumerate(seqs):
+        values[i, :seq_lens[i]] = seq[k]
+        values[i, seq_lens[i]:] = 0  # the buffer is reused, so clear the padding
+      d[data.placeholder] = values
+      d[data.size_placeholder[0]] = seq_lens
+    if self.network.train_flag is not False:
+      d[self.network.train_flag] = False
+    return d
+
+  def forward(self, seqs):
+    """
+    :param list[numpy.ndarray|dict[str,numpy.ndarray]] seqs: per seq, either the data (time,...)
+      if we feed only a single data key, or a dict data-key -> data (time,...)
+    :return: per seq, layer name -> output (time,...), without padding
+    :rtype: list[dict[str,numpy.ndarray]]
+    """
+    if not seqs:
+      return []
+    if not isinstance(seqs[0], dict):
+      assert len(self.data_keys) == 1, "need dicts for data keys %r" % self.data_keys
+      seqs = [{self.data_keys[0]: seq} for seq in seqs]
+    fetches_results = self.tf_session.run(self._fetches_dict, feed_dict=self.get_feed_dict(seqs))
+    results = [{} for _ in seqs]
+    for name in self.output_layer_names:
+      output = fetches_results["output:%s" % name]
+      seq_lens = fetches_results.get("size:%s" % name)
+      for i in range(len(seqs)):
+        if seq_lens is not None:
+          results[i][name] = output[i, :seq_lens[i]]
+        else:
+          results[i][name] = output[i]
+    return results
+
+
+class Engine(EngineBase):
   def __init__(self, config=None):
     """
     :param Config.Config|None config:
@@ -493,13 +626,18 @@ class Engine(object):
     self.train_data = None; " :type: Dataset.Dataset "
     self.start_epoch = None
     self.use_dynamic_train_flag = False
+    self._forward_sessions = {}  # type: dict[(tuple[str],tuple[str]),ForwardSession]
+    self.save_model_async = False
+    self.checkpoint_saver = BackgroundCheckpointSaver()
 
   def finalize(self):
+    self.checkpoint_saver.wait()
     self._close_tf_session()
     tf.reset_default_graph()
     self.network = None
     self.updater = None
     self._merge_all_summaries = None
+    self._forward_sessions.clear()
 
   def _get_devices_config(self):
     """
@@ -564,11 +702,7 @@ class Engine(object):
     tf.reset_default_graph()
     self._checked_uninitialized_vars = False
     self._merge_all_summaries = None
-
-  get_train_start_epoch_batch = TheanoEngine.get_train_start_epoch_batch
-  config_get_final_epoch = TheanoEngine.config_get_final_epoch
-  get_epoch_model = TheanoEngine.get_epoch_model
-  epoch_model_filename = TheanoEngine.epoch_model_filename
+    self._forward_sessions.clear()
 
   def get_epoch_model_filename(self):
     return self.epoch_model_filename(self.model_filename, self.epoch, self.is_pretrain_epoch())
@@ -594,6 +728,12 @@ class Engine(object):
     :param str filename: full filename for model
     """
     print("Save model under %s" % (filename,), file=log.v4)
+    if self.save_model_async:
+      # Snapshot into host memory now. The checkpoint is written in the background.
+      params_snapshot = self.network.get_params_snapshot(session=self.tf_session)
+      self.checkpoint_saver.save(
+        filename, lambda tmp_filename: TFNetwork.save_params_snapshot_to_file(params_snapshot, tmp_filename))
+      return
     self.network.save_params_to_file(filename, session=self.tf_session)
 
   def init_train_from_config(self, config, train_data, dev_data, eval_data):
@@ -613,6 +753,7 @@ class Engine(object):
     self.update_batch_size = config.int('update_batch_size', 0)
     self.save_model_epoch_interval = config.int('save_interval', 1)
     self.save_epoch1_initial_model = config.bool('save_epoch1_initial_model', False)
+    self.save_model_async = config.bool('save_model_async', False)
     self.learning_rate_control = loadLearningRateControlFromConfig(config)
     self.learning_rate = self.learning_rate_control.defaultLearningRate
     self.initial_learning_rate = self.learning_rate
@@ -649,7 +790,7 @@ class Engine(object):
       # In self.init_train_epoch(), we initialize a new model.
       net_dict = self.pretrain.get_network_json_for_epoch(self.epoch)
     else:
-      net_dict = LayerNetwork.json_from_config(config)
+      net_dict = LayerNetworkDescription.network_json_from_config(config)
 
     self._init_network(net_desc=net_dict, epoch=self.epoch)
 
@@ -666,6 +807,7 @@ class Engine(object):
     self._make_tf_session()
     tf.set_random_seed(42)
     network = TFNetwork(
+      config=self.config,
       rnd_seed=epoch,
       train_flag=tf.placeholder(tf.bool, shape=(), name="train_flag")
       if self.use_dynamic_train_flag else False)
@@ -685,6 +827,12 @@ class Engine(object):
     from Util import dict_diff_str
     print("reinit because network description differs. Diff:",
           dict_diff_str(self.network.layers_desc, net_desc), file=log.v3)
+    if self.config.bool("grow_network_in_place", True):
+      try:
+        self._grow_network(net_desc)
+        return
+      except CannotGrowNetwork as exc:
+        print("Cannot grow the network in place (%s: %s), rebuild it." % (type(exc).__name__, exc), file=log.v3)
     old_network_params = self.network.get_params_serialized(self.tf_session)
     self._init_network(net_desc)
     # Otherwise it's initialized randomly which is fine.
@@ -693,6 +841,27 @@ class Engine(object):
     # e.g. if it is the initial model from self.init_network_from_config().
     self.network.set_params_by_serialized(old_network_params, session=self.tf_session)
 
+  def _grow_network(self, net_desc):
+    """
+    Grows the existing network in the existing graph and session, see :func:`TFNetwork.grow_from_dict`.
+    Only the new (and changed) layers and the loss and optimizer ops are constructed.
+
+    :param dict[str,dict[str]] net_desc:
+    """
+    new_layers = self.network.grow_from_dict(net_desc)
+    print("grown network in place, new layers: %s" % [layer.name for layer in new_layers], file=log.v3)
+    self.network.layers_desc = net_desc
+    self._checked_uninitialized_vars = False
+    self._merge_all_summaries = None
+    self._forward_sessions.clear()
+    if self.train_data:
+      # The objective has changed, thus we need new optimizer ops.
+      self.updater = Updater(config=self.config, tf_session=self.tf_session, network=self.network)
+      self.updater.set_trainable_vars(self.network.get_trainable_params())
+    # Initializes the params of the new layers.
+    self.check_uninitialized_vars()
+    self.network.print_network_info()
+
   def train(self):
     if self.start_epoch:
       print("start training at epoch %i and step %i" % (self.start_epoch, self.start_batch), file=log.v3)
@@ -749,6 +918,7 @@ class Engine(object):
       # Save last model, in case it was not saved yet (depends on save_model_epoch_interval).
       if self.model_filename:
         self.save_model(self.get_epoch_model_filename())
+      self.checkpoint_saver.wait()
 
       if self.epoch != self.final_epoch:
         print("Stopped after epoch %i and not %i as planned." % (self.epoch, self.final_epoch), file=log.v3)
@@ -776,6 +946,8 @@ class Engine(object):
 
   def train_epoch(self):
     print("start", self.get_epoch_str(), "with learning rate", self.learning_rate, "...", file=log.v4)
+    # Raises the exception of the background save of the last epoch, if there was one.
+    self.checkpoint_saver.check_error()
 
     if self.epoch == 1 and self.save_epoch1_initial_model:
       epoch0_model_filename = self.epoch_model_filename(self.model_filename, 0, self.is_pretrain_epoch())
@@ -801,6 +973,7 @@ class Engine(object):
     if not trainer.finalized:
       if trainer.device_crash_batch is not None:  # Otherwise we got an unexpected exception - a bug in our code.
         self.save_model(self.get_epoch_model_filename() + ".crash_%i" % trainer.device_crash_batch)
+      self.checkpoint_saver.wait()
       sys.exit(1)
 
     assert not any(numpy.isinf(list(trainer.score.values()))) or any(numpy.isnan(list(trainer.score.values()))), \
@@ -887,6 +1060,32 @@ class Engine(object):
         self.tf_session.run(tf.variables_initializer(uninitialized_vars))
       self._checked_uninitialized_vars = True
 
+  def get_forward_output_layer_name(self, output_layer_name=None):
+    """
+    :param str|None output_layer_name: e.g. "output". if not set, will read from config "forward_output_layer"
+    :rtype: str
+    """
+    if not output_layer_name:
+      output_layer_name = self.config.value("forward_output_layer", self.network.get_default_output_layer_name())
+      assert output_layer_name, "output layer not defined. set forward_output_layer in config"
+    assert output_layer_name in self.network.layers, "output layer %r not found" % output_layer_name
+    return output_layer_name
+
+  def get_forward_session(self, output_layer_names=None, data_keys=None):
+    """
+    :param list[str]|str|None output_layer_names: if not set, see :func:`get_forward_output_layer_name`
+    :param list[str]|None data_keys: extern data keys to feed. by default only the default input
+    :return: forward session for the current network. it is cached until the network gets reinitialized
+    :rtype: ForwardSession
+    """
+    if not output_layer_names or isinstance(output_layer_names, str):
+      output_layer_names = [self.get_forward_output_layer_name(output_layer_names)]
+    key = (tuple(output_layer_names), tuple(data_keys) if data_keys is not None else None)
+    if key not in self._forward_sessions:
+      self._forward_sessions[key] = ForwardSession(
+        engine=self, output_layer_names=output_layer_names, data_keys=data_keys)
+    return self._forward_sessions[key]
+
   def forward_single(self, dataset, seq_idx, output_layer_name=None):
     """
     :param Dataset.Dataset dataset:
@@ -895,30 +1094,106 @@ class Engine(object):
     :return: numpy array, output in time major format (time,batch,dim)
     :rtype: numpy.ndarray
     """
-    if not output_layer_name:
-      output_layer_name = self.config.value("forward_output_layer", self.network.get_default_output_layer_name())
-      assert output_layer_name, "output layer not defined. set forward_output_layer in config"
-    assert output_layer_name in self.network.layers, "output layer %r not found" % output_layer_name
+    output_layer_name = self.get_forward_output_layer_name(output_layer_name)
+    data_keys = sorted(self.network.used_data_keys)
+    forward_session = self.get_forward_session(output_layer_names=[output_layer_name], data_keys=data_keys)
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    seq = {k: dataset.get_data(seq_idx, k) for k in data_keys}
+    output_value = forward_session.forward([seq])[0][output_layer_name]
+    return numpy.expand_dims(output_value, axis=1)  # (time,batch,dim)
+
+  def forward_to_hdf(self, data, output_file, combine_labels='', batch_size=0):
+    """
+    Forwards the dataset and writes the output of the forward output layer into a HDF file,
+    in the same layout as the Theano Engine.forward_to_hdf(), i.e. as HDFDataset reads it.
+    The data is prefetched by the DataProvider thread and written by a HDFForwardWriterThread.
 
-    # No Runner instance here but a very simplified version of Runner.run().
-    # First we need a custom DataProvider with a custom BatchSetGenerator
-    # which will yield only one single batch for the provided sequence idx.
-    batch = Batch()
-    batch.add_frames(seq_idx=seq_idx, seq_start_frame=0, length=dataset.get_seq_length(seq_idx))
-    batch_generator = iter([batch])
-    batches = BatchSetGenerator(dataset, generator=batch_generator)
+    :param Dataset.Dataset data:
+    :param str output_file:
+    :param str combine_labels: ignored at the moment
+    :param int batch_size: 0 means the config "batch_size"
+    """
+    import h5py
+    from Util import hdf5_strings, hdf5_chunk_shape, HDFForwardWriterThread
+    output_layer_name = self.get_forward_output_layer_name()
+    output = self.network.layers[output_layer_name].output
+    assert output.time_dim_axis is not None and not output.sparse and output.ndim == 2, (
+      "expected output (time,dim) for layer %r, got %r" % (output_layer_name, output))
+    data_keys = sorted(self.network.used_data_keys)
+    if not batch_size:
+      batch_size = self.config.int('batch_size', 1)
+    # Every seq gets its own slice (like recurrent), such that we can strip the padding by the seq lens.
+    batches = data.generate_batches(
+      recurrent_net=True, batch_size=batch_size, max_seqs=self.max_seqs, used_data_keys=data_keys)
     data_provider = DataProvider(
-      tf_session=self.tf_session, extern_data=self.network.extern_data,
-      data_keys=self.network.used_data_keys,
-      dataset=dataset, batches=batches)
-
+      tf_session=self.tf_session, extern_data=self.network.extern_data, data_keys=data_keys,
+      dataset=data, batches=batches, provide_seq_info=True)
+    fetches_dict = {
+      "output": output.get_placeholder_as_batch_major(),
+      "seq_lens": output.size_placeholder[output.time_dim_axis_excluding_batch]}
     # Maybe some new uninitialized vars. Last check.
     self.check_uninitialized_vars()
 
-    feed_dict = data_provider.get_feed_dict(previous_feed_dict=None, single_threaded=True)
-    output_data = self.network.layers[output_layer_name].output
-    output_value = self.tf_session.run(output_data.get_placeholder_as_time_major(), feed_dict=feed_dict)
-    return output_value
+    cache = h5py.File(output_file, "w")
+    writer = None
+    try:
+      target = self.network.extern_data.default_target
+      cache.attrs['inputPattSize'] = output.dim
+      cache.attrs['numDims'] = 1
+      num_labels = data.get_data_dim(target) if target in data.num_outputs else output.dim
+      cache.attrs['numLabels'] = num_labels
+      # HDFDataset needs the labels.
+      hdf5_strings(cache, 'labels', data.labels.get(target) or ["%i" % i for i in range(num_labels)])
+      try:
+        num_frames = data.get_num_timesteps()
+        num_seqs = data.num_seqs
+      except Exception:  # not known in advance
+        num_frames, num_seqs = 0, 0
+      compression = self.config.value('forward_hdf_compression', None)
+      opts = {"chunks": hdf5_chunk_shape(
+        [None, output.dim], "float32", chunk_frames=self.config.int('forward_hdf_chunk_frames', 0))}
+      if compression:
+        opts["compression"] = compression
+      # Presized, and shrunk in the end by the writer to the real size.
+      inputs = cache.create_dataset("inputs", (num_frames, output.dim), dtype='f', maxshape=(None, output.dim), **opts)
+      seq_lengths = cache.create_dataset("seqLengths", (num_seqs,), dtype='i', maxshape=(None,))
+      writer = HDFForwardWriterThread(cache=cache, inputs=inputs, seq_lengths=seq_lengths)
+
+      print("Forward to HDF file %r, output layer %r." % (output_file, output_layer_name), file=log.v3)
+      start_time = time.time()
+      step = 0
+      data_provider.start_thread()
+      try:
+        while data_provider.have_more_data():
+          feed_dict = data_provider.get_feed_dict(previous_feed_dict=None)
+          if self.network.train_flag is not False:
+            feed_dict[self.network.train_flag] = False
+          fetches_results = self.tf_session.run(fetches_dict, feed_dict=feed_dict)
+          feats = []
+          tags = []
+          for i, seq_info in enumerate(data_provider.last_seq_info):
+            if seq_info is None:
+              continue
+            seq_idx, seq_tag = seq_info
+            feats.append(fetches_results["output"][i, :fetches_results["seq_lens"][i]])
+            tags.append(seq_tag)
+          if feats:  # the batch could consist of padding slices only
+            writer.add(
+              numpy.concatenate(feats, axis=0), numpy.array([f.shape[0] for f in feats], dtype="int32"), tags=tags)
+          step += 1
+        assert data_provider.reached_end, "did not reach the end of the dataset"
+      finally:
+        data_provider.stop_thread()
+      writer.finish()
+      cache.attrs['numTimesteps'] = writer.num_frames
+      cache.attrs['numSeqs'] = writer.num_seqs
+    finally:
+      if writer:
+        writer.stop()  # no-op if finished. otherwise, we got an exception
+      cache.close()
+    elapsed = time.time() - start_time
+    print("Forwarded %i seqs, %i frames in %i steps, elapsed %s, %.1f frames/sec." % (
+      writer.num_seqs, writer.num_frames, step, hms(elapsed), writer.num_frames / max(elapsed, 1e-10)), file=log.v3)
 
   def analyze(self, data, statistics):
     """
@@ -2,10 +2,16 @@
 from __future__ import print_function
 
 import tensorflow as tf
+from tensorflow.python.framework import op_def_registry
 import NativeOp
 import TFUtil
 import os
 import re
+import sys
+
+
+# The ops which TF itself has. Taken before we register any native op.
+_tf_builtin_op_names = set(op_def_registry.get_registered_ops().keys())
 
 
 def _camel_case_to_snake_case(name):
@@ -88,6 +94,12 @@ class OpMaker(object):
 
   @property
   def op_name(self):
+    """
+    :return: name for REGISTER_OP. must not clash with a TF op, e.g. SparseToDense
+    :rtype: str
+    """
+    if self.name in _tf_builtin_op_names:
+      return "NativeOp%s" % self.name
     return self.name
 
   @property
@@ -114,7 +126,7 @@ class OpMaker(object):
     # https://github.com/tensorflow/tensorflow/blob/master/tensorflow/core/kernels/debug_ops.h  CopyOp...
     # http://stackoverflow.com/questions/37565367/designing-an-accumulating-tensorflow-gpu-operator
     # We also include NativeOp.cpp.
-    in_info, out_info, _ = NativeOp.NativeOp._resolve_want_inplace_dummy(
+    in_info, out_info, _ = NativeOp.NativeOpBaseMixin._resolve_want_inplace_dummy(
       in_info=self.description.in_info, out_info=self.description.out_info)
     out_is_ref = dict()  # output vars which are inplace, out_name -> in_idx
     # want_inplace: output-index which this input should operate on
@@ -127,10 +139,11 @@ class OpMaker(object):
         assert out_name not in out_is_ref
         out_is_ref[out_name] = in_idx
     def map_name(v, is_out=False):
-      name = v["name"].lower()
+      # TF wants names like [a-z][a-z0-9_]*, e.g. "_initial_w" is not allowed.
+      name = v["name"].lower().lstrip("_")
       if is_out:
         # Maybe it clashes with some input name. TF doesn't allow the same name.
-        if any([v["name"].lower() == name for v in in_info]):
+        if any([map_name(v_in) == name for v_in in in_info]):
           name = "out_%s" % name
       return name
     def map_type(v, is_out=False):
@@ -276,8 +289,7 @@ class OpMaker(object):
     code_header += """
     typedef float real;
     typedef int integer;
-    extern "C"
-    extern int sgemm_(char *transa, char *transb,
+    extern "C" int sgemm_(char *transa, char *transb,
       integer *m, integer *n, integer *k,
       const real *alpha,
       const real *a, integer *lda,
@@ -318,6 +330,7 @@ class OpMaker(object):
         #undef Ndarray_sgemm
         #undef DEF_KERNEL
         #undef start_dev_kernel
+        #undef start_dev_kernel2
         #undef assert_cmp
         #undef threadIdx
         #undef blockIdx
@@ -345,11 +358,14 @@ class OpMaker(object):
   def _make_mod(self):
     if self.cache_key in self.mod_cache:
       return self.mod_cache[self.cache_key]
+    ld_flags = ["-lblas"]
+    if not self.with_cuda and sys.platform != "darwin":  # the default clang there does not support it
+      ld_flags += ["-fopenmp"]  # multithreaded CPU kernels, see start_dev_kernel2 in NativeOp.cpp
     comp = TFUtil.OpCodeCompiler(
       base_name=self.name, code_version=self.description.code_version,
       code=self._make_code(),
       include_deps=[self.support_native_op_cpp_filename],
-      ld_flags=["-lblas"],
+      ld_flags=ld_flags,
       **dict(self.compiler_opts))
     mod = comp.load_module()
     self.mod_cache[self.cache_key] = mod
@@ -386,7 +402,7 @@ class OpMaker(object):
         return grad_outputs
 
       grad_wrapper.__name__ = grad_description.name
-      ops.RegisterGradient(self.name)(grad_wrapper)
+      ops.RegisterGradient(self.op_name)(grad_wrapper)
 
     return op
 
@@ -401,6 +417,27 @@ def make_lstm_op(**kwargs):
   return maker.make_op()
 
 
+def make_fast_baum_welch_op(**kwargs):
+  """
+  :return: op, see :class:`NativeOp.FastBaumWelchOp`
+  :rtype: (tf.Tensor) -> tuple[tf.Tensor]
+  """
+  maker = OpMaker(OpDescription.from_gen_base(NativeOp.FastBaumWelchOp), **kwargs)
+  return maker.make_op()
+
+
+def precompile_op(gen_base, compiler_opts=None):
+  """
+  Compiles the op and its gradient op, such that they are in the op cache (see :class:`TFUtil.OpCodeCompiler`)
+  when they are used later, e.g. for training.
+
+  :param type[NativeOp.NativeOpGenBase] gen_base: e.g. NativeOp.LstmGenericBase
+  :param dict[str]|None compiler_opts: passed on to OpCodeCompiler as kwargs
+  """
+  maker = OpMaker(OpDescription.from_gen_base(gen_base), compiler_opts=compiler_opts)
+  maker.make_op()
+
+
 class RecSeqCellOp(object):
   def __init__(self, n_hidden):
     self.n_hidden = n_hidden
@@ -2,11 +2,12 @@
 from __future__ import print_function
 
 import tensorflow as tf
+import re
 import sys
 import numpy
 from Log import log
 from TFNetworkLayer import Data, LayerBase, get_layer_class
-from TFUtil import reuse_name_scope, VariableAssigner
+from TFUtil import reuse_name_scope, get_current_name_scope, VariableAssigner
 
 
 class ExternData(object):
@@ -89,6 +90,13 @@ class ExternData(object):
     return {"names": names, "shapes": shapes, "dtypes": dtypes}
 
 
+class CannotGrowNetwork(Exception):
+  """
+  Raised by :func:`TFNetwork.grow_from_dict` if the network cannot be grown in place,
+  e.g. because of a changed param shape. The network then should be rebuilt from scratch.
+  """
+
+
 class TFNetwork(object):
   def __init__(self, config=None, extern_data=None, rnd_seed=42, train_flag=False):
     """
@@ -122,6 +130,9 @@ class TFNetwork(object):
     self.recurrent = False
     self._assigner_cache = {}  # type: dict[tf.Variable,VariableAssigner]
     self.concat_sources_dropout_cache = {}  # type: dict[(tuple[LayerBase],float),Data]
+    self._param_reuse = None  # type: dict[(str,str),tf.Variable]|None  # (layer name, param key) -> param
+    self._param_keys = {}  # type: dict[str,(str,str)]  # param name -> (layer name, param key), see add_layer()
+    self._layer_scope_names = {}  # type: dict[str,str]  # layer name -> absolute name scope, see add_layer()
 
   def construct_from(self, list_or_dict):
     """
@@ -196,7 +207,13 @@ class TFNetwork(object):
     assert "output" not in layer_desc
     layer_desc["name"] = name
     layer_desc["network"] = self
-    with reuse_name_scope(layer_class.cls_get_tf_scope_name(name)):
+    scope_name = layer_class.cls_get_tf_scope_name(name)
+    if self._param_reuse is not None:
+      # A rebuilt layer gets a new scope, such that its new params get exactly the names which the layer
+      # requested (not uniquified by TF), which is the param key, see maybe_reuse_param().
+      scope_name = self._get_unused_scope_name(scope_name)
+    with reuse_name_scope(scope_name):
+      self._layer_scope_names[name] = get_current_name_scope()
       output = layer_class.get_out_data_from_opts(**layer_desc)
       layer = layer_class(output=output, **layer_desc)
       layer.post_init()
@@ -208,6 +225,123 @@ class TFNetwork(object):
       self.recurrent = True
     return layer
 
+  def grow_from_dict(self, net_dict):
+    """
+    Grows the network in place to the new net dict, e.g. for the next pretrain epoch,
+    instead of constructing a new network in a new graph.
+    Unchanged layers are kept, with their variables. New layers are constructed.
+    Changed layers and the layers depending on them (via sources or target) are reconstructed,
+    and reuse the existing variables of the same layer and param key, see :func:`maybe_reuse_param`.
+    The objective and the saver are reset, such that they get rebuilt.
+    Raises :class:`CannotGrowNetwork` if this is not possible (e.g. a changed param shape),
+    in which case the network is left as before and should be rebuilt from scratch.
+
+    :param dict[str,dict[str]] net_dict:
+    :return: the newly constructed layers
+    :rtype: list[LayerBase]
+    """
+    old_layers = self.layers.copy()
+    old_layers_desc = self.layers_desc.copy()
+    rebuild = set()
+    for name in self.layers.keys():
+      if name in net_dict:
+        if net_dict[name] != old_layers_desc.get(name):
+          rebuild.add(name)
+      elif name != "data" and not name.startswith("data:"):  # implicitly added data layers stay
+        rebuild.add(name)  # removed
+    while True:  # add all layers which depend on the rebuilt layers
+      dependents = set([name for (name, layer) in self.layers.items()
+                        if name not in rebuild and any([dep in rebuild for dep in self._get_layer_deps(layer)])])
+      if not dependents:
+        break
+      rebuild.update(dependents)
+    param_reuse = {}
+    for name in rebuild:
+      for param in self.layers[name].params.values():
+        if param.name not in self._param_keys:  # e.g. via tf.get_variable, thus we could not reuse it
+          raise CannotGrowNetwork("param %r of layer %r was not added via add_param()" % (param.name, name))
+        param_reuse[self._param_keys[param.name]] = param
+    for name in rebuild:
+      self.layers.pop(name)
+      self.layers_desc.pop(name, None)
+    self._param_reuse = param_reuse
+    try:
+      self.construct_from_dict(net_dict)
+    except CannotGrowNetwork:
+      self.layers = old_layers
+      self.layers_desc = old_layers_desc
+      raise
+    finally:
+      self._param_reuse = None
+    self.recurrent = any([layer.recurrent for layer in self.layers.values()])
+    # Reset everything which depends on the set of layers. Rebuilt lazily.
+    self.total_loss = None
+    self.total_constraints = None
+    self.total_objective = None
+    self._selected_train_layers = None
+    self.saver = None
+    summaries = tf.get_collection_ref(tf.GraphKeys.SUMMARIES)
+    summaries[:] = [x for x in summaries if not re.match("^objective(_[0-9]+)?/", x.op.name)]
+    return [layer for (name, layer) in sorted(self.layers.items()) if old_layers.get(name) is not layer]
+
+  def _get_layer_deps(self, layer):
+    """
+    :param LayerBase layer:
+    :return: names of the layers which this layer uses, i.e. its sources, and its target if that is a layer
+    :rtype: list[str]
+    """
+    deps = [src.name for src in layer.sources]
+    if layer.target in self.layers:
+      deps.append(layer.target)
+    return deps
+
+  def _get_unused_scope_name(self, scope_name):
+    """
+    :param str scope_name: relative to the current name scope
+    :return: scope_name, or scope_name with some suffix "_<i>", such that the graph has no ops in it yet
+    :rtype: str
+    """
+    prefix = get_current_name_scope()
+    if prefix:
+      prefix += "/"
+    used = set([op.name[len(prefix):].split("/")[0]
+                for op in tf.get_default_graph().get_operations() if op.name.startswith(prefix)])
+    name = scope_name
+    i = 0
+    while name in used:
+      i += 1
+      name = "%s_%i" % (scope_name, i)
+    return name
+
+  def maybe_reuse_param(self, layer, param):
+    """
+    Registers the param under the layer name and its param key, which is its name relative to the layer scope,
+    e.g. ("output", "W") for "output/W:0".
+    While reconstructing layers in :func:`grow_from_dict`, we reuse the existing variable with the same
+    layer name and param key. The rebuilt layer has a new scope (e.g. "output_1/W:0"), see :func:`add_layer`.
+    The new variable is removed from the variable collections, thus it never gets initialized.
+
+    :param LayerBase layer:
+    :param tf.Variable param: newly created variable of the layer
+    :return: param, or the existing variable
+    :rtype: tf.Variable
+    """
+    scope_prefix = self._layer_scope_names[layer.name] + "/"
+    assert param.name.startswith(scope_prefix), "param %r not in scope of layer %r" % (param.name, layer)
+    key = (layer.name, param.name[len(scope_prefix):].rsplit(":", 1)[0])
+    if not self._param_reuse or key not in self._param_reuse:
+      self._param_keys[param.name] = key
+      return param
+    old_param = self._param_reuse.pop(key)
+    if old_param.get_shape().as_list() != param.get_shape().as_list() or old_param.dtype != param.dtype:
+      raise CannotGrowNetwork("cannot reuse param %r with shape %r for shape %r" % (
+        old_param.name, old_param.get_shape().as_list(), param.get_shape().as_list()))
+    for key in [tf.GraphKeys.GLOBAL_VARIABLES, tf.GraphKeys.TRAINABLE_VARIABLES]:
+      collection = tf.get_collection_ref(key)
+      if param in collection:
+        collection.remove(param)
+    return old_param
+
   def get_extern_data(self, key, mark_data_key_as_used=True):
     """
     Returns Data and add the key to self.used_data_keys if mark_data_key_as_used.
@@ -505,6 +639,43 @@ class TFNetwork(object):
           continue
         raise
 
+  def get_params_snapshot(self, session):
+    """
+    :param tf.Session session:
+    :return: copy of the values of all params which are saved in the checkpoint, in host memory.
+      param name as in the checkpoint -> value
+    :rtype: dict[str,numpy.ndarray]
+    """
+    params = self.get_params_list() + self.get_auxiliary_params()
+    values = session.run(params)
+    # The fetched arrays can share the memory of the variables, which are updated inplace. Thus copy.
+    return {param.op.name: numpy.array(value, copy=True) for (param, value) in zip(params, values)}
+
+  @staticmethod
+  def save_params_snapshot_to_file(params_snapshot, filename):
+    """
+    Saves a checkpoint which can be loaded via :func:`load_params_from_file`.
+    This does not use the graph nor the session of the network, thus it can run in a background thread.
+
+    :param dict[str,numpy.ndarray] params_snapshot: via :func:`get_params_snapshot`
+    :param str filename:
+    :return: written files, the index file last
+    :rtype: list[str]
+    """
+    import glob
+    with tf.Graph().as_default():
+      feed_dict = {}
+      var_list = {}
+      for name, value in sorted(params_snapshot.items()):
+        placeholder = tf.placeholder(dtype=value.dtype, shape=value.shape)
+        var_list[name] = tf.Variable(initial_value=placeholder, trainable=False)
+        feed_dict[placeholder] = value
+      saver = tf.train.Saver(var_list=var_list)
+      with tf.Session(config=tf.ConfigProto(device_count={"GPU": 0})) as session:
+        session.run(tf.variables_initializer(list(var_list.values())), feed_dict=feed_dict)
+        saver.save(sess=session, save_path=filename, write_meta_graph=False, write_state=False)
+    return sorted(glob.glob("%s.data-*" % filename)) + ["%s.index" % filename]
+
   def load_params_from_file(self, filename, session):
     """
     Will save the model parameters to the filename.
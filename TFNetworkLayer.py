@@ -158,6 +158,7 @@ class LayerBase(object):
     :rtype tf.Variable
     """
     assert param.name
+    param = self.network.maybe_reuse_param(layer=self, param=param)
     self.params[param.name] = param
     return param
 
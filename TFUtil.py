@@ -1142,11 +1142,16 @@ class OpCodeCompiler(object):
     return "%s/%s.cc" % (self._mod_path, self.base_name)
 
   _cleanup_time_limit_days = 60
+  _cleanup_old_done_paths = set()  # base mod paths which we already checked in this process
 
   def _cleanup_old(self):
     mod_path = self._mod_path  # .../base_name/hash
     base_mod_path = os.path.dirname(mod_path)  # .../base_name
     my_mod_path_name = os.path.basename(mod_path)
+    # Scanning the dir can be slow, e.g. on NFS. Doing it once per process is enough.
+    if base_mod_path in self._cleanup_old_done_paths:
+      return
+    self._cleanup_old_done_paths.add(base_mod_path)
     if not os.path.exists(base_mod_path):
       return
     import time
@@ -1283,8 +1288,8 @@ class OpCodeCompiler(object):
       common_opts += compiler_opts
     common_opts += ["-D_GLIBCXX_USE_CXX11_ABI=0"]  # might be obsolete in the future
     common_opts += ["-D%s=%s" % item for item in sorted(self.c_macro_defines)]
-    common_opts += self.ld_flags
     opts = common_opts + [self._cc_filename, "-o", self._so_filename]
+    opts += self.ld_flags  # after the source, otherwise the linker might drop the libs (e.g. with --as-needed)
     cmd_bin = "g++"
     if self._cuda_env:
       cmd_bin = self._cuda_env.get_compiler_bin()
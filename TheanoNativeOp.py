@@ -0,0 +1,363 @@
+"""
+The Theano op for :class:`NativeOp.NativeOpBaseMixin`, i.e. the CPU and GPU op,
+together with the Theano optimizations for it (inplace and GPU).
+This is separate from NativeOp such that the op descriptions can be used without Theano, e.g. for TF.
+"""
+
+import sys
+import os
+import theano
+import theano.sandbox.cuda
+import theano.tensor as T
+from theano.compile import optdb
+from theano import gof
+from Util import escape_c_str
+from TheanoUtil import try_register_gpu_opt, make_var_tuple
+from NativeOp import NativeOpBaseMixin
+
+
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+  long = int
+
+
+class NativeOp(theano.Op, NativeOpBaseMixin):
+  """
+  We wrap some C code which can define a forward pass
+  and optionally a backward pass (for gradient calculation).
+  The C code should be Numpy and CUDA compatible. See NativeOp.cpp.
+  We also support inplace operations, i.e. we can operate inplace on some inputs.
+  You can define in a flexible way all the inputs and the outputs.
+  See __init__() for the details.
+
+  All output variables are created automatically with the right shape
+   but their content is not initialized,
+   except when its used by some input variable as the inplace output
+   - in that case, it is either the input variable or it has a copy of its data.
+  """
+
+  __props__ = ("in_info", "out_info",
+               "c_fw_code", "c_bw_code", "c_extra_support_code", "code_version",
+               "grad_input_map", "name",
+               "custom_grad")
+
+  def __init__(self, custom_grad=None, **kwargs):
+    """
+    :param function custom_grad: if given, will use this instead for self.grad
+    :param dict[str] kwargs: all passed to NativeOpBaseMixin
+    """
+    theano.Op.__init__(self)
+    NativeOpBaseMixin.__init__(self, **kwargs)
+    self.custom_grad = custom_grad
+
+  def __str__(self):
+    return "%s{%s,%s}" % (
+      self.__class__.__name__,
+      self.name,
+      "inplace" if self.destroy_map else "no_inplace")
+
+  @classmethod
+  def as_tensor_var(cls, v):
+    return theano.tensor.as_tensor_variable(v)
+
+  @classmethod
+  def tensor_type(cls, dtype, ndim):
+    return T.TensorType(dtype=dtype, broadcastable=(False,) * ndim)
+
+  @classmethod
+  def contiguous(cls, v):
+    from TheanoUtil import Contiguous
+    assert isinstance(v, theano.Variable)
+    if getattr(v, 'owner', None):
+      assert isinstance(v.owner, theano.Apply)
+      if isinstance(v.owner.op, Contiguous.__base__):
+        return v
+    return Contiguous()(v)
+
+  def _convert_input_var(self, v, info):
+    v = self.as_tensor_var(v)
+    dtype = info.get("dtype", "float32")
+    if v.dtype != dtype:
+      v = T.cast(v, dtype)
+    if v.ndim != info["ndim"]:
+      raise TypeError("input var ndim %i does not match with info %r" % (v.ndim, info))
+    if info.get("need_contiguous", False):
+      v = self.contiguous(v)
+    return v
+
+  def grad(self, inputs, output_grads):
+    if self.custom_grad:
+      return self.custom_grad(self, inputs, output_grads)
+
+    if not self.c_bw_code:
+      # Unknown how to calculate gradient.
+      return [T.DisconnectedType()() for inp in inputs]
+
+    assert len(self.in_info) == len(inputs)
+    assert len(self.out_info) == len(output_grads)
+
+    # Some of output_grads might be of disconnected type.
+    out_shapes = self.infer_shape(None, [v.shape for v in inputs])
+    assert len(out_shapes) == len(output_grads)
+    for i, out_grad in enumerate(output_grads):
+      if isinstance(out_grad.type, T.DisconnectedType):
+        output_grads[i] = T.zeros(out_shapes[i], dtype="float32")
+
+    kwargs_for_grad = self.kwargs_for_grad_op()
+    grad_op = self.__class__(**kwargs_for_grad)
+
+    grad_inputs = inputs + list(make_var_tuple(self(*inputs))) + output_grads
+    grad_inputs = self._filter_grad_inputs(grad_inputs)
+    assert len(grad_op.in_info) == len(grad_inputs)
+    grad_outputs = make_var_tuple(grad_op(*grad_inputs))
+    assert len(grad_op.out_info) == len(grad_outputs)
+    if grad_op.num_dummy_outs > 0:
+      grad_outputs = grad_outputs[:-grad_op.num_dummy_outs]  # remove any dummy outputs
+
+    def print_fn(op, x):
+      import numpy
+      first = x[(0,) * x.ndim]
+      stats = (first, x.shape, numpy.min(x), numpy.max(x), numpy.mean(x), numpy.std(x),
+               numpy.isinf(x).any(), numpy.isnan(x).any())
+      print(op.message, "first/shape/min/max/mean/std/any-inf/any-nan:", stats)
+    #input_grads = [theano.printing.Print("in grad %i" % i, global_fn=print_fn)(v)
+    #               for (i, v) in enumerate(input_grads)]
+
+    return self.make_results_of_gradient(grad_outputs, disconnected_type=T.DisconnectedType())
+
+  def connection_pattern(self, node):
+    assert len(node.inputs) == len(self.in_info)
+    pattern = [[info.get("gradient", "") != "disconnected"] * len(self.out_info)
+               for info in self.in_info]
+    return pattern
+
+  def make_node(self, *args):
+    assert len(args) == len(self.in_info)
+    args = [self._convert_input_var(arg, info) for arg, info in zip(args, self.in_info)]
+    outputs = [self.tensor_type(dtype=info.get("dtype", "float32"), ndim=info["ndim"])()
+               for info in self.out_info]
+    return theano.Apply(self, args, outputs)
+
+  def perform(self, node, inputs, output_storage):
+    raise NotImplementedError("NativeOp: no pure Python implementation, only C implementation")
+
+  def c_code_cache_version(self):
+    return self.code_version
+
+  def c_support_code(self):
+    base_src = open(os.path.dirname(__file__) + "/NativeOp.cpp").read()
+    return "\n\n".join([
+      T.blas.blas_header_text(),
+      "#define CUDA 0",
+      base_src,
+      self.c_extra_support_code])
+
+  def c_libraries(self):
+    return T.blas.ldflags()
+
+  def c_compile_args(self):
+    args = T.blas.ldflags(libs=False, flags=True)
+    if sys.platform != "darwin":  # the default clang there does not support it
+      args = args + ["-fopenmp"]  # multithreaded kernels, see start_dev_kernel2 in NativeOp.cpp
+    return args
+
+  def c_lib_dirs(self):
+    return T.blas.ldflags(libs=False, libs_dir=True)
+
+  def c_header_dirs(self):
+    return T.blas.ldflags(libs=False, include_dir=True)
+
+  def c_code(self, node, name, inputs, outputs, sub):
+    assert len(inputs) == len(self.in_info)
+    assert len(outputs) == len(self.out_info)
+    return """
+    {
+      int n_inputs = %(n_inputs)i, n_outputs = %(n_outputs)i;
+      Ndarray* inputs[] = {%(input_var_names_str)s};
+      Ndarray** outputs[] = {%(output_var_names_str)s};
+      int in_ndims[] = {%(input_ndims_str)s};
+      int out_ndims[] = {%(output_ndims_str)s};
+      Ndarray_DIM_Type output_shapes_flat[] = {%(output_shapes_flat_str)s};
+      int in_want_inplace[] = {%(input_want_inplace_str)s};
+      bool in_is_inplace[] = {%(input_is_inplace_str)s};
+
+      // Check if we can reuse any preallocated output.
+      // Reset those which we cannot reuse.
+      {
+        int out_shape_idx = 0;
+        for(int i = 0; i < n_outputs; ++i) {
+          assert_cmp(out_shape_idx + out_ndims[i], <=, ARRAY_LEN(output_shapes_flat));
+          if(*outputs[i]) {
+            bool can_reuse = true;
+            for(int j = 0; j < out_ndims[i]; ++j)
+              if(output_shapes_flat[out_shape_idx + j] != Ndarray_DIMS(*outputs[i])[j]) {
+                can_reuse = false;
+                break;
+              }
+            if(!can_reuse)
+              Py_CLEAR(*outputs[i]);
+          }
+          out_shape_idx += out_ndims[i];
+        }
+        assert_cmp(out_shape_idx, ==, ARRAY_LEN(output_shapes_flat));
+      }
+
+      // Maybe reuse or otherwise copy input into output vars.
+      for(int i = 0; i < n_inputs; ++i)
+        if(in_want_inplace[i] >= 0) {
+          assert_cmp(in_want_inplace[i], <, n_outputs);
+          Py_XDECREF(*outputs[in_want_inplace[i]]);
+          if(in_is_inplace[i]) {
+            *(outputs[in_want_inplace[i]]) = inputs[i];
+            Py_INCREF(inputs[i]);
+          } else {
+            *(outputs[in_want_inplace[i]]) = (Ndarray*) Ndarray_Copy(inputs[i]);
+            if(!*(outputs[in_want_inplace[i]])) %(fail)s;
+            inputs[i] = *(outputs[in_want_inplace[i]]);  // reset with copy
+          }
+        }
+
+      // Init the remaining output vars. Note that they are initialized randomly!
+      {
+        int out_shape_idx = 0;
+        for(int i = 0; i < n_outputs; ++i) {
+          assert(out_shape_idx + out_ndims[i] <= ARRAY_LEN(output_shapes_flat));
+          if(*(outputs[i])) {
+            for(int j = 0; j < out_ndims[i]; ++j)
+              // If this fails, we maybe have reused an input which has an invalid shape.
+              assert_cmp(output_shapes_flat[out_shape_idx + j], ==, Ndarray_DIMS(*outputs[i])[j]);
+          }
+          else {
+            *(outputs[i]) = (Ndarray*) Ndarray_NewDims(out_ndims[i], &output_shapes_flat[out_shape_idx]);
+            if(!*(outputs[i])) %(fail)s;
+          }
+          out_shape_idx += out_ndims[i];
+        }
+        assert_cmp(out_shape_idx, ==, ARRAY_LEN(output_shapes_flat));
+      }
+
+      // And the user C code starts here.
+      // --------------------------------
+      %(c_code)s;
+    }
+    """ % {
+      'name': name, 'fail': sub['fail'],
+      'op_name': escape_c_str(self.name),
+      'c_code': self.c_fw_code % {'fail': sub['fail']},
+      'n_inputs': len(inputs), 'n_outputs': len(outputs),
+      'input_var_names_str': ", ".join(["%s" % inp for inp in inputs]),
+      'output_var_names_str': ", ".join(["&%s" % out for out in outputs]),
+      'input_ndims_str': ', '.join(["%i" % info["ndim"] for info in self.in_info]),
+      'output_ndims_str': ', '.join(["%i" % info["ndim"] for info in self.out_info]),
+      'output_shapes_flat_str':
+        ', '.join([(("%i" % s) if isinstance(s, (int, long))
+                    else "Ndarray_DIMS(inputs[%i])[%i]" % s)
+                   for info in self.out_info for s in info["shape"]]),
+      "input_want_inplace_str": ", ".join([str(int(info.get("want_inplace", -1)))
+                                           for info in self.in_info]),
+      "input_is_inplace_str": ", ".join([str(int(info.get("is_inplace", False)))
+                                         for info in self.in_info])
+    }
+
+
+class GpuNativeOp(NativeOp, theano.sandbox.cuda.GpuOp):
+
+  @classmethod
+  def as_tensor_var(cls, v):
+    from theano.sandbox.cuda.basic_ops import as_cuda_ndarray_variable
+    return as_cuda_ndarray_variable(v)
+
+  @classmethod
+  def tensor_type(cls, dtype, ndim):
+    from theano.sandbox.cuda import CudaNdarrayType
+    if dtype != "float32":
+      print("%s: WARNING: cannot handle type %r, will use float32 instead" % ("GpuNativeOp", dtype))
+      dtype = "float32"
+    return CudaNdarrayType(dtype=dtype, broadcastable=(False,) * ndim)
+
+  @classmethod
+  def contiguous(cls, v):
+    from theano.sandbox.cuda.basic_ops import gpu_contiguous
+    assert isinstance(v, (theano.sandbox.cuda.CudaNdarrayVariable, theano.sandbox.cuda.CudaNdarrayConstant))
+    if getattr(v, 'owner', None):
+      assert isinstance(v.owner, theano.Apply)
+      if v.owner.op == gpu_contiguous:
+        return v
+    return gpu_contiguous(v)
+
+  def c_compile_args(self):
+    return T.blas.ldflags(libs=False, flags=True)
+
+  def c_support_code(self):
+    src = open(os.path.dirname(__file__) + "/NativeOp.cpp").read()
+    return "\n\n".join([
+      "#define CUDA 1",
+      src,
+      self.c_extra_support_code,
+      "// end of c_support_code\n\n\n"])
+
+
+@gof.local_optimizer([NativeOp], inplace=True)
+def inplace_NativeOp(node):
+  if isinstance(node.op, NativeOp) and not node.op.destroy_map:
+    kwargs = {k: getattr(node.op, k) for k in node.op.__props__}
+    # TODO: We could try to make each input inplace individually.
+    # What we do now is just to try to make all inplace.
+    kwargs["in_info"] = [dict(info) for info in node.op.in_info]
+    any_inplace = False
+    for info in kwargs["in_info"]:
+      if info.get("want_inplace", -1) >= 0:
+        any_inplace = True
+        info["is_inplace"] = True
+    if not any_inplace:
+      return False
+    new_op = node.op.__class__(**kwargs)
+    from TheanoUtil import make_var_tuple
+    new_v = make_var_tuple(new_op(*node.inputs))
+    return new_v
+  return False
+
+try:
+  optdb.register('inplace_NativeOp',
+                 gof.TopoOptimizer(inplace_NativeOp
+                                   , failure_callback=gof.TopoOptimizer.warn_inplace
+                                   ),
+                 60, 'fast_run', 'inplace')
+except ValueError:  # can happen if it was already registered before, e.g. when we reload the module
+  pass
+
+
+@try_register_gpu_opt(NativeOp)
+def local_gpu_NativeOp(node):
+  if isinstance(node.op, NativeOp):
+    # see also: https://github.com/Theano/Theano/blob/master/theano/sandbox/cuda/opt.py
+    from theano.sandbox.cuda import host_from_gpu
+    args = node.inputs
+    if any([(x.owner and x.owner.op == host_from_gpu) for x in args]):
+      gpu_op = GpuNativeOp(**{key: getattr(node.op, key) for key in node.op.__props__})
+      args = [x.owner.inputs[0] if (x.owner and x.owner.op == host_from_gpu) else x
+              for x in args]
+      outputs = make_var_tuple(gpu_op(*args))
+      return [host_from_gpu(out) for out in outputs]
+
+
+def precompile_op(gen_base):
+  """
+  Compiles the op and its gradient op via Theano functions, such that they are in the Theano cache
+  (compiledir) when they are used later, e.g. for training.
+  We compile the GPU variant if Theano uses the GPU, otherwise the CPU variant, as usual.
+
+  :param type[NativeOp.NativeOpGenBase] gen_base: e.g. NativeOp.LstmGenericBase
+  """
+  op = gen_base.make_op()
+  op_cls = GpuNativeOp if theano.sandbox.cuda.cuda_enabled else NativeOp
+  ops = [op_cls(**{key: getattr(op, key) for key in op.__props__})]
+  if op.c_bw_code and not op.custom_grad:
+    ops.append(op_cls(**op.kwargs_for_grad_op()))
+  for op in ops:
+    inputs = [op.tensor_type(dtype=info.get("dtype", "float32"), ndim=info["ndim"])() for info in op.in_info]
+    outputs = make_var_tuple(op(*inputs))
+    # Mutable inputs such that the inplace optimization applies, as in the graphs we use for training.
+    theano.function(
+      inputs=[theano.In(v, mutable=True) for v in inputs], outputs=outputs, on_unused_input="ignore")
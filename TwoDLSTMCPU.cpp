@@ -0,0 +1,479 @@
+// CPU implementation of the 2D LSTM (MDLSTM), see TwoDLSTMCPUOp.py.
+// This follows the CUDA implementation (cuda_implementation/c_support_code_mdlstm.cpp, with STABLE_CELL).
+// Like there, the predecessor "state" which goes into the cell state differs between the ops:
+// MultiDirectionalTwoDLSTMOp (4 directions) uses the cell state of the y and x predecessor,
+// while BidirectionalTwoDLSTMOp (1 or 2 directions, also used by DeepLSTM) reads the part of H at offset
+// 2 * n_cells, i.e. the lambda gate of the y and x predecessor. See twod_lstm_old_state_idx().
+//
+// Layout (all float32, C-contiguous):
+//   X:     (height, width, n_batch, n_in)
+//   W:     (n_in, 5 * n_cells)
+//   V_h:   (n_cells, 5 * n_cells)
+//   V_v:   (n_cells, 5 * n_cells)
+//   b:     (5 * n_cells,)
+//   sizes: (n_batch, 2), height and width of every image. The images are aligned at the top left.
+//   Y:     (height, width, n_batch, n_cells)
+//   H:     (height, width, n_batch, 5 * n_cells)
+// After the fwd pass, H holds the input, forget, lambda and output gate and the cell state (in this order).
+//
+// Every direction runs over the flipped image. We iterate in direction coordinates (y, x)
+// and flip back to get the position in memory, like the CUDA implementation.
+// All positions on an anti-diagonal (y + x = diag) only depend on the previous anti-diagonal,
+// thus we compute all of them (for all directions) in parallel, via OpenMP.
+// The recurrent matrix multiplications are done via BLAS (sgemm), per position.
+
+#include <algorithm>
+#include <cassert>
+#include <cmath>
+#include <vector>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// Like sgemm, but for row-major (C-contiguous) matrices:
+// C = op(A) * op(B) + beta * C, where op(A) is (m,k), op(B) is (k,n) and C is (m,n).
+static void twod_lstm_sgemm(bool transpose_A, bool transpose_B, int m, int n, int k,
+                            const float* A, int lda, const float* B, int ldb, float beta, float* C, int ldc)
+{
+  // Column-major BLAS sees the transposed matrices, thus we calculate C^T = op(B)^T * op(A)^T.
+  char transa = transpose_B ? 'T' : 'N';
+  char transb = transpose_A ? 'T' : 'N';
+  float alpha = 1.0f;
+  sgemm_(&transa, &transb, &n, &m, &k, &alpha, B, &ldb, A, &lda, &beta, C, &ldc);
+}
+
+struct TwoDLSTMDir
+{
+  bool flip_y, flip_x;
+  int height, width, n_batch, n_cells;
+  const float* sizes;
+
+  //position in memory (in units of positions) of (y, x) in direction coordinates
+  long pos(int y, int x) const
+  {
+    if(flip_y)
+      y = (height - 1) - y;
+    if(flip_x)
+      x = (width - 1) - x;
+    return long(y) * width + x;
+  }
+
+  //1.0 or 0.0 for every image in the batch, whether the (y, x) position is inside the image
+  void valid(int y, int x, float* out) const
+  {
+    if(flip_y)
+      y = (height - 1) - y;
+    if(flip_x)
+      x = (width - 1) - x;
+    for(int n = 0; n < n_batch; ++n)
+    {
+      int img_height = int(sizes[2 * n]);
+      int img_width = int(sizes[2 * n + 1]);
+      out[n] = float(y < img_height && x < img_width);
+    }
+  }
+};
+
+//like lstm_stable_cell_kernel_batched, for one position
+static void twod_lstm_cell_fwd(float* data, const float* old_state_y, const float* old_state_x,
+  float* output, const float* valid, int n_cells, int n_batch)
+{
+  for(int n = 0; n < n_batch; ++n)
+  {
+    for(int c = 0; c < n_cells; ++c)
+    {
+      int start = n * 5 * n_cells + c;
+      float valid_batch = valid[n];
+
+      float inpGate = 1.f / (1.f + expf(-data[start]));
+      float fgtGate = 1.f / (1.f + expf(-data[start + n_cells]));
+      float lambdaGate = 1.f / (1.f + expf(-data[start + 2 * n_cells]));
+      float outGate = 1.f / (1.f + expf(-data[start + 3 * n_cells]));
+      float state = inpGate * tanhf(data[start + 4 * n_cells]);
+      if(old_state_y)
+        state += fgtGate * lambdaGate * old_state_y[start];
+      if(old_state_x)
+        state += fgtGate * (1.0f - lambdaGate) * old_state_x[start];
+      state *= valid_batch;
+
+      output[n * n_cells + c] = outGate * tanhf(state) * valid_batch;
+
+      data[start] = inpGate;
+      data[start + n_cells] = fgtGate;
+      data[start + 2 * n_cells] = lambdaGate;
+      data[start + 3 * n_cells] = outGate;
+      data[start + 4 * n_cells] = state;
+    }
+  }
+}
+
+//like lstm_bwd_stable_cell_kernel_batched, for one position
+static void twod_lstm_cell_bwd(float* delta, const float* epsilon,
+  const float* next_epsilon_y, const float* next_epsilon_x, float* epsilon_y, float* epsilon_x,
+  const float* last_state_y, const float* last_state_x, const float* Y, const float* valid,
+  int n_cells, int n_batch)
+{
+  for(int n = 0; n < n_batch; ++n)
+  {
+    for(int c = 0; c < n_cells; ++c)
+    {
+      int inner_idx = n * n_cells + c;
+      int start = n * 5 * n_cells + c;
+      float valid_batch = valid[n];
+
+      float inpGate = delta[start];
+      float fgtGate = delta[start + n_cells];
+      float lambdaGate = delta[start + 2 * n_cells];
+      float outGate = delta[start + 3 * n_cells];
+      float state = delta[start + 4 * n_cells];
+      float lastState_y = last_state_y ? last_state_y[start] : 0.f;
+      float lastState_x = last_state_x ? last_state_x[start] : 0.f;
+      float eps = epsilon[inner_idx];
+
+      //avoid division by 0
+      float gc = 0.f; //g(c(t))
+      float gzc = 0.f; //g(z_c(t))
+      if(outGate != 0)
+        gc = Y[inner_idx] / outGate;
+      if(inpGate != 0)
+        gzc = (state - fgtGate * lambdaGate * lastState_y - fgtGate * (1.0f - lambdaGate) * lastState_x) / inpGate;
+
+      //delta_output
+      delta[start + 3 * n_cells] = outGate * (1.f - outGate) * gc * eps * valid_batch;
+
+      //epsilon_c
+      float epsilon_c = (1.f - (gc * gc)) * outGate * eps;
+      if(next_epsilon_y)
+        epsilon_c += next_epsilon_y[inner_idx];
+      if(next_epsilon_x)
+        epsilon_c += next_epsilon_x[inner_idx];
+
+      epsilon_y[inner_idx] = epsilon_c * fgtGate * lambdaGate * valid_batch;
+      epsilon_x[inner_idx] = epsilon_c * fgtGate * (1.0f - lambdaGate) * valid_batch;
+
+      //delta_cell
+      delta[start + 4 * n_cells] = inpGate * (1.f - (gzc * gzc)) * epsilon_c * valid_batch;
+
+      //delta_forget
+      delta[start + n_cells] = fgtGate * (1.f - fgtGate) * epsilon_c *
+                               (lastState_y * lambdaGate + lastState_x * (1.0f - lambdaGate)) * valid_batch;
+
+      //delta_lambda
+      delta[start + 2 * n_cells] = fgtGate * lambdaGate * (1.f - lambdaGate) * epsilon_c
+                                   * (lastState_y - lastState_x) * valid_batch;
+
+      //delta_input
+      delta[start] = inpGate * (1.f - inpGate) * gzc * epsilon_c * valid_batch;
+    }
+  }
+}
+
+//the index of the part of H of the predecessor positions which is used as the old state, in units of n_cells.
+//4 is the cell state, like MultiDirectionalTwoDLSTMOp.
+//BidirectionalTwoDLSTMOp uses 2 (the lambda gate), in the fwd and in the bwd pass, and we do the same.
+static int twod_lstm_old_state_idx(int n_dirs)
+{
+  return n_dirs <= 2 ? 2 : 4;
+}
+
+//the positions (in direction coordinates) of an anti-diagonal, in the same order as the CUDA implementation
+static void twod_lstm_diag(int diag, int height, int width, int* diag_size, int* y_high, int* x_low)
+{
+  int n_diags = width + height - 1;
+  *diag_size = std::min(diag + 1, std::min(n_diags - diag, std::min(width, height)));
+  *y_high = std::min(diag, height - 1);
+  *x_low = std::max(diag - height + 1, 0);
+}
+
+//H: initialized with b + X * W. Y: output.
+//dirs, Hs, Ys, V_hs, V_vs: one entry per direction.
+static void twod_lstm_fwd(int n_dirs, const TwoDLSTMDir* dirs, float** Hs, float** Ys,
+  const float** V_hs, const float** V_vs)
+{
+  const TwoDLSTMDir& dims = dirs[0];
+  const int height = dims.height, width = dims.width, n_batch = dims.n_batch, n_cells = dims.n_cells;
+  const long H_pos_size = long(n_batch) * 5 * n_cells;
+  const long Y_pos_size = long(n_batch) * n_cells;
+  const long old_state_offset = long(twod_lstm_old_state_idx(n_dirs)) * n_cells;
+  const int n_diags = width + height - 1;
+  for(int diag = 0; diag < n_diags; ++diag)
+  {
+    int diag_size, y_high, x_low;
+    twod_lstm_diag(diag, height, width, &diag_size, &y_high, &x_low);
+    #pragma omp parallel for schedule(static)
+    for(int i = 0; i < n_dirs * diag_size; ++i)
+    {
+      const TwoDLSTMDir& dir = dirs[i / diag_size];
+      float* H = Hs[i / diag_size];
+      float* Y = Ys[i / diag_size];
+      int y = y_high - (i % diag_size);
+      int x = x_low + (i % diag_size);
+      float* data = H + dir.pos(y, x) * H_pos_size;
+      if(x > 0)
+        twod_lstm_sgemm(false, false, n_batch, 5 * n_cells, n_cells,
+          Y + dir.pos(y, x - 1) * Y_pos_size, n_cells, V_hs[i / diag_size], 5 * n_cells, 1.0f, data, 5 * n_cells);
+      if(y > 0)
+        twod_lstm_sgemm(false, false, n_batch, 5 * n_cells, n_cells,
+          Y + dir.pos(y - 1, x) * Y_pos_size, n_cells, V_vs[i / diag_size], 5 * n_cells, 1.0f, data, 5 * n_cells);
+      std::vector<float> valid(n_batch);
+      dir.valid(y, x, &valid[0]);
+      twod_lstm_cell_fwd(data,
+        y > 0 ? H + dir.pos(y - 1, x) * H_pos_size + old_state_offset : 0,
+        x > 0 ? H + dir.pos(y, x - 1) * H_pos_size + old_state_offset : 0,
+        Y + dir.pos(y, x) * Y_pos_size, &valid[0], n_cells, n_batch);
+    }
+  }
+}
+
+//deltas: initialized with H from the fwd pass, will get the derivatives w.r.t. H (before the activation functions).
+//epsilons: initialized with DY, will be overwritten.
+//dirs, deltas, epsilons, Ys, V_hs, V_vs: one entry per direction.
+static void twod_lstm_bwd(int n_dirs, const TwoDLSTMDir* dirs, float** deltas, float** epsilons, const float** Ys,
+  const float** V_hs, const float** V_vs)
+{
+  const TwoDLSTMDir& dims = dirs[0];
+  const int height = dims.height, width = dims.width, n_batch = dims.n_batch, n_cells = dims.n_cells;
+  const long H_pos_size = long(n_batch) * 5 * n_cells;
+  const long Y_pos_size = long(n_batch) * n_cells;
+  const long Y_size = long(height) * width * Y_pos_size;
+  const long old_state_offset = long(twod_lstm_old_state_idx(n_dirs)) * n_cells;
+  const int n_diags = width + height - 1;
+  //per direction: epsilon_y (cell state derivative * forget_gate * lambda_gate) and epsilon_x, for every position
+  std::vector<float> workmem(size_t(n_dirs) * 2 * Y_size);
+  for(int diag = n_diags - 1; diag >= 0; --diag)
+  {
+    int diag_size, y_high, x_low;
+    twod_lstm_diag(diag, height, width, &diag_size, &y_high, &x_low);
+    #pragma omp parallel for schedule(static)
+    for(int i = 0; i < n_dirs * diag_size; ++i)
+    {
+      const TwoDLSTMDir& dir = dirs[i / diag_size];
+      float* delta = deltas[i / diag_size];
+      float* epsilon_y = &workmem[size_t(i / diag_size) * 2 * Y_size];
+      float* epsilon_x = epsilon_y + Y_size;
+      int y = y_high - (i % diag_size);
+      int x = x_low + (i % diag_size);
+      bool botBorder = (y == height - 1);
+      bool rightBorder = (x == width - 1);
+      float* epsilon = epsilons[i / diag_size] + dir.pos(y, x) * Y_pos_size;
+      if(!rightBorder)
+        twod_lstm_sgemm(false, true, n_batch, n_cells, 5 * n_cells,
+          delta + dir.pos(y, x + 1) * H_pos_size, 5 * n_cells, V_hs[i / diag_size], 5 * n_cells, 1.0f, epsilon, n_cells);
+      if(!botBorder)
+        twod_lstm_sgemm(false, true, n_batch, n_cells, 5 * n_cells,
+          delta + dir.pos(y + 1, x) * H_pos_size, 5 * n_cells, V_vs[i / diag_size], 5 * n_cells, 1.0f, epsilon, n_cells);
+      std::vector<float> valid(n_batch);
+      dir.valid(y, x, &valid[0]);
+      twod_lstm_cell_bwd(delta + dir.pos(y, x) * H_pos_size, epsilon,
+        botBorder ? 0 : epsilon_y + dir.pos(y + 1, x) * Y_pos_size,
+        rightBorder ? 0 : epsilon_x + dir.pos(y, x + 1) * Y_pos_size,
+        epsilon_y + dir.pos(y, x) * Y_pos_size,
+        epsilon_x + dir.pos(y, x) * Y_pos_size,
+        y > 0 ? delta + dir.pos(y - 1, x) * H_pos_size + old_state_offset : 0,
+        x > 0 ? delta + dir.pos(y, x - 1) * H_pos_size + old_state_offset : 0,
+        Ys[i / diag_size] + dir.pos(y, x) * Y_pos_size, &valid[0], n_cells, n_batch);
+    }
+  }
+}
+
+//DV_h = sum over all positions of Y(y, x - 1)^T * delta(y, x), in direction coordinates.
+//DV_v = sum over all positions of Y(y - 1, x)^T * delta(y, x), in direction coordinates.
+static void twod_lstm_bwd_recurrent_weights(const TwoDLSTMDir& dir, const float* delta, const float* Y,
+  float* DV_h, float* DV_v)
+{
+  const int height = dir.height, width = dir.width, n_batch = dir.n_batch, n_cells = dir.n_cells;
+  const long H_pos_size = long(n_batch) * 5 * n_cells;
+  const long Y_pos_size = long(n_batch) * n_cells;
+  std::fill(DV_h, DV_h + n_cells * 5 * n_cells, 0.0f);
+  std::fill(DV_v, DV_v + n_cells * 5 * n_cells, 0.0f);
+  //in memory, the predecessor is at x - 1, or at x + 1 if flipped
+  if(width > 1)
+  {
+    int Y_x = dir.flip_x ? 1 : 0;
+    int delta_x = dir.flip_x ? 0 : 1;
+    for(int y = 0; y < height; ++y)
+      twod_lstm_sgemm(true, false, n_cells, 5 * n_cells, (width - 1) * n_batch,
+        Y + (long(y) * width + Y_x) * Y_pos_size, n_cells,
+        delta + (long(y) * width + delta_x) * H_pos_size, 5 * n_cells, 1.0f, DV_h, 5 * n_cells);
+  }
+  if(height > 1)
+  {
+    int Y_y = dir.flip_y ? 1 : 0;
+    int delta_y = dir.flip_y ? 0 : 1;
+    twod_lstm_sgemm(true, false, n_cells, 5 * n_cells, (height - 1) * width * n_batch,
+      Y + long(Y_y) * width * Y_pos_size, n_cells,
+      delta + long(delta_y) * width * H_pos_size, 5 * n_cells, 0.0f, DV_v, 5 * n_cells);
+  }
+}
+
+// ---------------------------------------------------------------------------------------------
+// Theano interface (numpy arrays), used by TwoDLSTMCPUOp and TwoDLSTMCPUOpGrad.
+// flips: (flip_y, flip_x) for every direction.
+
+//holds new references to C-contiguous variants of the inputs
+struct TwoDLSTMContiguousInputs
+{
+  std::vector<PyArrayObject*> arrays;
+
+  ~TwoDLSTMContiguousInputs()
+  {
+    for(size_t i = 0; i < arrays.size(); ++i)
+      Py_XDECREF(arrays[i]);
+  }
+
+  const float* get(PyArrayObject* a)
+  {
+    PyArrayObject* c = PyArray_GETCONTIGUOUS(a);
+    assert(c);
+    arrays.push_back(c);
+    return reinterpret_cast<const float*>(PyArray_DATA(c));
+  }
+};
+
+static float* twod_lstm_new_output(PyArrayObject** out, int nd, npy_intp* dims)
+{
+  Py_XDECREF(*out);
+  *out = (PyArrayObject*) PyArray_ZEROS(nd, dims, NPY_FLOAT32, 0);
+  if(!*out)
+    return 0;
+  return reinterpret_cast<float*>(PyArray_DATA(*out));
+}
+
+static bool twod_lstm_check_shapes(int n_dirs, PyArrayObject* X, PyArrayObject** Ws, PyArrayObject** V_hs,
+  PyArrayObject** V_vs, PyArrayObject* sizes)
+{
+  const npy_intp* X_dims = PyArray_DIMS(X);
+  npy_intp n_cells = PyArray_DIMS(V_hs[0])[0];
+  for(int d = 0; d < n_dirs; ++d)
+  {
+    if(PyArray_DIMS(Ws[d])[0] != X_dims[3] || PyArray_DIMS(Ws[d])[1] != 5 * n_cells ||
+       PyArray_DIMS(V_hs[d])[0] != n_cells || PyArray_DIMS(V_hs[d])[1] != 5 * n_cells ||
+       PyArray_DIMS(V_vs[d])[0] != n_cells || PyArray_DIMS(V_vs[d])[1] != 5 * n_cells)
+    {
+      PyErr_Format(PyExc_ValueError, "TwoDLSTMCPUOp: W, V_h or V_v of direction %i has wrong shape", d + 1);
+      return false;
+    }
+  }
+  if(PyArray_DIMS(sizes)[0] != X_dims[2] || PyArray_DIMS(sizes)[1] != 2)
+  {
+    PyErr_SetString(PyExc_ValueError, "TwoDLSTMCPUOp: sizes has wrong shape");
+    return false;
+  }
+  return true;
+}
+
+static bool twod_lstm_cpu_fwd(int n_dirs, const int* flips, PyArrayObject* X, PyArrayObject** Ws,
+  PyArrayObject** V_hs, PyArrayObject** V_vs, PyArrayObject** bs, PyArrayObject* sizes,
+  PyArrayObject*** Ys, PyArrayObject*** Hs)
+{
+  if(!twod_lstm_check_shapes(n_dirs, X, Ws, V_hs, V_vs, sizes))
+    return false;
+  TwoDLSTMContiguousInputs inputs;
+  const npy_intp* X_dims = PyArray_DIMS(X);
+  const int height = X_dims[0], width = X_dims[1], n_batch = X_dims[2], n_in = X_dims[3];
+  const int n_cells = PyArray_DIMS(V_hs[0])[0];
+  const int n_rows = height * width * n_batch;
+  const float* X_data = inputs.get(X);
+  const float* sizes_data = inputs.get(sizes);
+  npy_intp Y_dims[] = {height, width, n_batch, n_cells};
+  npy_intp H_dims[] = {height, width, n_batch, 5 * n_cells};
+
+  std::vector<TwoDLSTMDir> dirs(n_dirs);
+  std::vector<float*> H_ptrs(n_dirs), Y_ptrs(n_dirs);
+  std::vector<const float*> V_h_ptrs(n_dirs), V_v_ptrs(n_dirs);
+  for(int d = 0; d < n_dirs; ++d)
+  {
+    TwoDLSTMDir dir = {bool(flips[2 * d]), bool(flips[2 * d + 1]), height, width, n_batch, n_cells, sizes_data};
+    dirs[d] = dir;
+    H_ptrs[d] = twod_lstm_new_output(Hs[d], 4, H_dims);
+    Y_ptrs[d] = twod_lstm_new_output(Ys[d], 4, Y_dims);
+    if(!H_ptrs[d] || !Y_ptrs[d])
+      return false;
+    V_h_ptrs[d] = inputs.get(V_hs[d]);
+    V_v_ptrs[d] = inputs.get(V_vs[d]);
+    if(n_rows == 0)
+      continue;
+    //H = b + X * W
+    const float* b = inputs.get(bs[d]);
+    for(int r = 0; r < n_rows; ++r)
+      std::copy(b, b + 5 * n_cells, H_ptrs[d] + long(r) * 5 * n_cells);
+    if(n_in > 0)
+      twod_lstm_sgemm(false, false, n_rows, 5 * n_cells, n_in,
+        X_data, n_in, inputs.get(Ws[d]), 5 * n_cells, 1.0f, H_ptrs[d], 5 * n_cells);
+  }
+  if(n_rows > 0)
+    twod_lstm_fwd(n_dirs, &dirs[0], &H_ptrs[0], &Y_ptrs[0], &V_h_ptrs[0], &V_v_ptrs[0]);
+  return true;
+}
+
+static bool twod_lstm_cpu_bwd(int n_dirs, const int* flips, PyArrayObject* X, PyArrayObject** Ws,
+  PyArrayObject** V_hs, PyArrayObject** V_vs, PyArrayObject* sizes,
+  PyArrayObject** DYs, PyArrayObject** Ys, PyArrayObject** Hs,
+  PyArrayObject** DX, PyArrayObject*** DWs, PyArrayObject*** DV_hs, PyArrayObject*** DV_vs, PyArrayObject*** Dbs)
+{
+  if(!twod_lstm_check_shapes(n_dirs, X, Ws, V_hs, V_vs, sizes))
+    return false;
+  TwoDLSTMContiguousInputs inputs;
+  const npy_intp* X_dims = PyArray_DIMS(X);
+  const int height = X_dims[0], width = X_dims[1], n_batch = X_dims[2], n_in = X_dims[3];
+  const int n_cells = PyArray_DIMS(V_hs[0])[0];
+  const int n_rows = height * width * n_batch;
+  const float* X_data = inputs.get(X);
+  const float* sizes_data = inputs.get(sizes);
+  npy_intp X_dims_[] = {height, width, n_batch, n_in};
+  npy_intp W_dims[] = {n_in, 5 * n_cells};
+  npy_intp V_dims[] = {n_cells, 5 * n_cells};
+  npy_intp b_dims[] = {5 * n_cells};
+
+  float* DX_data = twod_lstm_new_output(DX, 4, X_dims_);
+  if(!DX_data)
+    return false;
+  std::vector<TwoDLSTMDir> dirs(n_dirs);
+  std::vector<std::vector<float> > deltas(n_dirs), epsilons(n_dirs);
+  std::vector<float*> delta_ptrs(n_dirs), epsilon_ptrs(n_dirs);
+  std::vector<const float*> Y_ptrs(n_dirs), V_h_ptrs(n_dirs), V_v_ptrs(n_dirs);
+  for(int d = 0; d < n_dirs; ++d)
+  {
+    TwoDLSTMDir dir = {bool(flips[2 * d]), bool(flips[2 * d + 1]), height, width, n_batch, n_cells, sizes_data};
+    dirs[d] = dir;
+    const float* H = inputs.get(Hs[d]);
+    const float* DY = inputs.get(DYs[d]);
+    deltas[d].assign(H, H + long(n_rows) * 5 * n_cells);
+    epsilons[d].assign(DY, DY + long(n_rows) * n_cells);
+    delta_ptrs[d] = deltas[d].empty() ? 0 : &deltas[d][0];
+    epsilon_ptrs[d] = epsilons[d].empty() ? 0 : &epsilons[d][0];
+    Y_ptrs[d] = inputs.get(Ys[d]);
+    V_h_ptrs[d] = inputs.get(V_hs[d]);
+    V_v_ptrs[d] = inputs.get(V_vs[d]);
+  }
+  if(n_rows > 0)
+    twod_lstm_bwd(n_dirs, &dirs[0], &delta_ptrs[0], &epsilon_ptrs[0], &Y_ptrs[0], &V_h_ptrs[0], &V_v_ptrs[0]);
+
+  for(int d = 0; d < n_dirs; ++d)
+  {
+    float* DW = twod_lstm_new_output(DWs[d], 2, W_dims);
+    float* DV_h = twod_lstm_new_output(DV_hs[d], 2, V_dims);
+    float* DV_v = twod_lstm_new_output(DV_vs[d], 2, V_dims);
+    float* Db = twod_lstm_new_output(Dbs[d], 1, b_dims);
+    if(!DW || !DV_h || !DV_v || !Db)
+      return false;
+    if(n_rows == 0)
+      continue;
+    const float* delta = delta_ptrs[d];
+    if(n_in > 0)
+    {
+      //DW = X^T * delta
+      twod_lstm_sgemm(true, false, n_in, 5 * n_cells, n_rows, X_data, n_in, delta, 5 * n_cells, 0.0f, DW, 5 * n_cells);
+      //DX += delta * W^T
+      twod_lstm_sgemm(false, true, n_rows, n_in, 5 * n_cells,
+        delta, 5 * n_cells, inputs.get(Ws[d]), 5 * n_cells, 1.0f, DX_data, n_in);
+    }
+    //Db = (1 ... 1) * delta
+    for(int r = 0; r < n_rows; ++r)
+      for(int j = 0; j < 5 * n_cells; ++j)
+        Db[j] += delta[long(r) * 5 * n_cells + j];
+    twod_lstm_bwd_recurrent_weights(dirs[d], delta, Y_ptrs[d], DV_h, DV_v);
+  }
+  return true;
+}
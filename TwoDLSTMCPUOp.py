@@ -0,0 +1,182 @@
+
+"""
+CPU implementation of the 2D LSTM (MDLSTM) of the GPU ops
+cuda_implementation.MultiDirectionalTwoDLSTMOp and cuda_implementation.BiDirectionalTwoDLSTMOp,
+used by NetworkTwoDLayer.TwoDLSTMLayer when we run on CPU.
+The C++ code is in TwoDLSTMCPU.cpp.
+Like the GPU ops, for 1 or 2 directions (BidirectionalTwoDLSTMOp), the lambda gate of the predecessors
+is used as their old state, and for 4 directions (MultiDirectionalTwoDLSTMOp) their cell state.
+"""
+
+import os
+import sys
+import theano
+import theano.gradient
+import theano.tensor as T
+
+
+# (flip_y, flip_x) for every direction, for the given number of directions.
+# The order is the same as the outputs of the GPU ops, i.e. for 4 directions like MultiDirectionalTwoDLSTMOp,
+# and for 1 or 2 directions like BidirectionalTwoDLSTMOp (where we only use the first output for 1 direction).
+Flips = {
+  1: ((0, 0),),
+  2: ((0, 0), (0, 1)),
+  4: ((0, 0), (1, 0), (0, 1), (1, 1))
+}
+
+
+class _TwoDLSTMCPUOpBase(theano.Op):
+  __props__ = ("directions",)
+
+  def __init__(self, directions=4):
+    """
+    :param int directions: 1, 2 or 4, see :data:`Flips`
+    """
+    super(_TwoDLSTMCPUOpBase, self).__init__()
+    assert directions in Flips, "only 1, 2 or 4 directions are supported"
+    self.directions = directions
+
+  @classmethod
+  def _as_float32_var(cls, v, ndim):
+    v = T.as_tensor_variable(v)
+    assert v.dtype == "float32"
+    assert v.ndim == ndim, (v, v.ndim, ndim)
+    return v
+
+  def c_support_code(self):
+    with open(os.path.dirname(os.path.abspath(__file__)) + "/TwoDLSTMCPU.cpp") as f:
+      src = f.read()
+    return "\n\n".join([T.blas.blas_header_text(), src])
+
+  def c_libraries(self):
+    return T.blas.ldflags()
+
+  def c_compile_args(self):
+    args = T.blas.ldflags(libs=False, flags=True)
+    if sys.platform != "darwin":  # the default clang there does not support it
+      args = args + ["-fopenmp"]
+    return args
+
+  def c_lib_dirs(self):
+    return T.blas.ldflags(libs=False, libs_dir=True)
+
+  def c_header_dirs(self):
+    return T.blas.ldflags(libs=False, include_dir=True)
+
+  def _c_flips(self):
+    return ", ".join(["%i, %i" % flip for flip in Flips[self.directions]])
+
+  #!!! change this when changing the code!
+  def c_code_cache_version(self):
+    return 2,
+
+
+class TwoDLSTMCPUOpGrad(_TwoDLSTMCPUOpBase):
+  def make_node(self, X, *args):
+    """
+    :param X: (height,width,batch,n_in)
+    :param args: W*n, V_h*n, V_v*n, b*n, sizes, DY*n, Y*n, H*n, for n directions
+    """
+    n = self.directions
+    assert len(args) == 7 * n + 1
+    expected_ndims = [2] * (3 * n) + [1] * n + [2] + [4] * (3 * n)
+    X = self._as_float32_var(X, 4)
+    args = [self._as_float32_var(v, ndim) for (v, ndim) in zip(args, expected_ndims)]
+    # Outputs: DX, DW*n, DV_h*n, DV_v*n, Db*n.
+    return theano.Apply(self, [X] + args, [v.type() for v in [X] + args[:4 * n]])
+
+  def infer_shape(self, node, input_shapes):
+    return input_shapes[:4 * self.directions + 1]
+
+  def c_code(self, node, name, input_names, output_names, sub):
+    n = self.directions
+    X = input_names[0]
+    Ws, V_hs, V_vs, _, sizes, DYs, Ys, Hs = [
+      input_names[1 + i * n:1 + (i + 1) * n] for i in range(4)] + [input_names[4 * n + 1]] + [
+      input_names[4 * n + 2 + i * n:4 * n + 2 + (i + 1) * n] for i in range(3)]
+    DX = output_names[0]
+    DWs, DV_hs, DV_vs, Dbs = [output_names[1 + i * n:1 + (i + 1) * n] for i in range(4)]
+    return """
+    {
+      const int flips[] = {%(flips)s};
+      PyArrayObject* Ws[] = {%(Ws)s};
+      PyArrayObject* V_hs[] = {%(V_hs)s};
+      PyArrayObject* V_vs[] = {%(V_vs)s};
+      PyArrayObject* DYs[] = {%(DYs)s};
+      PyArrayObject* Ys[] = {%(Ys)s};
+      PyArrayObject* Hs[] = {%(Hs)s};
+      PyArrayObject** DWs[] = {%(DWs)s};
+      PyArrayObject** DV_hs[] = {%(DV_hs)s};
+      PyArrayObject** DV_vs[] = {%(DV_vs)s};
+      PyArrayObject** Dbs[] = {%(Dbs)s};
+      if(!twod_lstm_cpu_bwd(%(n)i, flips, %(X)s, Ws, V_hs, V_vs, %(sizes)s, DYs, Ys, Hs,
+                            &%(DX)s, DWs, DV_hs, DV_vs, Dbs))
+        %(fail)s;
+    }
+    """ % {
+      "flips": self._c_flips(), "n": n, "X": X, "sizes": sizes, "DX": DX,
+      "Ws": ", ".join(Ws), "V_hs": ", ".join(V_hs), "V_vs": ", ".join(V_vs),
+      "DYs": ", ".join(DYs), "Ys": ", ".join(Ys), "Hs": ", ".join(Hs),
+      "DWs": ", ".join(["&" + v for v in DWs]), "DV_hs": ", ".join(["&" + v for v in DV_hs]),
+      "DV_vs": ", ".join(["&" + v for v in DV_vs]), "Dbs": ", ".join(["&" + v for v in Dbs]),
+      "fail": sub["fail"]}
+
+
+class TwoDLSTMCPUOp(_TwoDLSTMCPUOpBase):
+  def make_node(self, X, *args):
+    """
+    :param X: (height,width,batch,n_in)
+    :param args: W*n, V_h*n, V_v*n, b*n, sizes, for n directions.
+      sizes is (batch,2), the height and width of every image.
+    :return: outputs Y*n (height,width,batch,n_cells), (gates and cell states) H*n (height,width,batch,5*n_cells)
+    """
+    n = self.directions
+    assert len(args) == 4 * n + 1
+    expected_ndims = [2] * (3 * n) + [1] * n + [2]
+    X = self._as_float32_var(X, 4)
+    args = [self._as_float32_var(v, ndim) for (v, ndim) in zip(args, expected_ndims)]
+    return theano.Apply(self, [X] + args, [X.type() for _ in range(2 * n)])
+
+  def infer_shape(self, node, input_shapes):
+    Xs, W1s = input_shapes[:2]
+    Y_shape = (Xs[0], Xs[1], Xs[2], W1s[1] // 5)
+    H_shape = (Xs[0], Xs[1], Xs[2], W1s[1])
+    return [Y_shape] * self.directions + [H_shape] * self.directions
+
+  def grad(self, inputs, output_grads):
+    n = self.directions
+    fwd_results = self(*inputs)
+    DYs = [T.zeros_like(Y) if isinstance(DY.type, theano.gradient.DisconnectedType) else DY
+           for (DY, Y) in zip(output_grads[:n], fwd_results[:n])]
+    grads = TwoDLSTMCPUOpGrad(n)(*(inputs + DYs + fwd_results))
+    Dsizes = theano.gradient.grad_undefined(self, len(inputs) - 1, inputs[-1], 'cannot diff w.r.t. sizes')
+    return grads + [Dsizes]
+
+  def connection_pattern(self, node):
+    n = self.directions
+    # The gradient only goes through Y, not through H.
+    return [[True] * n + [False] * n for _ in node.inputs]
+
+  def c_code(self, node, name, input_names, output_names, sub):
+    n = self.directions
+    X = input_names[0]
+    Ws, V_hs, V_vs, bs = [input_names[1 + i * n:1 + (i + 1) * n] for i in range(4)]
+    sizes = input_names[4 * n + 1]
+    Ys, Hs = output_names[:n], output_names[n:]
+    return """
+    {
+      const int flips[] = {%(flips)s};
+      PyArrayObject* Ws[] = {%(Ws)s};
+      PyArrayObject* V_hs[] = {%(V_hs)s};
+      PyArrayObject* V_vs[] = {%(V_vs)s};
+      PyArrayObject* bs[] = {%(bs)s};
+      PyArrayObject** Ys[] = {%(Ys)s};
+      PyArrayObject** Hs[] = {%(Hs)s};
+      if(!twod_lstm_cpu_fwd(%(n)i, flips, %(X)s, Ws, V_hs, V_vs, bs, %(sizes)s, Ys, Hs))
+        %(fail)s;
+    }
+    """ % {
+      "flips": self._c_flips(), "n": n, "X": X, "sizes": sizes,
+      "Ws": ", ".join(Ws), "V_hs": ", ".join(V_hs), "V_vs": ", ".join(V_vs), "bs": ", ".join(bs),
+      "Ys": ", ".join(["&" + v for v in Ys]), "Hs": ", ".join(["&" + v for v in Hs]),
+      "fail": sub["fail"]}
@@ -85,6 +85,36 @@ class BackendEngine:
     return cls.get_selected_engine() == cls.TensorFlow
 
 
+def get_floatX():
+  """
+  :return: the float dtype for the data, e.g. "float32".
+    This is theano.config.floatX if Theano was already imported, e.g. via the Theano backend.
+    Otherwise it is read from the Theano config in the same way as Theano does it,
+    i.e. from THEANO_FLAGS and then from the .theanorc files, such that the datasets do not need to import Theano.
+  :rtype: str
+  """
+  if "theano" in sys.modules:
+    return sys.modules["theano"].config.floatX
+  floatX = None
+  for flag in os.environ.get("THEANO_FLAGS", "").split(","):
+    key, _, value = flag.partition("=")
+    if key.strip() in ["floatX", "global.floatX"]:
+      floatX = value.strip()  # the last one wins
+  if floatX:
+    return floatX
+  try:
+    from ConfigParser import RawConfigParser
+  except ImportError:  # Python3
+    from configparser import RawConfigParser
+  theanorc = os.environ.get("THEANORC", os.pathsep.join(["~/.theanorc", "~/.theanorc.txt"]))
+  parser = RawConfigParser()
+  parser.optionxform = str  # case-sensitive, like in Theano
+  parser.read([os.path.expanduser(filename) for filename in theanorc.split(os.pathsep)])
+  if parser.has_option("global", "floatX"):
+    return parser.get("global", "floatX")
+  return "float64"  # Theano default
+
+
 def cmd(s):
   """
   :type s: str
@@ -258,17 +288,252 @@ def hdf5_shape(filename, dimension):
   fin.close()
   return res
 
+def hdf5_chunk_shape(shape, dtype, chunk_frames=0):
+  """
+  The data is usually read seq by seq, i.e. the chunks span over the time axis and cover the whole frames.
+
+  :param list[int|None] shape: (time,...) of the data array. time can be None if resizable
+  :param str dtype:
+  :param int chunk_frames: number of frames per chunk. 0 means to choose them such that a chunk has about 256kB
+  :rtype: tuple[int]
+  """
+  if not chunk_frames:
+    frame_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+    chunk_frames = max(2 ** 18 // frame_bytes, 1)
+  if shape[0] is not None:
+    chunk_frames = min(chunk_frames, shape[0])
+  return (chunk_frames,) + tuple(shape[1:])
+
 def hdf5_strings(handle, name, data):
   try:
     S=max([len(d) for d in data])
     dset = handle.create_dataset(name, (len(data),), dtype="S"+str(S))
     dset[...] = data
-  except Exception:
+  except Exception:  # e.g. unicode, or no data at all
     dt = h5py.special_dtype(vlen=unicode)
-    del handle[name]
+    if name in handle:
+      del handle[name]
     dset = handle.create_dataset(name, (len(data),), dtype=dt)
     dset[...] = data
 
+
+class HDFForwardWriterThread(threading.Thread):
+  """
+  Writes the forwarded features into the HDF cache,
+  such that the compute thread does not wait for the disk.
+  The seq tags and times are also written batch by batch, i.e. nothing grows in memory with the dataset size.
+  """
+
+  def __init__(self, cache, inputs, seq_lengths, queue_size=4):
+    """
+    :param h5py.File cache: "seqTags" and (if there are times) "times" are created in there
+    :param h5py.Dataset inputs: (time,dim), resizable in time
+    :param h5py.Dataset seq_lengths: (seq,), resizable
+    :param int queue_size: max number of batches waiting to be written. if full, the compute thread blocks
+    """
+    try:
+      from Queue import Queue
+    except ImportError:  # Python3
+      from queue import Queue
+    threading.Thread.__init__(self, name="HDFForwardWriterThread")
+    self.daemon = True
+    self.cache = cache
+    self.inputs = inputs
+    self.seq_lengths = seq_lengths
+    self.seq_tags = cache.create_dataset(
+      "seqTags", seq_lengths.shape, dtype=h5py.special_dtype(vlen=unicode), maxshape=(None,))
+    self.times = None; " :type: h5py.Dataset | None "
+    self.queue = Queue(maxsize=queue_size)
+    self.num_frames = 0
+    self.num_seqs = 0
+    self.num_times = 0
+    self.exception = None; " :type: BaseException | None "
+    self.start()
+
+  def add(self, feats, lengths, tags, times=None):
+    """
+    :param numpy.ndarray feats: (time,dim), the concatenated seqs of one batch
+    :param numpy.ndarray lengths: (seq,)
+    :param list[str] tags: (seq,)
+    :param numpy.ndarray|None times: (N,2), the concatenated times of the seqs, if the dataset has them
+    """
+    if self.exception:
+      raise self.exception
+    assert len(tags) == lengths.shape[0]
+    self.queue.put((feats, lengths, tags, times))
+
+  def finish(self):
+    """
+    Waits until everything is written, and shrinks the arrays to the written size.
+    """
+    self.queue.put(None)
+    self.join()
+    if self.exception:
+      raise self.exception
+    self.inputs.resize(self.num_frames, axis=0)
+    self.seq_lengths.resize(self.num_seqs, axis=0)
+    self.seq_tags.resize(self.num_seqs, axis=0)
+    if self.times is not None:
+      self.times.resize(self.num_times, axis=0)
+
+  def stop(self):
+    """
+    Stops the thread without waiting for the remaining writes, e.g. after an exception in the compute thread.
+    Does nothing if it was already finished.
+    """
+    if not self.is_alive():
+      return
+    # Drop what is still waiting, such that the end marker fits into the queue.
+    try:
+      while True:
+        self.queue.get_nowait()
+    except Exception:  # Empty. the writer thread might also have taken the last one
+      pass
+    self.queue.put(None)
+    self.join()
+
+  @staticmethod
+  def _ensure_size(dataset, size):
+    if dataset.shape[0] < size:
+      # Grow exponentially, to not resize for every batch.
+      dataset.resize(max(size, dataset.shape[0] * 2), axis=0)
+
+  @classmethod
+  def _append(cls, dataset, offset, values):
+    """
+    :param h5py.Dataset dataset: resizable in axis 0
+    :param int offset: num of already written entries
+    :param numpy.ndarray|list values:
+    :return: new offset
+    :rtype: int
+    """
+    if len(values) == 0:
+      return offset
+    cls._ensure_size(dataset, offset + len(values))
+    dataset[offset:offset + len(values)] = values
+    return offset + len(values)
+
+  def run(self):
+    try:
+      while True:
+        item = self.queue.get()
+        if item is None:
+          break
+        feats, lengths, tags, times = item
+        self.num_frames = self._append(self.inputs, self.num_frames, feats)
+        self._append(self.seq_lengths, self.num_seqs, lengths)
+        self.num_seqs = self._append(self.seq_tags, self.num_seqs, [unicode(tag) for tag in tags])
+        if times is not None and len(times) > 0:
+          if self.times is None:
+            self.times = self.cache.create_dataset("times", (0, 2), dtype='f', maxshape=(None, 2))
+          self.num_times = self._append(self.times, self.num_times, times)
+    except BaseException as exc:
+      self.exception = exc
+      # Unblock the producer.
+      while not self.queue.empty():
+        self.queue.get_nowait()
+
+
+class BackgroundCheckpointSaver(object):
+  """
+  Writes model checkpoints in a background thread, such that training does not wait for the disk.
+  The caller takes a snapshot of the parameters in host memory and passes a write function
+  which only uses that snapshot.
+  Files are written under a temporary name, fsynced and then renamed to the final name.
+  Only one save is in flight at a time.
+  An exception of the background save is raised in the next call to :func:`save` or :func:`wait`.
+  """
+
+  # On these, we try again, e.g. for DiskQuota. This could save us multiple hours of computation.
+  RetryErrnos = ("EBUSY", "EDQUOT", "EIO", "ENOSPC")
+
+  def __init__(self, try_again_wait_time=10):
+    """
+    :param float try_again_wait_time: in secs
+    """
+    self.try_again_wait_time = try_again_wait_time
+    self.thread = None  # type: threading.Thread|None
+    self.exception = None  # type: BaseException|None
+    self.pending_filename = None  # type: str|None
+
+  def save(self, filename, write_func):
+    """
+    Waits for the previous save, and then starts the new one.
+
+    :param str filename: final filename (or filename prefix). the temporary name is derived from it
+    :param ((str)->list[str]) write_func: gets the temporary filename (prefix),
+      returns the written files in the order in which they should be renamed. all must start with the prefix
+    """
+    self.wait()
+    self.pending_filename = filename
+    self.thread = threading.Thread(
+      target=self._thread_main, args=(filename, write_func), name="BackgroundCheckpointSaver %s" % filename)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def wait(self):
+    """
+    Waits until the pending save is finished, and raises its exception, if there was one.
+    """
+    from Log import log
+    if self.thread:
+      if self.thread.is_alive():
+        print("Waiting for the background save of %s ..." % self.pending_filename, file=log.v4)
+      self.thread.join()
+      self.thread = None
+      self.pending_filename = None
+    if self.exception:
+      exc, self.exception = self.exception, None
+      raise exc
+
+  def check_error(self):
+    """
+    Does not wait, but raises the exception of a finished save, if there was one.
+    Should be called at every epoch boundary.
+    """
+    if self.thread and not self.thread.is_alive():
+      self.wait()
+
+  def _thread_main(self, filename, write_func):
+    from Log import log
+    try:
+      start_time = time.time()
+      self._write(filename, write_func)
+      print("Background save of %s finished after %.2f secs." % (filename, time.time() - start_time), file=log.v5)
+    except BaseException as exc:
+      print("Exception in background save of %s: %s" % (filename, exc), file=log.v2)
+      self.exception = exc
+
+  def _write(self, filename, write_func):
+    """
+    :param str filename:
+    :param ((str)->list[str]) write_func:
+    """
+    import errno
+    from Log import log
+    tmp_filename = "%s.tmp%i" % (filename, os.getpid())
+    while True:
+      try:
+        tmp_files = write_func(tmp_filename)
+        break
+      except IOError as e:
+        if e.errno in [getattr(errno, name, None) for name in self.RetryErrnos]:
+          print("Exception while saving:", e, file=log.v3)
+          print("Trying again in %s secs." % self.try_again_wait_time, file=log.v3)
+          time.sleep(self.try_again_wait_time)
+          continue
+        raise
+    for tmp_file in tmp_files:
+      assert tmp_file.startswith(tmp_filename)
+      fd = os.open(tmp_file, os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+    for tmp_file in tmp_files:
+      os.rename(tmp_file, filename + tmp_file[len(tmp_filename):])
+
+
 def model_epoch_from_filename(filename):
   if BackendEngine.is_theano_selected():
     return hdf5_dimension(filename, 'epoch')
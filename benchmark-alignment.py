@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the alignment ops on CPU, as used by AlignmentLayer, CAlignmentLayer and the NumpyAlignOp output layers,
+for some typical sizes (time frames x labels).
+
+* C code (Inv.py): InvOp (viterbi) and InvAlignOp (full), which align the seqs of the batch in parallel (OpenMP),
+  with different numbers of threads.
+* Numpy (OpNumpyAlign.py, OpInvAlign.py): the vectorized DP vs. the loop over all DP cells
+  (NumpyAlignOp._ViterbiSequence, NumpyAlignOp._fullAlignmentSequenceInv, InvAlignOp._viterbi2).
+  The loops are slow, thus we only measure them on a few seqs.
+
+All numbers are seqs per second.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import OmpBenchmark
+
+
+def make_data(n_time, n_batch, n_labels, n_classes, seed=42):
+  """
+  :return: scores (time,batch,class) as neg log probs, transcriptions (label,batch), lengths of both (batch,)
+  """
+  import numpy
+  rnd = numpy.random.RandomState(seed)
+  scores = -numpy.log(rnd.dirichlet(numpy.ones(n_classes), size=(n_time, n_batch))).astype("float32")
+  transcriptions = rnd.randint(0, n_classes // 3, size=(n_labels, n_batch)).astype("int32")
+  length_x = rnd.randint(n_time * 3 // 4, n_time + 1, size=(n_batch,)).astype("int32")
+  length_x[0] = n_time
+  length_y = numpy.maximum(length_x * n_labels // n_time, 1).astype("int32")
+  return scores, transcriptions, length_x, length_y
+
+
+def measure(args):
+  """
+  :param argparse.Namespace args: from main()
+  :return: "<size> <op>" -> seqs per second. The Numpy variants only with args.with_reference
+  :rtype: dict[str,float]
+  """
+  import numpy
+  import theano
+  import theano.tensor as T
+  from Inv import InvOp, InvAlignOp
+  from OpNumpyAlign import NumpyAlignOp
+  import OpInvAlign
+
+  x, y, len_x, len_y = T.ftensor3(), T.imatrix(), T.ivector(), T.ivector()
+  c_funcs = [
+    ("InvOp", theano.function([x, y, len_x, len_y], InvOp(1, 8, args.nstates)(x, y, len_x, len_y))),
+    ("InvAlignOp full", theano.function([x, y, len_x, len_y],
+                                        InvAlignOp(1, 8, args.nstates, mode='full')(x, y, len_x, len_y)))]
+  tdps = [1e10, 0., 1.9, 3., 2.5, 2., 1.4]
+
+  result = {}
+  for size in args.sizes.split(","):
+    n_time, n_labels = [int(n) for n in size.split("x")]
+    scores, transcriptions, length_x, length_y = make_data(n_time, args.n_batch, n_labels, args.n_classes)
+    for name, f in c_funcs:
+      result["%s %s" % (size, name)] = args.n_batch * OmpBenchmark.measure_calls_per_sec(
+        lambda: f(scores, transcriptions, length_x, length_y), args.num_runs)
+    if not args.with_reference:
+      continue
+
+    index_in = (numpy.arange(n_time)[:, None] < length_x[None, :]).astype("int8")
+    index_out = (numpy.arange(n_labels)[:, None] < length_y[None, :]).astype("int8")
+    inputs = [index_in, index_out, scores, transcriptions]
+    num_ref_seqs = min(args.num_ref_seqs, args.n_batch)
+
+    def loop_seqs(func):
+      for b in range(num_ref_seqs):
+        func(0, length_x[b], scores[:length_x[b], b], transcriptions[:length_y[b], b])
+
+    for name, op, loop_func in [
+          ("NumpyAlignOp", NumpyAlignOp(False), NumpyAlignOp(False)._ViterbiSequence),
+          ("NumpyAlignOp inverse", NumpyAlignOp(True), NumpyAlignOp(True)._fullAlignmentSequenceInv),
+          ("OpInvAlign.InvAlignOp", OpInvAlign.InvAlignOp(tdps, args.nstates),
+           OpInvAlign.InvAlignOp(tdps, args.nstates)._viterbi2)]:
+      output_storage = [[None] for _ in op.otypes]
+      result["%s %s" % (size, name)] = args.n_batch * OmpBenchmark.measure_calls_per_sec(
+        lambda: op.perform(None, inputs, output_storage), args.num_runs)
+      result["%s %s loops" % (size, name)] = num_ref_seqs * OmpBenchmark.measure_calls_per_sec(
+        lambda: loop_seqs(loop_func), 1)
+  return result
+
+
+def main(argv):
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("--sizes", default="100x10,300x30,600x60",
+                         help="comma-separated list of time frames x labels")
+  argparser.add_argument("--n_batch", type=int, default=20)
+  argparser.add_argument("--n_classes", type=int, default=60)
+  argparser.add_argument("--nstates", type=int, default=3)
+  argparser.add_argument("--num_runs", type=int, default=5)
+  argparser.add_argument("--num_ref_seqs", type=int, default=2, help="seqs for the Numpy loops")
+  args = OmpBenchmark.parse_args(argparser, argv)
+  if args.worker:
+    OmpBenchmark.run_worker(measure, args)
+    return
+
+  print("Alignment ops on CPU, batch %i, classes %i, states %i. Seqs per second:" % (
+    args.n_batch, args.n_classes, args.nstates))
+  results = OmpBenchmark.run_threads(argv, args)
+  for size in args.sizes.split(","):
+    print("%s (time x labels):" % size)
+    for name in ["InvOp", "InvAlignOp full"]:
+      baseline = results[0][1]["%s %s" % (size, name)]
+      print("  %s: %s" % (name, ", ".join([
+        "%i threads %.1f (%.2fx)" % (num_threads, result["%s %s" % (size, name)],
+                                     result["%s %s" % (size, name)] / baseline)
+        for (num_threads, result) in results])))
+    for name in ["NumpyAlignOp", "NumpyAlignOp inverse", "OpInvAlign.InvAlignOp"]:
+      result = results[0][1]
+      print("  %s: %.1f, with loops %.1f (%.1fx faster)" % (
+        name, result["%s %s" % (size, name)], result["%s %s loops" % (size, name)],
+        result["%s %s" % (size, name)] / result["%s %s loops" % (size, name)]))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the CTC decoders on CPU on the same data:
+best path (BestPathDecoder.BestPathDecodeOp) vs. prefix beam search (PrefixBeamSearchDecoder) with different beam sizes.
+The data are synthetic posteriors of random label seqs with noise, thus we also report the label error rate.
+Both decoders run in parallel over the seqs, via OpenMP, i.e. set OMP_NUM_THREADS to compare the number of threads.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import time
+import numpy
+
+
+def make_data(args):
+  """
+  :param args: argparse object from main()
+  :return: posteriors (time,batch,label) with blank as the last label, references (batch,max_len) padded with -1,
+    seq_lengths (batch,)
+  """
+  rnd = numpy.random.RandomState(42)
+  n_labels = args.n_labels  # with blank
+  blank = n_labels - 1
+  labellings = []
+  alignments = []
+  for _ in range(args.n_batch):
+    labelling = []
+    alignment = []
+    while True:
+      label = rnd.randint(0, blank)
+      frames = [blank] * rnd.randint(0, 3) + [label] * rnd.randint(1, 4)
+      if labelling and labelling[-1] == label and frames[0] != blank:
+        frames.insert(0, blank)  # repeated labels need a blank in between
+      if len(alignment) + len(frames) > args.n_time:
+        break
+      labelling.append(label)
+      alignment += frames
+    alignment = (alignment + [blank] * args.n_time)[:args.n_time]
+    labellings.append(labelling)
+    alignments.append(alignment)
+  seq_lengths = numpy.array([args.n_time] * args.n_batch, dtype="int32")
+  logits = rnd.normal(scale=args.noise, size=(args.n_time, args.n_batch, n_labels))
+  for b, alignment in enumerate(alignments):
+    logits[numpy.arange(args.n_time), b, alignment] += args.peak
+  posteriors = numpy.exp(logits - numpy.max(logits, axis=2, keepdims=True))
+  posteriors /= numpy.sum(posteriors, axis=2, keepdims=True)
+  max_len = max([len(l) for l in labellings])
+  references = numpy.array([l + [-1] * (max_len - len(l)) for l in labellings], dtype="int32")
+  return posteriors.astype("float32"), references, seq_lengths
+
+
+def main(argv):
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("--n_time", type=int, default=300)
+  argparser.add_argument("--n_batch", type=int, default=40)
+  argparser.add_argument("--n_labels", type=int, default=80, help="with blank")
+  argparser.add_argument("--noise", type=float, default=1.0, help="stddev of the logits")
+  argparser.add_argument("--peak", type=float, default=4.0, help="added to the logit of the aligned label")
+  argparser.add_argument("--beam_sizes", default="1,4,16,64", help="comma-separated list")
+  argparser.add_argument("--num_runs", type=int, default=5)
+  args = argparser.parse_args(argv[1:])
+
+  import theano
+  import theano.tensor as T
+  from BestPathDecoder import BestPathDecodeOp
+  from PrefixBeamSearchDecoder import PrefixBeamSearchErrorsOp
+
+  posteriors, references, seq_lengths = make_data(args)
+  num_ref_labels = numpy.sum(references >= 0)
+  x, y, lens = T.ftensor3(), T.imatrix(), T.ivector()
+  decoders = [("best path", BestPathDecodeOp()(x, y, lens))]
+  for beam_size in [int(n) for n in args.beam_sizes.split(",")]:
+    log_x = T.log(T.maximum(x, numpy.float32(1e-30)))
+    decoders.append(("beam %i" % beam_size, PrefixBeamSearchErrorsOp(beam_size=beam_size)(log_x, y, lens)))
+
+  print("CTC decoding on CPU, time %i, batch %i, labels %i:" % (args.n_time, args.n_batch, args.n_labels))
+  for name, edits in decoders:
+    f = theano.function([x, y, lens], T.sum(edits))
+    num_edits = f(posteriors, references, seq_lengths)  # warmup
+    start_time = time.time()
+    for _ in range(args.num_runs):
+      f(posteriors, references, seq_lengths)
+    seqs_per_sec = args.n_batch * args.num_runs / (time.time() - start_time)
+    print("  %s: %.1f seqs/sec, label error rate %.2f%%" % (name, seqs_per_sec, 100. * num_edits / num_ref_labels))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the CPU MDLSTM (TwoDLSTMCPUOp, used by NetworkTwoDLayer.TwoDLSTMLayer on CPU)
+on the layer shapes of demos/mdlstm/IAM/config_demo, with a single thread vs. multiple threads.
+The positions of every anti-diagonal (of all directions) are distributed over the OpenMP threads.
+BLAS is kept single-threaded, because the matrices per position are small.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import OmpBenchmark
+
+
+# (height, width, n_in, n_cells) of the MDLSTM layers of demos/mdlstm/IAM/config_demo,
+# with the image sizes of demos/mdlstm/IAM/features/raw/demo.h5 (about 133x1751, after the conv+pool layers).
+IamLayers = [
+  ("mdlstm0", 66, 875, 15, 30),
+  ("mdlstm1", 33, 437, 45, 60),
+  ("mdlstm2", 16, 218, 75, 90),
+  ("mdlstm3", 16, 218, 105, 120),
+  ("mdlstm4", 16, 218, 105, 120)]
+
+
+def measure(args):
+  """
+  :param argparse.Namespace args: from main()
+  :return: "<layer> fwd" and "<layer> fwd+bwd" -> positions per second
+  :rtype: dict[str,float]
+  """
+  import numpy
+  import theano
+  import theano.tensor as T
+  from TwoDLSTMCPUOp import TwoDLSTMCPUOp
+  rnd = numpy.random.RandomState(42)
+  n_batch, n_dirs = args.n_batch, args.directions
+  result = {}
+  for name, height, width, n_in, n_cells in IamLayers:
+    X = theano.shared(rnd.normal(size=(height, width, n_batch, n_in)).astype("float32"))
+    params = [
+      theano.shared(rnd.normal(scale=0.1, size=shape).astype("float32"))
+      for shape in [(n_in, 5 * n_cells)] * n_dirs + [(n_cells, 5 * n_cells)] * (2 * n_dirs) + [(5 * n_cells,)] * n_dirs]
+    sizes = T.constant(numpy.array([[height, width]] * n_batch, dtype="float32"))
+    Ys = TwoDLSTMCPUOp(n_dirs)(*([X] + params + [sizes]))[:n_dirs]
+    loss = sum([T.sum(Y) for Y in Ys])
+    for fname, outputs in [("fwd", loss), ("fwd+bwd", T.grad(loss, [X] + params))]:
+      f = theano.function([], outputs)
+      result["%s %s" % (name, fname)] = height * width * n_batch * OmpBenchmark.measure_calls_per_sec(f, args.num_runs)
+  return result
+
+
+def main(argv):
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("--n_batch", type=int, default=3, help="demo.h5 has 3 images")
+  argparser.add_argument("--directions", type=int, default=4)
+  argparser.add_argument("--num_runs", type=int, default=3)
+  args = OmpBenchmark.parse_args(argparser, argv)
+  if args.worker:
+    OmpBenchmark.run_worker(measure, args)
+    return
+
+  print("MDLSTM on CPU, IAM demo shapes, batch %i, %i directions. Positions per second:" % (
+    args.n_batch, args.directions))
+  results = OmpBenchmark.run_threads(argv, args, blas_num_threads=1)
+  baseline = results[0][1]
+  for num_threads, result in results:
+    print("  %i threads:" % num_threads)
+    for name, _, _, _, _ in IamLayers:
+      print("    %s: %s" % (name, ", ".join([
+        "%s %.0f (%.2fx)" % (fname, result["%s %s" % (name, fname)], result["%s %s" % (name, fname)] / baseline["%s %s" % (name, fname)])
+        for fname in ["fwd", "fwd+bwd"]])))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks MultiBatchBeamOp and its gradient (MultiBatchBeamGradAddOp) on CPU:
+the naive reference (_naive_multi_batch_beam, as used in tests/test_MultiBatchBeam.py),
+the Numpy perform() variant and the C code with a single thread vs. multiple threads.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import OmpBenchmark
+
+
+def measure(args):
+  """
+  :param argparse.Namespace args: from main()
+  :return: "<variant> fwd" and "<variant> bwd" -> calls per second.
+    The naive and Numpy variants do not use threads, thus only with args.with_reference.
+  :rtype: dict[str,float]
+  """
+  import numpy
+  import theano
+  import theano.tensor as T
+  import MultiBatchBeam
+  rnd = numpy.random.RandomState(42)
+  n_time, n_batch, n_dim, beam_width = args.n_time, args.n_batch, args.n_dim, args.beam_width
+  array = rnd.normal(size=(n_time, n_batch, n_dim)).astype("float32")
+  batch_lens = rnd.randint(n_time // 2, n_time + 1, size=(n_batch,)).astype("int32")
+  start_idxs = rnd.randint(-n_time, n_time, size=(n_batch,)).astype("int32")
+  D_beam = rnd.normal(size=(beam_width, n_batch, n_dim)).astype("float32")
+
+  def measure_func(func):
+    return OmpBenchmark.measure_calls_per_sec(func, args.num_runs)
+
+  result = {}
+  if args.with_reference:
+    result["naive fwd"] = measure_func(lambda: MultiBatchBeam._naive_multi_batch_beam(
+      array, start_idxs, batch_lens, beam_width, args.wrap_mode))
+    result["naive bwd"] = measure_func(lambda: MultiBatchBeam._naive_multi_batch_beam_grad(
+      array, start_idxs, batch_lens, beam_width, args.wrap_mode, output_grad=D_beam))
+  modes = [("c", theano.Mode(linker="c|py", optimizer=None))]
+  if args.with_reference:
+    modes.append(("numpy", theano.Mode(linker="py", optimizer=None)))
+  array_var, start_idxs_var, batch_lens_var, D_beam_var = T.ftensor3(), T.ivector(), T.ivector(), T.ftensor3()
+  beam = MultiBatchBeam.MultiBatchBeamOp(args.wrap_mode)(array_var, start_idxs_var, batch_lens_var, beam_width, 0, 0)
+  D_array = MultiBatchBeam.MultiBatchBeamGradAddOp(args.wrap_mode, zero_with_shape=True, array_ndim=3)(
+    array_var.shape, start_idxs_var, batch_lens_var, beam_width, D_beam_var)
+  for name, mode in modes:
+    f = theano.function([array_var, start_idxs_var, batch_lens_var], beam, mode=mode)
+    result["%s fwd" % name] = measure_func(lambda: f(array, start_idxs, batch_lens))
+    f_grad = theano.function([array_var, start_idxs_var, batch_lens_var, D_beam_var], D_array, mode=mode)
+    try:
+      result["%s bwd" % name] = measure_func(lambda: f_grad(array, start_idxs, batch_lens, D_beam))
+    except NotImplementedError:  # perform() needs inplace_increment
+      pass
+  return result
+
+
+def main(argv):
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("--wrap_mode", default="wrap_around", help="wrap_around or pad")
+  argparser.add_argument("--n_time", type=int, default=200)
+  argparser.add_argument("--n_batch", type=int, default=40)
+  argparser.add_argument("--n_dim", type=int, default=500)
+  argparser.add_argument("--beam_width", type=int, default=20)
+  argparser.add_argument("--num_runs", type=int, default=100)
+  args = OmpBenchmark.parse_args(argparser, argv)
+  if args.worker:
+    OmpBenchmark.run_worker(measure, args)
+    return
+
+  print("MultiBatchBeam on CPU, %s, time %i, batch %i, dim %i, beam %i. Calls per second:" % (
+    args.wrap_mode, args.n_time, args.n_batch, args.n_dim, args.beam_width))
+  results = OmpBenchmark.run_threads(argv, args)
+  baseline = results[0][1]
+  for name in sorted(baseline):
+    if not name.startswith("c "):
+      print("  %s: %.1f (%.2fx)" % (name, baseline[name], baseline[name] / baseline["naive %s" % name[-3:]]))
+  for num_threads, result in results:
+    print("  c, %i threads: %s" % (num_threads, ", ".join([
+      "%s %.1f (%.2fx vs. naive)" % (name[2:], result[name], result[name] / baseline["naive %s" % name[-3:]])
+      for name in sorted(result) if name.startswith("c ")])))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
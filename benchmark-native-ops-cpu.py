@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the native LSTM (NativeOp.LstmGenericBase, via TFNativeOp) on CPU,
+with the single-threaded kernels vs. multiple threads (see start_dev_kernel2 in NativeOp.cpp).
+The BLAS calls (the recurrent matrix multiplication) use their own threads, the same number in all runs.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import multiprocessing
+import OmpBenchmark
+
+
+def measure(args):
+  """
+  :param argparse.Namespace args: from main()
+  :return: frames per second of the fwd and fwd+bwd pass
+  :rtype: dict[str,float]
+  """
+  import numpy
+  import tensorflow as tf
+  import TFNativeOp
+  rnd = numpy.random.RandomState(42)
+  n_time, n_batch, n_cells = args.n_time, args.n_batch, args.n_cells
+  Z = tf.Variable(rnd.normal(scale=0.1, size=(n_time, n_batch, n_cells * 4)).astype("float32"))
+  V_h = tf.Variable(rnd.normal(scale=0.1, size=(n_cells, n_cells * 4)).astype("float32"))
+  c = tf.zeros((n_batch, n_cells))
+  i = tf.ones((n_time, n_batch))
+  op = TFNativeOp.make_lstm_op()
+  Y, _, d = op(Z * 1., V_h, c, i)  # the op works inplace on Z, thus give it a copy
+  grads = tf.gradients(tf.reduce_sum(Y) + tf.reduce_sum(d), [Z, V_h])
+  config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+  result = {}
+  with tf.Session(config=config) as session:
+    session.run(tf.global_variables_initializer())
+    for name, fetches in [("fwd", Y.op), ("fwd+bwd", [g.op for g in grads])]:
+      result[name] = n_time * n_batch * OmpBenchmark.measure_calls_per_sec(
+        lambda: session.run(fetches), args.num_runs)
+  return result
+
+
+def main(argv):
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("--n_time", type=int, default=100)
+  argparser.add_argument("--n_batch", type=int, default=40)
+  argparser.add_argument("--n_cells", type=int, default=500)
+  argparser.add_argument("--num_runs", type=int, default=10)
+  args = OmpBenchmark.parse_args(argparser, argv)
+  if args.worker:
+    OmpBenchmark.run_worker(measure, args)
+    return
+
+  print("Native LSTM on CPU, time %i, batch %i, cells %i. Frames per second:" % (
+    args.n_time, args.n_batch, args.n_cells))
+  results = OmpBenchmark.run_threads(argv, args, blas_num_threads=multiprocessing.cpu_count())
+  baseline = results[0][1]
+  for num_threads, result in results:
+    print("  %i threads: %s" % (num_threads, ", ".join([
+      "%s %.0f (%.2fx)" % (name, result[name], result[name] / baseline[name]) for name in sorted(result)])))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
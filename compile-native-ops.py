@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Compiles the native ops (see NativeOp) ahead of time, in parallel processes, into the op cache,
+such that e.g. on a fresh cluster node, the training does not need to compile them before the first batch.
+This compiles either the ops used by the network of a config, the given ops, or all ops.
+
+For TF, the ops go into the OpCodeCompiler cache dir (see TFUtil.OpCodeCompiler).
+For Theano, they go into the Theano compiledir. Theano uses THEANO_FLAGS as usual,
+e.g. device=gpu to compile the GPU variant.
+Note that Theano holds a lock on the compiledir while it compiles, thus this is mostly serial for Theano.
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import multiprocessing
+import time
+import rnn
+import NativeOp
+from Log import log
+from Util import BackendEngine, hms
+
+
+def precompile_op(op_name):
+  """
+  Runs in the worker process.
+
+  :param str op_name: e.g. "LstmGenericBase"
+  :return: (op_name, error or None, time in secs)
+  :rtype: (str, str|None, float)
+  """
+  start_time = time.time()
+  try:
+    gen_base = getattr(NativeOp, op_name)
+    if BackendEngine.is_tensorflow_selected():
+      import TFNativeOp
+      TFNativeOp.precompile_op(gen_base)
+    else:
+      import TheanoNativeOp
+      TheanoNativeOp.precompile_op(gen_base)
+  except Exception as exc:
+    return op_name, "%s: %s" % (type(exc).__name__, exc), time.time() - start_time
+  return op_name, None, time.time() - start_time
+
+
+def get_op_names(args):
+  """
+  :param args: argparse object from main()
+  :rtype: list[str]
+  """
+  if args.ops:
+    return args.ops.split(",")
+  if args.config:
+    from NetworkDescription import LayerNetworkDescription
+    network_json = LayerNetworkDescription.network_json_from_config(rnn.config)
+    return NativeOp.get_op_names_from_network_json(
+      network_json, tensorflow=BackendEngine.is_tensorflow_selected())
+  op_names = NativeOp.get_all_op_names()
+  if BackendEngine.is_tensorflow_selected():
+    # Custom gradients are not supported by TFNativeOp.
+    op_names = [name for name in op_names if not getattr(NativeOp, name).custom_grad]
+  return op_names
+
+
+def main(argv):
+  argparser = argparse.ArgumentParser(description=__doc__)
+  argparser.add_argument("config", nargs="?", help="compile the ops used by the network of this config")
+  argparser.add_argument("--ops", help="comma-separated op names, e.g. LstmGenericBase. default: from config or all")
+  argparser.add_argument("--tf", action="store_true", help="compile for TF. otherwise Theano. default: from config")
+  argparser.add_argument("--num_workers", type=int, default=multiprocessing.cpu_count())
+  args = argparser.parse_args(argv[1:])
+  rnn.initBetterExchook()
+  rnn.initConfig(configFilename=args.config)
+  if args.tf:
+    rnn.config.set("use_tensorflow", True)
+  rnn.config.set("log", [])
+  rnn.initLog()
+  # Do not import the backend itself here, i.e. no rnn.initBackendEngine(), because we fork the workers.
+  BackendEngine.select_engine(config=rnn.config)
+  op_names = get_op_names(args)
+  print("Compile native ops for %s: %s" % (
+    "TF" if BackendEngine.is_tensorflow_selected() else "Theano", ", ".join(op_names) or "<none>"), file=log.v3)
+  if not op_names:
+    return
+  start_time = time.time()
+  pool = multiprocessing.Pool(processes=max(min(args.num_workers, len(op_names)), 1))
+  failed = []
+  try:
+    for op_name, error, op_time in pool.imap_unordered(precompile_op, op_names):
+      if error:
+        print("%s: failed after %s: %s" % (op_name, hms(op_time), error), file=log.v1)
+        failed.append(op_name)
+      else:
+        print("%s: done in %s" % (op_name, hms(op_time)), file=log.v3)
+  finally:
+    pool.close()
+    pool.join()
+  print("Finished in %s. %i ops compiled, %i failed." % (
+    hms(time.time() - start_time), len(op_names) - len(failed), len(failed)), file=log.v3)
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -5,11 +5,15 @@ import numpy
 from Log import log
 import rnn
 import argparse
+import os
 import sys
+import subprocess
+import time
 import HDFDataset
+from Util import hms
 from Dataset import Dataset, init_dataset_via_str
 from Config import Config
-from Util import NumbersDict, human_size, progress_bar_with_time, try_run
+from Util import NumbersDict, human_size, progress_bar_with_time, try_run, hdf5_chunk_shape
 
 
 def hdf_dataset_init(file_name):
@@ -21,6 +25,99 @@ def hdf_dataset_init(file_name):
   return h5.File(file_name, "w")
 
 
+def _get_hdf_data_array(hdf_dataset, data_key):
+  """
+  :type hdf_dataset: h5py._hl.files.File
+  :param str data_key:
+  :rtype: h5py._hl.dataset.Dataset
+  """
+  if data_key == "data":
+    return hdf_dataset['inputs']
+  return hdf_dataset['targets/data'][data_key]
+
+
+def hdf_dump_create_data_array(dataset, hdf_dataset, data_key, shape, maxshape, parser_args):
+  """
+  Creates 'inputs' or 'targets/data/<data_key>'.
+  Chunking and compression are taken from parser_args, if given there.
+
+  :param Dataset dataset:
+  :type hdf_dataset: h5py._hl.files.File
+  :param str data_key:
+  :param list[int] shape:
+  :param list[int|None] maxshape: if the first dim is None, it is resizable
+  :param parser_args: argparse object from main()
+  """
+  if 'targets' not in hdf_dataset:
+    hdf_dataset.create_group('targets/data')
+    hdf_dataset.create_group('targets/size')
+    hdf_dataset.create_group('targets/labels')
+  dtype = dataset.get_data_dtype(data_key)
+  opts = {}
+  compression = getattr(parser_args, "compression", None)
+  chunk_frames = getattr(parser_args, "chunk_frames", 0)
+  if maxshape[0] is None or compression or chunk_frames:
+    if maxshape[0] is not None and shape[0] == 0:
+      pass  # cannot be chunked
+    else:
+      opts["chunks"] = hdf5_chunk_shape(maxshape, dtype, chunk_frames=chunk_frames)
+      if compression:
+        opts["compression"] = compression
+        opts["compression_opts"] = getattr(parser_args, "compression_opts", None)
+  if data_key == "data":
+    hdf_dataset.create_dataset('inputs', shape=shape, maxshape=maxshape, dtype=dtype, **opts)
+  else:
+    hdf_dataset['targets/data'].create_dataset(data_key, shape=shape, maxshape=maxshape, dtype=dtype, **opts)
+    hdf_dataset['targets/size'].attrs[data_key] = dataset.num_outputs[data_key][0]  # dim, as HDFDataset expects
+
+
+def hdf_dump_write_labels(dataset, hdf_dataset, data_keys):
+  """
+  :param Dataset dataset:
+  :type hdf_dataset: h5py._hl.files.File
+  :param list[str] data_keys:
+  """
+  for data_key in data_keys:
+    if data_key == "data":
+      continue  # not a target. HDFDataset expects labels only for the targets
+    if data_key in dataset.labels:
+      labels = dataset.labels[data_key]
+      assert len(labels) == dataset.num_outputs[data_key][0]
+    else:
+      labels = ["%s-class-%i" % (data_key, i) for i in range(dataset.get_data_dim(data_key))]
+    print >> log.v5, "Labels for %s:" % data_key, labels[:3], "..."
+    max_label_len = max(map(len, labels))
+    hdf_dataset['targets/labels'].create_dataset(
+      data_key, data=numpy.array(labels, dtype="S%i" % (max_label_len + 1)))
+
+
+def hdf_dump_write_seq_infos(dataset, hdf_dataset, seq_tags, seq_lens):
+  """
+  Writes 'seqTags' and 'seqLengths', each at once.
+
+  :param Dataset dataset:
+  :type hdf_dataset: h5py._hl.files.File
+  :param list[str] seq_tags:
+  :param list[NumbersDict] seq_lens:
+  """
+  print >> log.v3, "Set seq tags..."
+  max_tag_len = max(map(len, seq_tags))
+  hdf_dataset.create_dataset('seqTags', data=numpy.array(seq_tags, dtype="S%i" % (max_tag_len + 1)))
+
+  print >> log.v3, "Set seq len info..."
+  target_keys = [data_key for data_key in dataset.get_target_list() if data_key != "orth"]
+  lens = numpy.zeros((len(seq_lens), 2), dtype="int32")
+  for i, seq_len in enumerate(seq_lens):
+    data_len = seq_len["data"]
+    targets_len = seq_len["classes"]
+    for data_key in target_keys:
+      assert seq_len[data_key] == targets_len, "different lengths in multi-target not supported"
+    if targets_len is None:
+      targets_len = data_len
+    lens[i] = [data_len, targets_len]
+  hdf_dataset.create_dataset(HDFDataset.attr_seqLengths, data=lens)
+
+
 def hdf_dump_from_dataset(dataset, hdf_dataset, parser_args):
   """
   :param Dataset dataset: could be any dataset implemented as child of Dataset
@@ -28,6 +125,9 @@ def hdf_dump_from_dataset(dataset, hdf_dataset, parser_args):
   :param parser_args: argparse object from main()
   :return:
   """
+  if getattr(parser_args, "single_pass", False):
+    hdf_dump_from_dataset_single_pass(dataset, hdf_dataset, parser_args)
+    return
   print >> log.v3, "Work on epoch: %i" % parser_args.epoch
   dataset.init_seq_order(parser_args.epoch)
 
@@ -43,7 +143,6 @@ def hdf_dump_from_dataset(dataset, hdf_dataset, parser_args):
   seq_tags = []
   seq_lens = []
   total_seq_len = NumbersDict(0)
-  max_tag_len = 0
   dataset_num_seqs = try_run(lambda: dataset.num_seqs, default=None)  # can be unknown
   if parser_args.end_seq != float("inf"):
     if dataset_num_seqs is not None:
@@ -60,7 +159,6 @@ def hdf_dump_from_dataset(dataset, hdf_dataset, parser_args):
     seq_lens += [seq_len]
     tag = dataset.get_tag(seq_idx)
     seq_tags += [tag]
-    max_tag_len = max(len(tag), max_tag_len)
     total_seq_len += seq_len
     if dataset_num_seqs is not None:
       progress_bar_with_time(float(seq_idx - parser_args.start_seq) / dataset_num_seqs)
@@ -77,49 +175,13 @@ def hdf_dump_from_dataset(dataset, hdf_dataset, parser_args):
                      data_key, human_size(shape[0]), shape, dataset.get_data_dtype(data_key))
     shapes[data_key] = shape
 
-  print >> log.v3, "Set seq tags..."
-  hdf_dataset.create_dataset('seqTags', shape=(num_seqs,), dtype="S%i" % (max_tag_len + 1))
-  for i, tag in enumerate(seq_tags):
-    hdf_dataset['seqTags'][i] = tag
-    progress_bar_with_time(float(i) / num_seqs)
-
-  print >> log.v3, "Set seq len info..."
-  hdf_dataset.create_dataset(HDFDataset.attr_seqLengths, shape=(num_seqs, 2), dtype="int32")
-  for i, seq_len in enumerate(seq_lens):
-    data_len = seq_len["data"]
-    targets_len = seq_len["classes"]
-    for data_key in dataset.get_target_list():
-      if data_key == "orth":
-        continue
-      assert seq_len[data_key] == targets_len, "different lengths in multi-target not supported"
-    if targets_len is None:
-      targets_len = data_len
-    hdf_dataset[HDFDataset.attr_seqLengths][i] = [data_len, targets_len]
-    progress_bar_with_time(float(i) / num_seqs)
+  hdf_dump_write_seq_infos(dataset, hdf_dataset, seq_tags=seq_tags, seq_lens=seq_lens)
 
   print >> log.v3, "Create arrays in HDF..."
-  hdf_dataset.create_group('targets/data')
-  hdf_dataset.create_group('targets/size')
-  hdf_dataset.create_group('targets/labels')
   for data_key in data_keys:
-    if data_key == "data":
-      hdf_dataset.create_dataset(
-        'inputs', shape=shapes[data_key], dtype=dataset.get_data_dtype(data_key))
-    else:
-      hdf_dataset['targets/data'].create_dataset(
-        data_key, shape=shapes[data_key], dtype=dataset.get_data_dtype(data_key))
-      hdf_dataset['targets/size'].attrs[data_key] = dataset.num_outputs[data_key]
-
-    if data_key in dataset.labels:
-      labels = dataset.labels[data_key]
-      assert len(labels) == dataset.num_outputs[data_key][0]
-    else:
-      labels = ["%s-class-%i" % (data_key, i) for i in range(dataset.get_data_dim(data_key))]
-    print >> log.v5, "Labels for %s:" % data_key, labels[:3], "..."
-    max_label_len = max(map(len, labels))
-    hdf_dataset['targets/labels'].create_dataset(data_key, (len(labels),), dtype="S%i" % (max_label_len + 1))
-    for i, label in enumerate(labels):
-      hdf_dataset['targets/labels'][data_key][i] = label
+    hdf_dump_create_data_array(
+      dataset, hdf_dataset, data_key, shape=shapes[data_key], maxshape=shapes[data_key], parser_args=parser_args)
+  hdf_dump_write_labels(dataset, hdf_dataset, data_keys)
 
   # Again iterate through dataset, and set the data
   print >> log.v3, "Write data..."
@@ -131,10 +193,7 @@ def hdf_dump_from_dataset(dataset, hdf_dataset, parser_args):
     assert tag == tag_  # Just a check for sanity. We expect the same order.
     seq_len = dataset.get_seq_length(seq_idx)
     for data_key in data_keys:
-      if data_key == "data":
-        hdf_data = hdf_dataset['inputs']
-      else:
-        hdf_data = hdf_dataset['targets/data'][data_key]
+      hdf_data = _get_hdf_data_array(hdf_dataset, data_key)
       data = dataset.get_data(seq_idx, data_key)
       hdf_data[offsets[data_key]:offsets[data_key] + seq_len[data_key]] = data
 
@@ -151,6 +210,232 @@ def hdf_dump_from_dataset(dataset, hdf_dataset, parser_args):
   print >> log.v3, "All done."
 
 
+def hdf_dump_from_dataset_single_pass(dataset, hdf_dataset, parser_args):
+  """
+  Like :func:`hdf_dump_from_dataset`, but iterates only once through the dataset.
+  The data arrays are resizable, and the data is buffered and appended in bigger blocks.
+  The seq tags and lengths are written at the end.
+
+  :param Dataset dataset: could be any dataset implemented as child of Dataset
+  :type hdf_dataset: h5py._hl.files.File
+  :param parser_args: argparse object from main()
+  """
+  print >> log.v3, "Work on epoch: %i" % parser_args.epoch
+  dataset.init_seq_order(parser_args.epoch)
+
+  data_keys = sorted(dataset.get_data_keys())
+  print >> log.v3, "Data keys:", data_keys
+  if "orth" in data_keys:
+    data_keys.remove("orth")
+  for data_key in data_keys:
+    data_shape = list(dataset.get_data_shape(data_key))
+    hdf_dump_create_data_array(
+      dataset, hdf_dataset, data_key, shape=[0] + data_shape, maxshape=[None] + data_shape, parser_args=parser_args)
+  hdf_dump_write_labels(dataset, hdf_dataset, data_keys)
+
+  dataset_num_seqs = try_run(lambda: dataset.num_seqs, default=None)  # can be unknown
+  if dataset_num_seqs is not None:
+    dataset_num_seqs = min(dataset_num_seqs, parser_args.end_seq) - parser_args.start_seq
+    assert dataset_num_seqs > 0
+  write_buffer_frames = getattr(parser_args, "write_buffer_frames", 0) or 10000
+  buffers = {data_key: [] for data_key in data_keys}; " :type: dict[str,list[numpy.ndarray]] "
+  buffered_frames = NumbersDict(0)
+  offsets = NumbersDict(0)
+
+  def flush():
+    for data_key in data_keys:
+      if not buffers[data_key]:
+        continue
+      data = numpy.concatenate(buffers[data_key], axis=0)
+      del buffers[data_key][:]
+      if data.shape[0] == 0:
+        continue
+      hdf_data = _get_hdf_data_array(hdf_dataset, data_key)
+      hdf_data.resize(offsets[data_key] + data.shape[0], axis=0)
+      hdf_data[offsets[data_key]:] = data
+      offsets[data_key] += data.shape[0]
+
+  print >> log.v3, "Write data..."
+  seq_idx = parser_args.start_seq
+  seq_tags = []
+  seq_lens = []
+  while dataset.is_less_than_num_seqs(seq_idx) and seq_idx <= parser_args.end_seq:
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    seq_len = dataset.get_seq_length(seq_idx)
+    seq_lens += [seq_len]
+    seq_tags += [dataset.get_tag(seq_idx)]
+    for data_key in data_keys:
+      buffers[data_key].append(dataset.get_data(seq_idx, data_key))
+    buffered_frames += seq_len
+    if buffered_frames.max_value() >= write_buffer_frames:
+      flush()
+      buffered_frames = NumbersDict(0)
+    if dataset_num_seqs is not None:
+      progress_bar_with_time(float(seq_idx - parser_args.start_seq) / dataset_num_seqs)
+    seq_idx += 1
+  flush()
+
+  assert seq_tags, "no seqs dumped"
+  total_seq_len = NumbersDict(0)
+  for seq_len in seq_lens:
+    total_seq_len += seq_len
+  for data_key in data_keys:
+    assert offsets[data_key] == total_seq_len[data_key]  # Sanity check.
+    print >> log.v3, "Total len of %r is %s, shape %r, dtype %s" % (
+                     data_key, human_size(offsets[data_key]), _get_hdf_data_array(hdf_dataset, data_key).shape,
+                     dataset.get_data_dtype(data_key))
+  hdf_dump_write_seq_infos(dataset, hdf_dataset, seq_tags=seq_tags, seq_lens=seq_lens)
+
+  # Set some old-format attribs. Not needed for newer CRNN versions.
+  hdf_dataset.attrs[HDFDataset.attr_inputPattSize] = dataset.num_inputs
+  hdf_dataset.attrs[HDFDataset.attr_numLabels] = dataset.num_outputs.get("classes", (0, 0))[0]
+
+  print >> log.v3, "All done."
+
+
+def get_shard_seq_ranges(start_seq, end_seq, num_shards):
+  """
+  :param int start_seq: inclusive
+  :param int end_seq: exclusive
+  :param int num_shards:
+  :return: contiguous seq range (start, end) of every shard, end exclusive
+  :rtype: list[(int,int)]
+  """
+  num_seqs = end_seq - start_seq
+  assert num_seqs >= num_shards > 0
+  bounds = [start_seq + num_seqs * i // num_shards for i in range(num_shards + 1)]
+  return list(zip(bounds[:-1], bounds[1:]))
+
+
+def get_shard_filename(hdf_filename, start_seq, end_seq):
+  """
+  The shard is named by its seq range, thus an existing shard file is complete for exactly this range,
+  also when the dump is resumed with another number of shards.
+
+  :param str hdf_filename:
+  :param int start_seq: inclusive
+  :param int end_seq: exclusive
+  :rtype: str
+  """
+  return "%s.shard-seqs-%i-%i" % (hdf_filename, start_seq, end_seq - 1)
+
+
+def hdf_dump_sharded(args, num_seqs):
+  """
+  Dumps the dataset in args.num_shards shards, each in its own process (this script with --start_seq/--end_seq),
+  at most args.num_workers at a time.
+  A shard file is only created when its process succeeded, and it is named by its seq range.
+  Existing shard files are kept, thus a rerun only dumps the missing or failed shards.
+
+  :param argparse.Namespace args: from main()
+  :param int num_seqs: num seqs in the dataset, or end_seq
+  :return: shard filenames, or None if some shard failed
+  :rtype: list[str]|None
+  """
+  end_seq = num_seqs
+  if args.end_seq != float("inf"):
+    end_seq = min(end_seq, args.end_seq + 1)  # args.end_seq is inclusive
+  seq_ranges = get_shard_seq_ranges(args.start_seq, end_seq, args.num_shards)
+  shard_filenames = [get_shard_filename(args.hdf_filename, start, end) for (start, end) in seq_ranges]
+  todo = [i for i in range(args.num_shards)
+          if not os.path.exists(shard_filenames[i]) or i in (args.shard or [])]
+  total_seqs = end_seq - args.start_seq
+  todo_seqs = sum([seq_ranges[i][1] - seq_ranges[i][0] for i in todo])
+  print >> log.v3, "Dump %i seqs in %i shards, %i shards (%i seqs) to do, with %i workers" % (
+    total_seqs, args.num_shards, len(todo), todo_seqs, args.num_workers)
+  for i in range(args.num_shards):
+    if i not in todo:
+      print >> log.v4, "Shard %i/%i: complete, %s" % (i, args.num_shards, shard_filenames[i])
+  child_opts = ["--epoch", str(args.epoch), "--write_buffer_frames", str(args.write_buffer_frames),
+                "--chunk_frames", str(args.chunk_frames)]
+  if args.single_pass:
+    child_opts += ["--single_pass"]
+  if args.compression:
+    child_opts += ["--compression", args.compression]
+  if args.compression_opts is not None:
+    child_opts += ["--compression_opts", str(args.compression_opts)]
+  running = {}  # shard idx -> (process, start time)
+  failed = []
+  done_seqs = 0
+  dump_start_time = time.time()
+  while todo or running:
+    while todo and len(running) < args.num_workers:
+      shard_idx = todo.pop(0)
+      start, end = seq_ranges[shard_idx]
+      tmp_filename = "%s.tmp" % shard_filenames[shard_idx]
+      log_file = open("%s.log" % shard_filenames[shard_idx], "w")
+      cmd = [sys.executable, os.path.abspath(__file__), args.config_file_or_dataset, tmp_filename,
+             "--start_seq", str(start), "--end_seq", str(end - 1)] + child_opts
+      print >> log.v3, "Shard %i/%i: start, seqs %i-%i, log %s" % (shard_idx, args.num_shards, start, end - 1, log_file.name)
+      running[shard_idx] = (subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT), time.time())
+      log_file.close()
+    time.sleep(0.1)
+    for shard_idx, (proc, start_time) in sorted(running.items()):
+      if proc.poll() is None:
+        continue
+      del running[shard_idx]
+      if proc.returncode == 0:
+        os.rename("%s.tmp" % shard_filenames[shard_idx], shard_filenames[shard_idx])
+        done_seqs += seq_ranges[shard_idx][1] - seq_ranges[shard_idx][0]
+        elapsed = time.time() - dump_start_time
+        print >> log.v3, "Shard %i/%i: done after %.1f sec. Progress %i/%i seqs (%.1f%%), %i shards left, ETA %s" % (
+          shard_idx, args.num_shards, time.time() - start_time, done_seqs, todo_seqs, 100. * done_seqs / todo_seqs,
+          len(todo) + len(running), hms(elapsed * (todo_seqs - done_seqs) / done_seqs))
+      else:
+        print >> log.v1, "Shard %i/%i: failed with exit code %i, see %s.log. Retry it with --shard %i" % (
+          shard_idx, args.num_shards, proc.returncode, shard_filenames[shard_idx], shard_idx)
+        failed.append(shard_idx)
+  if failed:
+    print >> log.v1, "Failed shards: %r" % sorted(failed)
+    return None
+  return shard_filenames
+
+
+def hdf_merge_shards(shard_filenames, hdf_filename, copy_block_frames=100000):
+  """
+  Concatenates the HDF shards into one HDF file, with the same chunking and compression as the first shard.
+
+  :param list[str] shard_filenames:
+  :param str hdf_filename:
+  :param int copy_block_frames: number of frames to copy at once
+  """
+  print >> log.v3, "Merge %i shards into %s" % (len(shard_filenames), hdf_filename)
+  shards = [h5.File(filename, "r") for filename in shard_filenames]
+  first = shards[0]
+  tmp_filename = "%s.tmp" % hdf_filename
+  out = h5.File(tmp_filename, "w")
+  for key, value in first.attrs.items():
+    out.attrs[key] = value
+  out.create_group('targets/data')
+  first.copy('targets/labels', out['targets'])
+  first.copy('targets/size', out['targets'])
+  names = ['inputs'] + ['targets/data/%s' % k for k in first['targets/data']]
+  for name in names:
+    src = first[name]
+    total_len = sum([shard[name].shape[0] for shard in shards])
+    opts = {}
+    if src.chunks:
+      opts = {"chunks": src.chunks, "compression": src.compression, "compression_opts": src.compression_opts}
+      if total_len < src.chunks[0]:
+        opts["chunks"] = (max(total_len, 1),) + src.chunks[1:]
+    dst = out.create_dataset(name, shape=(total_len,) + src.shape[1:], dtype=src.dtype, **opts)
+    offset = 0
+    for shard in shards:
+      shard_data = shard[name]
+      for start in range(0, shard_data.shape[0], copy_block_frames):
+        block = shard_data[start:start + copy_block_frames]
+        dst[offset:offset + block.shape[0]] = block
+        offset += block.shape[0]
+    assert offset == total_len
+  out.create_dataset('seqTags', data=numpy.concatenate([shard['seqTags'][...] for shard in shards]))
+  out.create_dataset(
+    HDFDataset.attr_seqLengths, data=numpy.concatenate([shard[HDFDataset.attr_seqLengths][...] for shard in shards]))
+  out.close()
+  for shard in shards:
+    shard.close()
+  os.rename(tmp_filename, hdf_filename)
+
+
 def hdf_close(hdf_dataset):
   """
   :param h5py._hl.files.File hdf_dataset: to close
@@ -206,6 +491,24 @@ def main(argv):
   parser.add_argument('--start_seq', type=int, default=0, help="Start sequence index of the dataset to dump")
   parser.add_argument('--end_seq', type=int, default=float("inf"), help="End sequence index of the dataset to dump")
   parser.add_argument('--epoch', type=int, default=1, help="Optional start epoch for initialization")
+  parser.add_argument('--single_pass', action='store_true',
+                      help="Iterate only once through the dataset, and write the data in blocks")
+  parser.add_argument('--write_buffer_frames', type=int, default=10000,
+                      help="With --single_pass, number of frames to buffer before writing")
+  parser.add_argument('--compression', type=str, default=None, choices=["gzip", "lzf"],
+                      help="Compress the data arrays")
+  parser.add_argument('--compression_opts', type=int, default=None, help="For gzip, the level 0-9")
+  parser.add_argument('--chunk_frames', type=int, default=0,
+                      help="Number of frames per HDF chunk of the data arrays. 0 means automatic")
+  parser.add_argument('--num_shards', type=int, default=0,
+                      help="Dump into this many HDF shards, each dumped by its own process")
+  parser.add_argument('--num_workers', type=int, default=None,
+                      help="With --num_shards, number of shards dumped in parallel. Default is all")
+  parser.add_argument('--shard', type=int, action='append',
+                      help="With --num_shards, (re)dump this shard, even if it exists. Can be given multiple times")
+  parser.add_argument('--merge', type=str, default="list", choices=["list", "consolidate", "none"],
+                      help="With --num_shards, when all shards are there: 'list' writes the list of the shard files " +
+                           "into hdf_filename + '.list', 'consolidate' merges them into hdf_filename")
 
   args = parser.parse_args(argv[1:])
   crnn_config = None
@@ -214,6 +517,28 @@ def main(argv):
     crnn_config = args.config_file_or_dataset
   else:
     dataset_config_str = args.config_file_or_dataset
+  if args.num_shards:
+    if not args.num_workers:
+      args.num_workers = args.num_shards
+    dataset = None
+    if args.end_seq != float("inf"):
+      log.initialize(verbosity=[5])
+      num_seqs = args.end_seq + 1
+    else:
+      dataset = init(config_filename=crnn_config, cmd_line_opts=[], dataset_config_str=dataset_config_str)
+      num_seqs = dataset.num_seqs  # must be known, otherwise specify --end_seq
+    shard_filenames = hdf_dump_sharded(args, num_seqs=num_seqs)
+    if not shard_filenames:
+      sys.exit(1)
+    if args.merge == "list":
+      with open("%s.list" % args.hdf_filename, "w") as f:
+        f.write("".join(["%s\n" % filename for filename in shard_filenames]))
+      print >> log.v3, "Wrote shard list to %s.list. As dataset: %s" % (args.hdf_filename, ",".join(shard_filenames))
+    elif args.merge == "consolidate":
+      hdf_merge_shards(shard_filenames, args.hdf_filename)
+    if dataset:
+      rnn.finalize()
+    return
   dataset = init(config_filename=crnn_config, cmd_line_opts=[], dataset_config_str=dataset_config_str)
   hdf_dataset = hdf_dataset_init(args.hdf_filename)
   hdf_dump_from_dataset(dataset, hdf_dataset, args)
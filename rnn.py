@@ -14,30 +14,34 @@ __maintainer__ = "Patrick Doetsch"
 __email__ = "doetsch@i6.informatik.rwth-aachen.de"
 
 
+import time
+_import_start_time = time.time()
+
 import re
 import os
 import sys
-import time
 import json
 import numpy
+from collections import OrderedDict
 from optparse import OptionParser
 from Log import log
-from Device import Device, get_num_devices, TheanoFlags, getDevicesInitArgs
 from Config import Config
-from Engine import Engine
 from Dataset import Dataset, init_dataset, init_dataset_via_str, get_dataset_class
 from HDFDataset import HDFDataset
 from Debug import initIPythonKernel, initBetterExchook, initFaulthandler, initCudaNotInMainProcCheck
 from Util import initThreadJoinHack, custom_exec, describe_crnn_version, describe_theano_version, \
   describe_tensorflow_version, BackendEngine, get_tensorflow_version_tuple
+# Note: The backend modules (Device, Engine, TFEngine, ...) import Theano or TensorFlow.
+# They are imported only after initBackendEngine(), such that we only load the selected backend.
 
 
 config = None; """ :type: Config """
-engine = None; """ :type: Engine | TFEngine.Engine """
+engine = None; """ :type: Engine.Engine | TFEngine.Engine """
 train_data = None; """ :type: Dataset """
 dev_data = None; """ :type: Dataset """
 eval_data = None; """ :type: Dataset """
 quit = False
+startup_times = OrderedDict([("import", time.time() - _import_start_time)]); """ :type: dict[str,float] """
 
 
 def initConfig(configFilename=None, commandLineOptions=()):
@@ -123,7 +127,7 @@ def initConfigJsonNetwork():
 
 def initDevices():
   """
-  :rtype: list[Device]
+  :rtype: list[Device.Device]|None
   """
   oldDeviceConfig = ",".join(config.list('device', ['default']))
   if BackendEngine.is_tensorflow_selected():
@@ -133,6 +137,7 @@ def initDevices():
                        (os.environ.get("TF_DEVICE"), oldDeviceConfig), file=log.v4)
   if not BackendEngine.is_theano_selected():
     return None
+  from Device import Device, TheanoFlags, getDevicesInitArgs
   if "device" in TheanoFlags:
     # This is important because Theano likely already has initialized that device.
     config.set("device", TheanoFlags["device"])
@@ -236,7 +241,7 @@ def initData():
 
 def printTaskProperties(devices=None):
   """
-  :type devices: list[Device]
+  :type devices: list[Device.Device]|None
   """
 
   if train_data:
@@ -264,11 +269,12 @@ def printTaskProperties(devices=None):
 
 def initEngine(devices):
   """
-  :type devices: list[Device]
+  :type devices: list[Device.Device]|None
   Initializes global engine.
   """
   global engine
   if BackendEngine.is_theano_selected():
+    from Engine import Engine
     engine = Engine(devices)
   elif BackendEngine.is_tensorflow_selected():
     import TFEngine
@@ -301,13 +307,26 @@ def initBackendEngine():
     raise NotImplementedError
 
 
+def printStartupTimes():
+  """
+  Prints the startup times once, when the startup is complete,
+  i.e. after the network construction (:func:`initEngineNetwork`), or for tasks without network before the task.
+  """
+  print("Startup times: %s" % ", ".join(["%s %.2fs" % (name, t) for (name, t) in startup_times.items()]),
+        file=log.v3)
+
+
 def init(configFilename=None, commandLineOptions=()):
+  start_time = time.time()
   initBetterExchook()
   initThreadJoinHack()
   initConfig(configFilename=configFilename, commandLineOptions=commandLineOptions)
   initLog()
+  startup_times["config"] = time.time() - start_time
   crnnGreeting(configFilename=configFilename, commandLineOptions=commandLineOptions)
+  start_time = time.time()
   initBackendEngine()
+  startup_times["backend"] = time.time() - start_time
   initFaulthandler()
   if BackendEngine.is_theano_selected():
     if config.value('task', 'train') == "theano_graph":
@@ -317,11 +336,32 @@ def init(configFilename=None, commandLineOptions=()):
   if config.bool('ipython', False):
     initIPythonKernel()
   initConfigJsonNetwork()
+  start_time = time.time()
   devices = initDevices()
+  startup_times["devices"] = time.time() - start_time
   if needData():
+    start_time = time.time()
     initData()
+    startup_times["data"] = time.time() - start_time
   printTaskProperties(devices)
+  start_time = time.time()
   initEngine(devices)
+  startup_times["engine"] = time.time() - start_time
+
+
+def initEngineNetwork(train=False):
+  """
+  Constructs the network of the engine, and reports the startup times including that.
+
+  :param bool train: whether to init for training (init_train_from_config) or not (init_network_from_config)
+  """
+  start_time = time.time()
+  if train:
+    engine.init_train_from_config(config, train_data, dev_data, eval_data)
+  else:
+    engine.init_network_from_config(config)
+  startup_times["network"] = time.time() - start_time
+  printStartupTimes()
 
 
 def finalize():
@@ -330,8 +370,11 @@ def finalize():
   sys.exited = True
   if BackendEngine.is_theano_selected():
     if engine:
-      for device in engine.devices:
-        device.terminate()
+      try:
+        engine.finalize()
+      finally:
+        for device in engine.devices:
+          device.terminate()
   elif BackendEngine.is_tensorflow_selected():
     if engine:
       engine.finalize()
@@ -348,10 +391,10 @@ def executeMainTask():
   task = config.value('task', 'train')
   if task == 'train':
     assert train_data.have_seqs(), "no train files specified, check train option: %s" % config.value('train', None)
-    engine.init_train_from_config(config, train_data, dev_data, eval_data)
+    initEngineNetwork(train=True)
     engine.train()
   elif task == "eval":
-    engine.init_train_from_config(config, train_data, dev_data, eval_data)
+    initEngineNetwork(train=True)
     engine.epoch = config.int("epoch", None)
     assert engine.epoch
     print("Evaluate epoch", engine.epoch, file=log.v4)
@@ -361,20 +404,20 @@ def executeMainTask():
     assert config.has('output_file'), 'no output file provided'
     combine_labels = config.value('combine_labels', '')
     output_file = config.value('output_file', '')
-    engine.init_network_from_config(config)
+    initEngineNetwork()
     engine.forward_to_hdf(
       data=eval_data, output_file=output_file, combine_labels=combine_labels,
       batch_size=config.int('forward_batch_size', 0))
   elif task == 'compute_priors':
     assert train_data is not None, 'train data for priors should be provided'
-    engine.init_network_from_config(config)
+    initEngineNetwork()
     engine.compute_priors(dataset=train_data, config=config)
   elif task == 'theano_graph':
     import theano.printing
     import theano.compile.io
     import theano.compile.function_module
     engine.start_epoch = 1
-    engine.init_network_from_config(config)
+    initEngineNetwork()
     for task in config.list('theano_graph.task', ['train']):
       func = engine.devices[-1].get_compute_func(task)
       prefix = config.value("theano_graph.prefix", "current") + ".task"
@@ -389,19 +432,20 @@ def executeMainTask():
                                  outfile = "%s.png" % prefix)
   elif task == 'analyze':  # anything based on the network + Device
     statistics = config.list('statistics', None)
-    engine.init_network_from_config(config)
+    initEngineNetwork()
     engine.analyze(data=eval_data or dev_data, statistics=statistics)
   elif task == "analyze_data":  # anything just based on the data
+    printStartupTimes()
     analyze_data(config)
   elif task == "classify":
     assert eval_data is not None, 'no eval data provided'
     assert config.has('label_file'), 'no output file provided'
     label_file = config.value('label_file', '')
-    engine.init_network_from_config(config)
+    initEngineNetwork()
     engine.classify(engine.devices[0], eval_data, label_file)
   elif task == "daemon":
-    engine.init_network_from_config(config)
-    engine.daemon()
+    initEngineNetwork()
+    engine.daemon(config)
   else:
     assert False, "unknown task: %s" % task
 
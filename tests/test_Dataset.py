@@ -159,3 +159,30 @@ def test_batches_non_recurrent_1():
   assert_equal(all_batches[3].seqs[0].frame_length, 5)
   assert_equal(all_batches[3].seqs[0].batch_slice, 0)
   assert_equal(all_batches[3].seqs[0].batch_frame_offset, 0)
+
+
+def test_calculate_priori():
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=7, seq_len=4)
+  dataset.init_seq_order(1)
+  counts = np.zeros((3,))
+  for seq_idx in range(7):
+    for t in dataset.generate_seq(seq_idx).targets["classes"]:
+      counts[t] += 1
+  priori = dataset.calculate_priori(load_seqs_step=3)
+  assert_true(np.allclose(priori, counts / np.sum(counts)))
+  dataset.init_seq_order(1)
+  priori_workers = dataset.calculate_priori(load_seqs_step=2, num_workers=2)
+  assert_true(np.allclose(priori_workers, priori))
+
+
+def test_calculate_priori_workers_need_random_access():
+  from GeneratingDataset import Task12AXDataset
+  # Without block_size, the seqs depend on the running random state, i.e. workers would get other seqs.
+  dataset = Task12AXDataset(num_seqs=12)
+  assert_false(dataset.is_random_access())
+  dataset.init_seq_order(1)
+  priori = dataset.calculate_priori()
+  dataset.init_seq_order(1)
+  assert_true(np.allclose(dataset.calculate_priori(num_workers=2), priori))
+  dataset = Task12AXDataset(num_seqs=12, block_size=5)
+  assert_true(dataset.is_random_access())
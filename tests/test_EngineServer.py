@@ -0,0 +1,86 @@
+
+from nose.tools import assert_equal, assert_true
+from EngineServer import LRUCache, LatencyStats, BatchingInferenceServer, make_request_key
+from Log import log
+import threading
+
+log.initialize()
+
+
+def test_LRUCache():
+  cache = LRUCache(max_size=2)
+  cache.put("a", 1)
+  cache.put("b", 2)
+  assert_equal(cache.get("a"), 1)  # "b" is now least recently used
+  cache.put("c", 3)
+  assert_true("b" not in cache)
+  assert_equal(cache.get("a"), 1)
+  assert_equal(cache.get("c"), 3)
+  assert_equal(len(cache), 2)
+
+
+def test_LatencyStats():
+  stats = LatencyStats(max_len=100)
+  assert_equal(stats.percentile(50), None)
+  for i in range(200):
+    stats.add(float(i))
+  assert_equal(stats.percentile(50), 149.5)
+  assert_true(stats.percentile(99) > 198.0)
+
+
+def test_BatchingInferenceServer():
+  batch_sizes = []
+
+  def forward(params_list):
+    batch_sizes.append(len(params_list))
+    return [params["data"] * 2 for params in params_list]
+
+  server = BatchingInferenceServer(network=None, devices=None, max_seqs=4, max_wait_time=0.5, forward_func=forward)
+  results = {}
+
+  def request(i):
+    results[i] = server.classify({"data": [[float(i)]] * (i + 1)}, timeout=10)
+
+  threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  for i in range(8):
+    assert_equal(results[i].tolist(), [[i * 2.0]] * (i + 1))
+  assert_equal(sum(batch_sizes), 8)
+  assert_true(max(batch_sizes) <= 4)
+  assert_true(len(batch_sizes) < 8)  # some requests were batched together
+  key = server.submit({"data": [[1.0]] * 2})
+  assert_equal(server.poll(key), {"result": [[2.0]] * 2})  # from the cache
+  stats = server.get_stats()
+  assert_equal(stats["num_requests"], 9)
+  assert_equal(stats["num_cache_hits"], 1)
+  assert_true(stats["latency_p99"] is not None)
+  server.stop()
+
+
+def test_BatchingInferenceServer_failed_request_resubmit():
+  num_calls = [0]
+
+  def forward(params_list):
+    num_calls[0] += 1
+    if num_calls[0] == 1:
+      raise Exception("device crashed")
+    return [params["data"] * 2 for params in params_list]
+
+  server = BatchingInferenceServer(network=None, devices=None, max_wait_time=0.0, forward_func=forward)
+  params = {"data": [[1.0]] * 3}
+  try:
+    server.classify(params, timeout=10)
+    assert False, "expected an exception"
+  except Exception as exc:
+    assert_true("device crashed" in str(exc))
+  key = make_request_key(params)
+  assert_equal(server.poll(key), {"error": "forward failed: device crashed"})
+  assert_true(key not in server.pending)
+  # The resubmit is forwarded again.
+  assert_equal(server.classify(params, timeout=10).tolist(), [[2.0]] * 3)
+  assert_equal(num_calls[0], 2)
+  assert_equal(server.poll(key), {"result": [[2.0]] * 3})
+  server.stop()
@@ -202,3 +202,4 @@ def test_DeviceBatchRun_outputs_format():
 
   assert_greater(tester.score, 0)
   assert_greater(tester.error, 0)
+
@@ -20,3 +20,70 @@ def test_load_seqs():
   dataset.load_seqs(1, 3)
 
 
+
+
+def test_DummyDataset_generate_seqs():
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=10, seq_len=3)
+  dataset.init_seq_order(epoch=1)
+  for seq, block_seq in zip([dataset.generate_seq(i) for i in range(2, 7)], dataset.generate_seqs(2, 7)):
+    assert_equal(seq.seq_idx, block_seq.seq_idx)
+    assert_true(np.allclose(seq.features, block_seq.features))
+    assert_equal(seq.targets["classes"].tolist(), block_seq.targets["classes"].tolist())
+
+
+def _get_all_seqs(dataset):
+  dataset.init_seq_order(epoch=3)
+  seqs = []
+  for seq_idx in range(0, dataset.num_seqs, 3):
+    dataset.load_seqs(seq_idx, seq_idx + 3)
+    for i in range(seq_idx, min(seq_idx + 3, dataset.num_seqs)):
+      seqs.append((dataset.get_data(i, "data"), dataset.get_data(i, "classes")))
+  return seqs
+
+
+def test_Task12AXDataset_workers():
+  from GeneratingDataset import Task12AXDataset
+  seqs = _get_all_seqs(Task12AXDataset(num_seqs=11, block_size=4))
+  seqs_workers = _get_all_seqs(Task12AXDataset(num_seqs=11, block_size=4, num_workers=2))
+  assert_equal(len(seqs), 11)
+  assert_equal(len(seqs_workers), 11)
+  for (features, targets), (features_w, targets_w) in zip(seqs, seqs_workers):
+    assert_true(10 <= features.shape[0] < 100)
+    assert_equal(features.shape, (targets.shape[0], 9))
+    assert_equal(features.tolist(), features_w.tolist())
+    assert_equal(targets.tolist(), targets_w.tolist())
+    assert_equal(targets.tolist(), Task12AXDataset.make_output_seq(list(np.argmax(features, axis=1))))
+
+
+def test_Task12AXDataset_default_stream():
+  # Without block_size, we get the same data as from generate_seq with the epoch as seed.
+  from GeneratingDataset import Task12AXDataset
+  seqs = _get_all_seqs(Task12AXDataset(num_seqs=5))
+  ref_dataset = Task12AXDataset(num_seqs=5)
+  ref_dataset.init_seq_order(epoch=3)
+  for seq_idx, (features, targets) in enumerate(seqs):
+    ref_seq = ref_dataset.generate_seq(seq_idx)
+    assert_equal(features.tolist(), ref_seq.features.tolist())
+    assert_equal(targets.tolist(), ref_seq.targets["classes"].tolist())
+
+
+def test_Task12AXDataset_generate_input_seqs():
+  from GeneratingDataset import Task12AXDataset
+  dataset = Task12AXDataset(num_seqs=1)
+  dataset.init_seq_order(epoch=1)
+  input_seqs = dataset.generate_input_seqs([10, 50, 99] * 20)
+  assert_equal([len(seq) for seq in input_seqs], [10, 50, 99] * 20)
+  targets = np.concatenate([dataset.make_output_seq(seq) for seq in input_seqs])
+  assert_true(0 < np.sum(targets == 1) < len(targets))  # some "R"
+
+
+def test_CopyTaskDataset_generate_seqs():
+  from GeneratingDataset import CopyTaskDataset
+  dataset = CopyTaskDataset(nsymbols=5, minlen=2, maxlen=6, num_seqs=8)
+  dataset.init_seq_order(epoch=1)
+  seqs = dataset.generate_seqs(0, 8)
+  assert_equal([seq.seq_idx for seq in seqs], list(range(8)))
+  for seq in seqs:
+    assert_true(2 <= seq.features.shape[0] <= 6)
+    assert_equal(seq.features.dtype, np.int8)
+    assert_true(np.all(seq.features < 5))
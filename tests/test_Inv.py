@@ -0,0 +1,94 @@
+
+import sys
+import os
+sys.path += ["."]  # Python 3 hack
+import subprocess
+import numpy
+import theano
+import theano.tensor as T
+from nose.tools import assert_equal
+from Inv import InvOp, InvOpFull, InvAlignOp
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def _run_with_omp_threads(test_func_name, num_threads=4):
+  """
+  The C code aligns the seqs of the batch in parallel (via OpenMP).
+  OpenMP takes the num of threads from OMP_NUM_THREADS when it is loaded,
+  thus we run the test in a new process to cover the multithreaded path, without changing our own env.
+
+  :param str test_func_name: test function of this module
+  :param int num_threads:
+  """
+  tests_dir = os.path.dirname(os.path.abspath(__file__))
+  code = "import sys; sys.path[:0] = [%r, %r]; import test_Inv; test_Inv.%s()" % (
+    tests_dir, os.path.dirname(tests_dir), test_func_name)
+  subprocess.check_call([sys.executable, "-c", code], env=dict(os.environ, OMP_NUM_THREADS=str(num_threads)))
+
+
+def _make_batch(n_time=50, n_batch=9, n_labels=10, max_len=6, seed=42):
+  rnd = numpy.random.RandomState(seed)
+  x = -numpy.log(rnd.dirichlet(numpy.ones(n_labels), size=(n_time, n_batch))).astype("float32")
+  y = rnd.randint(0, n_labels, size=(max_len, n_batch)).astype("int32")
+  len_x = numpy.array([n_time - 4 * (b % 5) for b in range(n_batch)], dtype="int32")
+  len_y = numpy.array([max_len - (b % 3) for b in range(n_batch)], dtype="int32")
+  return x, y, len_x, len_y
+
+
+def _check_batch_vs_single_seqs(op):
+  x, y, len_x, len_y = _make_batch()
+  inputs = [T.ftensor3("x"), T.imatrix("y"), T.ivector("len_x"), T.ivector("len_y")]
+  f = theano.function(inputs, op(*inputs))
+  attention = f(x, y, len_x, len_y)
+  assert_equal(attention.shape, (y.shape[0] * op.nstates, x.shape[1], x.shape[0]))
+  assert numpy.any(attention > 0)
+  for b in range(x.shape[1]):
+    ref = f(x[:, b:b + 1], y[:, b:b + 1], len_x[b:b + 1], len_y[b:b + 1])
+    numpy.testing.assert_array_equal(attention[:, b:b + 1], ref)
+  return attention, len_x, len_y
+
+
+def test_InvOp_batch_vs_single_seqs():
+  _check_batch_vs_single_seqs(InvOp(min_skip=1, max_skip=8, nstates=2))
+
+
+def test_InvOp_coverage_batch_vs_single_seqs():
+  _check_batch_vs_single_seqs(InvOp(min_skip=1, max_skip=8, nstates=1, coverage=2))
+
+
+def test_InvOpFull_batch_vs_single_seqs():
+  _check_batch_vs_single_seqs(InvOpFull(min_skip=1, max_skip=8, nstates=2))
+
+
+def test_InvAlignOp_full_batch_vs_single_seqs():
+  _check_batch_vs_single_seqs(InvAlignOp(min_skip=1, max_skip=8, nstates=2, mode='full'))
+
+
+def test_InvAlignOp_viterbi_batch_vs_single_seqs():
+  op = InvAlignOp(min_skip=1, max_skip=8, nstates=2, mode='viterbi')
+  attention, len_x, len_y = _check_batch_vs_single_seqs(op)
+  for b in range(attention.shape[1]):
+    n_states = len_y[b] * op.nstates
+    # Every state of the seq is aligned to exactly one frame, monotonic, the last one to the last frame.
+    assert numpy.all(attention[n_states:, b] == 0) and numpy.all(attention[:, b, len_x[b]:] == 0)
+    assert numpy.all(attention[:n_states, b].sum(axis=1) == 1)
+    frames = attention[:n_states, b].argmax(axis=1)
+    assert numpy.all(numpy.diff(frames) > 0)
+    assert_equal(frames[-1], len_x[b] - 1)
+
+
+def test_InvOp_batch_vs_single_seqs_multithreaded():
+  _run_with_omp_threads("test_InvOp_batch_vs_single_seqs")
+
+
+def test_InvOpFull_batch_vs_single_seqs_multithreaded():
+  _run_with_omp_threads("test_InvOpFull_batch_vs_single_seqs")
+
+
+def test_InvAlignOp_full_batch_vs_single_seqs_multithreaded():
+  _run_with_omp_threads("test_InvAlignOp_full_batch_vs_single_seqs")
+
+
+def test_InvAlignOp_viterbi_batch_vs_single_seqs_multithreaded():
+  _run_with_omp_threads("test_InvAlignOp_viterbi_batch_vs_single_seqs")
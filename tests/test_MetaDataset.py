@@ -0,0 +1,216 @@
+
+from nose.tools import assert_equal, assert_true
+from MetaDataset import MetaDataset, CombinedDataset, ConcatDataset, ChunkShuffleDataset, \
+  _SubDatasetsRunner, _FramesRingBuffer
+import MetaDataset as MetaDatasetModule
+from CachedDataset2 import CachedDataset2
+from Dataset import DatasetSeq
+from Log import log
+import numpy
+import tempfile
+import os
+
+log.initialize()
+
+
+def _make_combined_dataset(**kwargs):
+  return CombinedDataset(
+    datasets={"a": {"class": "DummyDataset", "input_dim": 2, "output_dim": 3, "num_seqs": 5},
+              "b": {"class": "DummyDataset", "input_dim": 2, "output_dim": 3, "num_seqs": 3}},
+    data_map={("a", "data"): "data", ("a", "classes"): "classes",
+              ("b", "data"): "data"},
+    data_dims={"data": [2, 2], "classes": [3, 1]},
+    **kwargs)
+
+
+class _TaggedDataset(CachedDataset2):
+  """
+  Seqs "seq-0", "seq-1", ... where the data of seq i is [[i]]. Supports a predefined seq list.
+  """
+
+  def __init__(self, num_seqs, **kwargs):
+    super(_TaggedDataset, self).__init__(**kwargs)
+    self.all_tags = ["seq-%i" % i for i in range(num_seqs)]
+    self.num_inputs = 1
+    self.num_outputs = {"data": [1, 2]}
+    self.seq_list = None
+
+  def init_seq_order(self, epoch=None, seq_list=None):
+    super(_TaggedDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    self.seq_list = seq_list or self.all_tags
+    self._num_seqs = len(self.seq_list)
+    return True
+
+  def _collect_single_seq(self, seq_idx):
+    if seq_idx >= len(self.seq_list):
+      return None
+    tag = self.seq_list[seq_idx]
+    features = numpy.array([[self.all_tags.index(tag)]], dtype="float32")
+    return DatasetSeq(seq_idx=seq_idx, seq_tag=tag, features=features, targets={})
+
+
+def test_MetaDataset_seq_list_subset():
+  seq_list_file = tempfile.mktemp(suffix=".txt", prefix="nose-metadataset-seq-list")
+  with open(seq_list_file, "w") as f:
+    f.write("".join(["seq-%i\n" % i for i in range(5)]))
+  orig_init_dataset = MetaDatasetModule.init_dataset
+  MetaDatasetModule.init_dataset = lambda kwargs: _TaggedDataset(**kwargs)
+  try:
+    dataset = MetaDataset(
+      seq_list_file=seq_list_file, seq_lens_file=None,
+      datasets={"sub": {"num_seqs": 5}}, data_map={"data": ("sub", "data")}, data_dims={"data": [1, 2]})
+  finally:
+    MetaDatasetModule.init_dataset = orig_init_dataset
+    os.remove(seq_list_file)
+  dataset.init_seq_order(epoch=1, seq_list=["seq-3", "seq-1"])
+  assert_equal(dataset.num_seqs, 2)
+  dataset.load_seqs(0, 2)
+  assert_equal([dataset.get_tag(i) for i in range(2)], ["seq-3", "seq-1"])
+  assert_equal([dataset.get_data(i, "data").tolist() for i in range(2)], [[[3.]], [[1.]]])
+  assert_true(not dataset.is_less_than_num_seqs(2))
+  # Same epoch again, i.e. no reinit, but the number of seqs is still that of the subset.
+  dataset.init_seq_order(epoch=1, seq_list=["seq-3", "seq-1"])
+  assert_equal(dataset.num_seqs, 2)
+  dataset.init_seq_order(epoch=2)
+  assert_equal(dataset.num_seqs, 5)
+
+
+class _IndexedTaggedDataset(_TaggedDataset):
+  """
+  Like _TaggedDataset, but the real seq idxs are in reversed tag order, and it knows all its tags in advance.
+  """
+
+  def __init__(self, num_seqs, **kwargs):
+    super(_IndexedTaggedDataset, self).__init__(num_seqs=num_seqs, **kwargs)
+    self.all_tags = self.all_tags[::-1]
+    self.get_tag_calls = 0
+
+  def get_all_tags(self):
+    return self.all_tags
+
+  def init_seq_order(self, epoch=None, seq_list=None, seq_order=None):
+    assert seq_list is None and seq_order is not None, "expected to get the seq order via the join index"
+    return super(_IndexedTaggedDataset, self).init_seq_order(
+      epoch=epoch, seq_list=[self.all_tags[idx] for idx in seq_order])
+
+  def get_tag(self, sorted_seq_idx):
+    self.get_tag_calls += 1
+    return super(_IndexedTaggedDataset, self).get_tag(sorted_seq_idx)
+
+
+def test_MetaDataset_join_index_seq_idx_map():
+  seq_list_file = tempfile.mktemp(suffix=".txt", prefix="nose-metadataset-seq-list")
+  cache_file = tempfile.mktemp(suffix=".npz", prefix="nose-metadataset-join-index")
+  with open(seq_list_file, "w") as f:
+    f.write("".join(["seq-%i\n" % i for i in range(5)]))
+  orig_init_dataset = MetaDatasetModule.init_dataset
+  MetaDatasetModule.init_dataset = lambda kwargs: _IndexedTaggedDataset(**kwargs)
+  try:
+    datasets = []
+    for _ in range(2):  # the second one loads the join index from the cache file
+      datasets.append(MetaDataset(
+        seq_list_file=seq_list_file, seq_lens_file=None, join_index_cache_file=cache_file,
+        datasets={"sub": {"num_seqs": 5}}, data_map={"data": ("sub", "data")}, data_dims={"data": [1, 2]}))
+      assert_equal(datasets[-1]._seq_idx_maps["sub"].tolist(), [4, 3, 2, 1, 0])
+  finally:
+    MetaDatasetModule.init_dataset = orig_init_dataset
+    os.remove(seq_list_file)
+    if os.path.exists(cache_file):
+      os.remove(cache_file)
+  dataset = datasets[-1]
+  dataset.init_seq_order(epoch=1, seq_list=["seq-3", "seq-1", "seq-4"])
+  dataset.load_seqs(0, 3)
+  assert_equal([dataset.get_tag(i) for i in range(3)], ["seq-3", "seq-1", "seq-4"])
+  # The data is the real seq idx in the sub-dataset.
+  assert_equal([dataset.get_data(i, "data").tolist() for i in range(3)], [[[1.]], [[3.]], [[0.]]])
+  # No tag lookup per seq in the sub-dataset.
+  assert_equal(dataset.datasets["sub"].get_tag_calls, 0)
+
+
+def test_CombinedDataset_dataset_seq_idxs():
+  dataset = _make_combined_dataset()
+  seqs_dataset_idx = numpy.array([1, 0, 0, 1, 0])
+  dataset_seq_idxs = dataset._dataset_seq_idxs(seqs_dataset_idx)
+  assert_equal(dataset_seq_idxs.tolist(), [[1, 0], [0, 0], [0, 1], [1, 1], [0, 2]])
+
+
+def test_CombinedDataset_load_seqs():
+  for parallel in [False, True]:
+    dataset = _make_combined_dataset(parallel_load_seqs=parallel)
+    dataset.init_seq_order(epoch=1)
+    assert_equal(dataset.num_seqs, 8)
+    dataset.load_seqs(0, 8)
+    counts = {0: 0, 1: 0}
+    for seq_idx in range(8):
+      dataset_idx, dataset_seq_idx = dataset.dataset_seq_idxs[seq_idx]
+      assert_equal(dataset_seq_idx, counts[dataset_idx])
+      counts[dataset_idx] += 1
+      classes = dataset.get_data(seq_idx, "classes")
+      if dataset.dataset_idxs[dataset_idx] == "b":
+        assert_equal(classes.shape, (0,))
+      else:
+        assert_equal(classes.shape, (2,))
+    assert_equal(counts, {0: 5, 1: 3})
+
+
+def test_SubDatasetsRunner():
+  runner = _SubDatasetsRunner(parallel=True)
+  assert_equal(runner.map(lambda x: x * 2, [1, 2, 3]), [2, 4, 6])
+  assert_equal(runner.map(lambda x: x + 1, [1, 2, 3, 4, 5]), [2, 3, 4, 5, 6])
+  assert_true(runner.pool_num_threads >= 5)
+
+
+def test_ConcatDataset():
+  sub_num_seqs = [3, 4, 2]
+  for parallel, prefetch_num_seqs in [(False, 0), (True, 2)]:
+    dataset = ConcatDataset(
+      datasets=[{"class": "DummyDataset", "input_dim": 2, "output_dim": 3, "num_seqs": n} for n in sub_num_seqs],
+      parallel_init_seq_order=parallel, prefetch_num_seqs=prefetch_num_seqs)
+    dataset.init_seq_order(epoch=1)
+    assert_equal(dataset.num_seqs, 9)
+    tags = []
+    for start in range(0, 9, 2):
+      dataset.load_seqs(start, start + 2)
+      for seq_idx in range(start, min(start + 2, 9)):
+        tags.append(dataset.get_tag(seq_idx))
+    assert_equal(tags, ["seq-%i" % i for n in sub_num_seqs for i in range(n)])
+    assert_equal(dataset.dataset_seq_idx_starts, [0, 3, 7])
+    assert_equal([dataset._get_dataset_for_seq_idx(i) for i in range(9)], [0, 0, 0, 1, 1, 1, 1, 2, 2])
+    assert_true(not dataset.is_less_than_num_seqs(9))
+
+
+def test_ChunkShuffleDataset():
+  dataset = ChunkShuffleDataset(
+    dataset={"class": "DummyDataset", "input_dim": 2, "output_dim": 3, "num_seqs": 20, "seq_len": 2},
+    chunk_shuffle_buffer_size_mb=8 * 24 / (1024. * 1024.))  # 8 frames of data (2 float64) + classes (int64)
+  dataset.init_seq_order(epoch=1)
+  assert_equal(dataset.ring_buffers, {})
+  tags = []
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    assert_equal(dataset.get_data(seq_idx, "data").shape, (2, 2))
+    tags.append(dataset.get_tag(seq_idx))
+    seq_idx += 1
+  assert_equal(dataset.num_seqs, 20)
+  assert_equal(sorted([int(t.split(".")[-1]) for t in tags]), list(range(20)))
+  assert_true(tags != ["seq-%i.%i" % (i, i) for i in range(20)])  # shuffled
+  assert_equal(dataset.ring_buffers["data"].num_frames, 8)  # never needed to grow
+
+
+def test_FramesRingBuffer():
+  buf = _FramesRingBuffer(num_frames=10, frame_shape=(), dtype="int32")
+  h1 = buf.alloc(4)
+  h2 = buf.alloc(4)
+  assert_true(not buf.can_alloc(3))
+  buf.free(h1)  # out of order is fine
+  h3 = buf.alloc(3)  # wraps around
+  assert_equal(buf.allocs[h3][0], 0)
+  buf.get(h3)[...] = [1, 2, 3]
+  assert_true(not buf.can_alloc(3))
+  buf.grow(min_free_frames=3)
+  assert_equal(buf.get(h3).tolist(), [1, 2, 3])
+  h4 = buf.alloc(3)
+  assert_equal(buf.allocs[h4][0], 8)
+  buf.free(h2)
+  assert_equal(buf.get(buf.alloc(0)).shape, (0,))
@@ -1,5 +1,7 @@
 
 import sys
+import os
+import subprocess
 import numpy
 import theano
 import theano.scan_module.scan_op
@@ -14,14 +16,40 @@ better_exchook.replace_traceback_format_tb()
 
 naive_multi_batch_beam = MultiBatchBeam._naive_multi_batch_beam
 
-def numpy_multi_batch_beam(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left=0, pad_right=0, idx_dim=0, batch_dim=1):
+
+def _run_with_omp_threads(test_func_name, num_threads=4):
+  """
+  The C code only uses multiple threads (via OpenMP) if there is enough work and if we have multiple CPUs.
+  OMP_NUM_THREADS is only read when OpenMP is loaded, thus the test runs in a new process with it set.
+
+  :param str test_func_name: test function of this module
+  :param int num_threads:
+  """
+  tests_dir = os.path.dirname(os.path.abspath(__file__))
+  code = "import sys; sys.path[:0] = [%r, %r]; import test_MultiBatchBeam; test_MultiBatchBeam.%s()" % (
+    tests_dir, os.path.dirname(tests_dir), test_func_name)
+  subprocess.check_call([sys.executable, "-c", code], env=dict(os.environ, OMP_NUM_THREADS=str(num_threads)))
+
+# The Python linker uses MultiBatchBeamOp.perform(), the C linker uses the C code.
+# No optimizations, because constant folding would already calculate it (via the C code).
+py_mode = theano.Mode(linker="py", optimizer=None)
+c_mode = theano.Mode(linker="c|py", optimizer=None)
+
+def _multi_batch_beam_op(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left=0, pad_right=0, idx_dim=0, batch_dim=1):
   array = T.as_tensor(array)
   start_idxs = T.as_tensor(start_idxs)
   batch_lens = T.as_tensor(batch_lens)
   beam_width = T.as_tensor(beam_width)
   op = MultiBatchBeamOp(wrap_mode, idx_dim, batch_dim)
-  beam = op(array, start_idxs, batch_lens, beam_width, pad_left, pad_right)
-  return beam.eval()
+  return op(array, start_idxs, batch_lens, beam_width, pad_left, pad_right)
+
+def numpy_multi_batch_beam(*args, **kwargs):
+  beam = _multi_batch_beam_op(*args, **kwargs)
+  return theano.function([], beam, mode=py_mode)()
+
+def c_multi_batch_beam(*args, **kwargs):
+  beam = _multi_batch_beam_op(*args, **kwargs)
+  return theano.function([], beam, mode=c_mode)()
 
 def theano_cpu_multi_batch_beam(*args, **kwargs):
   res = MultiBatchBeam._theano_cpu_multi_batch_beam(*args, **kwargs)
@@ -29,12 +57,14 @@ def theano_cpu_multi_batch_beam(*args, **kwargs):
 
 naive_multi_batch_beam_grad = MultiBatchBeam._naive_multi_batch_beam_grad
 
-def _eval_or_None(x):
+def _eval_or_None(x, mode=None):
   if isinstance(x.type, T.DisconnectedType):
     return None
+  if mode:
+    return theano.function([], x, mode=mode)()
   return x.eval()
 
-def theano_op_multi_batch_beam_grad(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left=0, pad_right=0, idx_dim=0, batch_dim=1, output_grad=None):
+def _theano_op_multi_batch_beam_grad(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left=0, pad_right=0, idx_dim=0, batch_dim=1, output_grad=None, mode=None):
   array = T.as_tensor(array)
   start_idxs = T.as_tensor(start_idxs)
   batch_lens = T.as_tensor(batch_lens)
@@ -44,7 +74,13 @@ def theano_op_multi_batch_beam_grad(array, start_idxs, batch_lens, beam_width, w
   output_grad = T.as_tensor(output_grad)
   op = MultiBatchBeamOp(wrap_mode, idx_dim, batch_dim)
   D_array, D_start_idxs, D_batch_lens, D_beam_width, D_pad_left, D_pad_right = op.grad((array, start_idxs, batch_lens, beam_width, pad_left, pad_right), (output_grad, ))
-  return map(_eval_or_None, [D_array, D_pad_left, D_pad_right])
+  return [_eval_or_None(x, mode=mode) for x in [D_array, D_pad_left, D_pad_right]]
+
+def theano_op_multi_batch_beam_grad(*args, **kwargs):
+  return _theano_op_multi_batch_beam_grad(*args, mode=py_mode, **kwargs)
+
+def c_multi_batch_beam_grad(*args, **kwargs):
+  return _theano_op_multi_batch_beam_grad(*args, mode=c_mode, **kwargs)
 
 def theano_cpu_multi_batch_beam_grad(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left=0, pad_right=0, idx_dim=0, batch_dim=1, output_grad=None):
   array = T.as_tensor(array)
@@ -61,7 +97,7 @@ def theano_cpu_multi_batch_beam_grad(array, start_idxs, batch_lens, beam_width,
 
 def compare_implementations(*args, **kwargs):
   results = {}
-  for method in ["numpy", "naive", "theano_cpu"]:
+  for method in ["numpy", "c", "naive", "theano_cpu"]:
     m = globals()["%s_multi_batch_beam" % method]
     try:
       res = m(*args, **kwargs)
@@ -82,7 +118,7 @@ def compare_implementations(*args, **kwargs):
 
 def compare_grad_implementations(*args, **kwargs):
   results = {}
-  for method in ["theano_op", "naive", "theano_cpu"]:
+  for method in ["theano_op", "c", "naive", "theano_cpu"]:
     m = globals()["%s_multi_batch_beam_grad" % method]
     try:
       res = m(*args, **kwargs)
@@ -220,6 +256,48 @@ def test_random_pad():
   D_beam = numpy.random.random(beam.shape)
   compare_grad_implementations(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left, pad_right, output_grad=D_beam)
 
+def test_c_random_big_wrap():
+  # Enough work such that the C code uses multiple threads.
+  n_time = 200
+  n_batch = 50
+  n_dim = 20
+  beam_width = 20
+  numpy.random.seed(123)
+  array = numpy.random.random(n_time * n_batch * n_dim).astype("float32").reshape(n_time, n_batch, n_dim)
+  batch_lens = numpy.array([numpy.random.randint(n_time / 5, n_time) for i in range(n_batch)])
+  start_idxs = numpy.array([numpy.random.randint(-n_time, n_time) for i in range(n_batch)])
+  beam = compare_implementations(array, start_idxs, batch_lens, beam_width, "wrap_around")
+  D_beam = numpy.random.random(beam.shape).astype("float32")
+  compare_grad_implementations(array, start_idxs, batch_lens, beam_width, "wrap_around", output_grad=D_beam)
+
+def test_c_random_big_wrap_multithreaded():
+  _run_with_omp_threads("test_c_random_big_wrap")
+
+def test_c_float_idxs_pad_vector():
+  # Float indices like we get them from the GPU, and pad values which are broadcasted over the last dims.
+  n_time = 20
+  n_batch = 8
+  beam_width = 7
+  numpy.random.seed(42)
+  array = numpy.random.random((n_time, n_batch, 3, 2)).astype("float32")
+  batch_lens = numpy.array([numpy.random.randint(1, n_time) for i in range(n_batch)], dtype="float32")
+  start_idxs = numpy.array([numpy.random.randint(-n_time, n_time) for i in range(n_batch)], dtype="float32")
+  pad_left = numpy.array([-1, -2], dtype="float32")
+  pad_right = numpy.arange(6, dtype="float32").reshape(3, 2) + 10
+  for wrap_mode in ["wrap_around", "pad"]:
+    beam = c_multi_batch_beam(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left, pad_right)
+    ref_beam = numpy_multi_batch_beam(array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left, pad_right)
+    assert_equal(beam.shape, (beam_width, n_batch, 3, 2))
+    numpy.testing.assert_almost_equal(beam, ref_beam)
+    D_beam = numpy.random.random(beam.shape).astype("float32")
+    D_array, _, _ = c_multi_batch_beam_grad(
+      array, start_idxs, batch_lens, beam_width, wrap_mode, pad_left, pad_right, output_grad=D_beam)
+    # Some idxs occur multiple times here (beam_width > batch_lens), thus this also covers the accumulation.
+    ref_D_array, _, _ = naive_multi_batch_beam_grad(
+      array, start_idxs.astype("int32"), batch_lens.astype("int32"), beam_width, wrap_mode, pad_left, pad_right,
+      output_grad=D_beam)
+    numpy.testing.assert_almost_equal(D_array, ref_D_array, decimal=5)
+
 def test_inc_subtensor():
   # If there are some indexes multiple times in the subtensor,
   # we expect for inc_subtensor that they are all accumulated.
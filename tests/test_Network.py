@@ -65,3 +65,34 @@ def test_enc_dec1_hdf():
   assert_equal(sorted(network.j.keys()), sorted(loaded_net.j.keys()))
 
   os.remove(filename)
+
+
+def test_ctc_decoder_lm_file_loaded_once():
+  import numpy
+  from PrefixBeamSearchDecoder import estimate_char_ngram_lm
+  tmp_dir = tempfile.mkdtemp()
+  lm_file = tmp_dir + "/lm.npy"
+  numpy.save(lm_file, estimate_char_ngram_lm([[0, 1, 2], [2, 1]], num_labels=3, order=2))
+  config = Config()
+  config.update({
+    "num_inputs": 5, "num_outputs": 4,
+    "network": {"output": {"class": "softmax", "loss": "ctc",
+                           "ctc_decoder_opts": {"beam_size": 4, "lm_file": lm_file, "lm_weight": 0.5}}}})
+  orig_load = numpy.load
+  loaded = []
+
+  def counting_load(*args, **kwargs):
+    loaded.append(args[0])
+    return orig_load(*args, **kwargs)
+  numpy.load = counting_load
+  try:
+    network = LayerNetwork.from_config_topology(config)
+    layer = network.output["output"]
+    layer.ctc_label_errors()
+    layer.ctc_label_errors()
+  finally:
+    numpy.load = orig_load
+    os.remove(lm_file)
+    os.rmdir(tmp_dir)
+  assert_equal(loaded, [lm_file])
+  assert_equal(layer.ctc_decoder_lm_scores.get_value().shape, (4, 3))
@@ -0,0 +1,137 @@
+
+from nose.tools import assert_equal, assert_true
+from NumpyDumpDataset import NumpyDumpDataset, NumpyDumpBinaryCache, convert_to_binary_cache
+from Log import log
+import numpy
+import os
+import shutil
+import tempfile
+
+log.initialize()
+
+
+def _write_dumps(prefix, seq_lens, num_inputs=3, num_outputs=5):
+  rnd = numpy.random.RandomState(42)
+  seqs = []
+  for seq_idx, seq_len in enumerate(seq_lens):
+    features = rnd.uniform(-1, 1, (seq_len, num_inputs))
+    targets = rnd.randint(0, num_outputs, (seq_len,))
+    numpy.savetxt("%s%i.data.txt.gz" % (prefix, seq_idx), features)
+    numpy.savetxt("%s%i.targets.txt.gz" % (prefix, seq_idx), targets, fmt='%i')
+    seqs.append((features, targets))
+  return seqs
+
+
+def _read_all(dataset):
+  dataset.init_seq_order(epoch=1)
+  seqs = []
+  for seq_idx in range(dataset.num_seqs):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    seqs.append((dataset.get_data(seq_idx, "data"), dataset.get_data(seq_idx, "classes")))
+  return seqs
+
+
+def test_NumpyDumpDataset_binary_cache():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    prefix = os.path.join(tmp_dir, "dump-")
+    seqs = _write_dumps(prefix, seq_lens=[4, 2, 7])
+    text_dataset = NumpyDumpDataset(prefix=prefix, num_inputs=3, num_outputs=5)
+    assert_equal(text_dataset.num_seqs, 3)
+    cache_prefix = os.path.join(tmp_dir, "cache-")
+    dataset = NumpyDumpDataset(prefix=prefix, num_inputs=3, num_outputs=5, binary_cache_prefix=cache_prefix)
+    assert_equal(dataset.num_seqs, 3)
+    assert_true(os.path.exists(NumpyDumpBinaryCache.index_filename(cache_prefix)))
+    for (features, targets), (text_features, text_targets), (cache_features, cache_targets) in zip(
+          seqs, _read_all(text_dataset), _read_all(dataset)):
+      numpy.testing.assert_allclose(cache_features, features.astype("float32"))
+      numpy.testing.assert_array_equal(text_features, cache_features)
+      assert_equal(cache_targets.tolist(), targets.tolist())
+      assert_equal(text_targets.tolist(), targets.tolist())
+      # Both paths give the same dtypes.
+      assert_equal(cache_features.dtype, numpy.float32)
+      assert_equal(cache_targets.dtype, numpy.int32)
+      assert_equal(text_features.dtype, numpy.float32)
+      assert_equal(text_targets.dtype, numpy.int32)
+    # The existing store is reused, also for a subset of the seqs.
+    index_mtime = os.stat(NumpyDumpBinaryCache.index_filename(cache_prefix)).st_mtime
+    dataset = NumpyDumpDataset(
+      prefix=prefix, num_inputs=3, num_outputs=5, end_seq=2, binary_cache_prefix=cache_prefix)
+    assert_equal(dataset.num_seqs, 2)
+    assert_equal(os.stat(NumpyDumpBinaryCache.index_filename(cache_prefix)).st_mtime, index_mtime)
+    # A changed dump is converted again.
+    targets_filename = "%s1.targets.txt.gz" % prefix
+    numpy.savetxt(targets_filename, (seqs[1][1] + 1) % 5, fmt='%i')
+    os.utime(targets_filename, (index_mtime + 10, index_mtime + 10))
+    dataset = NumpyDumpDataset(
+      prefix=prefix, num_inputs=3, num_outputs=5, end_seq=2, binary_cache_prefix=cache_prefix)
+    assert_equal(_read_all(dataset)[1][1].tolist(), ((seqs[1][1] + 1) % 5).tolist())
+    # A deleted dump does not match anymore, i.e. it would be rebuilt.
+    os.remove("%s0.data.txt.gz" % prefix)
+    assert_true(not NumpyDumpBinaryCache(cache_prefix).matches(
+      prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=2, num_inputs=3))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_convert_to_binary_cache_single_frame():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    prefix = os.path.join(tmp_dir, "dump-")
+    seqs = _write_dumps(prefix, seq_lens=[1, 3])
+    cache_prefix = os.path.join(tmp_dir, "cache-")
+    assert_equal(convert_to_binary_cache(prefix=prefix, postfix=".txt.gz", cache_prefix=cache_prefix, num_inputs=3), 2)
+    cache = NumpyDumpBinaryCache(cache_prefix)
+    features, targets = cache.get_seq(0)
+    assert_equal(features.shape, (1, 3))
+    assert_equal(targets.tolist(), seqs[0][1].tolist())
+    assert_true(cache.matches(prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=None, num_inputs=3))
+    assert_true(not cache.matches(prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=3, num_inputs=3))
+    # Another dump was added.
+    numpy.savetxt("%s2.data.txt.gz" % prefix, numpy.zeros((2, 3)))
+    numpy.savetxt("%s2.targets.txt.gz" % prefix, numpy.zeros((2,)), fmt='%i')
+    assert_true(not cache.matches(prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=None, num_inputs=3))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_NumpyDumpBinaryCache_matches_quick_vs_full_check():
+  tmp_dir = tempfile.mkdtemp()
+  orig_stat = os.stat
+  try:
+    prefix = os.path.join(tmp_dir, "dump-")
+    seqs = _write_dumps(prefix, seq_lens=[2] * 20)
+    cache_prefix = os.path.join(tmp_dir, "cache-")
+    convert_to_binary_cache(prefix=prefix, postfix=".txt.gz", cache_prefix=cache_prefix, num_inputs=3)
+    cache = NumpyDumpBinaryCache(cache_prefix)
+    stat_calls = []
+
+    def counting_stat(*args, **kwargs):
+      stat_calls.append(args[0])
+      return orig_stat(*args, **kwargs)
+    os.stat = counting_stat
+    assert_true(cache.matches(prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=None, num_inputs=3))
+    os.stat = orig_stat
+    # Only the first and the last dump, and the probe for an added dump, but not every dump.
+    assert_equal(
+      sorted(set(stat_calls)),
+      sorted(["%s%i.%s.txt.gz" % (prefix, seq_idx, key) for seq_idx in [0, 19] for key in ["data", "targets"]] +
+             ["%s20.data.txt.gz" % prefix]))
+    # An in-place change of a dump in the middle is only seen by the full check.
+    index_mtime = orig_stat(NumpyDumpBinaryCache.index_filename(cache_prefix)).st_mtime
+    targets_filename = "%s7.targets.txt.gz" % prefix
+    numpy.savetxt(targets_filename, (seqs[7][1] + 1) % 5, fmt='%i')
+    os.utime(targets_filename, (index_mtime + 10, index_mtime + 10))
+    assert_true(cache.matches(prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=None, num_inputs=3))
+    assert_true(not cache.matches(
+      prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=None, num_inputs=3, full_check=True))
+    dataset = NumpyDumpDataset(
+      prefix=prefix, num_inputs=3, num_outputs=5, binary_cache_prefix=cache_prefix, binary_cache_full_check=True)
+    assert_equal(_read_all(dataset)[7][1].tolist(), ((seqs[7][1] + 1) % 5).tolist())
+    # A removed dump in the middle changes the number of dump files.
+    os.remove("%s7.data.txt.gz" % prefix)
+    assert_true(not NumpyDumpBinaryCache(cache_prefix).matches(
+      prefix=prefix, postfix=".txt.gz", start_seq=0, end_seq=None, num_inputs=3))
+  finally:
+    os.stat = orig_stat
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,48 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+import numpy
+from nose.tools import assert_equal
+from OpInvAlign import InvAlignOp
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+tdps = [1e10, 0., 1.9, 3., 2.5, 2., 1.4]
+
+
+def test_viterbi_vs_loops():
+  # _viterbi2 is the same DP with loops over states and time.
+  rnd = numpy.random.RandomState(42)
+  for nstates, n_time, n_labels in [(1, 30, 5), (3, 50, 4), (3, 14, 4), (2, 9, 4)]:
+    op = InvAlignOp(tdps, nstates)
+    scores = rnd.uniform(0., 5., size=(n_time, 7)).astype("float32")
+    transcription = rnd.randint(0, 7, size=(n_labels,)).astype("int32")
+    attention, labelling = op._viterbi(0, n_time, scores, transcription)
+    ref_attention, ref_labelling = op._viterbi2(0, n_time, scores, transcription)
+    assert_equal(list(attention), list(ref_attention))
+    assert_equal(list(labelling), list(ref_labelling))
+
+
+def test_perform():
+  rnd = numpy.random.RandomState(1)
+  n_time, n_batch, max_len, nstates = 40, 3, 4, 3
+  op = InvAlignOp(tdps, nstates)
+  scores = rnd.uniform(0., 5., size=(n_time, n_batch, 6)).astype("float32")
+  index_in = numpy.ones((n_time, n_batch), dtype="int8")
+  index_in[30:, 1] = 0
+  index_out = numpy.ones((max_len, n_batch), dtype="int8")
+  index_out[2:, 2] = 0
+  transcriptions = rnd.randint(0, 6, size=(max_len, n_batch)).astype("int32")
+  output_storage = [[None], [None], [None]]
+  op.perform(None, [index_in, index_out, scores, transcriptions], output_storage)
+  labelling, attention, index = [out[0] for out in output_storage]
+  assert_equal(list(index.sum(axis=0)), [max_len * nstates, max_len * nstates, 2 * nstates])
+  for b in range(n_batch):
+    length_x, length_y = index_in[:, b].sum(), index_out[:, b].sum()
+    ref_attention, ref_labelling = op._viterbi2(0, length_x, scores[:length_x, b], transcriptions[:length_y, b])
+    assert_equal(list(attention[:length_y * nstates, b]), list(ref_attention + b * n_time))
+    assert_equal(list(labelling[:length_y * nstates, b]), list(ref_labelling))
+    # monotonic, ends in the last frame
+    assert_equal(ref_attention[-1], length_x - 1)
+    assert (numpy.diff(ref_attention) > 0).all()
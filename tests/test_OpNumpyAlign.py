@@ -0,0 +1,57 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+import numpy
+from nose.tools import assert_equal
+from OpNumpyAlign import NumpyAlignOp
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def _make_batch(n_time=40, n_batch=5, n_labels=6, max_len=5, seed=42):
+  rnd = numpy.random.RandomState(seed)
+  scores = rnd.uniform(0., 5., size=(n_time, n_batch, n_labels + 1)).astype("float32")
+  length_x = numpy.array([n_time - 7 * (b % 3) for b in range(n_batch)])
+  length_y = numpy.array([max_len - (b % max_len) for b in range(n_batch)])
+  index_in = (numpy.arange(n_time)[:, None] < length_x[None, :]).astype("int8")
+  index_out = (numpy.arange(max_len)[:, None] < length_y[None, :]).astype("int8")
+  transcriptions = rnd.randint(0, n_labels, size=(max_len, n_batch)).astype("int32")
+  return index_in, index_out, scores, transcriptions
+
+
+def _perform(op, *inputs):
+  output_storage = [[None]]
+  op.perform(None, list(inputs), output_storage)
+  return output_storage[0][0]
+
+
+def _check_batch_vs_sequences(inverse, **kwargs):
+  op = NumpyAlignOp(inverse)
+  index_in, index_out, scores, transcriptions = _make_batch(**kwargs)
+  alignment = _perform(op, index_in, index_out, scores, transcriptions)
+  assert_equal(alignment.shape, index_in.shape)
+  for b in range(scores.shape[1]):
+    length_x = index_in[:, b].sum()
+    length_y = index_out[:, b].sum()
+    if inverse:
+      ref = op._fullAlignmentSequenceInv(0, length_x, scores[:length_x, b], transcriptions[:length_y, b])
+    else:
+      ref = op._ViterbiSequence(0, length_x, scores[:length_x, b], transcriptions[:length_y, b])
+    assert_equal(list(alignment[:length_x, b]), list(ref))
+    assert_equal(list(alignment[length_x:, b]), [0] * (scores.shape[0] - length_x))
+
+
+def test_viterbi_batch_vs_sequences():
+  _check_batch_vs_sequences(inverse=False)
+
+
+def test_viterbi_batch_vs_sequences_single():
+  _check_batch_vs_sequences(inverse=False, n_batch=1, n_time=25, seed=1)
+
+
+def test_inverse_batch_vs_sequences():
+  _check_batch_vs_sequences(inverse=True)
+
+
+def test_inverse_batch_vs_sequences_long():
+  _check_batch_vs_sequences(inverse=True, n_time=80, n_batch=7, max_len=9, seed=3)
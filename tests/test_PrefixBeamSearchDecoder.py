@@ -0,0 +1,143 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+import itertools
+import numpy
+from nose.tools import assert_equal, assert_raises
+from PrefixBeamSearchDecoder import PrefixBeamSearchErrorsOp, prefix_beam_search_decode, estimate_char_ngram_lm
+from BestPathDecoder import BestPathDecodeOp
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def _log_softmax(x):
+  x = x - numpy.max(x, axis=-1, keepdims=True)
+  return (x - numpy.log(numpy.sum(numpy.exp(x), axis=-1, keepdims=True))).astype("float32")
+
+
+def _prefix_beam_search_reference(log_posteriors, beam_size, lm_scores=None, lm_weight=1.0, lm_bonus=0.0):
+  """
+  Straightforward variant of PrefixBeamSearchDecoder.cpp for a single seq.
+
+  :param numpy.ndarray log_posteriors: (time,label), blank is the last label
+  :rtype: tuple[int]
+  """
+  n_labels = log_posteriors.shape[1] - 1
+  blank = n_labels
+
+  def lm_score(prefix):
+    score = lm_bonus * len(prefix)
+    if lm_scores is not None:
+      n_contexts = lm_scores.shape[0]
+      context = n_contexts - 1
+      for label in prefix:
+        score += lm_weight * lm_scores[context, label]
+        context = (context * (n_labels + 1) + label) % n_contexts
+    return score
+
+  beam = {(): (0., -numpy.inf)}  # prefix -> (p_blank, p_non_blank)
+  for lp in log_posteriors:
+    next_beam = {}
+    def add(prefix, p_blank=-numpy.inf, p_non_blank=-numpy.inf):
+      old_blank, old_non_blank = next_beam.get(prefix, (-numpy.inf, -numpy.inf))
+      next_beam[prefix] = (numpy.logaddexp(old_blank, p_blank), numpy.logaddexp(old_non_blank, p_non_blank))
+    for prefix, (p_blank, p_non_blank) in beam.items():
+      p_total = numpy.logaddexp(p_blank, p_non_blank)
+      add(prefix, p_blank=p_total + lp[blank])
+      if prefix:
+        add(prefix, p_non_blank=p_non_blank + lp[prefix[-1]])
+      for label in range(n_labels):
+        if prefix and prefix[-1] == label:
+          add(prefix + (label,), p_non_blank=p_blank + lp[label])
+        else:
+          add(prefix + (label,), p_non_blank=p_total + lp[label])
+    scored = sorted(next_beam.items(), key=lambda item: -(numpy.logaddexp(*item[1]) + lm_score(item[0])))
+    beam = dict(scored[:beam_size])
+  return max(beam.items(), key=lambda item: numpy.logaddexp(*item[1]) + lm_score(item[0]))[0]
+
+
+def _make_batch(n_time, n_batch, n_labels_incl_blank, seed=42, scale=2.0):
+  rnd = numpy.random.RandomState(seed)
+  log_posteriors = _log_softmax(rnd.normal(scale=scale, size=(n_time, n_batch, n_labels_incl_blank)))
+  seq_lengths = numpy.array([n_time - (i % 3) for i in range(n_batch)], dtype="int32")
+  return log_posteriors, seq_lengths
+
+
+def test_vs_reference():
+  log_posteriors, seq_lengths = _make_batch(n_time=12, n_batch=5, n_labels_incl_blank=5)
+  for beam_size in [1, 3, 8]:
+    labellings = prefix_beam_search_decode(log_posteriors, seq_lengths, beam_size=beam_size)
+    for i, labelling in enumerate(labellings):
+      ref = _prefix_beam_search_reference(log_posteriors[:seq_lengths[i], i], beam_size=beam_size)
+      assert_equal(tuple(labelling), ref)
+
+
+def test_vs_reference_with_lm():
+  log_posteriors, seq_lengths = _make_batch(n_time=10, n_batch=4, n_labels_incl_blank=4)
+  lm_scores = estimate_char_ngram_lm([[0, 1, 2, 1], [2, 2, 0], [1, 0, 1, 0]], num_labels=3, order=3)
+  assert_equal(lm_scores.shape, (16, 3))
+  numpy.testing.assert_allclose(numpy.sum(numpy.exp(lm_scores), axis=1), 1., rtol=1e-5)
+  kwargs = dict(beam_size=4, lm_scores=lm_scores, lm_weight=0.7, lm_bonus=0.3)
+  labellings = prefix_beam_search_decode(log_posteriors, seq_lengths, **kwargs)
+  for i, labelling in enumerate(labellings):
+    ref = _prefix_beam_search_reference(log_posteriors[:seq_lengths[i], i], **kwargs)
+    assert_equal(tuple(labelling), ref)
+
+
+def test_exact_with_big_beam():
+  # With a beam which covers all prefixes, we get the most probable labelling.
+  n_time, n_labels_incl_blank = 4, 3
+  log_posteriors, _ = _make_batch(n_time=n_time, n_batch=1, n_labels_incl_blank=n_labels_incl_blank, scale=1.0)
+  probs = {}
+  for path in itertools.product(range(n_labels_incl_blank), repeat=n_time):
+    labelling = tuple([l for (j, l) in enumerate(path) if l != n_labels_incl_blank - 1 and (j == 0 or path[j - 1] != l)])
+    score = sum([log_posteriors[t, 0, l] for (t, l) in enumerate(path)])
+    probs[labelling] = numpy.logaddexp(probs.get(labelling, -numpy.inf), score)
+  best = max(probs.items(), key=lambda item: item[1])[0]
+  labelling, = prefix_beam_search_decode(log_posteriors, numpy.array([n_time]), beam_size=1000)
+  assert_equal(tuple(labelling), best)
+
+
+def test_peaky_like_best_path():
+  # Labelling (per frame): 0 0 b 1 b 1 1 b 2, blank is 3.
+  frames = [0, 0, 3, 1, 3, 1, 1, 3, 2]
+  log_posteriors = numpy.full((len(frames), 2, 4), numpy.log(0.01), dtype="float32")
+  for t, l in enumerate(frames):
+    log_posteriors[t, :, l] = numpy.log(0.97)
+  labellings = prefix_beam_search_decode(log_posteriors, numpy.array([len(frames), 3]), beam_size=5)
+  assert_equal(list(labellings[0]), [0, 1, 1, 2])
+  assert_equal(list(labellings[1]), [0])
+  # Same number of edits as best path.
+  refs = numpy.array([[0, 1, 2, -1, -1], [0, 1, 1, 2, 2]], dtype="int32")
+  seq_lengths = numpy.array([len(frames), len(frames)], dtype="int32")
+  edits = PrefixBeamSearchErrorsOp(beam_size=5)(log_posteriors, refs, seq_lengths).eval()
+  best_path_edits = BestPathDecodeOp()(numpy.exp(log_posteriors), refs, seq_lengths).eval()
+  assert_equal(list(edits), [1, 1])
+  assert_equal(list(edits), list(best_path_edits))
+
+
+def test_errors_op():
+  log_posteriors, seq_lengths = _make_batch(n_time=15, n_batch=6, n_labels_incl_blank=4)
+  refs = numpy.array([[0, 1, 2, 0, 1, -1], [1, -1, -1, -1, -1, -1], [2, 2, 2, 2, 2, 2],
+                      [-1] * 6, [0, 1, 0, 1, -1, -1], [2, 1, 0, -1, -1, -1]], dtype="int32")
+  edits = PrefixBeamSearchErrorsOp(beam_size=4)(log_posteriors, refs, seq_lengths).eval()
+  labellings = prefix_beam_search_decode(log_posteriors, seq_lengths, beam_size=4)
+  for i, labelling in enumerate(labellings):
+    ref = [l for l in refs[i] if l >= 0]
+    # Levenshtein distance.
+    dists = numpy.arange(len(ref) + 1)
+    for j, l in enumerate(labelling):
+      prev = dists.copy()
+      dists[0] = j + 1
+      for k in range(len(ref)):
+        dists[k + 1] = min(dists[k] + 1, prev[k + 1] + 1, prev[k] + (l != ref[k]))
+    assert_equal(edits[i], dists[-1])
+
+
+def test_seq_lengths_out_of_range():
+  log_posteriors, seq_lengths = _make_batch(n_time=5, n_batch=2, n_labels_incl_blank=3)
+  refs = numpy.zeros((2, 3), dtype="int32")
+  for bad_seq_lengths in [[5, 6], [-1, 2], [5]]:
+    bad_seq_lengths = numpy.array(bad_seq_lengths, dtype="int32")
+    assert_raises(ValueError, prefix_beam_search_decode, log_posteriors, bad_seq_lengths)
+    assert_raises(ValueError, PrefixBeamSearchErrorsOp(beam_size=2)(log_posteriors, refs, bad_seq_lengths).eval)
@@ -0,0 +1,88 @@
+
+from nose.tools import assert_equal, assert_true
+from RawWavDataset import RawWavDataset
+from Log import log
+import numpy
+import scipy.io.wavfile
+import tempfile
+import shutil
+import os
+
+log.initialize()
+
+
+def _naive_frames(signal, frameLength, frameShift):
+  nrOfFrames = int(numpy.ceil((float(signal.shape[0] - frameLength) / frameShift) + 1))
+  padded = numpy.zeros(((nrOfFrames - 1) * frameShift + frameLength,), dtype="float32")
+  padded[:signal.shape[0]] = signal
+  return numpy.array([padded[i * frameShift:i * frameShift + frameLength] for i in range(nrOfFrames)])
+
+
+def test_RawWavDataset_frames():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    rnd = numpy.random.RandomState(42)
+    signals = [rnd.randint(-1000, 1000, size=(n,)).astype("int16") for n in [100, 57, 64]]
+    list_file = "%s/wavs.txt" % tmp_dir
+    with open(list_file, "w") as f:
+      for i, signal in enumerate(signals):
+        scipy.io.wavfile.write("%s/%i.wav" % (tmp_dir, i), 16000, signal)
+        f.write("%s/%i.wav\n" % (tmp_dir, i))
+    store_file = "%s/store.raw" % tmp_dir
+    for num_workers in [2, 1]:  # second time, the store is reused
+      dataset = RawWavDataset(
+        listFile=list_file, frameLength=20, frameShift=8, num_outputs=1,
+        sampleStoreFile=store_file, numDecodeWorkers=num_workers)
+      dataset.init_seq_order(epoch=None)
+      dataset.load_seqs(0, 3)
+      for i, signal in enumerate(signals):
+        frames = dataset.get_data(i, "data")
+        assert_equal(frames.dtype, numpy.float32)
+        numpy.testing.assert_array_equal(frames, _naive_frames(signal, 20, 8))
+    assert_true(os.path.exists(store_file + ".index.npz"))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_RawWavDataset_modified_wav_file():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    list_file = "%s/wavs.txt" % tmp_dir
+    wav_file = "%s/0.wav" % tmp_dir
+    with open(list_file, "w") as f:
+      f.write("%s\n" % wav_file)
+    store_file = "%s/store.raw" % tmp_dir
+    for i, n in enumerate([100, 57]):
+      signal = numpy.arange(n, dtype="int16") * (i + 1)
+      scipy.io.wavfile.write(wav_file, 16000, signal)
+      os.utime(wav_file, (1000000 + i, 1000000 + i))  # independent of the file system time resolution
+      dataset = RawWavDataset(
+        listFile=list_file, frameLength=20, frameShift=8, num_outputs=1,
+        sampleStoreFile=store_file, numDecodeWorkers=1)
+      dataset.init_seq_order(epoch=None)
+      dataset.load_seqs(0, 1)
+      numpy.testing.assert_array_equal(dataset.get_data(0, "data"), _naive_frames(signal, 20, 8))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_RawWavDataset_failed_build_removes_temp_files():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    list_file = "%s/wavs.txt" % tmp_dir
+    scipy.io.wavfile.write("%s/0.wav" % tmp_dir, 16000, numpy.zeros((50,), dtype="int16"))
+    with open("%s/1.wav" % tmp_dir, "w") as f:
+      f.write("not a wav file")
+    with open(list_file, "w") as f:
+      f.write("%s/0.wav\n%s/1.wav\n" % (tmp_dir, tmp_dir))
+    try:
+      RawWavDataset(
+        listFile=list_file, frameLength=20, frameShift=8, num_outputs=1,
+        sampleStoreFile="%s/store.raw" % tmp_dir, numDecodeWorkers=1)
+    except ValueError:
+      pass  # scipy cannot read the second file
+    else:
+      assert False, "expected the build to fail"
+    assert_equal(sorted(os.listdir(tmp_dir)), ["0.wav", "1.wav", "wavs.txt"])
+  finally:
+    shutil.rmtree(tmp_dir)
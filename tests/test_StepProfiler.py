@@ -0,0 +1,47 @@
+
+from nose.tools import assert_equal, assert_true
+from StepProfiler import StepProfiler
+from Log import log
+import json
+import shutil
+import tempfile
+
+log.initialize()
+
+
+def test_StepProfiler():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    profiler = StepProfiler.create(name="train epoch 1", epoch=1, file_prefix=tmp_dir + "/prof")
+    for step in range(3):
+      with profiler.phase(StepProfiler.Data, step=step):
+        pass
+      profiler.add(StepProfiler.Compute, start_time=10.0, end_time=10.5, step=step)
+      profiler.finish_step(step)
+    profiler.finalize()
+    assert_equal(profiler.num_steps, 3)
+    assert_equal(profiler.total_times[StepProfiler.Compute], 1.5)
+    assert_true("compute-bound" in profiler.get_summary_str())
+    records = [json.loads(line) for line in open(tmp_dir + "/prof.jsonl").read().splitlines()]
+    assert_equal([r["step"] for r in records], [0, 1, 2])
+    assert_equal(records[0]["compute"], 0.5)
+    assert_true("data" in records[0])
+    trace = json.load(open(tmp_dir + "/prof.train_epoch_1.ep001.trace.json"))
+    assert_equal(len(trace["traceEvents"]), 6)
+    assert_equal(trace["traceEvents"][1]["dur"], 500000)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_StepProfiler_collect_is_own_phase():
+  profiler = StepProfiler(name="train")
+  profiler.add(StepProfiler.Data, start_time=10.0, end_time=10.3, step=0)
+  profiler.add(StepProfiler.Compute, start_time=10.3, end_time=10.5, step=0)
+  profiler.add(StepProfiler.Collect, start_time=10.5, end_time=11.0, step=0)
+  profiler.finish_step(0)
+  profiler.finalize()
+  assert_equal(sorted(profiler.total_times.keys()), ["collect", "compute", "data"])
+  s = profiler.get_summary_str()
+  assert_true("collect " in s, s)
+  # Collecting waits for the device compute, thus it counts as compute for the hint.
+  assert_true(s.endswith("; compute-bound"), s)
@@ -0,0 +1,135 @@
+
+from nose.tools import assert_equal
+from StereoDataset import StereoHdfDataset, DatasetWithTimeContext
+from Log import log
+import numpy
+import h5py
+import tempfile
+import shutil
+
+log.initialize()
+
+
+def _create_files(tmp_dir, seqs):
+  hdf_file = "%s/data.hdf" % tmp_dir
+  with h5py.File(hdf_file, "w") as f:
+    for i, (inputs, outputs) in enumerate(seqs):
+      f.create_dataset("inputs/%i" % i, data=inputs)
+      f.create_dataset("outputs/%i" % i, data=outputs)
+  norm_file = "%s/norm.hdf" % tmp_dir
+  with h5py.File(norm_file, "w") as f:
+    f.create_dataset("inputs/mean", data=numpy.array([1.0, -2.0, 0.5]))
+    f.create_dataset("inputs/variance", data=numpy.array([4.0, 1.0, 0.25]))
+  return hdf_file, norm_file
+
+
+def _make_seqs():
+  rnd = numpy.random.RandomState(42)
+  return [(rnd.normal(size=(n, 3)), rnd.normal(size=(n, 2))) for n in [5, 7, 1, 4]]
+
+
+def test_StereoHdfDataset_normalization():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    seqs = _make_seqs()
+    hdf_file, norm_file = _create_files(tmp_dir, seqs)
+    for read_ahead in [0, 3]:
+      dataset = StereoHdfDataset(hdf_file, normalizationFile=norm_file, readAheadNumSeqs=read_ahead)
+      assert_equal(dataset.num_inputs, 3)
+      assert_equal(dataset.num_outputs, {"classes": (2, 2)})
+      dataset.init_seq_order(epoch=1)
+      dataset.load_seqs(0, 4)
+      for seq_idx in range(4):
+        inputs, outputs = seqs[seq_idx]
+        data = dataset.get_data(seq_idx, "data")
+        assert_equal(data.dtype, numpy.float32)
+        numpy.testing.assert_allclose(
+          data, (inputs - [1.0, -2.0, 0.5]) / numpy.sqrt([4.0, 1.0, 0.25]), rtol=1e-5)
+        numpy.testing.assert_allclose(dataset.get_data(seq_idx, "classes"), outputs, rtol=1e-5)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_DatasetWithTimeContext():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    seqs = _make_seqs()
+    hdf_file, _ = _create_files(tmp_dir, seqs)
+    tau = 2
+    dataset = DatasetWithTimeContext(hdf_file, tau=tau)
+    dataset.init_seq_order(epoch=1)
+    dataset.load_seqs(0, 4)
+    for seq_idx in range(4):
+      inputs = seqs[seq_idx][0]
+      frames = inputs.shape[0]
+      padded = numpy.concatenate([numpy.zeros((tau, 3)), inputs, numpy.zeros((tau, 3))])
+      expected = numpy.array([padded[t:t + 2 * tau + 1].flatten() for t in range(frames)])
+      numpy.testing.assert_allclose(dataset.get_data(seq_idx, "data"), expected, rtol=1e-5)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_StereoHdfDataset_bundle():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    seqs = _make_seqs()
+    hdf_files = []
+    for file_idx, file_seqs in enumerate([seqs[:3], seqs[3:]]):
+      hdf_files.append("%s/data%i.hdf" % (tmp_dir, file_idx))
+      with h5py.File(hdf_files[-1], "w") as f:
+        for i, (inputs, outputs) in enumerate(file_seqs):
+          f.create_dataset("inputs/%i" % i, data=inputs)
+          f.create_dataset("outputs/%i" % i, data=outputs)
+    bundle_file = "%s/data.bundle" % tmp_dir
+    with open(bundle_file, "w") as f:
+      f.write("\n".join(hdf_files) + "\n")
+    dataset = StereoHdfDataset(bundle_file, readAheadNumSeqs=2)
+    assert_equal(dataset.num_seqs, 4)
+    assert_equal([fileIdx for (fileIdx, _, _) in dataset._seqMap], [0, 0, 0, 1])
+    dataset.init_seq_order(epoch=1)
+    dataset.load_seqs(0, 4)
+    for seq_idx in range(4):
+      inputs, outputs = seqs[seq_idx]
+      numpy.testing.assert_allclose(dataset.get_data(seq_idx, "data"), inputs, rtol=1e-5)
+      numpy.testing.assert_allclose(dataset.get_data(seq_idx, "classes"), outputs, rtol=1e-5)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+class _RecordingFile(object):
+  """
+  Wraps a h5py.File and records all keys of item accesses.
+  """
+
+  def __init__(self, fh):
+    self.fh = fh
+    self.keys = []
+
+  def __getitem__(self, key):
+    self.keys.append(key)
+    return self.fh[key]
+
+  def __contains__(self, key):
+    return key in self.fh
+
+  def close(self):
+    self.fh.close()
+
+
+def test_StereoHdfDataset_no_name_lookup_per_seq():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    seqs = _make_seqs()
+    hdf_file, _ = _create_files(tmp_dir, seqs)
+    dataset = StereoHdfDataset(hdf_file, readAheadNumSeqs=0)
+    fh = _RecordingFile(dataset._fileHandlers[0])
+    dataset._fileHandlers[0] = fh
+    dataset.init_seq_order(epoch=1)
+    dataset.load_seqs(0, 4)
+    for seq_idx in range(4):
+      numpy.testing.assert_allclose(dataset.get_data(seq_idx, "data"), seqs[seq_idx][0], rtol=1e-5)
+    # Every seq is read via the object references of its input and output dataset, not via names.
+    assert_equal(len(fh.keys), 2 * 4)
+    assert all([isinstance(key, h5py.Reference) for key in fh.keys])
+  finally:
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,277 @@
+
+import os
+import sys
+sys.path += ["."]  # Python 3 hack
+from nose.tools import assert_equal, assert_is_instance
+import numpy
+import numpy.testing
+from Config import Config
+from TFEngine import Engine, ForwardSession
+from GeneratingDataset import DummyDataset
+from Log import log
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+log.initialize()
+
+
+def _make_engine(net_dict):
+  config = Config()
+  config.update({"num_inputs": 3, "num_outputs": {"classes": [4, 1]}, "device": "cpu"})
+  engine = Engine(config=config)
+  engine.epoch = 1
+  engine._init_network(net_desc=net_dict, epoch=1)
+  return engine
+
+
+def test_ForwardSession():
+  engine = _make_engine({
+    "hidden": {"class": "linear", "activation": "tanh", "n_out": 5},
+    "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}})
+  session = engine.get_forward_session(output_layer_names=["hidden", "output"])
+  assert_is_instance(session, ForwardSession)
+  assert engine.get_forward_session(output_layer_names=["hidden", "output"]) is session
+  rnd = numpy.random.RandomState(42)
+  seqs = [rnd.normal(size=(n, 3)).astype("float32") for n in [4, 7, 1]]
+  results = session.forward(seqs)
+  assert_equal(len(results), 3)
+  for seq, result in zip(seqs, results):
+    assert_equal(result["hidden"].shape, (seq.shape[0], 5))
+    assert_equal(result["output"].shape, (seq.shape[0], 4))
+  # Framewise network, thus each seq alone must give the same output, also with the reused buffers.
+  for seq, result in zip(seqs, results):
+    single_result, = session.forward([seq])
+    numpy.testing.assert_almost_equal(single_result["output"], result["output"], decimal=5)
+  engine.finalize()
+
+
+def test_forward_single():
+  engine = _make_engine({"output": {"class": "softmax", "loss": "ce"}})
+  dataset = DummyDataset(input_dim=3, output_dim=4, num_seqs=2, seq_len=5)
+  dataset.init_seq_order(epoch=1)
+  output = engine.forward_single(dataset=dataset, seq_idx=0)
+  assert_equal(output.shape, (5, 1, 4))
+  engine.finalize()
+
+
+def test_forward_to_hdf():
+  import os
+  import tempfile
+  from HDFDataset import HDFDataset
+  engine = _make_engine({"output": {"class": "softmax", "loss": "ce"}})
+  engine.max_seqs = 2
+  dataset = DummyDataset(input_dim=3, output_dim=4, num_seqs=5, seq_len=6)
+  dataset.init_seq_order(epoch=1)
+  fd, output_file = tempfile.mkstemp(suffix=".hdf")
+  os.close(fd)
+  engine.forward_to_hdf(data=dataset, output_file=output_file, batch_size=100)
+  hdf_dataset = HDFDataset()
+  hdf_dataset.add_file(output_file)
+  hdf_dataset.initialize()
+  hdf_dataset.init_seq_order(epoch=1)
+  assert_equal(hdf_dataset.num_seqs, 5)
+  hdf_dataset.load_seqs(0, 5)
+  dataset.init_seq_order(epoch=1)  # can only be loaded in order
+  for seq_idx in range(5):
+    assert_equal(hdf_dataset.get_tag(seq_idx), "seq-%i" % seq_idx)
+    expected = engine.forward_single(dataset=dataset, seq_idx=seq_idx)[:, 0]
+    numpy.testing.assert_almost_equal(hdf_dataset.get_data(seq_idx, "data"), expected, decimal=5)
+  engine.finalize()
+  os.remove(output_file)
+
+
+def test_forward_to_hdf_empty_dataset():
+  import os
+  import tempfile
+  import h5py
+  engine = _make_engine({"output": {"class": "softmax", "loss": "ce"}})
+  engine.max_seqs = 2
+  dataset = DummyDataset(input_dim=3, output_dim=4, num_seqs=0)
+  dataset.init_seq_order(epoch=1)
+  fd, output_file = tempfile.mkstemp(suffix=".hdf")
+  os.close(fd)
+  engine.forward_to_hdf(data=dataset, output_file=output_file, batch_size=100)
+  with h5py.File(output_file, "r") as f:
+    assert_equal(f.attrs["numSeqs"], 0)
+    assert_equal(f["inputs"].shape, (0, 4))
+    assert_equal(f["seqTags"].shape, (0,))
+  engine.finalize()
+  os.remove(output_file)
+
+
+def test_forward_to_hdf_exception():
+  import os
+  import tempfile
+  import h5py
+  engine = _make_engine({"output": {"class": "softmax", "loss": "ce"}})
+  engine.max_seqs = 2
+  dataset = DummyDataset(input_dim=3, output_dim=4, num_seqs=5, seq_len=6)
+  dataset.init_seq_order(epoch=1)
+  fd, output_file = tempfile.mkstemp(suffix=".hdf")
+  os.close(fd)
+
+  class BrokenSession:
+    def __init__(self, session):
+      self.session = session
+
+    def run(self, fetches, *args, **kwargs):
+      if isinstance(fetches, dict) and "output" in fetches:
+        raise Exception("forward failed")
+      return self.session.run(fetches, *args, **kwargs)
+
+    def __getattr__(self, item):
+      return getattr(self.session, item)
+
+  tf_session = engine.tf_session
+  engine.tf_session = BrokenSession(tf_session)
+  try:
+    engine.forward_to_hdf(data=dataset, output_file=output_file, batch_size=100)
+    assert False, "expected an exception"
+  except Exception as exc:
+    assert_equal(str(exc), "forward failed")
+  finally:
+    engine.tf_session = tf_session
+  # The file was closed, i.e. we can open it again.
+  with h5py.File(output_file, "w"):
+    pass
+  engine.finalize()
+  os.remove(output_file)
+
+
+def test_maybe_init_new_network_grow_in_place():
+  import os
+  import shutil
+  import tempfile
+  net_dict1 = {
+    "hidden1": {"class": "linear", "activation": "tanh", "n_out": 5},
+    "output": {"class": "softmax", "loss": "ce", "from": ["hidden1"]}}
+  net_dict2 = {
+    "hidden1": {"class": "linear", "activation": "tanh", "n_out": 5},
+    "hidden2": {"class": "linear", "activation": "tanh", "n_out": 5, "from": ["hidden1"]},
+    "output": {"class": "softmax", "loss": "ce", "from": ["hidden2"]}}
+  engine = _make_engine(net_dict1)
+  session = engine.tf_session
+  hidden1 = engine.network.layers["hidden1"]
+  output_values = engine.network.layers["output"].get_param_values_dict(session)
+  engine.maybe_init_new_network(net_dict2)
+  assert engine.tf_session is session  # no rebuild
+  assert engine.network.layers["hidden1"] is hidden1
+  assert_equal(sorted(engine.network.layers.keys()), ["data", "hidden1", "hidden2", "output"])
+  for name, value in engine.network.layers["output"].get_param_values_dict(session).items():
+    numpy.testing.assert_equal(value, output_values[name])
+  assert_equal(len(engine.network.get_params_list()), 6)
+  seq = numpy.ones((3, 3), dtype="float32")
+  output, = engine.get_forward_session().forward([seq])
+  assert_equal(output["output"].shape, (3, 4))
+  # The checkpoint must be loadable by a network constructed from scratch.
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    engine.save_model(tmp_dir + "/model")
+    engine.finalize()
+    engine2 = _make_engine(net_dict2)
+    engine2.network.load_params_from_file(tmp_dir + "/model", session=engine2.tf_session)
+    output2, = engine2.get_forward_session().forward([seq])
+    numpy.testing.assert_almost_equal(output2["output"], output["output"], decimal=5)
+    engine2.finalize()
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_save_model_async():
+  import shutil
+  import tempfile
+  net_dict = {
+    "hidden": {"class": "linear", "activation": "tanh", "n_out": 5},
+    "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}}
+  engine = _make_engine(net_dict)
+  engine.save_model_async = True
+  seq = numpy.ones((3, 3), dtype="float32")
+  output, = engine.get_forward_session().forward([seq])
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    engine.save_model(tmp_dir + "/model")
+    engine.finalize()  # waits for the save
+    engine2 = _make_engine(net_dict)
+    engine2.network.load_params_from_file(tmp_dir + "/model", session=engine2.tf_session)
+    output2, = engine2.get_forward_session().forward([seq])
+    numpy.testing.assert_almost_equal(output2["output"], output["output"], decimal=5)
+    engine2.finalize()
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_no_theano_import():
+  import subprocess
+  # Needs a fresh process, as other tests might have imported Theano.
+  code = "import sys, rnn, TFEngine, HDFDataset, NativeOp, TFNativeOp; print('theano' in sys.modules)"
+  out = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)) + "/..")
+  assert_equal(out.decode("utf8").strip().splitlines()[-1], "False")
+
+
+def _make_reversed_params_layer_class():
+  import tensorflow as tf
+  import TFNetworkLayer
+
+  class ReversedParamsLayer(TFNetworkLayer._ConcatInputLayer):
+    """
+    Creates the params "W_1" and "W" in that order, or only "W".
+    Mapped by their TF names, the new "W_1" would get the existing "W".
+    """
+    layer_class = "_test_reversed_params"
+
+    def __init__(self, num_params, **kwargs):
+      super(ReversedParamsLayer, self).__init__(**kwargs)
+      x = self.input_data.placeholder
+      for name in ["W_1", "W"][2 - num_params:]:
+        x += self.add_param(tf.Variable(name=name, initial_value=tf.ones((self.input_data.dim,))))
+      self.output.placeholder = x
+      self.output.size_placeholder = self.input_data.size_placeholder.copy()
+
+    @classmethod
+    def get_out_data_from_opts(cls, sources=(), **kwargs):
+      return TFNetworkLayer.get_concat_sources_data_template(sources)
+
+  TFNetworkLayer.get_layer_class("copy")  # init the dict
+  TFNetworkLayer._LayerClassDict[ReversedParamsLayer.layer_class] = ReversedParamsLayer
+  return ReversedParamsLayer
+
+
+def test_maybe_init_new_network_grow_in_place_param_keys():
+  layer_class = _make_reversed_params_layer_class()
+  net_dict1 = {
+    "hidden": {"class": layer_class.layer_class, "num_params": 1},
+    "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}}
+  net_dict2 = {
+    "hidden": {"class": layer_class.layer_class, "num_params": 2},
+    "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}}
+  engine = _make_engine(net_dict1)
+  session = engine.tf_session
+  W = engine.network.layers["hidden"].params["hidden/W:0"]
+  W.load(numpy.array([3., 4., 5.], dtype="float32"), session=session)
+  engine.maybe_init_new_network(net_dict2)
+  assert engine.tf_session is session  # no rebuild
+  hidden = engine.network.layers["hidden"]
+  assert_equal(sorted(hidden.params.keys()), ["hidden/W:0", "hidden_1/W_1:0"])
+  assert hidden.params["hidden/W:0"] is W
+  numpy.testing.assert_equal(session.run(W), [3., 4., 5.])
+  numpy.testing.assert_equal(session.run(hidden.params["hidden_1/W_1:0"]), [1., 1., 1.])
+  engine.finalize()
+
+
+def test_maybe_init_new_network_grow_in_place_target_dependency():
+  net_dict1 = {
+    "hidden": {"class": "linear", "activation": "tanh", "n_out": 5},
+    "aux": {"class": "linear", "activation": "tanh", "n_out": 2, "target": "hidden", "is_output_layer": True},
+    "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}}
+  net_dict2 = net_dict1.copy()
+  net_dict2["hidden"] = {"class": "linear", "activation": "relu", "n_out": 5}
+  engine = _make_engine(net_dict1)
+  session = engine.tf_session
+  aux = engine.network.layers["aux"]
+  assert_equal(aux.target, "hidden")
+  engine.maybe_init_new_network(net_dict2)
+  assert engine.tf_session is session  # no rebuild
+  # aux only depends on hidden via its target, but it must be rebuilt as well.
+  assert engine.network.layers["aux"] is not aux
+  assert engine.network.layers["aux"].params["aux/W:0"] is aux.params["aux/W:0"]
+  engine.finalize()
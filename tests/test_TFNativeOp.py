@@ -0,0 +1,223 @@
+
+import os
+import sys
+sys.path += ["."]  # Python 3 hack
+import subprocess
+import tensorflow as tf
+import numpy
+import numpy.testing
+import TFNativeOp
+import NativeOp
+from nose.tools import assert_equal
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+session = tf.InteractiveSession()
+
+
+def _run_with_omp_threads(test_func_name, num_threads=4):
+  """
+  The kernels only use multiple threads (via OpenMP) if there is enough work and if we have multiple CPUs.
+  OpenMP takes the num of threads from OMP_NUM_THREADS when it is loaded,
+  thus we run the test in a new process to cover the multithreaded path, without changing our own env.
+
+  :param str test_func_name: test function of this module
+  :param int num_threads:
+  """
+  tests_dir = os.path.dirname(os.path.abspath(__file__))
+  code = "import sys; sys.path[:0] = [%r, %r]; import test_TFNativeOp; test_TFNativeOp.%s()" % (
+    tests_dir, os.path.dirname(tests_dir), test_func_name)
+  subprocess.check_call([sys.executable, "-c", code], env=dict(os.environ, OMP_NUM_THREADS=str(num_threads)))
+
+
+def _lstm_reference(Z, V_h, c, i):
+  """
+  Pure TF variant of NativeOp.LstmGenericBase.
+
+  :param tf.Tensor Z: (time,batch,dim*4)
+  :param tf.Tensor V_h: (dim,dim*4)
+  :param tf.Tensor c: (batch,dim)
+  :param numpy.ndarray i: (time,batch)
+  :return: Y (time,batch,dim), d (batch,dim)
+  """
+  n_time = i.shape[0]
+  n_cells = int(V_h.get_shape()[0])
+  ys = []
+  y = tf.zeros_like(c)
+  state = c
+  for t in range(n_time):
+    h = Z[t] + tf.matmul(y, V_h)
+    cell_in = tf.tanh(h[:, :n_cells])
+    in_gate, forget_gate, out_gate = [tf.sigmoid(h[:, k * n_cells:(k + 1) * n_cells]) for k in range(1, 4)]
+    i_t = tf.constant(i[t][:, None])
+    state = (in_gate * cell_in + forget_gate * state) * i_t + state * (1. - i_t)
+    y = out_gate * tf.tanh(state) * i_t
+    ys.append(y)
+  return tf.stack(ys), state
+
+
+def test_NativeLstm_vs_reference():
+  n_time, n_batch, n_cells = 5, 12, 48  # n_batch * n_cells is enough to use multiple threads
+  rnd = numpy.random.RandomState(42)
+  Z = tf.constant(rnd.normal(scale=0.5, size=(n_time, n_batch, n_cells * 4)).astype("float32"))
+  V_h = tf.constant(rnd.normal(scale=0.1, size=(n_cells, n_cells * 4)).astype("float32"))
+  c = tf.constant(rnd.normal(scale=0.5, size=(n_batch, n_cells)).astype("float32"))
+  i = numpy.ones((n_time, n_batch), dtype="float32")
+  i[3:, 0] = 0.
+  i[1:, 5] = 0.
+  op = TFNativeOp.make_lstm_op()
+  # The op works inplace on Z, thus give it a copy.
+  Y, _, d = op(Z * 1., V_h, c, tf.constant(i))
+  ref_Y, ref_d = _lstm_reference(Z, V_h, c, i)
+  loss = tf.reduce_sum(Y * Y) + tf.reduce_sum(d)
+  ref_loss = tf.reduce_sum(ref_Y * ref_Y) + tf.reduce_sum(ref_d)
+  grads = tf.gradients(loss, [Z, V_h, c])
+  ref_grads = tf.gradients(ref_loss, [Z, V_h, c])
+  values, ref_values = session.run([[Y, d] + grads, [ref_Y, ref_d] + ref_grads])
+  for v, ref_v in zip(values, ref_values):
+    numpy.testing.assert_allclose(v, ref_v, rtol=1e-4, atol=1e-5)
+
+
+def test_NativeLstm_vs_reference_multithreaded():
+  _run_with_omp_threads("test_NativeLstm_vs_reference")
+
+
+def _make_fast_bw_fsa(labels_per_seq, state_offset=0):
+  """
+  Simple HMM topology per seq: one state per label with a loop, and a start state.
+
+  :param list[list[int]] labels_per_seq:
+  :return: edges (4,n_edges) uint32, weights (n_edges,), start_end_states (2,n_batch) uint32
+  """
+  rnd = numpy.random.RandomState(13)
+  edges = []
+  start_end_states = []
+  for seq_idx, labels in enumerate(labels_per_seq):
+    start_state = state_offset
+    state = start_state
+    for label in labels:
+      edges.append((state, state + 1, label, seq_idx))
+      edges.append((state + 1, state + 1, label, seq_idx))
+      state += 1
+    start_end_states.append((start_state, state))
+    state_offset = state + 1
+  edges = numpy.array(edges, dtype="uint32").transpose()
+  # Shuffle the edges, the op must not depend on the order.
+  edges = edges[:, rnd.permutation(edges.shape[1])]
+  weights = rnd.uniform(0., 1., size=(edges.shape[1],)).astype("float32")
+  return edges, weights, numpy.array(start_end_states, dtype="uint32").transpose()
+
+
+def _fast_bw_reference(am_scores, edges, weights, start_end_states, index):
+  """
+  Straightforward forward-backward in -log space, like NativeOp.FastBaumWelchOp.
+
+  :return: output (time,batch,dim), sums (time,batch)
+  """
+  n_time, n_batch, _ = am_scores.shape
+  n_states = edges[:2].max() + 1
+  output = numpy.full(am_scores.shape, numpy.inf)
+  sums = numpy.zeros((n_time, n_batch))
+  def log_add(a, b):
+    return -numpy.logaddexp(-a, -b)
+  for b in range(n_batch):
+    seq_len = int(index[:, b].sum())
+    seq_edges = [(edges[0, e], edges[1, e], edges[2, e], weights[e]) for e in range(edges.shape[1]) if edges[3, e] == b]
+    alpha = numpy.full((seq_len + 1, n_states), numpy.inf)
+    alpha[0, start_end_states[0, b]] = 0.
+    for t in range(seq_len):
+      for from_, to, emission, weight in seq_edges:
+        alpha[t + 1, to] = log_add(alpha[t + 1, to], alpha[t, from_] + weight + am_scores[t, b, emission])
+    beta = numpy.full((seq_len + 1, n_states), numpy.inf)
+    beta[seq_len, start_end_states[1, b]] = 0.
+    for t in reversed(range(seq_len)):
+      for from_, to, emission, weight in seq_edges:
+        beta[t, from_] = log_add(beta[t, from_], beta[t + 1, to] + weight + am_scores[t, b, emission])
+    for t in range(seq_len):
+      scores = [(emission, alpha[t, from_] + weight + am_scores[t, b, emission] + beta[t + 1, to])
+                for from_, to, emission, weight in seq_edges]
+      total = numpy.inf
+      for _, score in scores:
+        total = log_add(total, score)
+      sums[t, b] = total
+      for emission, score in scores:
+        output[t, b, emission] = log_add(output[t, b, emission], score - total)
+  return output, sums
+
+
+def test_FastBaumWelch_vs_reference():
+  n_time, n_emissions = 7, 5
+  labels_per_seq = [[1, 2, 3], [4, 0], [2, 2, 1, 3], [3]]
+  n_batch = len(labels_per_seq)
+  edges, weights, start_end_states = _make_fast_bw_fsa(labels_per_seq, state_offset=2)
+  rnd = numpy.random.RandomState(42)
+  am_scores = rnd.normal(size=(n_time, n_batch, n_emissions))
+  am_scores = -(am_scores - numpy.log(numpy.sum(numpy.exp(am_scores), axis=2, keepdims=True)))  # -log softmax
+  am_scores = am_scores.astype("float32")
+  index = numpy.ones((n_time, n_batch), dtype="float32")
+  index[5:, 1] = 0.
+  index[4:, 3] = 0.
+  state_buffer = numpy.zeros((2, edges[:2].max() + 1), dtype="float32")
+  op = TFNativeOp.make_fast_baum_welch_op()
+  # The op takes the edges and states as uint32 in float32 memory.
+  output, sums = session.run(op(
+    am_scores, edges.view("float32"), weights, start_end_states.view("float32"), index, state_buffer))
+  ref_output, ref_sums = _fast_bw_reference(am_scores, edges, weights, start_end_states, index)
+  assert numpy.all(numpy.isinf(output[5:, 1])) and numpy.all(numpy.isinf(output[4:, 3]))
+  assert numpy.all(sums[5:, 1] == 0.) and numpy.all(sums[4:, 3] == 0.)
+  numpy.testing.assert_allclose(output, ref_output, rtol=1e-4, atol=1e-4)
+  numpy.testing.assert_allclose(sums, ref_sums, rtol=1e-4, atol=1e-4)
+  # The posteriors of every frame within the seq sum up to one.
+  numpy.testing.assert_allclose(numpy.sum(numpy.exp(-output), axis=2), index, rtol=1e-4, atol=1e-4)
+
+
+def test_get_op_names_from_network_json():
+  from NativeOp import get_op_names_from_network_json, get_all_op_names
+  theano_net = {
+    "lstm": {"class": "native_lstm", "n_out": 10},
+    "rec": {"class": "rec", "unit": "lstm", "n_out": 10},
+    "output": {"class": "softmax", "loss": "fast_bw", "from": ["lstm"]}}
+  assert_equal(get_op_names_from_network_json(theano_net), ["FastBaumWelchOp", "LstmGenericBase"])
+  tf_net = {
+    "lstm": {"class": "rec", "unit": "lstm", "n_out": 10},
+    "output": {"class": "softmax", "loss": "ce", "from": ["lstm"]}}
+  assert_equal(get_op_names_from_network_json(tf_net, tensorflow=True), ["LstmGenericBase"])
+  assert_equal(get_op_names_from_network_json({"output": {"class": "softmax"}}, tensorflow=True), [])
+  assert "LstmGenericBase" in get_all_op_names()
+
+
+def test_OpMaker_builtin_op_name_clash():
+  # TF itself has a SparseToDense op, thus ours gets another name.
+  maker = TFNativeOp.OpMaker(TFNativeOp.OpDescription.from_gen_base(NativeOp.SparseToDense))
+  assert_equal(maker.op_name, "NativeOpSparseToDense")
+  maker.make_op()
+  # The inputs like "_initial_w" get valid TF names.
+  TFNativeOp.OpMaker(TFNativeOp.OpDescription.from_gen_base(NativeOp.MaxAndArgmaxSparse)).make_op()
+
+
+def test_FastBaumWelch_vs_reference_multithreaded():
+  _run_with_omp_threads("test_FastBaumWelch_vs_reference")
+
+
+def test_SparseToDense_duplicate_indices():
+  # Many entries go to the same [t,b,j], which the kernel adds up via elem_atomic_add.
+  n_time, n_batch, n_dim, n_sparse_idx = 3, 4, 2, 300  # n_batch * n_sparse_idx is enough to use multiple threads
+  rnd = numpy.random.RandomState(42)
+  s0 = rnd.randint(0, n_time, size=(n_sparse_idx, n_batch)).astype("float32")
+  s1 = rnd.randint(0, n_dim, size=(n_sparse_idx, n_batch)).astype("float32")
+  weight = rnd.uniform(0., 1., size=(n_sparse_idx, n_batch)).astype("float32")
+  mask = (rnd.uniform(size=(n_sparse_idx, n_batch)) < 0.9).astype("float32")
+  initial_W = numpy.zeros((n_time, n_batch, n_dim), dtype="float32")
+  op = TFNativeOp.OpMaker(TFNativeOp.OpDescription.from_gen_base(NativeOp.SparseToDense)).make_op()
+  W = session.run(op(initial_W, s0, s1, weight, mask))
+  ref_W = numpy.zeros((n_time, n_batch, n_dim), dtype="float64")
+  for i in range(n_sparse_idx):
+    for b in range(n_batch):
+      if mask[i, b] > 0.1:
+        ref_W[int(s0[i, b]), b, int(s1[i, b])] += weight[i, b]
+  numpy.testing.assert_allclose(W, ref_W, rtol=1e-4)
+
+
+def test_SparseToDense_duplicate_indices_multithreaded():
+  _run_with_omp_threads("test_SparseToDense_duplicate_indices")
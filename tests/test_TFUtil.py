@@ -1,6 +1,7 @@
 
 import tensorflow as tf
 import sys
+import os
 sys.path += ["."]  # Python 3 hack
 from TFUtil import *
 from nose.tools import assert_equal, assert_is_instance
@@ -123,3 +124,16 @@ def test_reuse_name_scope():
 
       c2 = tf.Variable(name="c", initial_value=tf.zeros((2,)))
       assert_equal(c2.name, "lstm0/rec/c_1:0")
+
+
+def test_OpCodeCompiler_cleanup_old_once():
+  import shutil
+  comp = OpCodeCompiler(base_name="test_cleanup_old_once", code_version=1, code="")
+  base_mod_path = os.path.dirname(comp._mod_path)
+  old_dir = "%s/old" % base_mod_path
+  try:
+    os.makedirs(old_dir)  # corrupt dir, would be deleted by the cleanup
+    OpCodeCompiler(base_name="test_cleanup_old_once", code_version=2, code="")
+    assert os.path.exists(old_dir)  # the cleanup only runs once per process
+  finally:
+    shutil.rmtree(base_mod_path)
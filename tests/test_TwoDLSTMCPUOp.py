@@ -0,0 +1,229 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+import numpy
+import numpy.testing
+import theano
+import theano.tensor as T
+from TwoDLSTMCPUOp import TwoDLSTMCPUOp, Flips
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def _twod_lstm_reference(X, W, V_h, V_v, b, sizes, flip_y, flip_x):
+  """
+  Straightforward Theano variant of one direction of TwoDLSTMCPUOp, via Python loops over every image.
+
+  :param X: (height,width,batch,n_in)
+  :param numpy.ndarray sizes: (batch,2)
+  :return: Y (height,width,batch,n_cells)
+  """
+  height, width, n_batch, _ = [int(d) for d in X.tag.test_value.shape]
+  n_cells = V_h.get_value().shape[0]
+  Y = T.zeros((height, width, n_batch, n_cells), dtype="float32")
+  for n in range(n_batch):
+    img_height, img_width = [int(d) for d in sizes[n]]
+    img = X[:img_height, :img_width, n]
+    if flip_y:
+      img = img[::-1]
+    if flip_x:
+      img = img[:, ::-1]
+    ys = [[None] * img_width for _ in range(img_height)]
+    states = [[None] * img_width for _ in range(img_height)]
+    for y in range(img_height):
+      for x in range(img_width):
+        h = T.dot(img[y, x], W) + b
+        if x > 0:
+          h += T.dot(ys[y][x - 1], V_h)
+        if y > 0:
+          h += T.dot(ys[y - 1][x], V_v)
+        in_gate, forget_gate, lambda_gate, out_gate = [
+          T.nnet.sigmoid(h[k * n_cells:(k + 1) * n_cells]) for k in range(4)]
+        state = in_gate * T.tanh(h[4 * n_cells:])
+        if y > 0:
+          state += forget_gate * lambda_gate * states[y - 1][x]
+        if x > 0:
+          state += forget_gate * (1. - lambda_gate) * states[y][x - 1]
+        states[y][x] = state
+        ys[y][x] = out_gate * T.tanh(state)
+    img_Y = T.stack([T.stack(row) for row in ys])
+    if flip_y:
+      img_Y = img_Y[::-1]
+    if flip_x:
+      img_Y = img_Y[:, ::-1]
+    Y = T.set_subtensor(Y[:img_height, :img_width, n], img_Y)
+  return Y
+
+
+def _sigmoid(x):
+  return 1. / (1. + numpy.exp(-x))
+
+
+def _twod_lstm_gpu_reference(X, W, V_h, V_v, b, sizes, flip_y, flip_x, old_state_idx, DY):
+  """
+  Numpy variant of one direction of the CUDA kernels lstm_stable_cell_kernel_batched and
+  lstm_bwd_stable_cell_kernel_batched (cuda_implementation/c_support_code_mdlstm.cpp),
+  where the old state of the predecessors is the part old_state_idx * n_cells of their H,
+  i.e. 4 (cell state) for MultiDirectionalTwoDLSTMOp and 2 (lambda gate) for BidirectionalTwoDLSTMOp.
+
+  :param numpy.ndarray X: (height,width,batch,n_in)
+  :param numpy.ndarray sizes: (batch,2)
+  :param numpy.ndarray DY: (height,width,batch,n_cells), the derivative w.r.t. Y
+  :return: Y, DX, DW, DV_h, DV_v, Db
+  """
+  height, width, n_batch, _ = X.shape
+  n_cells = V_h.shape[0]
+  valid = ((numpy.arange(height)[:, None, None] < sizes[None, None, :, 0]) &
+           (numpy.arange(width)[None, :, None] < sizes[None, None, :, 1])).astype("float32")
+
+  def flip(v):
+    if flip_y:
+      v = v[::-1]
+    if flip_x:
+      v = v[:, ::-1]
+    return v
+
+  # Everything in direction coordinates.
+  X, valid, DY = flip(X), flip(valid), flip(DY)
+  s = slice(old_state_idx * n_cells, (old_state_idx + 1) * n_cells)
+  H = numpy.zeros((height, width, n_batch, 5 * n_cells), dtype="float32")
+  Y = numpy.zeros((height, width, n_batch, n_cells), dtype="float32")
+  for y in range(height):
+    for x in range(width):
+      h = X[y, x].dot(W) + b
+      if x > 0:
+        h += Y[y, x - 1].dot(V_h)
+      if y > 0:
+        h += Y[y - 1, x].dot(V_v)
+      in_gate, forget_gate, lambda_gate, out_gate = [_sigmoid(h[:, k * n_cells:(k + 1) * n_cells]) for k in range(4)]
+      state = in_gate * numpy.tanh(h[:, 4 * n_cells:])
+      if y > 0:
+        state += forget_gate * lambda_gate * H[y - 1, x, :, s]
+      if x > 0:
+        state += forget_gate * (1. - lambda_gate) * H[y, x - 1, :, s]
+      state *= valid[y, x][:, None]
+      Y[y, x] = out_gate * numpy.tanh(state) * valid[y, x][:, None]
+      H[y, x] = numpy.concatenate([in_gate, forget_gate, lambda_gate, out_gate, state], axis=1)
+
+  delta = H.copy()
+  epsilon = DY.copy()
+  epsilon_y = numpy.zeros_like(Y)
+  epsilon_x = numpy.zeros_like(Y)
+  for y in reversed(range(height)):
+    for x in reversed(range(width)):
+      if x < width - 1:
+        epsilon[y, x] += delta[y, x + 1].dot(V_h.T)
+      if y < height - 1:
+        epsilon[y, x] += delta[y + 1, x].dot(V_v.T)
+      in_gate, forget_gate, lambda_gate, out_gate, state = [
+        H[y, x, :, k * n_cells:(k + 1) * n_cells] for k in range(5)]
+      # The predecessors are processed later, thus delta still holds their H.
+      last_state_y = delta[y - 1, x, :, s] if y > 0 else 0.
+      last_state_x = delta[y, x - 1, :, s] if x > 0 else 0.
+      v = valid[y, x][:, None]
+      gc = Y[y, x] / out_gate
+      gzc = (state - forget_gate * lambda_gate * last_state_y - forget_gate * (1. - lambda_gate) * last_state_x) / in_gate
+      epsilon_c = (1. - gc ** 2) * out_gate * epsilon[y, x]
+      if y < height - 1:
+        epsilon_c += epsilon_y[y + 1, x]
+      if x < width - 1:
+        epsilon_c += epsilon_x[y, x + 1]
+      epsilon_y[y, x] = epsilon_c * forget_gate * lambda_gate * v
+      epsilon_x[y, x] = epsilon_c * forget_gate * (1. - lambda_gate) * v
+      delta[y, x] = numpy.concatenate([
+        in_gate * (1. - in_gate) * gzc * epsilon_c,
+        forget_gate * (1. - forget_gate) * epsilon_c *
+        (last_state_y * lambda_gate + last_state_x * (1. - lambda_gate)),
+        forget_gate * lambda_gate * (1. - lambda_gate) * epsilon_c * (last_state_y - last_state_x),
+        out_gate * (1. - out_gate) * gc * epsilon[y, x],
+        in_gate * (1. - gzc ** 2) * epsilon_c], axis=1) * v
+
+  DW = numpy.einsum("yxbi,yxbj->ij", X, delta)
+  DV_h = numpy.einsum("yxbi,yxbj->ij", Y[:, :-1], delta[:, 1:])
+  DV_v = numpy.einsum("yxbi,yxbj->ij", Y[:-1], delta[1:])
+  Db = delta.sum(axis=(0, 1, 2))
+  DX = delta.dot(W.T)
+  return flip(Y), flip(DX), DW, DV_h, DV_v, Db
+
+
+def _make_inputs(directions, rnd):
+  height, width, n_batch, n_in, n_cells = 3, 4, 3, 2, 3
+  sizes = numpy.array([[3, 4], [2, 3], [3, 1]], dtype="float32")
+  X = rnd.normal(size=(height, width, n_batch, n_in)).astype("float32")
+  params = []
+  for _ in range(directions):
+    W = rnd.normal(scale=0.5, size=(n_in, 5 * n_cells)).astype("float32")
+    V_h = rnd.normal(scale=0.5, size=(n_cells, 5 * n_cells)).astype("float32")
+    V_v = rnd.normal(scale=0.5, size=(n_cells, 5 * n_cells)).astype("float32")
+    b = rnd.normal(scale=0.5, size=(5 * n_cells,)).astype("float32")
+    params.append((W, V_h, V_v, b))
+  return X, params, sizes
+
+
+def _check_vs_reference(directions):
+  rnd = numpy.random.RandomState(42)
+  X_val, param_values, sizes = _make_inputs(directions, rnd)
+  X = T.tensor4("X", dtype="float32")
+  X.tag.test_value = X_val
+  params = [[theano.shared(v) for v in p] for p in param_values]
+  Ws, V_hs, V_vs, bs = [[p[i] for p in params] for i in range(4)]
+  Ys = TwoDLSTMCPUOp(directions)(*([X] + Ws + V_hs + V_vs + bs + [T.constant(sizes)]))[:directions]
+  ref_Ys = [_twod_lstm_reference(X, W, V_h, V_v, b, sizes, flip_y, flip_x)
+            for ((W, V_h, V_v, b), (flip_y, flip_x)) in zip(params, Flips[directions])]
+  # Use different weights per direction in the loss, to get different gradients.
+  loss = sum([T.sum(Y ** 2) * (i + 1) for (i, Y) in enumerate(Ys)])
+  ref_loss = sum([T.sum(Y ** 2) * (i + 1) for (i, Y) in enumerate(ref_Ys)])
+  wrt = [X] + Ws + V_hs + V_vs + bs
+  f = theano.function([X], Ys + T.grad(loss, wrt))
+  # The unrolled reference graph is big, thus do not spend time on optimizing it.
+  ref_f = theano.function([X], ref_Ys + T.grad(ref_loss, wrt), mode="FAST_COMPILE")
+  values = f(X_val)
+  ref_values = ref_f(X_val)
+  assert len(values) == len(ref_values)
+  for v, ref_v in zip(values, ref_values):
+    numpy.testing.assert_allclose(v, ref_v, rtol=1e-4, atol=1e-5)
+  # Outside of the images, we get zeros.
+  for Y in values[:directions]:
+    assert numpy.all(Y[2:, :, 1] == 0.) and numpy.all(Y[:, 3:, 1] == 0.) and numpy.all(Y[:, 1:, 2] == 0.)
+
+
+def _check_vs_gpu_reference(directions, old_state_idx):
+  rnd = numpy.random.RandomState(42)
+  X_val, param_values, sizes = _make_inputs(directions, rnd)
+  DY_vals = [rnd.normal(size=X_val.shape[:3] + (param_values[0][1].shape[0],)).astype("float32")
+             for _ in range(directions)]
+  X = T.tensor4("X", dtype="float32")
+  params = [[theano.shared(v) for v in p] for p in param_values]
+  Ws, V_hs, V_vs, bs = [[p[i] for p in params] for i in range(4)]
+  Ys = TwoDLSTMCPUOp(directions)(*([X] + Ws + V_hs + V_vs + bs + [T.constant(sizes)]))[:directions]
+  # The gradient of this loss w.r.t. Y is DY.
+  loss = sum([T.sum(Y * DY) for (Y, DY) in zip(Ys, DY_vals)])
+  f = theano.function([X], Ys + T.grad(loss, [X] + Ws + V_hs + V_vs + bs))
+  values = f(X_val)
+  Ys, DX = values[:directions], values[directions]
+  DWs, DV_hs, DV_vs, Dbs = [
+    values[directions + 1 + i * directions:directions + 1 + (i + 1) * directions] for i in range(4)]
+  ref_DX = numpy.zeros_like(X_val)
+  for d, ((W, V_h, V_v, b), (flip_y, flip_x), DY) in enumerate(zip(param_values, Flips[directions], DY_vals)):
+    ref_Y, ref_DX_d, ref_DW, ref_DV_h, ref_DV_v, ref_Db = _twod_lstm_gpu_reference(
+      X_val, W, V_h, V_v, b, sizes, flip_y, flip_x, old_state_idx, DY)
+    ref_DX += ref_DX_d
+    for v, ref_v in [(Ys[d], ref_Y), (DWs[d], ref_DW), (DV_hs[d], ref_DV_h), (DV_vs[d], ref_DV_v), (Dbs[d], ref_Db)]:
+      numpy.testing.assert_allclose(v, ref_v, rtol=1e-4, atol=1e-5)
+  numpy.testing.assert_allclose(DX, ref_DX, rtol=1e-4, atol=1e-5)
+
+
+def test_TwoDLSTMCPUOp_4dirs_vs_reference():
+  _check_vs_reference(directions=4)
+
+
+def test_TwoDLSTMCPUOp_1dir_vs_gpu_reference():
+  _check_vs_gpu_reference(directions=1, old_state_idx=2)
+
+
+def test_TwoDLSTMCPUOp_2dirs_vs_gpu_reference():
+  _check_vs_gpu_reference(directions=2, old_state_idx=2)
+
+
+def test_TwoDLSTMCPUOp_4dirs_vs_gpu_reference():
+  _check_vs_gpu_reference(directions=4, old_state_idx=4)
@@ -2,6 +2,9 @@
 from nose.tools import assert_equal, assert_raises, assert_true, assert_is
 from Util import *
 import numpy as np
+from Log import log
+
+log.initialize()
 
 
 def test_cmd_true():
@@ -73,3 +76,80 @@ def test_collect_class_init_kwargs():
   kwargs = collect_class_init_kwargs(C)
   print kwargs
   assert_equal(sorted(kwargs), ["a", "b", "c"])
+
+
+def test_get_floatX():
+  import os
+  import subprocess
+  import sys
+  import tempfile
+  # In a subprocess, because Theano must not be imported there.
+  code = "import sys; from Util import get_floatX; assert 'theano' not in sys.modules; print(get_floatX())"
+  fd, theanorc = tempfile.mkstemp(suffix=".theanorc")
+  os.write(fd, b"[global]\nfloatX = float16\n")
+  os.close(fd)
+  try:
+    for env_update, expected in [
+          ({"THEANORC": theanorc + ".does-not-exist"}, "float64"),
+          ({"THEANORC": theanorc}, "float16"),
+          ({"THEANORC": theanorc, "THEANO_FLAGS": "device=cpu,floatX=float32"}, "float32")]:
+      env = {k: v for (k, v) in os.environ.items() if k != "THEANO_FLAGS"}
+      env.update(env_update)
+      out = subprocess.check_output([sys.executable, "-c", code], env=env)
+      assert_equal(out.decode("utf8").strip(), expected)
+  finally:
+    os.remove(theanorc)
+
+
+def test_HDFForwardWriterThread():
+  import h5py
+  import numpy
+  import os
+  import tempfile
+  filename = tempfile.mktemp(suffix=".hdf", prefix="nose-forward-writer")
+  cache = h5py.File(filename, "w")
+  inputs = cache.create_dataset("inputs", (3, 2), dtype='f', maxshape=(None, 2))
+  seq_lengths = cache.create_dataset("seqLengths", (1,), dtype='i', maxshape=(None,))
+  writer = HDFForwardWriterThread(cache=cache, inputs=inputs, seq_lengths=seq_lengths, queue_size=1)
+  feats = numpy.arange(14, dtype="float32").reshape((7, 2))
+  writer.add(feats[:2], numpy.array([2], dtype="int32"), tags=["seq-0"])
+  writer.add(feats[2:], numpy.array([4, 1], dtype="int32"), tags=["seq-1", "seq-2"],
+             times=numpy.array([[0., 1.], [1., 2.]], dtype="float32"))
+  writer.finish()
+  assert_equal(inputs[...].tolist(), feats.tolist())
+  assert_equal(seq_lengths[...].tolist(), [2, 4, 1])
+  assert_equal(cache["seqTags"][...].tolist(), ["seq-0", "seq-1", "seq-2"])
+  assert_equal(cache["times"][...].tolist(), [[0., 1.], [1., 2.]])
+  cache.close()
+  os.remove(filename)
+
+
+def test_BackgroundCheckpointSaver():
+  import os
+  import shutil
+  import tempfile
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    saver = BackgroundCheckpointSaver()
+
+    def write_func(tmp_filename):
+      for postfix in [".data", ".index"]:
+        with open(tmp_filename + postfix, "w") as f:
+          f.write(os.path.basename(tmp_filename))
+      return [tmp_filename + ".data", tmp_filename + ".index"]
+
+    saver.save(tmp_dir + "/model.001", write_func)
+    saver.save(tmp_dir + "/model.002", write_func)  # waits for the first one
+    saver.wait()
+    assert_equal(sorted(os.listdir(tmp_dir)),
+                 ["model.001.data", "model.001.index", "model.002.data", "model.002.index"])
+
+    def broken_write_func(tmp_filename):
+      raise Exception("disk broken")
+
+    saver.save(tmp_dir + "/model.003", broken_write_func)
+    assert_raises(Exception, saver.wait)
+    saver.wait()  # the exception is raised only once
+    assert_true(not os.path.exists(tmp_dir + "/model.003"))
+  finally:
+    shutil.rmtree(tmp_dir)
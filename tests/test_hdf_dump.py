@@ -1,6 +1,7 @@
 
 from hdf_dump import *
 import os
+import numpy
 from Log import log
 import tempfile
 from GeneratingDataset import DummyDataset
@@ -55,3 +56,66 @@ def test_hdf_create_and_load():
   loaded_dataset.add_file(hdf_filename)
 
   os.remove(hdf_filename)
+
+
+def test_hdf_create_single_pass_and_load():
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=4, seq_len=3)
+  dataset.init_seq_order(epoch=1)
+  dumps = {}
+  for single_pass, compression in [(False, None), (True, None), (True, "gzip"), (True, "lzf")]:
+    hdf_filename = tempfile.mktemp(suffix=".hdf", prefix="nose-dataset-single-pass")
+    hdf_dataset = hdf_dataset_init(hdf_filename)
+    hdf_dump_from_dataset(dataset, hdf_dataset, DictAsObj(dict(
+      options, single_pass=single_pass, write_buffer_frames=5, compression=compression, chunk_frames=2)))
+    hdf_close(hdf_dataset)
+
+    loaded_dataset = HDFDataset()
+    loaded_dataset.add_file(hdf_filename)
+    loaded_dataset.initialize()
+    loaded_dataset.init_seq_order(epoch=1)
+    loaded_dataset.load_seqs(0, 4)
+    dumps[(single_pass, compression)] = [
+      (loaded_dataset.get_tag(i), loaded_dataset.get_data(i, "data").tolist(), loaded_dataset.get_data(i, "classes").tolist())
+      for i in range(4)]
+    os.remove(hdf_filename)
+  expected = [(seq.seq_tag, numpy.float32(seq.features).tolist(), seq.targets["classes"].tolist())
+              for seq in dataset.generate_seqs(0, 4)]
+  for key, dump in dumps.items():
+    assert dump == expected, "%r: %r" % (key, dump)
+
+
+def test_get_shard_seq_ranges():
+  assert get_shard_seq_ranges(0, 10, 3) == [(0, 3), (3, 6), (6, 10)]
+  assert get_shard_seq_ranges(5, 7, 2) == [(5, 6), (6, 7)]
+
+
+def test_get_shard_filename():
+  assert get_shard_filename("out.hdf", 3, 6) == "out.hdf.shard-seqs-3-5"
+
+
+def test_hdf_merge_shards():
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=5, seq_len=3)
+  dataset.init_seq_order(epoch=1)
+  hdf_filename = tempfile.mktemp(suffix=".hdf", prefix="nose-dataset-merge")
+  shard_filenames = []
+  for shard_idx, (start, end) in enumerate(get_shard_seq_ranges(0, 5, 2)):
+    shard_filenames.append(get_shard_filename(hdf_filename, start, end))
+    hdf_dataset = hdf_dataset_init(shard_filenames[-1])
+    hdf_dump_from_dataset(dataset, hdf_dataset, DictAsObj(dict(
+      options, start_seq=start, end_seq=end - 1, single_pass=True, compression="gzip")))
+    hdf_close(hdf_dataset)
+  hdf_merge_shards(shard_filenames, hdf_filename, copy_block_frames=2)
+
+  for filenames in [[hdf_filename], shard_filenames]:
+    loaded_dataset = HDFDataset()
+    for filename in filenames:
+      loaded_dataset.add_file(filename)
+    loaded_dataset.initialize()
+    loaded_dataset.init_seq_order(epoch=1)
+    loaded_dataset.load_seqs(0, 5)
+    for seq in dataset.generate_seqs(0, 5):
+      assert loaded_dataset.get_tag(seq.seq_idx) == seq.seq_tag
+      assert loaded_dataset.get_data(seq.seq_idx, "data").tolist() == numpy.float32(seq.features).tolist()
+      assert loaded_dataset.get_data(seq.seq_idx, "classes").tolist() == seq.targets["classes"].tolist()
+  for filename in [hdf_filename] + shard_filenames:
+    os.remove(filename)